@@ -1,20 +1,148 @@
+import threading
+
 from flask import Flask
 
-# Using DoubleDictKeyColValStore as it performs much better for
-# small / medium data load. 
-from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
-from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.backends import load_backend
+from keycolval.stores.memory import MemoryBudget
+from keycolval.data_structures.valueindex import ValueIndex
+from keycolval.persistence.changefeed import ChangeFeed
+from keycolval.instrumentation.metrics import MetricsRegistry
+from keycolval.instrumentation.profiling import SamplingProfiler
+from keycolval.instrumentation.profiling import SlowQueryLog
+from keycolval.persistence.progress import LoadProgress
+from keycolval.persistence.progress import PENDING
 
 app = Flask(__name__)
 app.config['DATA_STORE_FILE'] = '/tmp/keycolval-data'
+# Name of the store backend in keycolval/stores/backends.py to load. Using
+# DoubleDictKeyColValStore as it performs much better for small / medium data
+# load.
+app.config['STORE_BACKEND'] = 'doubledict'
+# Number of keys returned per page by /get-keys/.
+app.config['KEYS_PAGE_SIZE'] = 1000
+# Collect store, persistence and request metrics for the /metrics view.
+app.config['METRICS_ENABLED'] = True
+# Fraction of requests to run under cProfile. Adjustable at runtime via /profile/.
+app.config['PROFILE_SAMPLE_RATE'] = 0.0
+# Seconds after which a get_key or get_slice is logged as slow. None disables.
+app.config['SLOW_QUERY_THRESHOLD'] = 0.1
+# Snapshot the data store in the background every this many logged writes so
+# start-up only replays the data log since. None disables automatic snapshots.
+app.config['SNAPSHOT_EVERY_RECORDS'] = 100000
+# Image file the writer publishes with every snapshot for reader workers.
+app.config['SHARED_IMAGE_FILE'] = None
+# Seconds between publications of SHARED_IMAGE_FILE while there are new writes.
+# Readers are at most this plus their half second refresh interval, and the
+# time the image takes to write, behind the writer. Each publication rewrites
+# the whole image, so larger data sets want a longer interval. None only
+# publishes with snapshots.
+app.config['IMAGE_PUBLISH_INTERVAL'] = 5.0
+# Serve reads from SHARED_IMAGE_FILE instead of owning the data store. Run
+# any number of reader workers alongside one writer.
+app.config['READ_ONLY_WORKER'] = False
+# Seconds between background sweeps for expired cells which aren't read.
+# None leaves expired cells to be deleted when their key is next touched.
+app.config['REAP_INTERVAL'] = 1.0
+# Approximate bytes of data the store may hold in memory. None is unbounded.
+app.config['MEMORY_BUDGET_BYTES'] = None
+# What happens over budget: 'reject' writes, 'evict' least recently used keys
+# to EVICTION_FILE, or 'drop' them to be rebuilt from the data log when needed.
+app.config['MEMORY_POLICY'] = 'reject'
+app.config['EVICTION_FILE'] = '/tmp/keycolval-evicted'
+# Index values for /find/ and /find-prefix/, at the cost of memory and of
+# some time on every write.
+app.config['VALUE_INDEX'] = False
+# Number of recent changes held for consumers of /changes/. None disables the
+# change feed.
+app.config['CHANGE_FEED_SIZE'] = None
+# Seconds for which repeated set, increment and append calls on the same cell
+# are coalesced into one logged write. A crash loses up to this long of writes
+# to those cells. None logs every call.
+app.config['COALESCE_WINDOW'] = None
+
+# Registry shared by the data store and the request hooks.
+app.metrics = MetricsRegistry()
+app.profiler = SamplingProfiler()
+app.slow_query_log = SlowQueryLog()
+# How far loading the data store has got, for the /ready/ view.
+app.load_progress = LoadProgress()
+_load_lock = threading.Lock()
 
 @app.before_first_request
 def initialize_data_store():
 	"""
-	Hook to initialize the data store on app start-up.
+	Hook to load the data store on the first request if it wasn't loaded on
+	start-up, see load_data_store.
+	"""
+	load_data_store(app)
+
+def load_data_store(app, background=False):
+	"""
+	Build app's data store, replaying its data log, unless it's already been
+	loaded or is loading. Servers call this before they accept connections so
+	that the first request doesn't pay for it. With background the data store
+	is built on a thread of its own, which is returned straight away, while
+	app.load_progress reports how far it has got.
 	"""
-	app.data_store = DoubleDictKeyColValStore(
-						path=app.config['DATA_STORE_FILE'])
+	with _load_lock:
+		if app.load_progress.state != PENDING:
+			return None
+
+		app.load_progress.begin()
+
+	if not background:
+		_build_data_store(app)
+		return None
+
+	loader = threading.Thread(target=_build_data_store, args=(app,),
+							  name='keycolval-data-store-loader')
+	loader.daemon = True
+	loader.start()
+	return loader
+
+def _build_data_store(app):
+	try:
+		app.data_store = _create_data_store(app)
+	except Exception as error:
+		app.load_progress.finish(error)
+		raise
+
+	app.load_progress.finish()
+
+def _create_data_store(app):
+	app.metrics.enabled = app.config['METRICS_ENABLED']
+	app.profiler.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+	app.slow_query_log.threshold = app.config['SLOW_QUERY_THRESHOLD']
+
+	if app.config['READ_ONLY_WORKER']:
+		return load_backend('shared-image')(
+							path=app.config['SHARED_IMAGE_FILE'],
+							metrics=app.metrics,
+							slow_query_log=app.slow_query_log)
+
+	memory_budget = None
+
+	if app.config['MEMORY_BUDGET_BYTES'] is not None:
+		memory_budget = MemoryBudget(app.config['MEMORY_BUDGET_BYTES'],
+									 app.config['MEMORY_POLICY'],
+									 disk_path=app.config['EVICTION_FILE'])
+
+	return load_backend(app.config['STORE_BACKEND'])(
+						path=app.config['DATA_STORE_FILE'],
+						metrics=app.metrics,
+						slow_query_log=app.slow_query_log,
+						snapshot_every=app.config['SNAPSHOT_EVERY_RECORDS'],
+						image_path=app.config['SHARED_IMAGE_FILE'],
+						publish_interval=app.config['IMAGE_PUBLISH_INTERVAL'],
+						coalesce_window=app.config['COALESCE_WINDOW'],
+						reap_interval=app.config['REAP_INTERVAL'],
+						memory_budget=memory_budget,
+						value_index=ValueIndex() if app.config['VALUE_INDEX'] else None,
+						change_feed=(ChangeFeed(app.config['CHANGE_FEED_SIZE'])
+									 if app.config['CHANGE_FEED_SIZE'] else None),
+						load_progress=app.load_progress)
 
 # Import the views so they get registred.
 import keycolval.api.rest
+import keycolval.api.monitoring
+import keycolval.api.admin
@@ -0,0 +1,87 @@
+"""
+Define the administrative views for our application.
+
+Snapshots of the data store can be started and checked on through /snapshot/,
+and its memory use against the memory budget is reported by /memory/. Cells
+are imported in bulk by posting a file to /import/ and exported by /export/.
+"""
+
+from keycolval.api import app
+from keycolval.persistence.bulk import FORMATS
+from keycolval.persistence.bulk import import_stream
+from keycolval.persistence.bulk import iter_export
+from flask import Response
+from flask import abort
+from flask import jsonify
+from flask import request
+
+@app.route('/snapshot/', methods=['GET', 'POST'])
+def snapshot():
+	"""
+	GET returns whether a snapshot is being written and the data log offset of
+	the last completed snapshot.
+
+	POST starts a snapshot in the background. 'started' is false if one was
+	already being written.
+	"""
+	persistor = app.data_store.query_persistor
+
+	if not hasattr(persistor, 'snapshot'):
+		# The data store isn't persisted.
+		abort(404)
+
+	started = None
+
+	if request.method == 'POST':
+		started = persistor.snapshot()
+
+	return jsonify({'started': started,
+					'in_progress': persistor.snapshot_in_progress(),
+					'last_snapshot_offset': persistor.last_snapshot_offset})
+
+@app.route('/memory/', methods=['GET'])
+def memory():
+	"""
+	Return the approximate bytes of data the store holds in memory along
+	with its memory budget and how many keys have been moved out of memory.
+	"""
+	try:
+		return jsonify(app.data_store.memory_usage())
+	except ValueError:
+		# Reader workers map the data rather than holding it.
+		abort(404)
+
+@app.route('/import/', methods=['POST'])
+def import_cells():
+	"""
+	Import the cells in the request body, in the format named by the format
+	query argument (csv, tsv, jsonl or dump), and return how many were
+	written.
+	"""
+	file_format = request.args.get('format', 'csv')
+
+	if file_format not in FORMATS:
+		abort(400)
+
+	try:
+		cells = import_stream(app.data_store, request.stream, file_format)
+	except ValueError as error:
+		response = jsonify({'error': str(error)})
+		response.status_code = 400
+		return response
+
+	return jsonify({'cells': cells})
+
+@app.route('/export/', methods=['GET'])
+def export_cells():
+	"""
+	Stream a consistent export of the store in the format named by the
+	format query argument (csv, tsv, jsonl or dump).
+	"""
+	file_format = request.args.get('format', 'csv')
+
+	if file_format not in FORMATS:
+		abort(400)
+
+	return Response(iter_export(app.data_store, file_format),
+					mimetype='application/octet-stream')
@@ -0,0 +1,132 @@
+"""
+Define the monitoring views and request hooks for our application.
+
+Every request is counted and timed in app.metrics, and the /metrics view
+exposes the registry in the Prometheus text exposition format.
+
+A sample of requests can be profiled by setting a sample rate through the
+/profile/ view, and slow store reads can be inspected through /slow-queries/.
+
+/ready/ reports whether the data store has loaded, and how far replaying its
+data log has got while it hasn't. Until it has loaded every other view but
+/metrics responds with 503.
+"""
+
+from timeit import default_timer
+
+from keycolval.api import app
+from flask import Response
+from flask import g
+from flask import jsonify
+from flask import request
+
+# Endpoints served while the data store is loading.
+UNGATED_ENDPOINTS = ('ready', 'metrics')
+
+@app.before_request
+def start_request_timer():
+	"""
+	Note the time a request started so after_request can time it.
+	"""
+	if app.metrics.enabled:
+		g.request_start_time = default_timer()
+
+	g.profile = app.profiler.start()
+
+@app.before_request
+def require_data_store():
+	"""
+	Turn requests away while the data store is loaded in the background.
+	"""
+	if not app.load_progress.ready and request.endpoint not in UNGATED_ENDPOINTS:
+		response = jsonify(app.load_progress.report())
+		response.status_code = 503
+		response.headers['Retry-After'] = '1'
+		return response
+
+@app.after_request
+def record_request_metrics(response):
+	"""
+	Count and time every request by endpoint.
+	"""
+	if app.metrics.enabled and hasattr(g, 'request_start_time'):
+		# request.endpoint is None when no view matched the URL.
+		endpoint = request.endpoint or 'unmatched'
+
+		app.metrics.inc('keycolval_http_requests_total',
+						endpoint=endpoint,
+						method=request.method,
+						status=response.status_code)
+		app.metrics.observe('keycolval_http_request_seconds',
+							default_timer() - g.request_start_time,
+							endpoint=endpoint)
+
+	return response
+
+@app.teardown_request
+def stop_request_profile(exception):
+	"""
+	Stop profiling a sampled request. This runs even when the view raised.
+	"""
+	app.profiler.stop(getattr(g, 'profile', None))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+	"""
+	Expose all collected metrics in the Prometheus text format.
+	"""
+	return Response(app.metrics.render_prometheus(),
+					content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/ready/', methods=['GET'])
+def ready():
+	"""
+	Report how far loading the data store has got, with a 200 once it's
+	loaded and a 503 while it's loading or if it failed to load.
+	"""
+	response = jsonify(app.load_progress.report())
+	response.status_code = 200 if app.load_progress.ready else 503
+	return response
+
+@app.route('/profile/', methods=['GET', 'POST'])
+def profile():
+	"""
+	GET returns the aggregated profile of all sampled requests as text.
+
+	POST changes the sample rate with a 'sample_rate' form value between
+	0 and 1, and discards the collected samples if 'reset' is given.
+	"""
+	if request.method == 'POST':
+		if 'sample_rate' in request.form:
+			app.profiler.sample_rate = float(request.form['sample_rate'])
+
+		if 'reset' in request.form:
+			app.profiler.reset()
+
+		return jsonify({'sample_rate': app.profiler.sample_rate,
+						'samples': app.profiler.samples})
+
+	sort = request.args.get('sort', 'cumulative')
+	limit = request.args.get('limit', 50, type=int)
+
+	return Response(app.profiler.report(sort, limit), mimetype='text/plain')
+
+@app.route('/slow-queries/', methods=['GET', 'POST'])
+def slow_queries():
+	"""
+	GET returns the logged slow queries, slowest first.
+
+	POST changes the threshold with a 'threshold' form value in seconds
+	('none' disables the log), and clears the log if 'clear' is given.
+	"""
+	if request.method == 'POST':
+		if 'threshold' in request.form:
+			threshold = request.form['threshold']
+			app.slow_query_log.threshold = (None if threshold.lower() in ['none', 'null']
+											 else float(threshold))
+
+		if 'clear' in request.form:
+			app.slow_query_log.clear()
+
+	return jsonify({'threshold': app.slow_query_log.threshold,
+					'queries': app.slow_query_log.entries()})
@@ -8,22 +8,131 @@ resources and use HTTP Methods to maniplulate them.
 """
 
 from keycolval.api import app
+from keycolval.api.serialization import columns_response
+from keycolval.persistence.changefeed import ChangesExpiredError
+from keycolval.stores.memory import MemoryBudgetExceededError
+from keycolval.stores.sharedstore import ReadOnlyStoreError
+from flask import abort
 from flask import jsonify
 from flask import request
 
+@app.errorhandler(ReadOnlyStoreError)
+def read_only_store(error):
+	"""
+	Reader workers serving a shared image don't accept writes.
+	"""
+	response = jsonify({'error': str(error)})
+	response.status_code = 405
+	return response
+
+@app.errorhandler(MemoryBudgetExceededError)
+def memory_budget_exceeded(error):
+	"""
+	Writes are refused while a store with the reject policy is over its
+	memory budget.
+	"""
+	response = jsonify({'error': str(error)})
+	response.status_code = 507
+	return response
+
+@app.errorhandler(ChangesExpiredError)
+def changes_expired(error):
+	"""
+	A change feed consumer has fallen too far behind, or the store restarted,
+	and has to start again from a copy of the store.
+	"""
+	response = jsonify({'error': str(error)})
+	response.status_code = 410
+	return response
+
+# The fields of each type of change after its sequence number, type and key.
+CHANGE_FIELDS = {
+	'set': ('column', 'value'),
+	'delete': ('column',),
+	'delete_key': (),
+	'delete_slice': ('start', 'end'),
+}
+
 @app.route('/set/', methods=['POST'])
 def set_keycolval():
 	"""
-	Set a key, column, value in the datastore.
+	Set a key, column, value in the datastore. An optional 'ttl' in seconds
+	makes the column expire. Responds with a 400 if the ttl isn't a finite
+	number of at least 0.
 	"""
 	post_data = request.form
 
-	app.data_store.set(post_data['key'],
-					   post_data['column'],
-					   post_data['value'])
+	if post_data.get('ttl'):
+		try:
+			app.data_store.set_with_ttl(post_data['key'],
+										post_data['column'],
+										post_data['value'],
+										post_data['ttl'])
+		except ValueError:
+			abort(400)
+	else:
+		app.data_store.set(post_data['key'],
+						   post_data['column'],
+						   post_data['value'])
 	# Included posted data in HTTP response as confirmation.
 	return jsonify(dict(post_data))
 
+@app.route('/compare-and-set/', methods=['POST'])
+def compare_and_set():
+	"""
+	Set a key, column, value only if the column's current value is the
+	posted 'expected' value. Leave out 'expected' to only set the column
+	if it doesn't exist yet. 'set' in the response says whether it was set.
+	"""
+	post_data = request.form
+
+	was_set = app.data_store.compare_and_set(post_data['key'],
+											 post_data['column'],
+											 post_data.get('expected'),
+											 post_data['value'])
+	return jsonify({'set': was_set})
+
+@app.route('/increment/', methods=['POST'])
+def increment():
+	"""
+	Add the posted 'amount' (1 by default) to an integer column and return
+	the new value. Responds with a 400 if the column isn't an integer.
+	"""
+	post_data = request.form
+
+	try:
+		value = app.data_store.increment(post_data['key'],
+										 post_data['column'],
+										 post_data.get('amount', 1))
+	except ValueError:
+		abort(400)
+
+	return jsonify({'value': value})
+
+@app.route('/append/', methods=['POST'])
+def append():
+	"""
+	Append the posted 'value' to a column and return the new value.
+	"""
+	post_data = request.form
+
+	value = app.data_store.append(post_data['key'],
+								  post_data['column'],
+								  post_data['value'])
+	return jsonify({'value': value})
+
+@app.route('/set-columns/', methods=['POST'])
+def set_columns():
+	"""
+	Set several columns of a key at once from repeated 'column' and 'value'
+	form fields, paired up in order.
+	"""
+	post_data = request.form
+	columns = list(zip(post_data.getlist('column'), post_data.getlist('value')))
+
+	app.data_store.set_columns(post_data['key'], columns)
+	return jsonify({'key': post_data['key'], 'columns': len(columns)})
+
 @app.route('/get/<key>/<col>/', methods=['GET'])
 def get_keycol(key, col):
 	"""
@@ -38,15 +147,42 @@ def get_key(key):
 	Get all columns for a key.
 	"""
 	columns = app.data_store.get_key(key)
-	return jsonify(columns)
+	return columns_response(columns)
+
+@app.route('/get-many/', methods=['GET'])
+def get_many():
+	"""
+	Get all columns of each of the keys given as 'key' query parameters, all
+	as of the same moment even while they're being written. Each key's
+	columns are a list of [column, value] pairs in column order. Responds
+	with a 404 if the store doesn't support snapshots.
+	"""
+	try:
+		found = app.data_store.get_many(request.args.getlist('key'))
+	except ValueError:
+		abort(404)
+
+	return jsonify({'keys': [{'key': key, 'columns': [[col, val] for col, val in columns]}
+							 for key, columns in found]})
 
 @app.route('/get-keys/', methods=['GET'])
 def get_keys():
 	"""
-	Get all the current keys.
+	Get the current keys in order, a page at a time.
+
+	The optional 'start' and 'stop' query parameters bound the keys and
+	'limit' sets the page size (KEYS_PAGE_SIZE by default). 'next' in the
+	response is the start of the next page or null on the last page.
 	"""
-	keys = app.data_store.get_keys()
-	return jsonify({'keys': list(keys)})
+	start = request.args.get('start')
+	stop = request.args.get('stop')
+	limit = request.args.get('limit', app.config['KEYS_PAGE_SIZE'], type=int)
+
+	# Fetch one extra key to find out where the next page starts.
+	keys = app.data_store.scan_keys(start, stop, limit + 1)
+	next_key = keys[limit] if len(keys) > limit else None
+
+	return jsonify({'keys': keys[:limit], 'next': next_key})
 
 @app.route('/delete/<key>/<col>/', methods=['DELETE'])
 def delete_keycol(key, col):
@@ -64,16 +200,200 @@ def delete_key(key):
 	app.data_store.delete_key(key)
 	return jsonify({'key': key})
 
+@app.route('/delete-slice/<key>/<start>/<end>/', methods=['DELETE'])
+def delete_slice(key, start, end):
+	"""
+	Delete a slice of columns in a key in one operation. 'none' or 'null'
+	may be used as start or end indices in order to specify an open slice.
+	"""
+	deleted = app.data_store.delete_slice(key, _slice_index(start), _slice_index(end))
+	return jsonify({'key': key, 'deleted': deleted})
+
+def _slice_index(index):
+	"""
+	Read a start or end index of a slice, where 'none' or 'null' leave the
+	slice open ended.
+	"""
+	return None if index.lower() in ['none', 'null'] else index
+
+def _paging_args():
+	"""
+	Read the optional reverse, limit and offset query parameters used by
+	the slice views. Responds with a 400 unless limit and offset are whole
+	numbers of at least 0.
+	"""
+	return {
+		'reverse': request.args.get('reverse', '').lower() in ['1', 'true', 'yes'],
+		'limit': _count_arg('limit', None),
+		'offset': _count_arg('offset', 0),
+	}
+
+def _count_arg(name, default):
+	"""
+	Read a query parameter which has to be a whole number of at least 0,
+	responding with a 400 if it isn't.
+	"""
+	value = request.args.get(name)
+
+	if value is None:
+		return default
+
+	try:
+		value = int(value)
+	except ValueError:
+		abort(400)
+
+	if value < 0:
+		abort(400)
+
+	return value
+
 @app.route('/get-slice/<key>/<start>/<end>/', methods=['GET'])
 def get_slice(key, start, end):
 	"""
 	Get a slice of columns in a key.
 	'none' or 'null' may be used as start or end indices in
 	order to specify an open slice.
+
+	The optional 'reverse', 'limit' and 'offset' query parameters select
+	a page of the slice, e.g. ?reverse=1&limit=10 for the last 10 columns.
+
+	Column responses keep the columns in order and are streamed as JSON, or
+	in the binary encoding described in serialization.py when requested
+	with 'Accept: application/x-keycolval'.
+	"""
+	columns = app.data_store.get_slice(key, _slice_index(start), _slice_index(end),
+									   **_paging_args())
+
+	return columns_response(columns)
+
+@app.route('/get-prefix/<key>/<prefix>/', methods=['GET'])
+def get_prefix(key, prefix):
+	"""
+	Get the columns in a key which start with a prefix. Accepts the same
+	query parameters as get-slice.
+	"""
+	columns = app.data_store.get_prefix(key, prefix, **_paging_args())
+
+	return columns_response(columns)
+
+@app.route('/count-slice/<key>/<start>/<end>/', methods=['GET'])
+def count_slice(key, start, end):
+	"""
+	Count the columns in a slice of a key, returning the count along with the
+	first and last column of the slice.
+	"""
+	return jsonify(app.data_store.count_slice(key, _slice_index(start), _slice_index(end)))
+
+@app.route('/sum-slice/<key>/<start>/<end>/', methods=['GET'])
+def sum_slice(key, start, end):
+	"""
+	Sum the values in a slice of a key which are numbers, returning their
+	count, sum, min and max and how many values were skipped as they aren't
+	numbers.
+	"""
+	return jsonify(app.data_store.sum_slice(key, _slice_index(start), _slice_index(end)))
+
+@app.route('/histogram-slice/<key>/<start>/<end>/', methods=['GET'])
+def histogram_slice(key, start, end):
+	"""
+	Count the numeric values in a slice of a key into equal width bins. The
+	optional 'bins' query parameter sets the number of bins (10 by default)
+	and 'lower' and 'upper' the range they span, which defaults to the
+	smallest and largest value.
 	"""
-	start_index = None if start.lower() in ['none', 'null'] else start
-	end_index = None if end.lower() in ['none', 'null'] else end
-	
-	columns = app.data_store.get_slice(key, start_index, end_index)
-	
-	return jsonify(columns)	
+	try:
+		histogram = app.data_store.histogram_slice(
+						key, _slice_index(start), _slice_index(end),
+						bins=request.args.get('bins', 10, type=int),
+						lower=request.args.get('lower', None, type=float),
+						upper=request.args.get('upper', None, type=float))
+	except ValueError:
+		abort(400)
+
+	return jsonify(histogram)
+
+@app.route('/find/<value>/', methods=['GET'])
+def find_value(value):
+	"""
+	Get the key/column pairs holding a value. Responds with a 404 unless the
+	store has a value index.
+	"""
+	try:
+		cells = app.data_store.find_value(value)
+	except ValueError:
+		abort(404)
+
+	return jsonify({'cells': [[key, col] for key, col in cells]})
+
+@app.route('/find-prefix/<prefix>/', methods=['GET'])
+def find_value_prefix(prefix):
+	"""
+	Get the value/key/column triples of the values which start with prefix,
+	at most 'limit' of them. Responds with a 404 unless the store has a value
+	index.
+	"""
+	limit = request.args.get('limit', None, type=int)
+
+	try:
+		cells = app.data_store.find_value_prefix(prefix, limit)
+	except ValueError:
+		abort(404)
+
+	return jsonify({'cells': [list(cell) for cell in cells]})
+
+@app.route('/stats/<key>/', methods=['GET'])
+def get_key_stats(key):
+	"""
+	Get the statistics kept for a key. Empty if the key doesn't exist.
+	"""
+	stats = app.data_store.get_key_stats(key)
+	return jsonify(stats or {})
+
+@app.route('/stats/', methods=['GET'])
+def get_top_keys():
+	"""
+	Get the statistics of the largest or hottest keys. The 'by' query
+	parameter names the statistic to rank keys by (column_count, total_bytes,
+	writes or write_rate) and 'limit' the number of keys returned.
+	"""
+	by = request.args.get('by', 'total_bytes')
+	limit = request.args.get('limit', 10, type=int)
+
+	try:
+		top_keys = app.data_store.get_top_keys(by, limit)
+	except ValueError:
+		abort(400)
+
+	return jsonify({'by': by,
+					'keys': [dict(stats, key=key) for key, stats in top_keys]})
+
+@app.route('/changes/', methods=['GET'])
+def get_changes():
+	"""
+	Long-poll for the changes made after the sequence number 'after', on the
+	key 'key' or on the keys starting with 'prefix' if given and at most
+	'limit' of them. Waits up to 'wait' seconds for a change if there are
+	none. The response's 'next' is the 'after' to send next time along with
+	its 'epoch'. Responds with a 410 if the changes are gone and with a 404
+	unless the store has a change feed.
+	"""
+	try:
+		found = app.data_store.read_changes(
+					request.args.get('after', 0, type=int),
+					request.args.get('key'),
+					request.args.get('prefix'),
+					request.args.get('limit', 1000, type=int),
+					request.args.get('wait', 0, type=float),
+					request.args.get('epoch'))
+	except ValueError:
+		abort(404)
+
+	changes = []
+
+	for change in found['changes']:
+		fields = dict(zip(CHANGE_FIELDS[change[1]], change[3:]))
+		fields.update(sequence=change[0], type=change[1], key=change[2])
+		changes.append(fields)
+
+	return jsonify({'epoch': found['epoch'], 'next': found['next'], 'changes': changes})
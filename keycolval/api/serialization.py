@@ -0,0 +1,142 @@
+"""
+Encoding of column/value responses.
+
+jsonify builds a dict from the store's list of tuples, encodes all of it in
+one go (pretty printed by default) and then copies the string into the
+response. Column responses instead go through columns_response which encodes
+in chunks, writing each string with the C accelerated JSON string encoder and
+keeping the columns in their sorted order. Responses of up to STREAM_BYTES are
+sent in one piece with a Content-Length, so the connection can be kept alive,
+and larger ones are streamed in pieces of about STREAM_BYTES.
+
+Clients which send 'Accept: application/x-keycolval' get a compact binary
+encoding instead: a four byte big-endian column count followed by each
+column and value as a data log field (a one byte type tag, a four byte length
+and the data, see keycolval/persistence/records.py). Values are written as raw
+bytes, so there is no escaping to do on either side; decode_columns reads the
+format back.
+"""
+
+import itertools
+import json
+import struct
+from json.encoder import encode_basestring_ascii
+
+from keycolval.persistence.records import decode_field
+from keycolval.persistence.records import encode_field
+from flask import Response
+from flask import request
+
+JSON_MIMETYPE = 'application/json'
+BINARY_MIMETYPE = 'application/x-keycolval'
+
+# Columns encoded per chunk of a response.
+CHUNK_COLUMNS = 256
+# Bytes of a response above which it's streamed rather than sent in one piece,
+# and about the bytes of each piece written when it is.
+STREAM_BYTES = 64 << 10
+
+_COUNT = struct.Struct('>I')
+
+# The text type, unicode on Python 2 and str on Python 3.
+_TEXT_TYPE = type(u'')
+# Strings the JSON string encoder takes. On Python 2 str is bytes.
+_JSON_STRING_TYPES = (_TEXT_TYPE, str)
+
+def _encode_json_value(value):
+	if isinstance(value, _JSON_STRING_TYPES):
+		return encode_basestring_ascii(value)
+
+	return json.dumps(value)
+
+def iter_json_columns(columns, chunk_size=CHUNK_COLUMNS):
+	"""
+	Generate the chunks of a JSON object mapping the columns of a list of
+	column/value tuples to their values.
+	"""
+	encode = _encode_json_value
+
+	yield '{'
+
+	for start in range(0, len(columns), chunk_size):
+		chunk = ','.join(['%s:%s' % (encode(col), encode(val))
+						  for col, val in columns[start:start + chunk_size]])
+		yield ',' + chunk if start else chunk
+
+	yield '}'
+
+def iter_binary_columns(columns, chunk_size=CHUNK_COLUMNS):
+	"""
+	Generate the chunks of the binary encoding of a list of column/value
+	tuples.
+	"""
+	yield _COUNT.pack(len(columns))
+
+	for start in range(0, len(columns), chunk_size):
+		yield b''.join([encode_field(col) + encode_field(val)
+						for col, val in columns[start:start + chunk_size]])
+
+def decode_columns(data):
+	"""
+	Decode a binary encoded response back into a list of column/value tuples.
+	"""
+	count = _COUNT.unpack_from(data, 0)[0]
+	offset = _COUNT.size
+	columns = []
+
+	for _ in range(count):
+		col, offset = decode_field(data, offset)
+		val, offset = decode_field(data, offset)
+		columns.append((col, val))
+
+	return columns
+
+def iter_pieces(chunks, piece_bytes=STREAM_BYTES):
+	"""
+	Generate the chunks joined into pieces of at least piece_bytes, apart from
+	the last one.
+	"""
+	piece = []
+	size = 0
+
+	for chunk in chunks:
+		piece.append(chunk)
+		size += len(chunk)
+
+		if size >= piece_bytes:
+			yield _join(piece)
+			piece = []
+			size = 0
+
+	if piece:
+		yield _join(piece)
+
+def _join(chunks):
+	# The chunks are all text or all bytes.
+	return chunks[0][:0].join(chunks)
+
+def columns_response(columns):
+	"""
+	Return a response for a list of column/value tuples in the encoding the
+	client accepts, JSON unless it prefers the binary encoding. Responses of
+	up to STREAM_BYTES have a Content-Length and larger ones are streamed.
+	"""
+	mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, BINARY_MIMETYPE])
+
+	if mimetype == BINARY_MIMETYPE:
+		chunks = iter_binary_columns(columns)
+	else:
+		mimetype = JSON_MIMETYPE
+		chunks = iter_json_columns(columns)
+
+	head = []
+	size = 0
+
+	for chunk in chunks:
+		head.append(chunk)
+		size += len(chunk)
+
+		if size > STREAM_BYTES:
+			return Response(iter_pieces(itertools.chain(head, chunks)), mimetype=mimetype)
+
+	return Response(_join(head), mimetype=mimetype)
@@ -0,0 +1,195 @@
+"""
+A production WSGI server for the application, built on Werkzeug's server
+classes rather than the single-threaded, reloading development server which
+app.run starts.
+
+Connections are handled by a fixed pool of threads fed from a queue, which
+saves starting a thread per connection, and HTTP/1.1 keep-alive is supported
+for responses with a Content-Length, which is everything but exports and
+column responses of more than STREAM_BYTES (see serialization.py). A
+keep-alive connection holds its thread until it's been idle for keep_alive
+seconds, so the pool needs more threads than there are clients which keep
+connections open.
+
+The data store is loaded, and a request run through the application, before
+the server binds its port, so nothing reaches it before it can answer. With
+load_before_bind=False the server binds straight away and the data store is
+loaded in the background while /ready/ reports the progress of replaying the
+data log and other requests get a 503. Reader workers serving a shared image
+(READ_ONLY_WORKER) can also be pre-forked into several processes sharing the
+listening socket after warming up, so they share the mapped image. A data store
+which owns the data log has a single writer and only runs in one process.
+
+The data store can be served over the binary RPC protocol alongside HTTP, for
+clients which make many small calls. The RPC server runs threads of its own in
+every process.
+"""
+
+import os
+import threading
+
+try:
+	from Queue import Queue
+except ImportError:
+	from queue import Queue
+
+from werkzeug.serving import BaseWSGIServer
+from werkzeug.serving import WSGIRequestHandler
+
+from keycolval.api import load_data_store
+from keycolval.rpc.server import RPCServer
+
+
+# Seconds an idle keep-alive connection is kept open for.
+KEEP_ALIVE_TIMEOUT = 5.0
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+	"""
+	Speaks HTTP/1.1, so connections are kept alive between requests unless a
+	response has no Content-Length, and only logs requests when the server's
+	access_log is set.
+	"""
+	protocol_version = 'HTTP/1.1'
+	# Responses are written out in one go when flushed rather than a header at
+	# a time, and without waiting for the client to acknowledge the previous
+	# packet, which would add a delayed ACK to every kept-alive request.
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def setup(self):
+		# Note: StreamRequestHandler applies this to the connection.
+		self.timeout = self.server.keep_alive
+		WSGIRequestHandler.setup(self)
+
+	def log_request(self, code='-', size='-'):
+		if self.server.access_log:
+			WSGIRequestHandler.log_request(self, code, size)
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+	"""
+	A WSGI server which handles connections on a pool of worker threads.
+	"""
+	multithread = True
+
+	def __init__(self, host, port, app, threads=16, keep_alive=KEEP_ALIVE_TIMEOUT,
+				 access_log=False):
+		BaseWSGIServer.__init__(self, host, port, app, handler=KeepAliveRequestHandler)
+		self.threads = threads
+		self.keep_alive = keep_alive
+		self.access_log = access_log
+		self._connections = Queue()
+		self._workers = []
+
+	def serve_forever(self):
+		"""
+		Start the thread pool and accept connections until shut down. The
+		threads are started here rather than on creation so that a server can
+		be forked first.
+		"""
+		for _ in range(self.threads - len(self._workers)):
+			worker = threading.Thread(target=self._handle_connections)
+			worker.daemon = True
+			worker.start()
+			self._workers.append(worker)
+
+		BaseWSGIServer.serve_forever(self)
+
+	def process_request(self, request, client_address):
+		"""
+		Hand an accepted connection to the thread pool.
+		"""
+		self._connections.put((request, client_address))
+
+	def _handle_connections(self):
+		while True:
+			request, client_address = self._connections.get()
+
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+
+
+def warm_up(app):
+	"""
+	Load the data store and run a request through the application, so that
+	the first client request doesn't pay for either.
+	"""
+	load_data_store(app)
+	app.test_client().get('/get-keys/?limit=1')
+
+
+def serve(app, host='127.0.0.1', port=5000, threads=16, processes=1,
+		  keep_alive=KEEP_ALIVE_TIMEOUT, access_log=False, rpc_port=None,
+		  load_before_bind=True):
+	"""
+	Warm up the application and serve it until interrupted, on threads
+	threads in each of processes processes. With rpc_port the data store is
+	also served over the binary protocol in keycolval/rpc on that port. With
+	load_before_bind=False the data store is loaded after binding, in the
+	background, and the RPC server is only started once it has loaded.
+	"""
+	if processes > 1 and not app.config['READ_ONLY_WORKER']:
+		raise ValueError('Only READ_ONLY_WORKER applications can run in several '
+						 'processes, as the data log has a single writer.')
+
+	if not load_before_bind:
+		if processes > 1:
+			raise ValueError('Several processes can only be forked once the data '
+							 'store has loaded.')
+
+		server = ThreadPoolWSGIServer(host, port, app, threads, keep_alive, access_log)
+		loader = load_data_store(app, background=True)
+
+		if rpc_port is not None and loader is not None:
+			rpc_starter = threading.Thread(target=_serve_rpc_once_loaded,
+										   args=(app, loader, host, rpc_port))
+			rpc_starter.daemon = True
+			rpc_starter.start()
+
+		try:
+			server.serve_forever()
+		finally:
+			server.server_close()
+
+		return
+
+	warm_up(app)
+
+	server = ThreadPoolWSGIServer(host, port, app, threads, keep_alive, access_log)
+	rpc_server = RPCServer(app.data_store, host, rpc_port) if rpc_port is not None else None
+	children = []
+
+	for _ in range(processes - 1):
+		pid = os.fork()
+
+		if pid == 0:
+			children = []
+			break
+
+		children.append(pid)
+
+	if rpc_server is not None:
+		rpc_server.start()
+
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+		if rpc_server is not None:
+			rpc_server.server_close()
+
+		for pid in children:
+			os.waitpid(pid, 0)
+
+
+def _serve_rpc_once_loaded(app, loader, host, rpc_port):
+	loader.join()
+
+	if app.load_progress.ready:
+		RPCServer(app.data_store, host, rpc_port).start()
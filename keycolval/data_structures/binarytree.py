@@ -3,6 +3,8 @@ Quick and dirty implementation of BinaryTree for testing as data structure for s
 columns.
 """
 
+import math
+
 
 class Node(object):
     """
@@ -26,22 +28,85 @@ class BinaryTree(object):
 
     def __init__(self):
         self._root = None
+        # Number of nodes in the tree, kept up to date on insert and delete.
+        self._size = 0
+
+    def __len__(self):
+        """
+        Return the number of key/value pairs stored in the tree.
+        """
+        return self._size
+
+    @classmethod
+    def from_sorted(cls, items):
+        """
+        Build a perfectly balanced tree in O(n) from a list of key/value
+        pairs sorted by key with no repeated keys.
+        """
+        tree = cls()
+        tree._root = _build_balanced(items, 0, len(items), None)
+        tree._size = len(items)
+        return tree
+
+    def bulk_load(self, items):
+        """
+        Insert a list of key/value pairs sorted by key with no repeated keys,
+        overwriting the values of keys which already exist. Returns a list of
+        the overwritten values, or None for new keys, in the order of items.
+
+        A batch which is small next to the tree is inserted a pair at a time.
+        Otherwise the tree's pairs and the batch are merged and the tree is
+        rebuilt balanced in O(n + k), which also undoes any imbalance from
+        earlier inserts.
+        """
+        if not items:
+            return []
+
+        if self._size and len(items) * math.log(self._size + 1, 2) < self._size:
+            return [self.insert(key, value) for key, value in items]
+
+        existing = [(node.key, node.value) for node in self.iterate_range()]
+        merged = []
+        old_values = []
+        index = 0
+
+        for key, value in items:
+            while index < len(existing) and existing[index][0] < key:
+                merged.append(existing[index])
+                index += 1
+
+            if index < len(existing) and existing[index][0] == key:
+                old_values.append(existing[index][1])
+                index += 1
+            else:
+                old_values.append(None)
+
+            merged.append((key, value))
+
+        merged.extend(existing[index:])
+
+        self._root = _build_balanced(merged, 0, len(merged), None)
+        self._size = len(merged)
+        return old_values
 
     def insert(self, key, value):
         """
         Insert a key/value pair into binary tree as a node. If the key already exists
         overwrite the existing value at the node for this key with the new value.
+
+        Returns the value that was overwritten or None if the key is new.
         """
         node = Node(key, value)
 
         if self._root is None:
             self._root = node
+            self._size += 1
         else:
-            self._insert_in_subtree(node, self._root)
+            return self._insert_in_subtree(node, self._root)
 
     def _insert_in_subtree(self, node, subtree_root):
         """
-        Insert a node into a subtree.
+        Insert a node into a subtree, returning the overwritten value if any.
         """
         # If node key is greater than current node, insert into right subtree.
         if node.key > subtree_root.key:
@@ -50,9 +115,10 @@ class BinaryTree(object):
             if subtree_root.right is None:
                 subtree_root.right = node
                 subtree_root.right.parent = subtree_root
+                self._size += 1
             # Right child so perform insert against right subtree
             else:
-                self._insert_in_subtree(node, subtree_root.right)
+                return self._insert_in_subtree(node, subtree_root.right)
 
         # If node key is less than current node, insert into left subtree.
         elif node.key < subtree_root.key:
@@ -61,13 +127,16 @@ class BinaryTree(object):
             if subtree_root.left is None:
                 subtree_root.left = node
                 subtree_root.left.parent = subtree_root
+                self._size += 1
             # Left child so perform insert against right subtree.
             else:
-                self._insert_in_subtree(node, subtree_root.left)
+                return self._insert_in_subtree(node, subtree_root.left)
 
         # If node key is equal, just overwrite the value / aka update.
         elif node.key == subtree_root.key:
+            old_value = subtree_root.value
             subtree_root.value = node.value
+            return old_value
             
     def _iterate_subtree(self, sub_tree):
         """
@@ -95,22 +164,19 @@ class BinaryTree(object):
         """
         Find a node in a subtree with a given key.
         """
+        while sub_tree is not None and sub_tree.key != key:
+            if sub_tree.key > key:
+                # The current node key is greater than our search key
+                # so we go left.
+                sub_tree = sub_tree.left
+            else:
+                # The current node key is less than our search key
+                # so we go right.
+                sub_tree = sub_tree.right
 
-        if sub_tree == None or sub_tree.key == key:
-            # We either found the target key or it doesn't exist.
-            # We return the value of sub_tree which is either
-            # None for doesn't exist
-            # or the node if we found the key
-            return sub_tree
-
-        elif sub_tree.key > key:
-            # The current node key is greater than our search key
-            # so we go left.
-            return self._find_node(key, sub_tree.left)
-        elif sub_tree.key < key:
-            # The current node key is less than our search key
-            # so we go right.
-            return self._find_node(key, sub_tree.right)
+        # We either found the target key or it doesn't exist, in which case
+        # this is None.
+        return sub_tree
 
     def all(self):
         """
@@ -130,48 +196,81 @@ class BinaryTree(object):
         """
         Allow for finding a range of nodes which have keys within some
         boundary values.
-        
-        This algorithm is unoptimal it currently iterates over an entire
-        subtree where the target slice is contained rather than using the
-        fact that we have effecient means of finding the boundary nodes.
         """
+        return list(self.iterate_range(start_key, end_key))
+
+    def iterate_range(self, start_key=None, end_key=None, reverse=False):
+        """
+        Iterate over the nodes with keys between start_key and end_key
+        inclusive, in descending order if reverse is set. Either boundary
+        may be None for an open range.
+
+        Only the paths to the boundary nodes and the nodes in the range are
+        visited, so taking the first k nodes costs O(height + k).
+        """
+        return self._iterate_bounded(
+            lambda key: start_key is None or key >= start_key,
+            lambda key: end_key is None or key <= end_key,
+            reverse)
+
+    def iterate_prefix(self, prefix, reverse=False):
+        """
+        Iterate over the nodes with keys starting with prefix, in descending
+        order if reverse is set.
+        """
+        return self._iterate_bounded(
+            lambda key: key >= prefix,
+            lambda key: key < prefix or key.startswith(prefix),
+            reverse)
+
+    def _iterate_bounded(self, above_lower, below_upper, reverse):
+        """
+        Iterate in order over the nodes whose keys satisfy both above_lower
+        and below_upper. Both must be monotonic in the key: above_lower turns
+        True at the lower boundary and stays True, below_upper is True up to
+        the upper boundary and False after it.
+
+        An explicit stack holds the path of nodes still to be visited so that
+        we never descend into subtrees which are entirely out of range.
+        """
+        if reverse:
+            # Walk the mirror image of the tree with the boundaries swapped.
+            near_child, far_child = 'right', 'left'
+            in_near_bound, in_far_bound = below_upper, above_lower
+        else:
+            near_child, far_child = 'left', 'right'
+            in_near_bound, in_far_bound = above_lower, below_upper
 
-        def _find_range_root(start_key, end_key, subtree_root):
+        stack = []
+
+        def _descend(node):
             """
-            Given a start_key and end_key find the root node that
-            contains the entire range within the tree rooted at subtree_root.
+            Push the path towards the first in-bound node of a subtree.
             """
-            if ((start_key is None or subtree_root.key >= start_key) and
-                (end_key is None or subtree_root.key <= end_key)):
-               return subtree_root
-            elif end_key is not None and subtree_root.key > end_key:
-                _find_range_root(start_key, end_key, subtree_root.left)
-            elif start_key is not None and subtree_root.key < start_key:
-                _find_range_root(start_key, end_key, subtree_root.right)
-
-        range_root = _find_range_root(start_key, end_key, self._root)
+            while node is not None:
+                if in_near_bound(node.key):
+                    stack.append(node)
+                    node = getattr(node, near_child)
+                else:
+                    node = getattr(node, far_child)
 
-        node_range = []
+        _descend(self._root)
 
-        # Inneffeciency here. Iterating the entire subtree.
-        for node in self._iterate_subtree(range_root):
-            if ((start_key is None or node.key >= start_key) and
-                 (end_key is None or node.key <= end_key)):
+        while stack:
+            node = stack.pop()
 
-                node_range.append(node)
+            if not in_far_bound(node.key):
+                # Everything left on the stack is further out of range.
+                return
 
-            if node.key > end_key:
-                # Short circuit if we find our entire range.
-                # Note: short circuiting out of for loops is usually not
-                # ideal for readiblity. May want to look into re-working this
-                # loop.
-                return node_range
+            yield node
 
-        return node_range
+            _descend(getattr(node, far_child))
 
     def delete(self, key):
         """
-        Delete a node from the binary tree.
+        Delete a node from the binary tree. Returns the deleted value or None
+        if the key wasn't in the tree.
         """
 
         # First we get the node in question.
@@ -179,6 +278,8 @@ class BinaryTree(object):
 
         # If it exists we delete it.
         if node:
+            self._size -= 1
+            deleted_value = node.value
 
             if node.left and node.right:
                 # The node has two children.
@@ -190,60 +291,110 @@ class BinaryTree(object):
                 node.key = successor_node.key
                 node.value = successor_node.value
                 
-                # We drop the old successor node from the tree.
-                self._kill_node(successor_node)
-
-            elif node.left:
-                # The target node only has a left child.
-                # So we replace target node with it's left child.
-                self._replace_parent_with_child(node, node.left)
-            elif node.right:
-                # The target node only has a right child.
-                # So we replace target node with it's right child.
-                self._replace_parent_with_child(node, node.right)
+                # We drop the old successor node from the tree. It has no left
+                # child but may have a right one.
+                self._remove_node(successor_node)
             else:
-                # No children so we can just drop it.
-                self._kill_node(node)
+                self._remove_node(node)
+
+            return deleted_value
 
-    def _kill_node(self, node):
+    def delete_range(self, start_key=None, end_key=None):
         """
-        Actually remove a node from the tree by detaching it.
+        Delete the nodes with keys between start_key and end_key inclusive.
+        Either boundary may be None for an open range. Returns the deleted
+        key/value pairs in order.
+
+        Only the paths to the boundaries and the deleted nodes are visited and
+        each deleted subtree is spliced out in one go, so this costs
+        O(height + k) rather than a delete per node.
         """
-        # Grab it's parent so we can clean the child link.
-        parent = node.parent
-        
-        # Clean the parent's child link.
-        if parent.left == node:
-            parent.left = None
-        elif parent.right == node:
-            parent.right = None
-
-        # Clean this node's parent link.
-        node.parent = None
+        removed = []
+        self._root = self._prune(self._root, start_key, end_key, removed)
 
-        # The node is orphaned we can remove it.
-        del node
+        if self._root is not None:
+            self._root.parent = None
 
-    def _replace_parent_with_child(self, parent, child):
+        self._size -= len(removed)
+        return removed
+
+    def _prune(self, node, start_key, end_key, removed):
+        """
+        Remove the nodes in range from a subtree, appending their key/value
+        pairs to removed in order, and return the subtree's new root.
         """
-        Swap a parent node with one of it's child nodes removing the parent node.
+        if node is None:
+            return None
+
+        if start_key is not None and node.key < start_key:
+            # Only the right subtree can hold keys in range.
+            node.right = self._prune(node.right, start_key, end_key, removed)
+            _set_parent(node.right, node)
+            return node
+
+        if end_key is not None and node.key > end_key:
+            # Only the left subtree can hold keys in range.
+            node.left = self._prune(node.left, start_key, end_key, removed)
+            _set_parent(node.left, node)
+            return node
+
+        # The node itself is in range, so what's left of its subtrees is
+        # joined in its place.
+        left = self._prune(node.left, start_key, end_key, removed)
+        removed.append((node.key, node.value))
+        right = self._prune(node.right, start_key, end_key, removed)
+
+        return self._join(left, right)
+
+    def _join(self, left, right):
         """
+        Join two subtrees, where every key in left is less than every key in
+        right, under the smallest node of right and return the new root.
+        """
+        if left is None:
+            return right
 
-        # Update parent node's parent node to point to child.
-        if hasattr(parent, 'parent'):
-            parents_parent = parent.parent
+        if right is None:
+            return left
 
-            if parents_parent.left == parent:
-                parents_parent.left = child
-            elif parents_parent.right == parent:
-                parents_parent.right = child
+        successor = right
 
-            child.parent = parents_parent
-        else:
-            # Edge case where parent was root.
+        while successor.left is not None:
+            successor = successor.left
+
+        if successor is not right:
+            # Take the successor out of right, leaving its right child in its
+            # place.
+            successor.parent.left = successor.right
+            _set_parent(successor.right, successor.parent)
+            successor.right = right
+            right.parent = successor
+
+        successor.left = left
+        left.parent = successor
+
+        return successor
+
+    def _remove_node(self, node):
+        """
+        Remove a node with at most one child from the tree, putting the child,
+        if any, in its place.
+        """
+        child = node.left if node.left is not None else node.right
+        parent = node.parent
+
+        if parent is None:
+            # Edge case where the node was the root.
             self._root = child
+        elif parent.left is node:
+            parent.left = child
+        else:
+            parent.right = child
+
+        _set_parent(child, parent)
 
-        del parent
+        # The node is orphaned we can remove it.
+        node.parent = None
 
     def _find_successor(self, node):
         """
@@ -259,3 +410,28 @@ class BinaryTree(object):
             cur_node = cur_node.left
 
         return cur_node
+
+
+def _build_balanced(items, lower, upper, parent):
+    """
+    Build a balanced subtree out of the sorted key/value pairs in
+    items[lower:upper], with its middle pair at the root.
+    """
+    if lower >= upper:
+        return None
+
+    middle = (lower + upper) // 2
+    node = Node(*items[middle])
+    node.parent = parent
+    node.left = _build_balanced(items, lower, middle, node)
+    node.right = _build_balanced(items, middle + 1, upper, node)
+
+    return node
+
+
+def _set_parent(node, parent):
+    """
+    Point a node, which may be None, at its new parent.
+    """
+    if node is not None:
+        node.parent = parent
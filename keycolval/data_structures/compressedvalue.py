@@ -0,0 +1,170 @@
+"""
+Transparent compression of large values, both in memory and in the data log.
+
+A ValueCompressor replaces values above a size threshold with CompressedValue
+objects when they are stored and turns them back into the original value
+only when they are read, so values which are never read are never
+decompressed.
+"""
+
+import threading
+import zlib
+from timeit import default_timer
+
+try:
+    import lzma
+except ImportError:
+    try:
+        # lzma is only in the standard library from Python 3.3, the
+        # backports.lzma package provides it on Python 2.7.
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# The text type, unicode on Python 2 and str on Python 3.
+_TEXT_TYPE = type(u'')
+
+
+class CompressedValue(object):
+    """
+    A compressed value. text records whether the original value was text
+    which has to be decoded again after decompression.
+    """
+    __slots__ = ('data', 'text')
+
+    def __init__(self, data, text):
+        self.data = data
+        self.text = text
+
+    def __len__(self):
+        """
+        Return the compressed size in bytes, which is what the value costs in
+        memory and which the key statistics account for.
+        """
+        return len(self.data)
+
+
+class ValueCompressor(object):
+    """
+    Compresses string values of at least threshold bytes with zlib or lzma.
+    lzma needs Python 3.3 or later, or the backports.lzma package on Python
+    2.7.
+
+    Values which don't shrink are stored uncompressed. Running totals of the
+    bytes in and out and the time spent are kept for reporting.
+    """
+
+    def __init__(self, method='zlib', threshold=1024, level=6):
+        if method == 'lzma' and lzma is None:
+            raise ValueError('lzma compression needs Python 3.3 or backports.lzma.')
+        if method not in ('zlib', 'lzma'):
+            raise ValueError('Unknown compression method %r.' % method)
+
+        self.method = method
+        self.threshold = threshold
+        self.level = level
+
+        # Values are compressed from concurrent request threads, the lock
+        # guards the running totals and _last.
+        self._lock = threading.Lock()
+
+        self.values_compressed = 0
+        self.values_decompressed = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+
+        # The most recent (value, compressed value) pair. The persist path
+        # compresses a value for the data log right before the store
+        # compresses the same value object, so this saves doing it twice.
+        self._last = (None, None)
+
+    def compress(self, val):
+        """
+        Return the value to store for val: a CompressedValue if val is a large
+        enough string which compresses, otherwise val itself.
+        """
+        if isinstance(val, CompressedValue):
+            return val
+
+        with self._lock:
+            last_val, last_compressed = self._last
+
+        if val is last_val:
+            return last_compressed
+
+        if not isinstance(val, (bytes, _TEXT_TYPE)) or len(val) < self.threshold:
+            return val
+
+        start_time = default_timer()
+
+        text = isinstance(val, _TEXT_TYPE) and not isinstance(val, bytes)
+        raw = val.encode('utf-8') if text else val
+        data = self._compress_bytes(raw)
+
+        # Not worth it if it doesn't shrink, keep the original.
+        compressed = CompressedValue(data, text) if len(data) < len(raw) else val
+
+        with self._lock:
+            self.compress_seconds += default_timer() - start_time
+            self.raw_bytes += len(raw)
+
+            if compressed is val:
+                self.compressed_bytes += len(raw)
+            else:
+                self.values_compressed += 1
+                self.compressed_bytes += len(data)
+
+            self._last = (val, compressed)
+
+        return compressed
+
+    def decompress(self, stored):
+        """
+        Return the original value for a stored value.
+        """
+        if not isinstance(stored, CompressedValue):
+            return stored
+
+        start_time = default_timer()
+
+        raw = self._decompress_bytes(stored.data)
+        val = raw.decode('utf-8') if stored.text else raw
+
+        with self._lock:
+            self.decompress_seconds += default_timer() - start_time
+            self.values_decompressed += 1
+
+        return val
+
+    def decompress_items(self, items):
+        """
+        Decompress the values of a list of column/value tuples.
+        """
+        decompress = self.decompress
+        return [(col, decompress(val)) for col, val in items]
+
+    def ratio(self):
+        """
+        Return the ratio of stored bytes to original bytes for every value
+        which was considered for compression.
+        """
+        if not self.raw_bytes:
+            return 1.0
+
+        return float(self.compressed_bytes) / self.raw_bytes
+
+    def _compress_bytes(self, raw):
+        if self.method == 'lzma':
+            return lzma.compress(raw, preset=self.level)
+
+        return zlib.compress(raw, self.level)
+
+    def _decompress_bytes(self, data):
+        if self.method == 'lzma':
+            return lzma.decompress(data)
+
+        return zlib.decompress(data)
+
@@ -0,0 +1,157 @@
+"""
+A time ordered index of the cells in a store which expire.
+"""
+
+import heapq
+import itertools
+
+
+class ExpiryIndex(object):
+    """
+    Tracks the unix time at which each expiring key/column expires.
+
+    A heap ordered by expiry time lets pop_due find the cells which are due
+    in O(log n) per cell, so reaping costs time proportional to the number of
+    cells expiring rather than to the number of cells which could. Changing or
+    clearing a cell's expiry leaves its old heap entry behind to be skipped
+    when popped, and the heap is rebuilt once stale entries outnumber live ones.
+
+    A per-key dict of expiring columns along with a lower bound of each key's
+    earliest expiry lets reads check a key in O(1).
+    """
+
+    def __init__(self):
+        # (expire_at, sequence, key, column). The sequence number breaks ties
+        # so keys and columns never have to be compared.
+        self._heap = []
+        self._sequence = itertools.count()
+        # key -> {column: expire_at}
+        self._columns = {}
+        # key -> lower bound of the key's earliest expiry.
+        self._next = {}
+        self._count = 0
+
+    def __len__(self):
+        """
+        Return the number of expiring cells.
+        """
+        return self._count
+
+    def set(self, key, col, expire_at):
+        """
+        Set the time at which a cell expires.
+        """
+        columns = self._columns.setdefault(key, {})
+
+        if col not in columns:
+            self._count += 1
+
+        columns[col] = expire_at
+        self._next[key] = min(self._next.get(key, expire_at), expire_at)
+        heapq.heappush(self._heap, (expire_at, next(self._sequence), key, col))
+
+        if len(self._heap) > 2 * self._count + 64:
+            self._compact()
+
+    def get(self, key, col):
+        """
+        Return the time at which a cell expires or None if it doesn't.
+        """
+        return self._columns.get(key, {}).get(col)
+
+    def columns(self, key):
+        """
+        Return a dict of the times at which a key's expiring columns expire.
+        """
+        return dict(self._columns.get(key, ()))
+
+    def discard(self, key, col):
+        """
+        Stop a cell from expiring.
+        """
+        columns = self._columns.get(key)
+
+        if columns and col in columns:
+            del columns[col]
+            self._count -= 1
+
+            if not columns:
+                del self._columns[key]
+                del self._next[key]
+
+    def discard_key(self, key):
+        """
+        Stop every cell of a key from expiring.
+        """
+        columns = self._columns.pop(key, None)
+
+        if columns:
+            self._count -= len(columns)
+            del self._next[key]
+
+    def is_due(self, key, now):
+        """
+        Return True if any of a key's cells may have expired by now.
+        """
+        return key in self._next and self._next[key] <= now
+
+    def pop_due_columns(self, key, now):
+        """
+        Remove and return the columns of a key which have expired by now.
+        """
+        columns = self._columns.get(key)
+
+        if not columns:
+            return []
+
+        due = [col for col, expire_at in columns.items() if expire_at <= now]
+
+        for col in due:
+            del columns[col]
+
+        self._count -= len(due)
+
+        if columns:
+            self._next[key] = min(columns.values())
+        else:
+            del self._columns[key]
+            del self._next[key]
+
+        return due
+
+    def pop_due(self, now, limit=None):
+        """
+        Remove and return up to limit (key, column) tuples of the cells which
+        have expired by now, earliest first.
+        """
+        heap = self._heap
+        due = []
+
+        while heap and heap[0][0] <= now and (limit is None or len(due) < limit):
+            expire_at, sequence, key, col = heapq.heappop(heap)
+            columns = self._columns.get(key)
+
+            if columns is None or columns.get(col) != expire_at:
+                # A stale entry for a cell whose expiry was changed or cleared.
+                continue
+
+            self.discard(key, col)
+            due.append((key, col))
+
+        return due
+
+    def items(self):
+        """
+        Generate (key, column, expire_at) tuples for every expiring cell.
+        """
+        for key, columns in self._columns.items():
+            for col, expire_at in columns.items():
+                yield key, col, expire_at
+
+    def _compact(self):
+        """
+        Rebuild the heap from the live entries only.
+        """
+        self._heap = [(expire_at, next(self._sequence), key, col)
+                      for key, col, expire_at in self.items()]
+        heapq.heapify(self._heap)
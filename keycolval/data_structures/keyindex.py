@@ -0,0 +1,100 @@
+"""
+An ordered index of the keys in a store which allows keys to be listed in
+order and in pages without copying every key on each call.
+"""
+
+import threading
+from bisect import bisect_left
+
+from keycolval.data_structures.sortedcolumns import bisect_prefix
+from keycolval.data_structures.sortedcolumns import bisect_range
+from keycolval.data_structures.sortedcolumns import page
+
+
+class SortedKeyIndex(object):
+    """
+    A sorted list of keys which is maintained incrementally.
+
+    New keys are collected in a pending set and removed keys in a set of
+    tombstones, and both are only merged into the sorted list the next time
+    the index is read. Bulk loads and deletes therefore pay for a single sort
+    or rebuild of the list rather than an insert into or delete from the
+    middle of a large list for every key, and stores which never list their
+    keys in order never pay for sorting at all.
+
+    Reads merge into the list, so every method holds the index's own lock.
+    Stores read their index without holding their write lock.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._pending = set()
+        self._removed = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys) + len(self._pending) - len(self._removed)
+
+    def add(self, key):
+        """
+        Add a key which isn't already in the index.
+        """
+        with self._lock:
+            if key in self._removed:
+                # The key is still in the sorted list.
+                self._removed.discard(key)
+            else:
+                self._pending.add(key)
+
+    def discard(self, key):
+        """
+        Remove a key from the index if it's there.
+        """
+        with self._lock:
+            if key in self._pending:
+                self._pending.discard(key)
+                return
+
+            index = bisect_left(self._keys, key)
+
+            if index < len(self._keys) and self._keys[index] == key:
+                self._removed.add(key)
+
+    def range(self, start=None, stop=None, limit=None, reverse=False, offset=0):
+        """
+        Return a sorted list of the keys between start and stop inclusive,
+        paged like a slice. Either boundary may be None for an open range.
+        """
+        with self._lock:
+            self._merge_pending()
+
+            lower, upper = bisect_range(self._keys, start, stop)
+            return page(self._keys, lower, upper, reverse, limit, offset)
+
+    def prefix(self, prefix, limit=None, reverse=False, offset=0):
+        """
+        Return a sorted list of the keys starting with prefix, paged like a
+        slice.
+        """
+        with self._lock:
+            self._merge_pending()
+
+            lower, upper = bisect_prefix(self._keys, prefix)
+            return page(self._keys, lower, upper, reverse, limit, offset)
+
+    def _merge_pending(self):
+        """
+        Merge pending and removed keys into the sorted list. Called holding
+        the lock.
+        """
+        if self._removed:
+            removed = self._removed
+            self._keys = [key for key in self._keys if key not in removed]
+            self._removed = set()
+
+        if self._pending:
+            # Timsort merges the already sorted run with the sorted new keys
+            # in close to linear time.
+            self._keys.extend(sorted(self._pending))
+            self._keys.sort()
+            self._pending.clear()
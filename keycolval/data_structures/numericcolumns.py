@@ -0,0 +1,276 @@
+"""
+Array backed copies of a key's columns for aggregating over slices of large
+keys without sending every cell to the client, see KeyColValStore.sum_slice.
+
+A NumericColumns holds a key's columns in a sorted list and their values
+parsed as floats in a parallel array, with NaN for the values which aren't
+finite numbers. A slice is found by bisecting the columns and aggregated in
+one pass over that part of the array. When NumPy is installed the array is a
+numpy array and the aggregates are vectorized, otherwise they loop over an
+array.array in Python. Both give the same results, up to the rounding of sums.
+
+Stores keep the NumericColumns of their large keys in a NumericColumnCache
+until the key is next written.
+"""
+
+import math
+import threading
+from array import array
+from collections import OrderedDict
+
+from keycolval.data_structures.sortedcolumns import bisect_range
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, the aggregates fall back to pure Python.
+    numpy = None
+
+
+NAN = float('nan')
+
+# Approximate bytes per cell of a NumericColumns: a list slot for the column,
+# which is shared with the store, and a float.
+CELL_BYTES = 16
+
+
+def parse_number(val):
+    """
+    Return val as a float, or NaN if it isn't a finite number.
+    """
+    try:
+        number = float(val)
+    except (TypeError, ValueError):
+        return NAN
+
+    if math.isnan(number) or math.isinf(number):
+        return NAN
+
+    return number
+
+
+class NumericColumns(object):
+    """
+    A sorted list of columns alongside an array of their values as numbers,
+    built from a sorted list of column/value tuples. With use_numpy False the
+    pure Python array is used even if NumPy is installed.
+    """
+
+    def __init__(self, items, use_numpy=None):
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        self.columns = [col for col, val in items]
+        values = [parse_number(val) for col, val in items]
+
+        if self.use_numpy:
+            self.values = numpy.array(values, dtype=numpy.float64)
+        else:
+            self.values = array('d', values)
+
+    def __len__(self):
+        return len(self.columns)
+
+    @property
+    def approximate_bytes(self):
+        return len(self.columns) * CELL_BYTES
+
+    def count(self, start, stop):
+        """
+        Return a dict of the number of columns between start and stop
+        inclusive (count) and the first and last of them, or None if there
+        are none.
+        """
+        lower, upper = bisect_range(self.columns, start, stop)
+
+        if lower == upper:
+            return {'count': 0, 'first': None, 'last': None}
+
+        return {'count': upper - lower, 'first': self.columns[lower],
+                'last': self.columns[upper - 1]}
+
+    def summarize(self, start, stop):
+        """
+        Return a dict of the number (count), sum, min and max of the values
+        of the columns between start and stop inclusive which are numbers,
+        and the number of values which were skipped as they aren't. min and
+        max are None if there are no numbers.
+        """
+        numbers, skipped = self._numbers(start, stop)
+        summary = {'count': len(numbers), 'skipped': skipped, 'sum': 0.0,
+                   'min': None, 'max': None}
+
+        if not len(numbers):
+            return summary
+
+        if self.use_numpy:
+            summary.update(sum=float(numbers.sum()), min=float(numbers.min()),
+                           max=float(numbers.max()))
+        else:
+            summary.update(sum=math.fsum(numbers), min=min(numbers), max=max(numbers))
+
+        return summary
+
+    def histogram(self, start, stop, bins=10, lower=None, upper=None):
+        """
+        Return a dict of the counts of the numeric values of the columns
+        between start and stop inclusive in bins equal width bins, the
+        bins + 1 edges of the bins and the number of values skipped as they
+        aren't numbers. The bins span lower to upper, which default to the
+        smallest and largest value, and values outside them aren't counted.
+        Every bin but the last holds the values from its lower edge up to
+        but not including its upper edge, as with numpy.histogram.
+        """
+        if bins < 1:
+            raise ValueError('bins must be at least 1, not %d.' % bins)
+
+        numbers, skipped = self._numbers(start, stop)
+
+        if lower is None or upper is None:
+            if not len(numbers):
+                smallest, largest = 0.0, 1.0
+            elif self.use_numpy:
+                smallest, largest = numbers.min(), numbers.max()
+            else:
+                smallest, largest = min(numbers), max(numbers)
+
+            lower = smallest if lower is None else lower
+            upper = largest if upper is None else upper
+
+        lower, upper = float(lower), float(upper)
+
+        if lower > upper:
+            raise ValueError('lower (%r) must not be more than upper (%r).' % (lower, upper))
+
+        if lower == upper:
+            lower, upper = lower - 0.5, upper + 0.5
+
+        if self.use_numpy:
+            counts, edges = numpy.histogram(numbers, bins, (lower, upper))
+            return {'counts': counts.tolist(), 'edges': edges.tolist(), 'skipped': skipped}
+
+        return {'counts': _count_bins(numbers, bins, lower, upper),
+                'edges': _edges(bins, lower, upper), 'skipped': skipped}
+
+    def _numbers(self, start, stop):
+        """
+        Return the values of the columns between start and stop inclusive
+        which are numbers, and the number of those which aren't.
+        """
+        lower, upper = bisect_range(self.columns, start, stop)
+
+        if self.use_numpy:
+            values = self.values[lower:upper]
+            numbers = values[~numpy.isnan(values)]
+        else:
+            # NaN is the only value which isn't equal to itself.
+            numbers = [val for val in self.values[lower:upper] if val == val]
+
+        return numbers, upper - lower - len(numbers)
+
+
+def _edges(bins, lower, upper):
+    """
+    Return the edges of bins equal width bins from lower to upper, computed
+    as numpy.linspace does.
+    """
+    step = (upper - lower) / bins
+    return [lower + i * step for i in range(bins)] + [upper]
+
+
+def _count_bins(numbers, bins, lower, upper):
+    """
+    Count numbers into bins equal width bins from lower to upper, placing
+    values on an edge the way numpy.histogram does.
+    """
+    edges = _edges(bins, lower, upper)
+    scale = bins / (upper - lower)
+    last = bins - 1
+    counts = [0] * bins
+
+    for number in numbers:
+        if not lower <= number <= upper:
+            continue
+
+        index = int((number - lower) * scale)
+
+        if index > last:
+            index = last
+
+        # The scaled index can be off by one next to an edge.
+        if number < edges[index]:
+            index -= 1
+        elif index < last and number >= edges[index + 1]:
+            index += 1
+
+        counts[index] += 1
+
+    return counts
+
+
+class NumericColumnCache(object):
+    """
+    Keeps the NumericColumns of recently aggregated keys with at least
+    min_columns columns, up to max_cells cells in all, dropping the least
+    recently used first.
+
+    Stores invalidate a key's entry before every data altering call on it and
+    build entries, both holding their write lock, so an entry always matches
+    the key it was built from.
+    """
+
+    def __init__(self, min_columns=1000, max_cells=1000000):
+        self.min_columns = min_columns
+        self.max_cells = max_cells
+        self.cells = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def approximate_bytes(self):
+        return self.cells * CELL_BYTES
+
+    def get(self, key):
+        """
+        Return the NumericColumns of key, or None if it isn't held.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is not None:
+                # Moved to the most recently used end.
+                self._entries[key] = entry
+
+            return entry
+
+    def put(self, key, entry):
+        """
+        Hold the NumericColumns of key, dropping the least recently used
+        entries to stay within max_cells.
+        """
+        if len(entry) > self.max_cells:
+            return
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = entry
+            self.cells += len(entry)
+
+            while self.cells > self.max_cells:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        """
+        Drop the NumericColumns of key, if it's held.
+        """
+        if key in self._entries:
+            with self._lock:
+                self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self.cells -= len(entry)
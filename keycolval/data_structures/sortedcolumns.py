@@ -0,0 +1,201 @@
+"""
+A sorted array of columns for keys which are read in order much more often
+than new columns are added to them, along with the bisect based range, prefix
+and paging helpers used by stores which keep sorted lists of columns.
+"""
+
+from bisect import bisect_left
+from bisect import bisect_right
+
+
+def bisect_range(columns, start, stop):
+    """
+    Return the (lower, upper) indices of the sorted list columns which hold
+    the columns between start and stop inclusive. Either boundary may be None
+    for an open range.
+    """
+    lower = 0 if start is None else bisect_left(columns, start)
+    upper = len(columns) if stop is None else bisect_right(columns, stop)
+    return lower, max(lower, upper)
+
+
+def bisect_prefix(columns, prefix):
+    """
+    Return the (lower, upper) indices of the sorted list columns which hold
+    the columns starting with prefix.
+    """
+    lower = bisect_left(columns, prefix)
+
+    # Every column from lower onwards is >= prefix, so the columns which start
+    # with prefix come first and we can bisect for the first one which doesn't.
+    low, high = lower, len(columns)
+
+    while low < high:
+        middle = (low + high) // 2
+
+        if columns[middle].startswith(prefix):
+            low = middle + 1
+        else:
+            high = middle
+
+    return lower, low
+
+
+def page_bounds(lower, upper, reverse=False, limit=None, offset=0):
+    """
+    Narrow the (lower, upper) indices of a range down to the entries which are
+    left after skipping offset entries and taking at most limit entries,
+    counting from the upper end if reverse is set.
+    """
+    if reverse:
+        upper = max(upper - offset, lower)
+
+        if limit is not None:
+            lower = max(lower, upper - limit)
+
+        return lower, upper
+
+    lower = min(lower + offset, upper)
+
+    if limit is not None:
+        upper = min(upper, lower + limit)
+
+    return lower, upper
+
+
+def page(columns, lower, upper, reverse=False, limit=None, offset=0):
+    """
+    Return the part of columns[lower:upper] which is left after skipping offset
+    entries and taking at most limit entries, counting from the upper end
+    and in descending order if reverse is set.
+    """
+    lower, upper = page_bounds(lower, upper, reverse, limit, offset)
+
+    if reverse:
+        return columns[lower:upper][::-1]
+
+    return columns[lower:upper]
+
+
+class SortedColumns(object):
+    """
+    Stores column/value pairs as a sorted list of columns alongside a dict
+    mapping columns to values.
+
+    The dict keeps get and overwrites at average O(1) while the sorted list
+    lets ordered access and slices run in O(log n + k) by bisecting for the
+    boundaries. The price is paid when a new column is added or removed which
+    shifts the list in O(n), although that shift is a fast memory move.
+    """
+
+    def __init__(self, items=None):
+        self._columns = []
+        self._values = {}
+
+        if items:
+            self._values = dict(items)
+            self._columns = sorted(self._values)
+
+    def __len__(self):
+        """
+        Return the number of columns.
+        """
+        return len(self._columns)
+
+    def __contains__(self, col):
+        return col in self._values
+
+    def __getitem__(self, col):
+        return self._values[col]
+
+    def __iter__(self):
+        """
+        Iterate over the columns in order.
+        """
+        return iter(self._columns)
+
+    def get(self, col, default=None):
+        """
+        Return the value of a column or default if it doesn't exist.
+        """
+        return self._values.get(col, default)
+
+    def set(self, col, val):
+        """
+        Set the value of a column. Returns the overwritten value or None if the
+        column is new.
+        """
+        old_val = self._values.get(col)
+
+        if old_val is None:
+            self._columns.insert(bisect_left(self._columns, col), col)
+
+        self._values[col] = val
+        return old_val
+
+    def delete(self, col):
+        """
+        Remove a column. Returns the removed value. Raises KeyError if the
+        column doesn't exist.
+        """
+        val = self._values.pop(col)
+        del self._columns[bisect_left(self._columns, col)]
+        return val
+
+    def delete_range(self, start, stop):
+        """
+        Remove the columns between start and stop inclusive, either of which
+        may be None for an open range, and return the removed column/value
+        tuples in order. The columns are found in O(log n) and removed with
+        a single shift of the list.
+        """
+        lower, upper = bisect_range(self._columns, start, stop)
+        values = self._values
+        removed = [(col, values.pop(col)) for col in self._columns[lower:upper]]
+
+        del self._columns[lower:upper]
+        return removed
+
+    def columns(self):
+        """
+        Return the sorted list of columns. This must not be modified.
+        """
+        return self._columns
+
+    def items(self):
+        """
+        Return a sorted list of all column/value tuples.
+        """
+        values = self._values
+        return [(col, values[col]) for col in self._columns]
+
+    def slice(self, start, stop, reverse=False, limit=None, offset=0):
+        """
+        Return a sorted list of column/value tuples with columns between start
+        and stop inclusive. Either boundary may be None for an open slice.
+
+        See page for how reverse, limit and offset are applied. This takes
+        O(log n + limit) time.
+        """
+        lower, upper = bisect_range(self._columns, start, stop)
+
+        values = self._values
+        return [(col, values[col])
+                for col in page(self._columns, lower, upper, reverse, limit, offset)]
+
+    def prefix(self, prefix, reverse=False, limit=None, offset=0):
+        """
+        Return a sorted list of column/value tuples with columns starting with
+        prefix, paged in the same way as slice.
+        """
+        lower, upper = bisect_prefix(self._columns, prefix)
+
+        values = self._values
+        return [(col, values[col])
+                for col in page(self._columns, lower, upper, reverse, limit, offset)]
+
+    def to_dict(self):
+        """
+        Return the columns as a plain dict.
+        """
+        return dict(self._values)
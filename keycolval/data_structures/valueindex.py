@@ -0,0 +1,160 @@
+"""
+A secondary index from the values in a store to the cells which hold them.
+"""
+
+from keycolval.data_structures.keyindex import SortedKeyIndex
+from keycolval.instrumentation.metrics import NULL_METRICS
+from keycolval.stores.statistics import approximate_size
+
+
+# Approximate bytes of bookkeeping per distinct value (its dict entry and set)
+# and per indexed cell (its tuple and set entry), on top of the payload.
+VALUE_OVERHEAD_BYTES = 300
+CELL_OVERHEAD_BYTES = 100
+
+# Values which can be looked up by prefix, str and unicode on Python 2. Bytes
+# and text can't be ordered against each other on Python 3, so only text is.
+_STRING_TYPES = (str, type(u''))
+
+
+class ValueIndex(object):
+    """
+    Maps each value held in a store to the set of (key, column) pairs which
+    hold it, for exact lookups, and keeps the distinct string values in a
+    SortedKeyIndex for prefix lookups.
+
+    A ValueIndex given to a store as the value_index keyword argument is
+    attached to it and kept up to date by every data altering call, in the
+    same places as the store's KeyStatisticsCatalog, so it's rebuilt along
+    with the store when the data log is replayed. Values are indexed as they
+    were set, before any compression.
+    """
+
+    def __init__(self):
+        # value -> set of (key, column)
+        self._cells = {}
+        self._values = SortedKeyIndex()
+        self._count = 0
+        self.approximate_bytes = 0
+        self.compressor = None
+        self.metrics = NULL_METRICS
+
+    def __len__(self):
+        """
+        Return the number of indexed cells.
+        """
+        return self._count
+
+    def attach(self, store):
+        """
+        Start indexing the values of store.
+        """
+        self.compressor = store.compressor
+        self.metrics = store.metrics
+
+        self.metrics.register_gauge('keycolval_value_index_bytes',
+                                    lambda: self.approximate_bytes)
+
+    def find(self, val):
+        """
+        Return a sorted list of the (key, column) tuples holding val.
+        """
+        return sorted(self._cells.get(val, ()))
+
+    def find_prefix(self, prefix, limit=None):
+        """
+        Return a list of (value, key, column) tuples for the cells holding a
+        string value which starts with prefix, in value then key order and at
+        most limit long.
+        """
+        found = []
+
+        for val in self._values.prefix(prefix):
+            # The value may have been removed since the prefix was read.
+            for key, col in sorted(self._cells.get(val, ())):
+                if limit is not None and len(found) >= limit:
+                    return found
+
+                found.append((val, key, col))
+
+        return found
+
+    def usage(self):
+        """
+        Return a dict describing the index's size.
+        """
+        return {
+            'values': len(self._cells),
+            'cells': self._count,
+            'approximate_bytes': self.approximate_bytes,
+        }
+
+    def record_set(self, key, col, val, old_val):
+        """
+        Record that col in key was set to the stored value val, replacing
+        old_val, which is None for a new column.
+        """
+        if old_val is not None:
+            self._remove(key, col, self._original(old_val))
+
+        self._add(key, col, self._original(val))
+
+    def record_sets(self, key, changes):
+        """
+        Record a batch of columns set in key, where changes is a list of
+        (col, val, old_val) tuples as for record_set.
+        """
+        for col, val, old_val in changes:
+            self.record_set(key, col, val, old_val)
+
+    def record_delete(self, key, col, old_val):
+        """
+        Record that col, which held the stored value old_val, was removed
+        from key.
+        """
+        self._remove(key, col, self._original(old_val))
+
+    def record_deletes(self, key, removed):
+        """
+        Record a batch of (col, old_val) tuples removed from key.
+        """
+        for col, old_val in removed:
+            self.record_delete(key, col, old_val)
+
+    def _original(self, stored):
+        if self.compressor is not None:
+            return self.compressor.decompress(stored)
+        return stored
+
+    def _add(self, key, col, val):
+        cells = self._cells.get(val)
+
+        if cells is None:
+            cells = self._cells[val] = set()
+            self.approximate_bytes += approximate_size(val) + VALUE_OVERHEAD_BYTES
+
+            if isinstance(val, _STRING_TYPES):
+                self._values.add(val)
+
+        cells.add((key, col))
+        self._count += 1
+        self.approximate_bytes += (approximate_size(key) + approximate_size(col) +
+                                   CELL_OVERHEAD_BYTES)
+
+    def _remove(self, key, col, val):
+        cells = self._cells.get(val)
+
+        if cells is None or (key, col) not in cells:
+            return
+
+        cells.discard((key, col))
+        self._count -= 1
+        self.approximate_bytes -= (approximate_size(key) + approximate_size(col) +
+                                   CELL_OVERHEAD_BYTES)
+
+        if not cells:
+            del self._cells[val]
+            self.approximate_bytes -= approximate_size(val) + VALUE_OVERHEAD_BYTES
+
+            if isinstance(val, _STRING_TYPES):
+                self._values.discard(val)
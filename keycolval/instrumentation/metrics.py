@@ -0,0 +1,335 @@
+"""
+In-process metrics for KeyColValStore implementations, the QueryPersistor and
+the REST API.
+
+A MetricsRegistry collects counters, latency histograms and gauges which can
+be read back in-process with snapshot() or rendered in the Prometheus text
+exposition format with render_prometheus().
+
+Objects which are instrumented hold a reference to a registry in a `metrics`
+attribute. When no registry is configured they hold NULL_METRICS instead, a
+disabled registry which every instrumentation point checks first, so the
+only cost paid on the hot path is an attribute lookup and a boolean test.
+"""
+
+import threading
+from functools import wraps
+from timeit import default_timer
+
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+                   0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Upper bounds of the histogram buckets used for column counts.
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+class Histogram(object):
+    """
+    A cumulative histogram with fixed bucket boundaries.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        Record a single observation.
+        """
+        self.count += 1
+        self.sum += value
+
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+                break
+
+    def cumulative_counts(self):
+        """
+        Return a list of (upper_bound, count) tuples where each count includes
+        all observations in the lower buckets, as Prometheus expects.
+        """
+        cumulative = []
+        running_total = 0
+
+        for upper_bound, count in zip(self.buckets, self.counts):
+            running_total += count
+            cumulative.append((upper_bound, running_total))
+
+        return cumulative
+
+
+class MetricsRegistry(object):
+    """
+    A thread safe collection of named counters, histograms and gauges.
+
+    Every metric is identified by its name plus an optional set of labels
+    which are passed as keyword arguments, e.g.
+
+        registry.inc('keycolval_store_operations_total', operation='set')
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._gauge_callbacks = {}
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increment a counter.
+        """
+        metric_key = (name, _label_tuple(labels))
+
+        with self._lock:
+            self._counters[metric_key] = self._counters.get(metric_key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Record an observation in a histogram.
+        """
+        metric_key = (name, _label_tuple(labels))
+
+        with self._lock:
+            histogram = self._histograms.get(metric_key)
+
+            if histogram is None:
+                histogram = self._histograms[metric_key] = Histogram(buckets)
+
+            histogram.observe(value)
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set a gauge to an explicit value.
+        """
+        with self._lock:
+            self._gauges[(name, _label_tuple(labels))] = value
+
+    def register_gauge(self, name, callback, **labels):
+        """
+        Register a gauge whose value is computed by calling callback whenever
+        the registry is read. This keeps the cost of gauges such as the store
+        size off of the hot path entirely.
+        """
+        with self._lock:
+            self._gauge_callbacks[(name, _label_tuple(labels))] = callback
+
+    def observe_operation(self, operation, elapsed):
+        """
+        Record a single store operation and how long it took.
+        """
+        self.inc('keycolval_store_operations_total', operation=operation)
+        self.observe('keycolval_store_operation_seconds', elapsed,
+                     operation=operation)
+
+    def observe_slice(self, columns_scanned, columns_returned):
+        """
+        Record how many columns a slice had to look at compared to how many
+        columns it actually returned.
+        """
+        self.observe('keycolval_slice_columns_scanned', columns_scanned,
+                     buckets=COUNT_BUCKETS)
+        self.observe('keycolval_slice_columns_returned', columns_returned,
+                     buckets=COUNT_BUCKETS)
+
+    def reset(self):
+        """
+        Drop all recorded values. Registered gauge callbacks are kept.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._gauges.clear()
+
+    def _gauge_values(self):
+        """
+        Return a dict of every gauge value, evaluating gauge callbacks.
+        """
+        with self._lock:
+            gauges = dict(self._gauges)
+            callbacks = list(self._gauge_callbacks.items())
+
+        # Callbacks are evaluated outside of the lock as they may be slow.
+        for metric_key, callback in callbacks:
+            gauges[metric_key] = callback()
+
+        return gauges
+
+    def snapshot(self):
+        """
+        Return a plain dict copy of every metric for in-process consumers.
+
+        Metric names map to a list of dicts each containing the metric labels
+        along with the value of the metric for those labels.
+        """
+        gauges = self._gauge_values()
+
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(metric_key, histogram.count, histogram.sum,
+                           histogram.cumulative_counts())
+                          for metric_key, histogram in self._histograms.items()]
+
+        snapshot = {}
+
+        for (name, labels), value in counters + list(gauges.items()):
+            snapshot.setdefault(name, []).append({'labels': dict(labels),
+                                                  'value': value})
+
+        for (name, labels), count, total, buckets in histograms:
+            snapshot.setdefault(name, []).append({'labels': dict(labels),
+                                                  'count': count,
+                                                  'sum': total,
+                                                  'buckets': buckets})
+
+        return snapshot
+
+    def render_prometheus(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        gauges = self._gauge_values()
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((metric_key, histogram.count, histogram.sum,
+                                 histogram.cumulative_counts())
+                                for metric_key, histogram in self._histograms.items())
+
+        lines = []
+
+        _render_simple(lines, 'counter', counters)
+        _render_simple(lines, 'gauge', sorted(gauges.items()))
+
+        described = set()
+
+        for (name, labels), count, total, buckets in histograms:
+            if name not in described:
+                lines.append('# TYPE %s histogram' % name)
+                described.add(name)
+
+            for upper_bound, bucket_count in buckets:
+                bucket_labels = labels + (('le', repr(float(upper_bound))),)
+                lines.append('%s_bucket%s %s' % (name, _format_labels(bucket_labels),
+                                                 bucket_count))
+
+            lines.append('%s_bucket%s %s' % (name, _format_labels(labels + (('le', '+Inf'),)),
+                                             count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(float(total))))
+            lines.append('%s_count%s %s' % (name, _format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetricsRegistry(MetricsRegistry):
+    """
+    A registry which is never enabled and discards everything it is given,
+    including gauge callbacks so that it doesn't keep stores alive.
+    """
+
+    def __init__(self):
+        super(NullMetricsRegistry, self).__init__(enabled=False)
+
+    def inc(self, name, amount=1, **labels):
+        """ discards the increment """
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """ discards the observation """
+
+    def set_gauge(self, name, value, **labels):
+        """ discards the gauge value """
+
+    def register_gauge(self, name, callback, **labels):
+        """ discards the gauge callback """
+
+
+# Instrumented objects reference this registry when metrics have not been
+# configured.
+NULL_METRICS = NullMetricsRegistry()
+
+
+def instrument(func):
+    """
+    The instrument decorator records a call counter and a latency histogram for
+    a method of an object with a `metrics` attribute, named after the method.
+
+    If the object also has a `slow_query_log` (see
+    keycolval.instrumentation.profiling.SlowQueryLog) the call is offered to
+    it as well.
+
+    When the object's registry is disabled and it has no slow query log the
+    method is called directly.
+    """
+    operation = func.__name__
+
+    @wraps(func)
+    def wrapper(obj, *args, **kwargs):
+        """
+        inner function wrapper
+        """
+        metrics = obj.metrics
+        slow_query_log = obj.slow_query_log
+
+        if not metrics.enabled and slow_query_log is None:
+            return func(obj, *args, **kwargs)
+
+        start_time = default_timer()
+        result = None
+
+        try:
+            result = func(obj, *args, **kwargs)
+            return result
+        finally:
+            # Calls which raise are counted and timed as well.
+            elapsed = default_timer() - start_time
+
+            if metrics.enabled:
+                metrics.observe_operation(operation, elapsed)
+
+            if slow_query_log is not None:
+                slow_query_log.record(operation, args, result, elapsed)
+
+    return wrapper
+
+
+def _label_tuple(labels):
+    """
+    Convert a labels dict into a hashable, consistently ordered tuple.
+    """
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    """
+    Format a label tuple as a Prometheus label set.
+    """
+    if not labels:
+        return ''
+
+    escaped = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                            .replace('"', '\\"')
+                                            .replace('\n', '\\n'))
+               for name, value in labels]
+
+    return '{%s}' % ','.join(escaped)
+
+
+def _render_simple(lines, metric_type, metrics):
+    """
+    Append counters or gauges to a list of Prometheus exposition lines.
+    """
+    described = set()
+
+    for (name, labels), value in metrics:
+        if name not in described:
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            described.add(name)
+
+        lines.append('%s%s %s' % (name, _format_labels(labels), value))
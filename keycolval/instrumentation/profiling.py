@@ -0,0 +1,161 @@
+"""
+Opt-in runtime profiling for a live server.
+
+SamplingProfiler runs cProfile over a configurable fraction of requests and
+aggregates the samples into a single report. The sample rate can be changed
+at any time, and a rate of 0 disables the profiler.
+
+SlowQueryLog records store reads which take longer than a threshold along with
+the key, the range and the number of columns involved, which is what is needed
+to find the giant keys behind latency spikes.
+"""
+
+import cProfile
+import logging
+import pstats
+import random
+import threading
+import time
+from collections import deque
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+slow_query_logger = logging.getLogger('keycolval.slow_queries')
+
+
+class SamplingProfiler(object):
+    """
+    Profile a random sample of units of work (usually requests) with cProfile
+    and aggregate the results.
+
+    Usage:
+
+        profile = profiler.start()
+        ... do some work ...
+        profiler.stop(profile)
+
+    start() returns None when the unit of work was not sampled, in which
+    case stop() does nothing.
+    """
+
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.samples = 0
+
+        self._lock = threading.Lock()
+        self._stats = None
+
+    def start(self):
+        """
+        Start profiling the current thread if it is picked for sampling.
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Only one profiler may be active at a time on some Python
+            # versions, so we skip samples which overlap.
+            return None
+
+        return profile
+
+    def stop(self, profile):
+        """
+        Stop a profile returned by start and add it to the aggregate.
+        """
+        if profile is None:
+            return
+
+        profile.disable()
+
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile, stream=StringIO())
+            else:
+                self._stats.add(profile)
+
+            self.samples += 1
+
+    def reset(self):
+        """
+        Discard all aggregated samples.
+        """
+        with self._lock:
+            self._stats = None
+            self.samples = 0
+
+    def report(self, sort='cumulative', limit=50):
+        """
+        Return the aggregated profile as text, sorted by the given pstats key.
+        """
+        with self._lock:
+            if self._stats is None:
+                return 'No samples collected (sample rate %s).\n' % self.sample_rate
+
+            stream = StringIO()
+            self._stats.stream = stream
+            self._stats.sort_stats(sort).print_stats(limit)
+
+        return 'Aggregated %s sampled profiles.\n%s' % (self.samples, stream.getvalue())
+
+
+class SlowQueryLog(object):
+    """
+    A bounded in-memory log of store reads which exceeded a time threshold.
+
+    Entries are also written to the keycolval.slow_queries logger.
+    """
+
+    def __init__(self, threshold=0.1, max_entries=1000,
+                 operations=('get_slice', 'get_key')):
+        # Threshold in seconds. None disables the log.
+        self.threshold = threshold
+        self.operations = frozenset(operations)
+
+        self._entries = deque(maxlen=max_entries)
+
+    def record(self, operation, args, result, elapsed):
+        """
+        Record an operation if it is one we track and it was slow. args are
+        the positional args the store method was called with.
+        """
+        if (self.threshold is None or elapsed < self.threshold or
+                operation not in self.operations):
+            return
+
+        entry = {
+            'operation': operation,
+            'key': args[0] if args else None,
+            'start': args[1] if len(args) > 1 else None,
+            'stop': args[2] if len(args) > 2 else None,
+            'columns': len(result) if result is not None else 0,
+            'elapsed': elapsed,
+            'timestamp': time.time(),
+        }
+
+        # deque.append is atomic so no lock is needed here.
+        self._entries.append(entry)
+
+        slow_query_logger.warning('%(operation)s key=%(key)r start=%(start)r '
+                                  'stop=%(stop)r columns=%(columns)s '
+                                  'elapsed=%(elapsed).6fs', entry)
+
+    def entries(self):
+        """
+        Return a list of the logged entries, slowest first.
+        """
+        return sorted(self._entries, key=lambda entry: entry['elapsed'], reverse=True)
+
+    def clear(self):
+        """
+        Remove all logged entries.
+        """
+        self._entries.clear()
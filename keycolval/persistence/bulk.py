@@ -0,0 +1,459 @@
+"""
+Bulk import and export of a store's cells.
+
+The text formats hold one cell per line:
+
+    csv     key,column,value            (what generate_data.py writes)
+    tsv     key<TAB>column<TAB>value
+    jsonl   {"key": ..., "column": ..., "value": ...} or [key, column, value]
+
+A dump starts with DUMP_MAGIC and holds a ('set_columns', key, [[column,
+value], ...]) record (see records.py) for every key, each followed by an
+('expire', key, column, expire_at) record for every one of its cells which
+expires, and ends with an ('end', cell count) record. Dumps keep values byte
+for byte and expiry times, which the text formats only do for text and don't
+do at all.
+
+Imports read the input in chunks of whole lines and parse each chunk,
+optionally in a pool of worker processes, into the rows of every key it
+holds. Each key's columns are sorted and written with a single set_columns
+call, which is logged as one record, rather than a set call per row.
+
+Exports are consistent and leave out the cells which have expired as of the
+export. Where os.fork is available they're encoded by a child
+process from a copy-on-write image of the store, as snapshots are, and
+streamed back through a pipe, so writes carry on meanwhile. Elsewhere the
+store's write lock is held until the export has been read.
+"""
+
+import csv
+import io
+import json
+import multiprocessing
+import os
+import signal
+from time import time
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+
+from keycolval.persistence.records import CorruptRecordError
+from keycolval.persistence.records import encode_record
+from keycolval.persistence.records import read_records
+
+
+DUMP_MAGIC = b'KCVDMP1\n'
+
+FORMATS = ('csv', 'tsv', 'jsonl', 'dump')
+
+_EXTENSIONS = {
+    '.csv': 'csv',
+    '.tsv': 'tsv',
+    '.jsonl': 'jsonl',
+    '.json': 'jsonl',
+    '.dump': 'dump',
+}
+
+# Bytes of input parsed at a time.
+CHUNK_BYTES = 4 << 20
+# Bytes read at a time from an export process.
+EXPORT_READ_BYTES = 1 << 16
+
+# The text type, unicode on Python 2 and str on Python 3.
+_TEXT_TYPE = type(u'')
+# On Python 2 str is bytes and is what csv reads and writes.
+_PY2 = str is bytes
+
+
+def guess_format(file_path):
+    """
+    Return the format of a file from its extension.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+
+    if extension not in _EXTENSIONS:
+        raise ValueError('Cannot tell the format of %s, it must be one of %s.'
+                         % (file_path, ', '.join(FORMATS)))
+
+    return _EXTENSIONS[extension]
+
+
+def import_file(store, file_path, file_format=None, processes=1, chunk_bytes=CHUNK_BYTES):
+    """
+    Import the cells in a file into store and return the number of cells
+    written. The format is guessed from the file's extension unless it's given.
+    """
+    with open(file_path, 'rb') as input_file:
+        return import_stream(store, input_file, file_format or guess_format(file_path),
+                             processes, chunk_bytes)
+
+
+def import_stream(store, stream, file_format, processes=1, chunk_bytes=CHUNK_BYTES):
+    """
+    Import the cells read from a binary stream into store and return the
+    number of cells written, which counts a column again when it's set again
+    further on in the input. Raises ValueError if the input can't be parsed,
+    after importing what came before the problem. With processes above one
+    the text formats are parsed by a pool of that many worker processes
+    while the store is loaded.
+    """
+    if file_format not in FORMATS:
+        raise ValueError('Unknown format %r.' % file_format)
+
+    if file_format == 'dump':
+        return _import_dump(store, stream)
+
+    chunks = iter_chunks(stream, chunk_bytes, quoted=file_format != 'jsonl')
+    cells = 0
+
+    if processes <= 1:
+        for chunk in chunks:
+            cells += _load_groups(store, parse_chunk((chunk, file_format)))
+
+        return cells
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        # A couple of chunks per worker are parsed ahead of the one being
+        # loaded, which bounds the memory used to the chunks in flight.
+        pending = deque()
+
+        for chunk in chunks:
+            pending.append(pool.apply_async(parse_chunk, ((chunk, file_format),)))
+
+            if len(pending) >= 2 * processes:
+                cells += _load_groups(store, pending.popleft().get())
+
+        while pending:
+            cells += _load_groups(store, pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return cells
+
+
+def iter_chunks(stream, chunk_bytes=CHUNK_BYTES, quoted=False):
+    """
+    Generate chunks of about chunk_bytes of whole lines read from a binary
+    stream. With quoted, chunks only end at line breaks outside of double
+    quotes, as quoted CSV fields may contain line breaks.
+    """
+    rest = b''
+
+    while True:
+        data = stream.read(chunk_bytes)
+
+        if not data:
+            if rest:
+                yield rest
+            return
+
+        data = rest + data
+        cut = _last_line_end(data, quoted)
+
+        if cut is None:
+            rest = data
+        else:
+            yield data[:cut]
+            rest = data[cut:]
+
+
+def _last_line_end(data, quoted):
+    """
+    Return the offset just after the last line break in data which isn't
+    inside quotes, or None if there is none.
+    """
+    if not quoted or b'"' not in data:
+        index = data.rfind(b'\n')
+        return None if index == -1 else index + 1
+
+    # Escaped quotes are doubled, so a line leaves a quoted field open if it
+    # holds an odd number of quotes.
+    cut = None
+    offset = 0
+    inside = False
+
+    for line in data.split(b'\n')[:-1]:
+        offset += len(line) + 1
+        inside ^= line.count(b'"') % 2 == 1
+
+        if not inside:
+            cut = offset
+
+    return cut
+
+
+def parse_chunk(args):
+    """
+    Parse a (chunk, format) pair into a list of (key, columns) tuples, where
+    columns is the sorted list of the key's column/value tuples. Later rows
+    for the same column win. This runs in the worker processes.
+    """
+    chunk, file_format = args
+    keys = {}
+
+    for key, col, val in _parse_rows(chunk, file_format):
+        columns = keys.get(key)
+
+        if columns is None:
+            columns = keys[key] = {}
+
+        columns[col] = val
+
+    return [(key, sorted(columns.items(), key=itemgetter(0)))
+            for key, columns in keys.items()]
+
+
+def _parse_rows(chunk, file_format):
+    """
+    Generate the (key, column, value) rows of a chunk.
+    """
+    if file_format == 'jsonl':
+        for line in chunk.splitlines():
+            if not line.strip():
+                continue
+
+            row = json.loads(line.decode('utf-8'))
+
+            if isinstance(row, dict):
+                yield row['key'], row['column'], row['value']
+            else:
+                key, col, val = row
+                yield key, col, val
+
+        return
+
+    lines = io.BytesIO(chunk) if _PY2 else io.StringIO(chunk.decode('utf-8'), newline='')
+    delimiter = '\t' if file_format == 'tsv' else ','
+
+    for row in csv.reader(lines, delimiter=delimiter):
+        if not row:
+            continue
+
+        if len(row) != 3:
+            raise ValueError('Expected a key, column and value but got %r.' % (row,))
+
+        yield row[0], row[1], row[2]
+
+
+def _load_groups(store, groups):
+    cells = 0
+
+    for key, columns in groups:
+        store.set_columns(key, columns)
+        cells += len(columns)
+
+    return cells
+
+
+def _import_dump(store, stream):
+    if stream.read(len(DUMP_MAGIC)) != DUMP_MAGIC:
+        raise ValueError('The input is not a keycolval dump.')
+
+    cells = 0
+
+    try:
+        for parts in read_records(stream):
+            if parts[0] == 'set_columns':
+                store.set_columns(parts[1], parts[2])
+                cells += len(parts[2])
+            elif parts[0] == 'expire':
+                store.expire(parts[1], parts[2], float(parts[3]))
+            elif parts[0] == 'end':
+                if int(parts[1]) != cells:
+                    raise ValueError('The dump holds %d cells rather than %s.'
+                                     % (cells, parts[1]))
+                return cells
+    except CorruptRecordError as error:
+        raise ValueError('The dump is corrupt: %s' % error)
+
+    raise ValueError('The dump ends before its end record.')
+
+
+def export_file(store, file_path, file_format=None):
+    """
+    Write a consistent export of store to a file and return the number of
+    bytes written. The format is guessed from the file's extension unless
+    it's given.
+    """
+    with open(file_path, 'wb') as output_file:
+        return export_stream(store, output_file, file_format or guess_format(file_path))
+
+
+def export_stream(store, stream, file_format):
+    """
+    Write a consistent export of store to a binary stream and return the
+    number of bytes written.
+    """
+    written = 0
+
+    for chunk in iter_export(store, file_format):
+        stream.write(chunk)
+        written += len(chunk)
+
+    return written
+
+
+def iter_export(store, file_format):
+    """
+    Return an iterator over the chunks of bytes of an export of store, as of
+    this call. The iterator must be read to the end or closed.
+    """
+    if file_format not in FORMATS:
+        raise ValueError('Unknown format %r.' % file_format)
+
+    if not hasattr(os, 'fork'):
+        return _iter_locked_export(store, file_format)
+
+    read_fd, write_fd = os.pipe()
+
+    # Holding the write lock while forking gives the child a consistent image
+    # of the store, as of the data log offset the export is encoded as of.
+    with store.write_lock:
+        log_offset = _log_offset(store)
+        now = time()
+        pid = os.fork()
+
+        if pid == 0:
+            # The child writes the export and exits without running any of
+            # the parent's cleanup.
+            status = 1
+            try:
+                os.close(read_fd)
+
+                with os.fdopen(write_fd, 'wb') as pipe:
+                    for chunk in _encode_store(store, file_format, log_offset, now):
+                        pipe.write(chunk)
+
+                status = 0
+            finally:
+                os._exit(status)
+
+    os.close(write_fd)
+    return _read_export(pid, read_fd)
+
+
+def _read_export(pid, read_fd):
+    """
+    Generate the chunks an export process writes to its pipe.
+    """
+    completed = False
+
+    try:
+        with os.fdopen(read_fd, 'rb') as pipe:
+            for chunk in iter(lambda: pipe.read(EXPORT_READ_BYTES), b''):
+                yield chunk
+
+        completed = True
+    finally:
+        if not completed:
+            # The reader gave up, so the rest of the export isn't wanted.
+            os.kill(pid, signal.SIGKILL)
+
+        status = os.waitpid(pid, 0)[1]
+
+    if status != 0:
+        raise IOError('The export process failed.')
+
+
+def _iter_locked_export(store, file_format):
+    with store.write_lock:
+        for chunk in _encode_store(store, file_format, _log_offset(store), time()):
+            yield chunk
+
+
+def _log_offset(store):
+    """
+    Return the offset the store's data log ends at, or None if it isn't
+    persisted.
+    """
+    log_offset = getattr(store.query_persistor, 'log_offset', None)
+    return log_offset() if log_offset is not None else None
+
+
+def _encode_store(store, file_format, log_offset, now):
+    """
+    Generate the chunks of bytes of the export of every key in store, leaving
+    out the cells which have expired by the unix time now.
+    """
+    groups = groupby(store.iter_all_cells(log_offset), key=itemgetter(0))
+    compressor = store.compressor
+    expiry = store.expiry
+    cells = 0
+
+    if file_format == 'dump':
+        yield DUMP_MAGIC
+
+    for key, key_cells in groups:
+        columns = [(col, val) for key, col, val in key_cells]
+        expire_times = expiry.columns(key)
+        expirations = []
+
+        if expire_times:
+            # Expired cells are left out and dumps carry the expiry times of
+            # the others.
+            live_columns = []
+
+            for col, val in columns:
+                expire_at = expire_times.get(col)
+
+                if expire_at is None:
+                    live_columns.append((col, val))
+                elif expire_at > now:
+                    live_columns.append((col, val))
+                    expirations.append((col, expire_at))
+
+            columns = live_columns
+
+            if not columns:
+                continue
+
+        if compressor is not None:
+            columns = compressor.decompress_items(columns)
+
+        cells += len(columns)
+        yield _encode_key(key, columns, file_format)
+
+        if file_format == 'dump' and expirations:
+            yield b''.join(encode_record(['expire', key, col, expire_at])
+                           for col, expire_at in expirations)
+
+    if file_format == 'dump':
+        yield encode_record(['end', cells])
+
+
+def _encode_key(key, columns, file_format):
+    """
+    Encode the columns of a key in one of the formats.
+    """
+    if file_format == 'dump':
+        return encode_record(['set_columns', key, columns])
+
+    if file_format == 'jsonl':
+        lines = [json.dumps({'key': key, 'column': col, 'value': _text(val)}) + '\n'
+                 for col, val in columns]
+        return ''.join(lines).encode('utf-8')
+
+    lines = io.BytesIO() if _PY2 else io.StringIO()
+    writer = csv.writer(lines, delimiter='\t' if file_format == 'tsv' else ',',
+                        lineterminator='\n')
+    writer.writerows((_text(key), _text(col), _text(val)) for col, val in columns)
+    data = lines.getvalue()
+
+    return data if _PY2 else data.encode('utf-8')
+
+
+def _text(value):
+    """
+    Return a value as the string type the text formats write.
+    """
+    if _PY2:
+        return value.encode('utf-8') if isinstance(value, _TEXT_TYPE) else str(value)
+
+    if isinstance(value, bytes):
+        # Only dumps keep bytes values intact.
+        return value.decode('utf-8', 'replace')
+
+    return value if isinstance(value, str) else str(value)
@@ -0,0 +1,179 @@
+"""
+A feed of the changes made to a store, which downstream consumers read to
+keep in sync with it instead of polling its keys.
+
+The persist decorator publishes the changes each data altering call made
+right after the call is logged to the data log, holding the store's write
+lock, so changes are numbered in the same order as the data log. A change is
+a tuple of its sequence number, its type and the arguments of that type:
+
+    (sequence, 'set', key, column, value)
+    (sequence, 'delete', key, column)
+    (sequence, 'delete_key', key)
+    (sequence, 'delete_slice', key, start, stop)
+
+Cells which expire are deleted with logged deletes, so they show up as
+delete changes when they're removed.
+
+The feed keeps the last capacity changes in memory, whatever the number of
+consumers, so a slow consumer costs nothing until it falls so far behind that
+the changes after its position are gone. Reading from there raises
+ChangesExpiredError and the consumer has to start again from a copy of the
+store, such as an export. Sequence numbers start from 1 again whenever the
+store is started, so consumers pass back the feed's epoch, which changes at
+the same time, to find out.
+"""
+
+import threading
+from collections import deque
+from itertools import islice
+from time import time
+
+from keycolval.instrumentation.metrics import NULL_METRICS
+
+
+# The longest a read may wait for changes, in seconds.
+MAX_WAIT = 30.0
+
+
+class ChangesExpiredError(Exception):
+    """
+    Exception raised when a consumer reads a ChangeFeed from a position
+    whose following changes are no longer held, or from another epoch.
+    """
+
+
+def call_changes(func_name, args, result):
+    """
+    Return the list of changes made by a data altering call with the given
+    name, args and result.
+    """
+    if func_name in ('set', 'set_until'):
+        return [('set', args[0], args[1], args[2])]
+
+    if func_name == 'set_columns':
+        return [('set', args[0], col, val) for col, val in args[1]]
+
+    if func_name == 'compare_and_set':
+        return [('set', args[0], args[1], args[3])] if result else []
+
+    if func_name == 'increment':
+        # The new value is returned as an int and stored as text.
+        return [('set', args[0], args[1], str(result))]
+
+    if func_name == 'append':
+        return [('set', args[0], args[1], result)]
+
+    if func_name == 'delete':
+        return [('delete', args[0], args[1])]
+
+    if func_name == 'delete_slice':
+        return [('delete_slice', args[0], args[1], args[2])] if result else []
+
+    if func_name == 'delete_key':
+        return [('delete_key', args[0])]
+
+    # expire only changes the cell once it expires, which is a delete.
+    return []
+
+
+class ChangeFeed(object):
+    """
+    Holds the last capacity changes made to a store in a ring buffer and
+    lets any number of consumers read them from a sequence number onwards,
+    waiting for new changes if there are none.
+
+    A ChangeFeed given to a store as the change_feed keyword argument is
+    attached to it and published to by the persist decorator. Calls replayed
+    from the data log aren't published.
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.epoch = '%x' % int(time() * 1000000)
+        self.last_sequence = 0
+        self.metrics = NULL_METRICS
+
+        # (sequence, type, args...) tuples, oldest first.
+        self._changes = deque(maxlen=capacity)
+        self._condition = threading.Condition()
+
+    def attach(self, store):
+        """
+        Start taking the changes made to store.
+        """
+        self.metrics = store.metrics
+
+        self.metrics.register_gauge('keycolval_change_feed_sequence',
+                                    lambda: self.last_sequence)
+
+    def publish(self, changes):
+        """
+        Number a list of changes, add them to the feed and wake up the
+        consumers waiting for changes.
+        """
+        if not changes:
+            return
+
+        with self._condition:
+            for change in changes:
+                self.last_sequence += 1
+                self._changes.append((self.last_sequence,) + change)
+
+            self._condition.notify_all()
+
+        if self.metrics.enabled:
+            self.metrics.inc('keycolval_change_feed_changes_total', len(changes))
+
+    def read(self, after=0, key=None, prefix=None, limit=1000, wait=0, epoch=None):
+        """
+        Return a list of at most limit of the changes numbered after the
+        sequence number after, only those on key or on keys starting with
+        prefix if either is given, and the sequence number to read on from
+        next time. Waits up to wait seconds (at most MAX_WAIT) for a change
+        if there are none.
+
+        Raises ChangesExpiredError if some of the changes after after are no
+        longer held, or if epoch is given and isn't the feed's epoch.
+        """
+        if epoch is not None and epoch != self.epoch:
+            raise ChangesExpiredError('The feed has restarted since epoch %s.' % epoch)
+
+        deadline = time() + min(wait or 0, MAX_WAIT)
+
+        with self._condition:
+            while True:
+                changes, after = self._read(after, key, prefix, limit)
+                remaining = deadline - time()
+
+                if changes or remaining <= 0:
+                    return changes, after
+
+                self._condition.wait(remaining)
+
+    def _read(self, after, key, prefix, limit):
+        if after > self.last_sequence:
+            raise ChangesExpiredError('Sequence %d is ahead of the feed, which is at %d.'
+                                      % (after, self.last_sequence))
+
+        oldest = self._changes[0][0] if self._changes else self.last_sequence + 1
+
+        if after < oldest - 1:
+            raise ChangesExpiredError('The changes after %d are no longer held, the '
+                                      'oldest is %d.' % (after, oldest))
+
+        changes = []
+
+        # Sequence numbers are consecutive, so a change's position in the
+        # buffer follows from its number.
+        for change in islice(self._changes, after + 1 - oldest, None):
+            after = change[0]
+
+            if ((key is None or change[2] == key) and
+                    (prefix is None or change[2].startswith(prefix))):
+                changes.append(change)
+
+                if len(changes) >= limit:
+                    break
+
+        return changes, after
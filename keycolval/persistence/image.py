@@ -0,0 +1,319 @@
+"""
+A read-only image of a store's data laid out for lookups straight from a
+memory map, which lets any number of reader processes share a single copy of
+the data through the page cache.
+
+An image holds every key in sorted order and, for every key, its columns in
+sorted order, with all keys, columns and values encoded as data log fields
+(see records.py). Keys and columns are ordered by their encoded bytes, which
+for text is the same order as comparing the strings.
+
+    | header | key, columns and values ... | column tables ... | key directory |
+    | expiry times |
+
+The header holds IMAGE_MAGIC, the image version, the number of keys and the
+offsets of the key directory and of the expiry times. The key directory is an
+array of (key offset, column table offset) entries and each column table is a
+count followed by an array of (column offset, value offset) entries, so both
+can be bisected in place without building any Python objects besides the
+ones returned.
+
+The expiry times are a count followed by the key, column and expire_at of
+every expiring cell in the image. Readers load them into an ExpiryIndex when
+they map the image and skip the cells which have expired since it was
+written. Cells which had already expired aren't written at all.
+"""
+
+import mmap
+import os
+import struct
+from time import time
+
+from keycolval.data_structures.expiryindex import ExpiryIndex
+
+from keycolval.persistence.records import decode_field
+from keycolval.persistence.records import encode_field
+from keycolval.persistence.records import field_data
+
+
+IMAGE_MAGIC = b'KCVIMG2\n'
+
+_IMAGE_HEADER = struct.Struct('>8sQQQQ')
+_ENTRY = struct.Struct('>QQ')
+_COUNT = struct.Struct('>I')
+_EXPIRE_AT = struct.Struct('>d')
+
+# The text type, unicode on Python 2 and str on Python 3.
+_TEXT_TYPE = type(u'')
+
+
+def sort_bytes(value):
+    """
+    Return the bytes a key or column is ordered by in an image.
+    """
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, _TEXT_TYPE):
+        value = str(value)
+    return value.encode('utf-8') if isinstance(value, _TEXT_TYPE) else value
+
+
+def write_image(file_path, cells, version, expirations=()):
+    """
+    Write (key, column, value) tuples from cells and the (key, column,
+    expire_at) tuples of the expiring ones from expirations to an image at
+    file_path, leaving out the cells which have already expired.
+
+    The image is written to a temporary file which is renamed into place, so
+    readers only ever map complete images.
+    """
+    now = time()
+    expiring = {}
+
+    for key, col, expire_at in expirations:
+        expiring[(key, col)] = expire_at
+
+    keys = {}
+    live_expirations = []
+
+    for key, col, val in cells:
+        expire_at = expiring.get((key, col))
+
+        if expire_at is not None:
+            if expire_at <= now:
+                continue
+
+            live_expirations.append((key, col, expire_at))
+
+        keys.setdefault(key, []).append((col, val))
+
+    temp_path = '%s.tmp' % file_path
+    directory = []
+
+    with open(temp_path, 'wb') as image_file:
+        # The header is written again once the directory offset is known.
+        image_file.write(_IMAGE_HEADER.pack(IMAGE_MAGIC, 0, 0, 0, 0))
+        offset = _IMAGE_HEADER.size
+
+        for key in sorted(keys, key=sort_bytes):
+            key_field = encode_field(key)
+            image_file.write(key_field)
+            key_offset = offset
+            offset += len(key_field)
+
+            entries = []
+
+            for col, val in sorted(keys[key], key=lambda item: sort_bytes(item[0])):
+                col_field = encode_field(col)
+                val_field = encode_field(val)
+                image_file.write(col_field)
+                image_file.write(val_field)
+                entries.append(_ENTRY.pack(offset, offset + len(col_field)))
+                offset += len(col_field) + len(val_field)
+
+            table = _COUNT.pack(len(entries)) + b''.join(entries)
+            image_file.write(table)
+            directory.append(_ENTRY.pack(key_offset, offset))
+            offset += len(table)
+
+        image_file.write(b''.join(directory))
+        expiry_offset = offset + len(directory) * _ENTRY.size
+        image_file.write(_COUNT.pack(len(live_expirations)))
+
+        for key, col, expire_at in live_expirations:
+            image_file.write(encode_field(key) + encode_field(col) +
+                             _EXPIRE_AT.pack(expire_at))
+
+        image_file.seek(0)
+        image_file.write(_IMAGE_HEADER.pack(IMAGE_MAGIC, version, len(directory),
+                                            offset, expiry_offset))
+        image_file.flush()
+        os.fsync(image_file.fileno())
+
+    os.rename(temp_path, file_path)
+
+
+class ImageView(object):
+    """
+    Lookups on a memory mapped image. An ImageView of a missing or empty file
+    is an empty image with no version.
+
+    The file stays mapped for as long as the view exists, even if a newer
+    image has been renamed over it, so a view always sees one version. The
+    image's expiry times are held in an ExpiryIndex called expiry.
+    """
+
+    def __init__(self, file_path=None):
+        self.version = None
+        self.key_count = 0
+        self.expiry = ExpiryIndex()
+        self._buf = b''
+        self._directory_offset = 0
+
+        if file_path is None or not os.path.isfile(file_path):
+            return
+
+        with open(file_path, 'rb') as image_file:
+            if os.fstat(image_file.fileno()).st_size == 0:
+                return
+
+            self._buf = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, key_count, directory_offset, expiry_offset = \
+            _IMAGE_HEADER.unpack_from(self._buf, 0)
+
+        if magic != IMAGE_MAGIC:
+            raise ValueError('%s is not a keycolval image.' % file_path)
+
+        self.version = version
+        self.key_count = key_count
+        self._directory_offset = directory_offset
+        self._load_expiry(expiry_offset)
+
+    def _load_expiry(self, offset):
+        count = _COUNT.unpack_from(self._buf, offset)[0]
+        offset += _COUNT.size
+
+        for _ in range(count):
+            key, offset = decode_field(self._buf, offset)
+            col, offset = decode_field(self._buf, offset)
+            self.expiry.set(key, col, _EXPIRE_AT.unpack_from(self._buf, offset)[0])
+            offset += _EXPIRE_AT.size
+
+    def is_live(self, key, col, now):
+        """
+        Return whether a cell in the image hasn't expired by now.
+        """
+        expire_at = self.expiry.get(key, col)
+        return expire_at is None or expire_at > now
+
+    def _key_entry(self, index):
+        return _ENTRY.unpack_from(self._buf, self._directory_offset + index * _ENTRY.size)
+
+    def _key_bytes(self, index):
+        return field_data(self._buf, self._key_entry(index)[0])
+
+    def _column_entry(self, table, index):
+        return _ENTRY.unpack_from(self._buf, table + _COUNT.size + index * _ENTRY.size)
+
+    def _column_bytes(self, table, index):
+        return field_data(self._buf, self._column_entry(table, index)[0])
+
+    def key(self, index):
+        """
+        Return the key at index in the key directory.
+        """
+        return decode_field(self._buf, self._key_entry(index)[0])[0]
+
+    def keys(self, lower, upper):
+        """
+        Return the keys from lower to upper in the key directory.
+        """
+        return [self.key(index) for index in range(lower, upper)]
+
+    def key_bounds(self, start, stop):
+        """
+        Return the (lower, upper) indices of the keys between start and stop
+        inclusive. Either boundary may be None for an open range.
+        """
+        return _bisect_range(self._key_bytes, self.key_count, start, stop)
+
+    def find_key(self, key):
+        """
+        Return the offset of a key's column table or None if the key doesn't
+        exist.
+        """
+        needle = sort_bytes(key)
+        index = _bisect(self._key_bytes, 0, self.key_count, needle, False)
+
+        if index < self.key_count and self._key_bytes(index) == needle:
+            return self._key_entry(index)[1]
+
+        return None
+
+    def column_count(self, table):
+        return _COUNT.unpack_from(self._buf, table)[0]
+
+    def find_value(self, table, col):
+        """
+        Return the value of a column in a column table or None if the column
+        doesn't exist.
+        """
+        needle = sort_bytes(col)
+        count = self.column_count(table)
+        column_bytes = lambda index: self._column_bytes(table, index)
+        index = _bisect(column_bytes, 0, count, needle, False)
+
+        if index < count and column_bytes(index) == needle:
+            return decode_field(self._buf, self._column_entry(table, index)[1])[0]
+
+        return None
+
+    def column_bounds(self, table, start, stop):
+        """
+        Return the (lower, upper) indices of the columns between start and
+        stop inclusive in a column table.
+        """
+        return _bisect_range(lambda index: self._column_bytes(table, index),
+                             self.column_count(table), start, stop)
+
+    def prefix_bounds(self, table, prefix):
+        """
+        Return the (lower, upper) indices of the columns starting with prefix
+        in a column table.
+        """
+        needle = sort_bytes(prefix)
+        count = self.column_count(table)
+        column_bytes = lambda index: self._column_bytes(table, index)
+        lower = _bisect(column_bytes, 0, count, needle, False)
+
+        # The columns from lower onwards which start with prefix come first.
+        low, high = lower, count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if column_bytes(middle).startswith(needle):
+                low = middle + 1
+            else:
+                high = middle
+
+        return lower, low
+
+    def items(self, table, lower, upper, reverse=False):
+        """
+        Return the column/value tuples from lower to upper in a column table,
+        in descending order if reverse is set.
+        """
+        buf = self._buf
+        indices = range(upper - 1, lower - 1, -1) if reverse else range(lower, upper)
+        items = []
+
+        for index in indices:
+            col_offset, val_offset = self._column_entry(table, index)
+            items.append((decode_field(buf, col_offset)[0], decode_field(buf, val_offset)[0]))
+
+        return items
+
+
+def _bisect(entry_bytes, low, high, needle, right):
+    """
+    Bisect the entries low to high, ordered by entry_bytes(index), for needle
+    like bisect_left, or like bisect_right if right is set.
+    """
+    while low < high:
+        middle = (low + high) // 2
+        current = entry_bytes(middle)
+
+        if current < needle or (right and current == needle):
+            low = middle + 1
+        else:
+            high = middle
+
+    return low
+
+
+def _bisect_range(entry_bytes, count, start, stop):
+    lower = 0 if start is None else _bisect(entry_bytes, 0, count, sort_bytes(start), False)
+    upper = count if stop is None else _bisect(entry_bytes, 0, count, sort_bytes(stop), True)
+    return lower, max(lower, upper)
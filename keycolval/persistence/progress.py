@@ -0,0 +1,93 @@
+"""
+Progress reports for loading a data store, so that readiness checks made
+while a large data log is replayed can say how far it has got.
+"""
+
+from timeit import default_timer
+
+
+# The states a load goes through.
+PENDING = 'pending'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class LoadProgress(object):
+    """
+    How far loading a data store has got. The loader calls begin and finish,
+    and a QueryPersistor given it as the load_progress keyword argument of a
+    store reports each phase of the load: reading the snapshot, then
+    replaying the data log after it. Other threads read it with report.
+    """
+
+    def __init__(self):
+        self.state = PENDING
+        self.error = None
+        # The phase being loaded and the bytes of it loaded so far.
+        self.phase = None
+        self.phase_bytes = 0
+        self.phase_total_bytes = 0
+        # Snapshot and data log records loaded so far.
+        self.records = 0
+
+        self._start_time = None
+        self._end_time = None
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    def begin(self):
+        """
+        Note that the load has started.
+        """
+        self.state = LOADING
+        self._start_time = default_timer()
+
+    def enter_phase(self, phase, total_bytes):
+        """
+        Note that the load has moved on to phase, which is total_bytes long.
+        """
+        self.phase = phase
+        self.phase_bytes = 0
+        self.phase_total_bytes = total_bytes
+
+    def advance(self, phase_bytes, records):
+        """
+        Note that phase_bytes of the current phase and records records in all
+        have been loaded.
+        """
+        self.phase_bytes = phase_bytes
+        self.records = records
+
+    def finish(self, error=None):
+        """
+        Note that the load has finished, or failed with error.
+        """
+        self.state = READY if error is None else FAILED
+        self.error = error
+        self.phase = None
+        self._end_time = default_timer()
+
+    def report(self):
+        """
+        Return a dict describing the load for a readiness check.
+        """
+        if self._start_time is None:
+            seconds = 0.0
+        else:
+            seconds = (self._end_time or default_timer()) - self._start_time
+
+        report = {'state': self.state, 'ready': self.ready, 'records': self.records,
+                  'seconds': round(seconds, 3)}
+
+        if self.phase is not None:
+            report['phase'] = self.phase
+            report['phase_bytes'] = self.phase_bytes
+            report['phase_total_bytes'] = self.phase_total_bytes
+
+        if self.error is not None:
+            report['error'] = '%s: %s' % (type(self.error).__name__, self.error)
+
+        return report
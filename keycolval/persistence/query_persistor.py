@@ -1,4 +1,49 @@
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+from functools import wraps
+from itertools import groupby
+from operator import itemgetter
 from os.path import isfile
+from timeit import default_timer
+
+from keycolval.data_structures.compressedvalue import CompressedValue
+from keycolval.instrumentation.metrics import NULL_METRICS
+from keycolval.persistence.changefeed import call_changes
+from keycolval.persistence.image import write_image
+from keycolval.persistence.records import CorruptRecordError
+from keycolval.persistence.records import LOG_MAGIC
+from keycolval.persistence.records import MappedLog
+from keycolval.persistence.records import encode_record
+from keycolval.persistence.records import has_intact_records
+from keycolval.persistence.records import is_framed_log
+from keycolval.persistence.records import scan_records
+from keycolval.persistence.records import truncate_log
+from keycolval.persistence.snapshot import iterate_snapshot
+from keycolval.persistence.snapshot import read_key_records
+from keycolval.persistence.snapshot import read_snapshot_offset
+from keycolval.persistence.snapshot import snapshot_path
+from keycolval.persistence.snapshot import write_snapshot
+
+
+logger = logging.getLogger('keycolval.persistence')
+
+# Logged calls whose last argument is a value to store, which is written to
+# the data log compressed when the persisted object has a ValueCompressor.
+COMPRESSED_VALUE_CALLS = ('set', 'compare_and_set')
+
+# Logged calls which only set the value of a single cell, which are coalesced
+# when the QueryPersistor has a coalesce_window.
+COALESCED_CALLS = ('set', 'compare_and_set', 'increment', 'append')
+
+# Cells held for coalescing after which they're written out early.
+COALESCE_MAX_CELLS = 10000
+
+# Replayed records between reports to a LoadProgress.
+PROGRESS_EVERY = 1000
 
 class QueryPersistorNotInitializedError(Exception):
     """
@@ -17,32 +62,284 @@ class QueryPersistor(object):
 
     QueryPersistor is only effective when initialized in the persisted objects
     __init__ function and when that object has @persist decorated functions.
+
+    Function calls are written as checksummed records (see records.py). When
+    the data log is opened any torn or corrupt records at the end of it, left
+    by a crash in the middle of a write, are truncated away after replaying
+    every record before them. Data logs in the old CSV format are converted.
+
+    snapshot() writes the persisted object's cells to a snapshot file in the
+    background, along with the data log offset it's consistent with. When a
+    snapshot exists only the data log after that offset has to be replayed.
+    With snapshot_every set a snapshot is started automatically every
+    snapshot_every records. With image_path set every snapshot also publishes
+    an image there for SharedImageKeyColValStore readers, and with
+    publish_interval set as well publish_image writes just the image in the
+    same way at most every publish_interval seconds after a logged write, so
+    readers don't wait for the next snapshot to see writes.
+
+    With coalesce_window set the calls in COALESCED_CALLS aren't logged as
+    they're made. The persist decorator hands the cell value each one leaves
+    to coalesce instead, which holds the latest value of every cell in memory
+    and writes them out as a set_columns record per key once the oldest has
+    been held for coalesce_window seconds, or once coalesce_max_cells cells
+    are held. A cell set a thousand times in the window is logged once.
+    Before any other call on a key is logged the key's held cells are written,
+    and flush and log_offset write all of them first, so snapshots, exports
+    and recovered keys miss nothing and replay gives the same state. The price
+    is durability: a crash loses the cells held at the time, up to
+    coalesce_window seconds of writes to them, besides what the data log
+    file's buffer holds. Held cells are written when the persisted object is
+    dropped and when the process exits normally.
+
+    With load_progress set to a LoadProgress the progress of loading the
+    snapshot and replaying the data log is reported to it as they run.
     """
-    def __init__(self, data_file_path, persisted_obj):
+    def __init__(self, data_file_path, persisted_obj, snapshot_every=None,
+                 image_path=None, publish_interval=None, coalesce_window=None,
+                 coalesce_max_cells=COALESCE_MAX_CELLS, load_progress=None):
         """
         Initialize a QueryPersistor object.
         """
+        # Report log activity to the persisted object's metrics registry if
+        # it has one.
+        self.metrics = getattr(persisted_obj, 'metrics', NULL_METRICS)
+
+        # Use the persisted object's ValueCompressor, if it has one, for the
+        # values written to the log.
+        self.compressor = getattr(persisted_obj, 'compressor', None)
+
+        # What the last load found, for reporting.
+        self.replayed_records = 0
+        self.truncated_bytes = 0
+        self.snapshot_records = 0
+
+        # A weak reference avoids a reference cycle with the persisted
+        # object, which would delay closing the data log.
+        self._persisted_obj = weakref.ref(persisted_obj)
+        self.snapshot_path = snapshot_path(data_file_path)
+        self.snapshot_every = snapshot_every
+        self.image_path = image_path
+        self._records_since_snapshot = 0
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_pid = None
+        self._snapshot_offset = None
+        # Whether the background write in progress is a full snapshot or
+        # only publishes the image.
+        self._writing_snapshot = False
+        # The data log offset of the last snapshot known to have completed,
+        # and of the last image published.
+        self.last_snapshot_offset = None
+        self.published_offset = None
+        self.publish_interval = publish_interval
+
+        # key -> {column: value} of the cells held for coalescing, and when
+        # the oldest of them was set.
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_cells = coalesce_max_cells
+        self._coalesced = {}
+        self._coalesced_cells = 0
+        self._coalesced_since = None
+
+        self.load_progress = load_progress
+
         # Start by loading an already existing data into
-        # the object being persisted.
-        self._load_data(data_file_path, persisted_obj)
+        # the object being persisted. The persisted object can tell replayed
+        # calls apart by its replaying attribute.
+        persisted_obj.replaying = True
+        try:
+            self._load_data(data_file_path, persisted_obj)
+        finally:
+            persisted_obj.replaying = False
         # Open up the data file in append mode so we don't
         # overwrite out previously stored data.
-        self.query_log_file = open(data_file_path, 'a')
+        self.query_log_file = open(data_file_path, 'ab')
+
+        if self.query_log_file.tell() == 0:
+            self.query_log_file.write(LOG_MAGIC)
+
+        if image_path is not None and publish_interval:
+            ImagePublisher(self, publish_interval).start()
+
+        if coalesce_window:
+            CoalescedCellWriter(self, coalesce_window).start()
+            _coalescing_persistors.add(self)
 
     def __call__(self, *args, **kwargs):
         """
         Callable which persists whatever is passed in as args in a format
         that can be later deserialized.
         """
-        # In case we are handed objects we cast everything to a string.
-        # This only works for objects that can be cleanly serialized with
-        # bytestring casting. Since our current usage is only strings
-        # this is fine.
-        query_parts = [str(part) for part in args]
-        # We are using CSV for serialization format.
-        query_log = ','.join(query_parts)
-        # Write newline delimited lines to the data log file.
-        self.query_log_file.write('%s\n' % query_log)
+        if self._coalesced and len(args) > 1 and args[1] in self._coalesced:
+            # The key's held cells come first so that replay sees the call
+            # after them, as it was made.
+            self._write_coalesced_key(args[1])
+
+        self._write(args)
+
+    def __del__(self):
+        # Held cells go out with the rest of the data log file's buffer when
+        # the persisted object is dropped. Nothing else can reach them now.
+        if getattr(self, '_coalesced', None) and hasattr(self, 'query_log_file'):
+            self.snapshot_every = None
+
+            for key in list(self._coalesced):
+                self._write_coalesced_key(key)
+
+    def coalesce(self, key, col, val):
+        """
+        Hold the value a coalesced call left in a cell, replacing any value
+        held for it already, to be logged later.
+        """
+        columns = self._coalesced.get(key)
+
+        if columns is None:
+            columns = self._coalesced[key] = {}
+
+        if col in columns:
+            if self.metrics.enabled:
+                self.metrics.inc('keycolval_log_coalesced_writes_total')
+        else:
+            self._coalesced_cells += 1
+
+        columns[col] = val
+
+        if self._coalesced_since is None:
+            self._coalesced_since = default_timer()
+        elif (self._coalesced_cells >= self.coalesce_max_cells or
+              default_timer() - self._coalesced_since >= self.coalesce_window):
+            self.write_coalesced()
+
+    def write_coalesced(self):
+        """
+        Log every cell held for coalescing.
+        """
+        persisted_obj = self._persisted_obj()
+
+        if persisted_obj is None:
+            return
+
+        with persisted_obj.write_lock:
+            for key in list(self._coalesced):
+                self._write_coalesced_key(key)
+
+    def coalesced_age(self):
+        """
+        Return the seconds the oldest cell held for coalescing has been held
+        for, or None if none are.
+        """
+        since = self._coalesced_since
+        return None if since is None else default_timer() - since
+
+    def _write_coalesced_key(self, key):
+        columns = self._coalesced.pop(key)
+        self._coalesced_cells -= len(columns)
+
+        if not self._coalesced:
+            # The window starts again with the next cell held.
+            self._coalesced_since = None
+
+        if self.compressor is not None:
+            columns = [(col, self.compressor.compress(val)) for col, val in columns.items()]
+        else:
+            columns = list(columns.items())
+
+        self._write(('set_columns', key, sorted(columns, key=itemgetter(0))))
+
+    def _write(self, args):
+        """
+        Append a logged call to the data log.
+        """
+        if self.compressor is not None and args and args[0] in COMPRESSED_VALUE_CALLS:
+            # The value is the last argument of these calls. The compressor
+            # remembers the value the persisted object just compressed so it
+            # doesn't have to be compressed again.
+            args = args[:-1] + (self.compressor.compress(args[-1]),)
+
+        record = encode_record(args)
+        # Write the framed record to the data log file.
+        self.query_log_file.write(record)
+
+        if self.metrics.enabled:
+            self.metrics.inc('keycolval_log_records_written_total')
+            self.metrics.inc('keycolval_log_bytes_written_total', len(record))
+
+        if self.snapshot_every:
+            # The call being logged has already been applied, so a snapshot
+            # started here matches the data log up to the current end.
+            self._records_since_snapshot += 1
+
+            # Cells held for coalescing are written by snapshot itself, in
+            # which case the snapshot lock is held and the next record
+            # starts the snapshot instead.
+            if (self._records_since_snapshot >= self.snapshot_every and
+                    not self._snapshot_lock.locked()):
+                self.snapshot()
+
+    def flush(self):
+        """
+        Flush buffered log records, after the cells held for coalescing,
+        out to the data log file.
+        """
+        if self._coalesced:
+            self.write_coalesced()
+
+        if not self.metrics.enabled:
+            self.query_log_file.flush()
+            return
+
+        start_time = default_timer()
+        self.query_log_file.flush()
+        self.metrics.observe('keycolval_log_flush_seconds', default_timer() - start_time)
+
+    def log_offset(self):
+        """
+        Flush the data log and return the offset it ends at.
+        """
+        self.flush()
+        return self.query_log_file.tell()
+
+    def iterate_key_records(self, keys, end_offset=None):
+        """
+        Generate the logged calls on the given set of keys, from the snapshot
+        if there is one and then from the data log up to end_offset, which
+        defaults to the current end of the data log. Replaying them rebuilds
+        those keys as they were at end_offset.
+
+        This reads through the whole snapshot and data log, so it's only
+        meant for recovering keys which are rarely needed.
+        """
+        self.flush()
+        log_offset = len(LOG_MAGIC)
+
+        if isfile(self.snapshot_path):
+            snapshot_offset, calls = read_key_records(self.snapshot_path, keys)
+
+            if snapshot_offset is not None:
+                log_offset = snapshot_offset
+
+                for query_parts in calls:
+                    yield query_parts
+
+        with MappedLog(self.query_log_file.name) as buf:
+            for offset, end, query_parts in scan_records(buf, log_offset):
+                if end_offset is not None and end > end_offset:
+                    return
+
+                if len(query_parts) > 1 and query_parts[1] in keys:
+                    yield query_parts
+
+    def replay_keys(self, target, keys, end_offset=None):
+        """
+        Replay the logged calls on the given set of keys, up to end_offset,
+        on target, which is usually a new, empty store.
+        """
+        target.replaying = True
+        try:
+            for query_parts in self.iterate_key_records(keys, end_offset):
+                _replay(target, query_parts)
+        finally:
+            target.replaying = False
 
     def _load_data(self, file_path, persisted_obj):
         """
@@ -50,27 +347,403 @@ class QueryPersistor(object):
         the series of function calls that were persisted on the object in order.
         """
         # Check that there is a file or this operation is meaningless.
-        if isfile(file_path):
-            data_file = open(file_path, 'r')
-            
-            for query in data_file:
-                # We strip newlines and split on commas.
-                # This implementation is fragile because it will break if the data
-                # persisted contains newlines.
-                query_parts = query.strip('\n').split(',')
-                
-                # The function name is always the first data point.
-                func_name = query_parts[0]
-                # Everything else is function args.
-                args = query_parts[1:]
+        if not isfile(file_path) or os.path.getsize(file_path) == 0:
+            return
+
+        start_time = default_timer()
+
+        if is_framed_log(file_path):
+            log_offset = self._load_snapshot(file_path, persisted_obj)
+            self._replay_framed_log(file_path, persisted_obj, log_offset)
+        else:
+            self._migrate_csv_log(file_path, persisted_obj)
+
+        if self.metrics.enabled:
+            self.metrics.inc('keycolval_log_records_replayed_total', self.replayed_records)
+            self.metrics.inc('keycolval_log_truncated_bytes_total', self.truncated_bytes)
+            self.metrics.observe('keycolval_log_replay_seconds', default_timer() - start_time)
+
+    def _load_snapshot(self, file_path, persisted_obj):
+        """
+        Load the data log's snapshot, if it has a usable one, into the
+        persisted object. Returns the data log offset to replay from.
+        """
+        if not isfile(self.snapshot_path):
+            return len(LOG_MAGIC)
+
+        log_offset = read_snapshot_offset(self.snapshot_path)
+
+        if log_offset is None or log_offset > os.path.getsize(file_path):
+            # The snapshot is damaged or belongs to a data log which has since
+            # been replaced, so it can't be trusted.
+            logger.warning('Ignoring snapshot %s which does not match %s.',
+                           self.snapshot_path, file_path)
+            return len(LOG_MAGIC)
+
+        progress = self.load_progress
+        # Snapshot records are read through a generator which doesn't say
+        # where they end, so the bytes loaded are only counted at the end.
+        snapshot_size = os.path.getsize(self.snapshot_path)
+
+        if progress is not None:
+            progress.enter_phase('snapshot', snapshot_size)
+
+        # A snapshot holds the cells of each key together, so they're loaded
+        # with a set_columns call per key, which the stores apply as a batch.
+        for (func_name, key), calls in groupby(iterate_snapshot(self.snapshot_path),
+                                               key=itemgetter(0, 1)):
+            calls = list(calls)
+
+            if func_name == 'set':
+                _replay(persisted_obj, ['set_columns', key, [call[2:] for call in calls]])
+            else:
+                for query_parts in calls:
+                    _replay(persisted_obj, query_parts)
+
+            self.snapshot_records += len(calls)
+
+            if progress is not None:
+                progress.records = self.snapshot_records
+
+        if progress is not None:
+            progress.advance(snapshot_size, self.snapshot_records)
+
+        self.last_snapshot_offset = log_offset
+        return log_offset
+
+    def _replay_framed_log(self, file_path, persisted_obj, log_offset):
+        """
+        Replay every valid record from log_offset onwards in a framed data log
+        in one sequential pass over a memory map of the file and truncate
+        whatever follows them if it's a torn tail.
+
+        Raises CorruptRecordError if intact records follow the first invalid
+        one, as truncating would throw them away. The log has to be repaired
+        with the verify_log script first.
+        """
+        valid_end = log_offset
+        progress = self.load_progress
+
+        with MappedLog(file_path) as buf:
+            size = len(buf)
+
+            if progress is not None:
+                progress.enter_phase('log', size - log_offset)
+
+            for offset, end, query_parts in scan_records(buf, log_offset):
+                _replay(persisted_obj, query_parts)
+                valid_end = end
+                self.replayed_records += 1
+
+                if progress is not None and self.replayed_records % PROGRESS_EVERY == 0:
+                    progress.advance(end - log_offset,
+                                     self.snapshot_records + self.replayed_records)
+
+            if progress is not None:
+                progress.advance(valid_end - log_offset,
+                                 self.snapshot_records + self.replayed_records)
+
+            if valid_end < size and has_intact_records(buf, valid_end):
+                raise CorruptRecordError(
+                    '%s has a corrupt record at byte %d with intact records after it. '
+                    'Check it with python -m keycolval.scripts.verify_log verify %s and '
+                    'repair it with repair, or repair --salvage to keep the intact '
+                    'records.' % (file_path, valid_end, file_path))
+
+        if valid_end < size:
+            # Everything after the last valid record is the remains of a
+            # write which was cut short, so it was never acknowledged.
+            self.truncated_bytes = size - valid_end
+            logger.warning('Truncating %d bytes of torn or corrupt records from the '
+                           'end of %s after %d valid records.',
+                           self.truncated_bytes, file_path, self.replayed_records)
+            truncate_log(file_path, valid_end)
 
-                # Call the function on the persisted object passing in the args.
-                getattr(persisted_obj, func_name)(*args)
+    def _migrate_csv_log(self, file_path, persisted_obj):
+        """
+        Replay a data log written in the old newline delimited CSV format and
+        rewrite it as a framed data log.
+        """
+        temp_path = '%s.migrate' % file_path
+
+        with open(file_path, 'r') as data_file:
+            with open(temp_path, 'wb') as framed_file:
+                framed_file.write(LOG_MAGIC)
+
+                for query in data_file:
+                    if not query.endswith('\n'):
+                        # A torn final line from a crash mid-write.
+                        self.truncated_bytes = len(query)
+                        break
+
+                    # We strip newlines and split on commas.
+                    query_parts = query[:-1].split(',')
+
+                    _replay(persisted_obj, query_parts)
+                    framed_file.write(encode_record(query_parts))
+                    self.replayed_records += 1
+
+                framed_file.flush()
+                os.fsync(framed_file.fileno())
+
+        os.rename(temp_path, file_path)
+        logger.info('Converted %s to the framed data log format.', file_path)
+
+
+    def snapshot(self, wait=False):
+        """
+        Start writing a snapshot of the persisted object. Returns False if a
+        snapshot is already being written.
+
+        Where os.fork is available the snapshot is written by a child process
+        which sees a copy-on-write image of the parent's memory, so writes
+        carry on while it runs and only pay for copying the pages they touch.
+        Elsewhere the snapshot is written before this returns. With wait the
+        call blocks until the snapshot, or the one already being written, is
+        complete.
+        """
+        return self._write_in_background(True, wait)
+
+    def publish_image(self, wait=False):
+        """
+        Start publishing an image of the persisted object to image_path
+        without writing a snapshot, in the same way as snapshot. Returns False
+        if a snapshot or image is already being written.
+        """
+        return self._write_in_background(False, wait)
+
+    def needs_publishing(self):
+        """
+        Return True if calls have been logged since the last image was
+        published.
+        """
+        return bool(self._coalesced) or self.query_log_file.tell() != self.published_offset
+
+    def _write_in_background(self, snapshot, wait):
+        """
+        Start writing a snapshot, or with snapshot False only the image, of
+        the persisted object in a forked child, see snapshot.
+        """
+        persisted_obj = self._persisted_obj()
+
+        # Holding the write lock while forking makes the child's image of the
+        # persisted object match the data log up to log_offset.
+        with persisted_obj.write_lock, self._snapshot_lock:
+            self._reap_snapshot(block=False)
+
+            if self._snapshot_pid is not None:
+                if not wait:
+                    return False
+
+                # Wait for the write which is already in progress. It does
+                # instead unless it only publishes the image and a snapshot
+                # was asked for.
+                covered = self._writing_snapshot or not snapshot
+                self._reap_snapshot(block=True)
+
+                if covered:
+                    return False
+
+            if snapshot:
+                self._records_since_snapshot = 0
+
+            log_offset = self.log_offset()
+            self._writing_snapshot = snapshot
+
+            if not hasattr(os, 'fork'):
+                self._write_snapshot(persisted_obj, log_offset, snapshot)
+                self._snapshot_finished(log_offset, True)
+                return True
+
+            start_time = default_timer()
+            pid = os.fork()
+
+            if pid == 0:
+                # The child writes the snapshot and exits without running any
+                # of the parent's cleanup, such as flushing its buffers.
+                status = 1
+                try:
+                    self._write_snapshot(persisted_obj, log_offset, snapshot)
+                    status = 0
+                finally:
+                    os._exit(status)
+
+            if self.metrics.enabled:
+                self.metrics.observe('keycolval_snapshot_fork_seconds',
+                                     default_timer() - start_time)
+
+            self._snapshot_pid = pid
+            self._snapshot_offset = log_offset
+
+            if wait:
+                self._reap_snapshot(block=True)
+
+        return True
+
+    def _write_snapshot(self, persisted_obj, log_offset, snapshot=True):
+        """
+        Write the snapshot, unless snapshot is False, and the image if there is
+        an image_path, of the persisted object as of log_offset.
+        """
+        expiry = getattr(persisted_obj, 'expiry', None)
+
+        if snapshot:
+            write_snapshot(self.snapshot_path, persisted_obj.iter_all_cells(log_offset),
+                           log_offset, expiry.items() if expiry is not None else ())
+
+        if self.image_path is not None:
+            write_image(self.image_path, persisted_obj.iter_all_cells(log_offset), log_offset,
+                        expiry.items() if expiry is not None else ())
+
+    def snapshot_in_progress(self):
+        """
+        Return True if a snapshot is being written in the background.
+        """
+        with self._snapshot_lock:
+            self._reap_snapshot(block=False)
+            return self._snapshot_pid is not None
+
+    def _reap_snapshot(self, block):
+        """
+        Collect the exit status of a finished snapshot process.
+        """
+        if self._snapshot_pid is None:
+            return
+
+        pid, status = os.waitpid(self._snapshot_pid, 0 if block else os.WNOHANG)
+
+        if pid == 0:
+            # Still running.
+            return
 
-            # Cleanup by closing the file.
-            data_file.close()
+        self._snapshot_pid = None
+        self._snapshot_finished(self._snapshot_offset, status == 0)
 
+    def _snapshot_finished(self, log_offset, succeeded):
+        """
+        Record the outcome of a snapshot or image publication.
+        """
+        if not succeeded:
+            logger.error('Writing %s failed.', self.snapshot_path if self._writing_snapshot
+                         else self.image_path)
+        else:
+            if self._writing_snapshot:
+                self.last_snapshot_offset = log_offset
+
+            if self.image_path is not None:
+                self.published_offset = log_offset
+
+        if self.metrics.enabled:
+            self.metrics.inc('keycolval_snapshots_total' if self._writing_snapshot
+                             else 'keycolval_images_published_total',
+                             status='succeeded' if succeeded else 'failed')
+
+
+class CoalescedCellWriter(threading.Thread):
+    """
+    A daemon thread which logs the cells a QueryPersistor holds for
+    coalescing once they've been held for its coalesce_window, so that cells
+    which stop being written are still logged in time. It only holds a weak
+    reference to the persistor and stops once the persistor is gone.
+    """
+
+    def __init__(self, query_persistor, interval):
+        threading.Thread.__init__(self, name='keycolval-coalesced-cell-writer')
+        self.daemon = True
+
+        self._query_persistor = weakref.ref(query_persistor)
+        self.interval = interval
+
+    def run(self):
+        while True:
+            query_persistor = self._query_persistor()
+
+            if query_persistor is None:
+                return
+
+            age = query_persistor.coalesced_age()
+
+            if age is not None and age >= query_persistor.coalesce_window:
+                query_persistor.write_coalesced()
+                age = None
+
+            # Wake up when the oldest held cell is due, and don't keep the
+            # persistor alive while waiting.
+            wait = self.interval - (age or 0)
+            del query_persistor
+            time.sleep(wait)
+
+
+class ImagePublisher(threading.Thread):
+    """
+    A daemon thread which has a QueryPersistor publish a new image every
+    interval seconds if calls were logged since the last one, which bounds
+    how far behind the writer SharedImageKeyColValStore readers can be. It
+    only holds a weak reference to the persistor and stops once the
+    persistor is gone.
+    """
+
+    def __init__(self, query_persistor, interval):
+        threading.Thread.__init__(self, name='keycolval-image-publisher')
+        self.daemon = True
+
+        self._query_persistor = weakref.ref(query_persistor)
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            query_persistor = self._query_persistor()
+
+            if query_persistor is None or query_persistor._persisted_obj() is None:
+                return
+
+            # snapshot_in_progress also collects a finished publication, which
+            # records the offset it published.
+            if (not query_persistor.snapshot_in_progress() and
+                    query_persistor.needs_publishing()):
+                query_persistor.publish_image()
 
+            del query_persistor
+
+
+# The QueryPersistors with a coalesce_window, whose held cells are written
+# when the process exits normally.
+_coalescing_persistors = weakref.WeakSet()
+
+
+def _write_coalesced_at_exit():
+    for query_persistor in list(_coalescing_persistors):
+        if query_persistor._persisted_obj() is not None:
+            query_persistor.flush()
+
+
+atexit.register(_write_coalesced_at_exit)
+
+
+def _replay(persisted_obj, query_parts):
+    """
+    Replay a single logged function call on the persisted object.
+    """
+    # The function name is always the first data point.
+    func_name = query_parts[0]
+    # Everything else is function args.
+    args = query_parts[1:]
+
+    if func_name == 'set_columns':
+        values = [val for col, val in args[-1]]
+    else:
+        values = args[-1:]
+
+    if (any(isinstance(val, CompressedValue) for val in values) and
+            getattr(persisted_obj, 'compressor', None) is None):
+        raise ValueError('The data log contains compressed values so the store '
+                         'must be opened with the ValueCompressor that wrote them.')
+
+    # Call the function on the persisted object passing in the args.
+    # Compressed values are passed through still compressed so they're only
+    # decompressed if they're read from the store.
+    getattr(persisted_obj, func_name)(*args)
 
 
 def persist(func):
@@ -81,7 +754,24 @@ def persist(func):
 
     It works by storing the data alter function's name and the args that were passed
     to that function so that the actions can be replayed at a later time.
+
+    Decorated calls hold the persisted object's write_lock (an RLock) and are only
+    logged once they have succeeded, so the data log order is the order the calls
+    were applied in and calls which raise aren't replayed. Calls made from inside
+    another decorated call aren't logged themselves, so an operation built out of
+    several others is logged and replayed as a single record.
+
+    If the persisted object has a before_persisted_call method it's called with the
+    name and args of every outermost call before the call runs. Any decorated calls
+    it makes are logged ahead of the call, and if it raises the call doesn't run.
+
+    A QueryPersistor with a coalesce_window is handed the cell values left by the
+    calls in COALESCED_CALLS to coalesce instead of the calls themselves.
+
+    If the persisted object has a change_feed the changes each logged call made are
+    published to it straight after the call is logged, except while replaying.
     """
+    @wraps(func)
     def wrapper(obj, *args, **kwargs):
         """
         inner function wrapper
@@ -95,13 +785,38 @@ def persist(func):
                        does not have a query_persistor attribute available."
             raise QueryPersistorNotInitializedError(message)
 
-        # Persist the function call.
-        # Note: This call is going to block for every data altering function call
-        # on the persisted object. If write speed becomes important the QueryPersistor
-        # should be updated to buffer data and write to disk using non-blocking means.
-        obj.query_persistor(func.__name__, *args)
+        with obj.write_lock:
+            if getattr(obj, '_persisting', False):
+                # Part of an outer call which is logged as a whole.
+                return func(obj, *args, **kwargs)
+
+            before_persisted_call = getattr(obj, 'before_persisted_call', None)
+
+            if before_persisted_call is not None:
+                before_persisted_call(func.__name__, args)
+
+            obj._persisting = True
+
+            try:
+                # Call the original function.
+                result = func(obj, *args, **kwargs)
+            finally:
+                obj._persisting = False
+
+            # Persist the function call, or with a coalescing QueryPersistor
+            # just the cell value it leaves.
+            if (func.__name__ in COALESCED_CALLS and
+                    getattr(obj.query_persistor, 'coalesce_window', None)):
+                for change in call_changes(func.__name__, args, result):
+                    obj.query_persistor.coalesce(*change[1:])
+            else:
+                obj.query_persistor(func.__name__, *args)
+
+            change_feed = getattr(obj, 'change_feed', None)
+
+            if change_feed is not None and not getattr(obj, 'replaying', False):
+                change_feed.publish(call_changes(func.__name__, args, result))
 
-        # Call the original function.
-        return func(obj, *args, **kwargs)
+        return result
 
     return wrapper
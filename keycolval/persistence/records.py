@@ -0,0 +1,392 @@
+"""
+The on-disk format of the QueryPersistor data log.
+
+A data log starts with LOG_MAGIC and is followed by a sequence of records.
+Every record is framed with a header made of a two byte sync marker, the
+length of the payload and the CRC32 of the payload:
+
+    | RECORD_MARKER (2) | payload length (4) | payload crc32 (4) | payload |
+
+The payload is the function name followed by the function args, each encoded
+as a one byte type tag, a four byte length and the data. A list field's data
+is its items encoded the same way. Lengths and
+checksums are big-endian unsigned ints.
+
+Framing means values may contain commas, newlines or any other bytes, and a
+record which was only partially written when the process died (a torn write)
+is detected by its length or checksum instead of being replayed. The sync
+marker lets repair_log find the records which follow a corrupted one.
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+from keycolval.data_structures.compressedvalue import CompressedValue
+
+
+LOG_MAGIC = b'KCVLOG1\n'
+RECORD_MARKER = b'\xa5\x5a'
+
+_RECORD_HEADER = struct.Struct('>2sII')
+_FIELD_HEADER = struct.Struct('>cI')
+
+# Field type tags.
+TEXT_FIELD = b's'
+BYTES_FIELD = b'b'
+COMPRESSED_TEXT_FIELD = b'z'
+COMPRESSED_BYTES_FIELD = b'Z'
+NONE_FIELD = b'n'
+LIST_FIELD = b'l'
+
+# The text type, unicode on Python 2 and str on Python 3.
+_TEXT_TYPE = type(u'')
+# On Python 2 str is bytes, which is written as text as well.
+_PY2 = str is bytes
+
+
+class CorruptRecordError(Exception):
+    """
+    Exception raised when a record can't be decoded even though its checksum
+    matched, which means it was written by an incompatible version, or when
+    a data log has a corrupt record in the middle rather than a torn tail.
+    """
+
+
+def encode_record(parts):
+    """
+    Encode a sequence of parts (a function name and its args) as a framed
+    record.
+    """
+    payload = b''.join(encode_field(part) for part in parts)
+    return _RECORD_HEADER.pack(RECORD_MARKER, len(payload),
+                               zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def encode_field(part):
+    """
+    Encode a single part of a record with its type tag.
+    """
+    if part is None:
+        tag, data = NONE_FIELD, b''
+    elif isinstance(part, (list, tuple)):
+        # Nested fields, such as the column/value pairs of a multi-column write.
+        tag = LIST_FIELD
+        data = b''.join(encode_field(item) for item in part)
+    elif isinstance(part, CompressedValue):
+        tag = COMPRESSED_TEXT_FIELD if part.text else COMPRESSED_BYTES_FIELD
+        data = part.data
+    elif isinstance(part, bytes):
+        # On Python 2 this is a str, which we treat as text.
+        tag = TEXT_FIELD if _PY2 else BYTES_FIELD
+        data = part
+    else:
+        # In case we are handed objects we cast everything else to text.
+        # Floats, such as expiry times, use repr which round trips exactly
+        # on Python 2 as well.
+        if isinstance(part, float):
+            part = repr(part)
+        elif not isinstance(part, _TEXT_TYPE):
+            part = str(part)
+
+        tag = TEXT_FIELD
+        data = part.encode('utf-8') if isinstance(part, _TEXT_TYPE) else part
+
+    return _FIELD_HEADER.pack(tag, len(data)) + data
+
+
+def decode_field(buf, offset):
+    """
+    Decode the field starting at buf[offset]. Returns the value and the
+    offset the field ends at.
+    """
+    tag, length = _FIELD_HEADER.unpack_from(buf, offset)
+    offset += _FIELD_HEADER.size
+    end = offset + length
+    data = buf[offset:end]
+
+    if tag == TEXT_FIELD:
+        return _decode_text(data), end
+    elif tag == BYTES_FIELD:
+        return data, end
+    elif tag == COMPRESSED_TEXT_FIELD:
+        return CompressedValue(data, True), end
+    elif tag == COMPRESSED_BYTES_FIELD:
+        return CompressedValue(data, False), end
+    elif tag == NONE_FIELD:
+        return None, end
+    elif tag == LIST_FIELD:
+        return decode_payload(data, 0, len(data)), end
+
+    raise CorruptRecordError('Unknown field type %r.' % tag)
+
+
+def _decode_text(data):
+    """
+    Decode the data of a text field back into text. On Python 2 a str which
+    wasn't UTF-8 was written as text too, and is given back as it was.
+    """
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        if not _PY2:
+            raise
+
+        return bytes(data)
+
+
+def field_data(buf, offset):
+    """
+    Return the raw data of the field starting at buf[offset] without
+    decoding it.
+    """
+    tag, length = _FIELD_HEADER.unpack_from(buf, offset)
+    offset += _FIELD_HEADER.size
+    return buf[offset:offset + length]
+
+
+def decode_payload(buf, start, end):
+    """
+    Decode the fields of a record payload found in buf[start:end].
+    """
+    parts = []
+    offset = start
+
+    while offset < end:
+        part, offset = decode_field(buf, offset)
+        parts.append(part)
+
+    if offset != end:
+        raise CorruptRecordError('Field lengths overrun the record.')
+
+    return parts
+
+
+def _valid_record_end(buf, offset, size):
+    """
+    Return the end offset of the record starting at offset if it's complete
+    and its checksum matches, otherwise None.
+    """
+    if offset + _RECORD_HEADER.size > size:
+        return None
+
+    marker, length, crc = _RECORD_HEADER.unpack_from(buf, offset)
+    start = offset + _RECORD_HEADER.size
+    end = start + length
+
+    if marker != RECORD_MARKER or end > size:
+        return None
+
+    if zlib.crc32(buf[start:end]) & 0xffffffff != crc:
+        return None
+
+    return end
+
+
+def scan_records(buf, offset=len(LOG_MAGIC)):
+    """
+    Generate (record_offset, record_end, parts) for each valid record in buf
+    from offset onwards, stopping at the end of buf or at the first record
+    which is incomplete or fails its checksum.
+
+    This is a single sequential pass over buf, which may be an mmap of the
+    data log so that nothing is copied besides the decoded fields.
+    """
+    size = len(buf)
+
+    while offset < size:
+        end = _valid_record_end(buf, offset, size)
+
+        if end is None:
+            return
+
+        yield offset, end, decode_payload(buf, offset + _RECORD_HEADER.size, end)
+        offset = end
+
+
+def read_records(stream):
+    """
+    Generate the parts of each record read from a file-like stream until the
+    stream ends. Unlike a data log a stream can't be truncated, so a record
+    which is incomplete or fails its checksum raises CorruptRecordError.
+    """
+    while True:
+        header = _read_exactly(stream, _RECORD_HEADER.size)
+
+        if not header:
+            return
+
+        if len(header) < _RECORD_HEADER.size:
+            raise CorruptRecordError('Incomplete record header.')
+
+        marker, length, crc = _RECORD_HEADER.unpack(header)
+        payload = _read_exactly(stream, length)
+
+        if (marker != RECORD_MARKER or len(payload) != length or
+                zlib.crc32(payload) & 0xffffffff != crc):
+            raise CorruptRecordError('Incomplete or corrupt record.')
+
+        yield decode_payload(payload, 0, length)
+
+
+def _read_exactly(stream, size):
+    """
+    Read size bytes from stream, or fewer if it ends first.
+    """
+    chunks = []
+
+    while size > 0:
+        chunk = stream.read(size)
+
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b''.join(chunks)
+
+
+class MappedLog(object):
+    """
+    Context manager which maps a data log file read-only. Empty files can't
+    be mapped so they give an empty bytes object instead.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def __enter__(self):
+        self._file = open(self.file_path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+
+        if size == 0:
+            self._map = None
+            return b''
+
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __exit__(self, *exc_info):
+        if self._map is not None:
+            self._map.close()
+
+        self._file.close()
+
+
+def is_framed_log(file_path):
+    """
+    Return True if the file starts with the framed log header.
+    """
+    with open(file_path, 'rb') as log_file:
+        return log_file.read(len(LOG_MAGIC)) == LOG_MAGIC
+
+
+def verify_log(file_path):
+    """
+    Check a data log without modifying it. Returns a dict with the number of
+    valid records, the offset the valid records end at, the file size and
+    the number of bytes after the valid records which recovery would drop.
+    Of those, the records which are still intact behind a corrupted record
+    are counted in salvageable_records.
+    """
+    with MappedLog(file_path) as buf:
+        if buf[:len(LOG_MAGIC)] != LOG_MAGIC:
+            raise ValueError('%s is not a framed keycolval data log.' % file_path)
+
+        records = 0
+        valid_end = len(LOG_MAGIC)
+
+        for offset, end, parts in scan_records(buf):
+            records += 1
+            valid_end = end
+
+        salvageable = sum(1 for record in _salvage_records(buf, valid_end))
+
+        return {
+            'records': records,
+            'valid_bytes': valid_end,
+            'file_size': len(buf),
+            'dropped_bytes': len(buf) - valid_end,
+            'salvageable_records': salvageable,
+        }
+
+
+def has_intact_records(buf, offset):
+    """
+    Return True if an intact record follows offset, in which case whatever
+    is at offset was corrupted in place rather than torn by a crash.
+    """
+    for record in _salvage_records(buf, offset):
+        return True
+
+    return False
+
+
+def _salvage_records(buf, offset):
+    """
+    Generate (offset, end) of every intact record after offset by searching
+    for the sync marker and checking each candidate's checksum.
+    """
+    size = len(buf)
+
+    while True:
+        offset = buf.find(RECORD_MARKER, offset)
+
+        if offset == -1:
+            return
+
+        end = _valid_record_end(buf, offset, size)
+
+        if end is None:
+            offset += 1
+        else:
+            yield offset, end
+            offset = end
+
+
+def repair_log(file_path, salvage=False):
+    """
+    Repair a data log by truncating everything after the last valid record,
+    which is what happens automatically when a store opens the log.
+
+    With salvage the intact records found after a corrupted region are kept
+    too, by rewriting the log. Only use this when the corruption isn't a
+    torn tail, as replaying records after a lost one may not be meaningful.
+
+    Returns the verify_log report from before the repair.
+    """
+    report = verify_log(file_path)
+
+    if not report['dropped_bytes']:
+        return report
+
+    if salvage and report['salvageable_records']:
+        temp_path = '%s.repair' % file_path
+
+        with MappedLog(file_path) as buf:
+            with open(temp_path, 'wb') as repaired:
+                repaired.write(buf[:report['valid_bytes']])
+
+                for offset, end in _salvage_records(buf, report['valid_bytes']):
+                    repaired.write(buf[offset:end])
+
+                repaired.flush()
+                os.fsync(repaired.fileno())
+
+        os.rename(temp_path, file_path)
+    else:
+        truncate_log(file_path, report['valid_bytes'])
+
+    return report
+
+
+def truncate_log(file_path, size):
+    """
+    Truncate a data log to size bytes and make sure it hits the disk.
+    """
+    with open(file_path, 'r+b') as log_file:
+        log_file.truncate(size)
+        log_file.flush()
+        os.fsync(log_file.fileno())
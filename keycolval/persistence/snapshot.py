@@ -0,0 +1,137 @@
+"""
+Snapshots of a persisted store, which let recovery skip replaying the part of
+the data log the snapshot already covers.
+
+A snapshot file starts with SNAPSHOT_MAGIC and holds records in the data log
+format (see records.py): a 'snapshot' record with the data log offset the
+snapshot is consistent with, a 'set' record for every cell, an 'expire' record
+for every expiring cell and an 'end' record with the number of cells. Snapshots are written to a temporary file which is
+renamed into place once complete, so an existing snapshot is never partial.
+"""
+
+import os
+
+from keycolval.persistence.records import MappedLog
+from keycolval.persistence.records import encode_record
+from keycolval.persistence.records import scan_records
+
+
+SNAPSHOT_MAGIC = b'KCVSNP1\n'
+
+
+def snapshot_path(data_file_path):
+    """
+    Return the path of the snapshot belonging to a data log.
+    """
+    return '%s.snapshot' % data_file_path
+
+
+def write_snapshot(file_path, cells, log_offset, expirations=()):
+    """
+    Write (key, column, value) tuples from cells and (key, column, expire_at)
+    tuples from expirations to a snapshot at file_path which is consistent
+    with the data log up to log_offset.
+    """
+    temp_path = '%s.tmp' % file_path
+    count = 0
+
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(SNAPSHOT_MAGIC)
+        snapshot_file.write(encode_record(['snapshot', log_offset]))
+
+        for key, col, val in cells:
+            snapshot_file.write(encode_record(['set', key, col, val]))
+            count += 1
+
+        for key, col, expire_at in expirations:
+            snapshot_file.write(encode_record(['expire', key, col, expire_at]))
+
+        snapshot_file.write(encode_record(['end', count]))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+    os.rename(temp_path, file_path)
+    return count
+
+
+def read_snapshot_offset(file_path):
+    """
+    Return the data log offset a snapshot is consistent with, or None if
+    file_path isn't a complete snapshot.
+
+    This reads through every record, which is far cheaper than replaying
+    them, so that a damaged snapshot is rejected before anything is loaded
+    from it.
+    """
+    with MappedLog(file_path) as buf:
+        if buf[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            return None
+
+        log_offset = None
+        count = 0
+        end_count = None
+
+        for offset, end, parts in scan_records(buf, len(SNAPSHOT_MAGIC)):
+            if parts[0] == 'snapshot':
+                log_offset = int(parts[1])
+            elif parts[0] == 'end':
+                end_count = int(parts[1])
+                break
+            elif parts[0] == 'set':
+                count += 1
+
+        if log_offset is None or end_count != count:
+            return None
+
+        return log_offset
+
+
+def iterate_snapshot(file_path):
+    """
+    Generate the logged function calls ('set', key, column, value) and
+    ('expire', key, column, expire_at) stored in a snapshot which
+    read_snapshot_offset accepted.
+    """
+    with MappedLog(file_path) as buf:
+        for offset, end, parts in scan_records(buf, len(SNAPSHOT_MAGIC)):
+            if parts[0] in ('set', 'expire'):
+                yield parts
+            elif parts[0] == 'end':
+                return
+
+
+def read_key_records(file_path, keys):
+    """
+    Return the data log offset a snapshot is consistent with along with a
+    list of its ('set', ...) and ('expire', ...) calls on the given keys, or
+    (None, []) if file_path isn't a complete snapshot.
+
+    The offset and the calls come from a single mapping of the file, so they
+    match even if a newer snapshot is renamed over it meanwhile.
+    """
+    with MappedLog(file_path) as buf:
+        if buf[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            return None, []
+
+        log_offset = None
+        count = 0
+        end_count = None
+        calls = []
+
+        for offset, end, parts in scan_records(buf, len(SNAPSHOT_MAGIC)):
+            if parts[0] == 'snapshot':
+                log_offset = int(parts[1])
+            elif parts[0] == 'end':
+                end_count = int(parts[1])
+                break
+            else:
+                if parts[0] == 'set':
+                    count += 1
+
+                if parts[1] in keys:
+                    calls.append(parts)
+
+        if log_offset is None or end_count != count:
+            return None, []
+
+        return log_offset, calls
@@ -0,0 +1,225 @@
+"""
+A client for the binary protocol in keycolval/rpc/protocol.py.
+
+An RPCClient holds one connection and may be shared between threads. Every
+KeyColValStore operation the protocol covers is a method of the client with
+the store's signature, e.g.
+
+    client = RPCClient('127.0.0.1', 5001)
+    client.set('key', 'column', 'value')
+    client.get_slice('key', 'a', 'm', limit=10)
+
+call_async sends a request and returns a PendingCall straight away, so many
+calls can be in flight on the connection at once, and batch runs a list of
+operations in a single round trip.
+
+There is no reader thread. Whichever thread is waiting for a response reads
+the next one off the connection and hands it to the call it answers, which
+saves a thread switch on every call.
+"""
+
+import inspect
+import socket
+import threading
+
+from keycolval.rpc.protocol import ERROR
+from keycolval.rpc.protocol import ERRORS
+from keycolval.rpc.protocol import OPERATIONS
+from keycolval.rpc.protocol import ProtocolError
+from keycolval.rpc.protocol import RemoteError
+from keycolval.rpc.protocol import encode_frame
+from keycolval.rpc.protocol import read_frame
+from keycolval.stores.abstract import KeyColValStore
+
+
+_MAX_REQUEST_ID = 0xffffffff
+
+_getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+
+
+class PendingCall(object):
+    """
+    A request sent by RPCClient.call_async whose response may not have
+    arrived yet.
+    """
+
+    def __init__(self, client, decode):
+        self.done = False
+        self._client = client
+        self._decode = decode
+        self._status = None
+        self._parts = None
+
+    def result(self):
+        """
+        Wait for the response and return the operation's result, or raise
+        the exception it raised.
+        """
+        self._client._wait(self)
+
+        if self._status == ERROR:
+            name, message = self._parts
+            raise ERRORS.get(name, RemoteError)(message if name in ERRORS
+                                                else '%s: %s' % (name, message))
+
+        return self._decode(self._parts[0])
+
+    def _resolve(self, status, parts):
+        self._status = status
+        self._parts = parts
+        self.done = True
+
+
+class RPCClient(object):
+    """
+    A connection to an RPCServer at (host, port). Operations raise the
+    exceptions in ERRORS as the store did, RemoteError for any other
+    exception raised on the server, and ProtocolError or socket.error if the
+    connection fails, after which the client can't be used.
+    """
+
+    def __init__(self, host='127.0.0.1', port=5001, timeout=None):
+        self._socket = socket.create_connection((host, port), timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._stream = self._socket.makefile('rb')
+
+        self._send_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        # request id -> PendingCall
+        self._pending = {}
+        self._last_id = 0
+        self._error = None
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        self._stream.close()
+        self._socket.close()
+
+    def call(self, operation, *args):
+        """
+        Run an operation on the server and return its result.
+        """
+        return self.call_async(operation, *args).result()
+
+    def call_async(self, operation, *args):
+        """
+        Send an operation to the server and return a PendingCall for its
+        result without waiting.
+        """
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown operation %r.' % operation)
+
+        return self._send([operation] + list(args), _decoder(operation))
+
+    def batch(self, operations):
+        """
+        Run a list of (operation, arg, ...) tuples on the server in one round
+        trip and return the list of their results. The operations run in
+        order and the exception raised by the first one which fails is
+        raised, after the operations before it have been applied.
+        """
+        calls = [list(call) for call in operations]
+
+        for call in calls:
+            if call[0] not in OPERATIONS:
+                raise ValueError('Unknown operation %r.' % call[0])
+
+        decoders = [_decoder(call[0]) for call in calls]
+
+        def decode(results):
+            return [decode_result(result) for decode_result, result in zip(decoders, results)]
+
+        return self._send(['batch', calls], decode).result()
+
+    def _send(self, parts, decode):
+        pending = PendingCall(self, decode)
+
+        with self._send_lock:
+            if self._error is not None:
+                raise self._error
+
+            self._last_id = self._last_id % _MAX_REQUEST_ID + 1
+            self._pending[self._last_id] = pending
+
+            try:
+                self._socket.sendall(encode_frame(self._last_id, parts))
+            except socket.error as error:
+                self._error = error
+                raise
+
+        return pending
+
+    def _wait(self, pending):
+        """
+        Read responses until pending has its own. Only one thread reads at a
+        time and it resolves the calls of any other threads as it goes.
+        """
+        while not pending.done:
+            with self._read_lock:
+                if pending.done:
+                    return
+
+                if self._error is not None:
+                    raise self._error
+
+                try:
+                    frame = read_frame(self._stream)
+
+                    if frame is None:
+                        raise ProtocolError('The server closed the connection.')
+                except (ProtocolError, socket.error) as error:
+                    self._error = error
+                    raise
+
+                request_id, status, parts = frame
+                answered = self._pending.pop(request_id, None)
+
+                if answered is not None:
+                    answered._resolve(status, parts)
+
+
+def _decoder(operation):
+    decode = OPERATIONS[operation][2]
+    return decode if decode is not None else _identity
+
+
+def _identity(val):
+    return val
+
+
+def _operation(name):
+    """
+    Return an RPCClient method calling the store operation name, which takes
+    the same arguments as the KeyColValStore method.
+    """
+    spec = _getargspec(getattr(KeyColValStore, name))
+    arg_names = spec.args[1:]
+    defaults = dict(zip(reversed(arg_names), reversed(spec.defaults or ())))
+
+    def method(self, *args, **kwargs):
+        if kwargs:
+            args = list(args)
+
+            for arg_name in arg_names[len(args):]:
+                if arg_name in kwargs:
+                    args.append(kwargs.pop(arg_name))
+                elif arg_name in defaults:
+                    args.append(defaults[arg_name])
+                else:
+                    raise TypeError('%s() is missing the argument %s.' % (name, arg_name))
+
+            if kwargs:
+                raise TypeError('%s() got unexpected arguments %s.'
+                                % (name, ', '.join(sorted(kwargs))))
+
+        return self.call(name, *args)
+
+    method.__name__ = name
+    method.__doc__ = getattr(KeyColValStore, name).__doc__
+    return method
+
+
+for _name in OPERATIONS:
+    setattr(RPCClient, _name, _operation(_name))
@@ -0,0 +1,187 @@
+"""
+The binary protocol spoken between RPCServer and RPCClient over TCP.
+
+Every message is a frame made of a header and a payload:
+
+    | payload length (4) | request id (4) | status (1) | payload |
+
+A request's payload is the operation name followed by its arguments and a
+response's payload is the operation's result, each encoded as a data log field
+(a one byte type tag, a four byte length and the data, see
+keycolval/persistence/records.py). Lengths and request ids are big-endian
+unsigned ints. Requests always have the status OK. A response with the status
+ERROR carries the name of the exception the operation raised and its message.
+
+A response carries the id of the request it answers, so a client can send
+any number of requests without waiting and match the responses up as they
+arrive. Keys, columns and values are sent as they are, so they may contain
+any characters.
+
+The 'batch' operation takes a list of [operation, argument, ...] lists and
+returns the list of their results, so that many small operations cost a
+single round trip. The operations run in order and a batch stops at the first
+one which raises.
+
+Fields only distinguish text, bytes, None and lists, so numbers and flags are
+sent as text and converted back by the receiving end with the converters in
+OPERATIONS, and dict results are sent as JSON, apart from read_changes whose
+changes are sent as fields so that values keep their type.
+
+Requests sent over a connection may run at the same time and be answered in
+any order, so a call which has to see the effect of another should be sent
+once the other's response has arrived, or along with it in a batch. A
+read_changes which waits for changes holds up one of the server's few threads
+for the connection, so consumers waiting for changes should have a connection
+of their own.
+"""
+
+import json
+import struct
+
+from keycolval.persistence.changefeed import ChangesExpiredError
+from keycolval.persistence.records import decode_payload
+from keycolval.persistence.records import encode_field
+from keycolval.stores.memory import MemoryBudgetExceededError
+from keycolval.stores.sharedstore import ReadOnlyStoreError
+
+
+FRAME_HEADER = struct.Struct('>IIB')
+
+# Frame statuses.
+OK = 0
+ERROR = 1
+
+# Frames larger than this are refused rather than buffered.
+MAX_FRAME_BYTES = 64 << 20
+
+
+class RemoteError(Exception):
+    """
+    Exception raised by RPCClient when an operation raised an exception on
+    the server which isn't one of ERRORS.
+    """
+
+
+class ProtocolError(Exception):
+    """
+    Exception raised when a peer sends a frame which can't be decoded.
+    """
+
+
+# Exceptions which the client raises again as themselves, by name.
+ERRORS = dict((error.__name__, error) for error in (
+    KeyError, ValueError, TypeError, MemoryBudgetExceededError, ReadOnlyStoreError,
+    ChangesExpiredError))
+
+
+def _int(val):
+    return None if val is None else int(val)
+
+
+def _float(val):
+    return None if val is None else float(val)
+
+
+def _flag(val):
+    # Flags are sent as the text of a bool.
+    return val in (u'True', b'True')
+
+
+def _tuples(items):
+    return [tuple(item) for item in items]
+
+
+def _json(val):
+    return json.loads(val)
+
+
+def _json_tuples(val):
+    return [tuple(item) for item in json.loads(val)]
+
+
+def _keys_columns(found):
+    return [(key, _tuples(columns)) for key, columns in found]
+
+
+def _encode_changes(found):
+    return [found['epoch'], found['next'], found['changes']]
+
+
+def _decode_changes(parts):
+    epoch, next_sequence, changes = parts
+    return {'epoch': epoch, 'next': int(next_sequence),
+            'changes': [(int(change[0]),) + tuple(change[1:]) for change in changes]}
+
+
+# Operation name -> (argument converters, result encoder, result decoder).
+# Argument converters are applied by the server to the arguments in order and
+# None leaves an argument as it was sent. The result encoder is applied by the
+# server and the decoder by the client.
+OPERATIONS = {
+    'set': ((), None, None),
+    'get': ((), None, None),
+    'get_key': ((), None, _tuples),
+    'get_keys': ((), list, set),
+    'get_many': ((), None, _keys_columns),
+    'delete': ((), None, None),
+    'delete_key': ((), None, None),
+    'delete_slice': ((), None, _int),
+    'get_slice': ((None, None, None, _flag, _int, _int), None, _tuples),
+    'get_prefix': ((None, None, _flag, _int, _int), None, _tuples),
+    'compare_and_set': ((), None, _flag),
+    'increment': ((None, None, _int), None, _int),
+    'append': ((), None, None),
+    'set_columns': ((None, _tuples), None, None),
+    'set_until': ((None, None, None, _float), None, None),
+    'set_with_ttl': ((None, None, None, _float), None, None),
+    'expire': ((None, None, _float), None, _flag),
+    'scan_keys': ((None, None, _int, _flag), None, None),
+    'get_key_stats': ((), json.dumps, _json),
+    'get_top_keys': ((None, _int), json.dumps, _json_tuples),
+    'memory_usage': ((), json.dumps, _json),
+    'find_value': ((), None, _tuples),
+    'find_value_prefix': ((None, _int), None, _tuples),
+    'read_changes': ((_int, None, None, _int, _float), _encode_changes, _decode_changes),
+    'count_slice': ((), json.dumps, _json),
+    'sum_slice': ((), json.dumps, _json),
+    'histogram_slice': ((None, None, None, _int, _float, _float), json.dumps, _json),
+}
+
+
+def encode_frame(request_id, parts, status=OK):
+    """
+    Encode a frame holding the fields in parts.
+    """
+    payload = b''.join(encode_field(part) for part in parts)
+    return FRAME_HEADER.pack(len(payload), request_id, status) + payload
+
+
+def read_frame(stream):
+    """
+    Read a frame from a buffered binary stream and return its request id,
+    status and fields, or None if the stream ended between frames.
+    """
+    header = stream.read(FRAME_HEADER.size)
+
+    if not header:
+        return None
+
+    if len(header) < FRAME_HEADER.size:
+        raise ProtocolError('The connection closed part way through a frame.')
+
+    length, request_id, status = FRAME_HEADER.unpack(header)
+
+    if length > MAX_FRAME_BYTES:
+        raise ProtocolError('A frame of %d bytes is larger than the limit of %d.'
+                            % (length, MAX_FRAME_BYTES))
+
+    payload = stream.read(length)
+
+    if len(payload) < length:
+        raise ProtocolError('The connection closed part way through a frame.')
+
+    try:
+        return request_id, status, decode_payload(payload, 0, length)
+    except Exception as error:
+        raise ProtocolError('Cannot decode a frame: %s' % error)
+
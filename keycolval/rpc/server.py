@@ -0,0 +1,168 @@
+"""
+A TCP server which runs the operations of the binary protocol in
+keycolval/rpc/protocol.py against a data store.
+
+Each connection is served by its own thread, which reads requests and hands
+them to a small pool of worker threads of the connection's own, so a client
+may pipeline any number of requests on a connection and a slow one doesn't
+hold up the rest. Each worker writes its response as soon as its operation
+returns, so responses come back in the order operations finish and clients
+match them up by request id.
+"""
+
+import logging
+import socket
+import threading
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from keycolval.rpc.protocol import ERROR
+from keycolval.rpc.protocol import OPERATIONS
+from keycolval.rpc.protocol import ProtocolError
+from keycolval.rpc.protocol import encode_frame
+from keycolval.rpc.protocol import read_frame
+
+
+logger = logging.getLogger('keycolval.rpc')
+
+
+class RPCRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serves the requests sent over one connection until the client closes it.
+    """
+    # Responses are small and sent one at a time, so they go out unbuffered
+    # and without waiting for the previous packet to be acknowledged.
+    wbufsize = 0
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        threads = self.server.connection_threads
+        # Requests waiting for a worker, a few per worker at most so that a
+        # client which sends faster than they're served is held back.
+        self._requests = Queue(2 * threads)
+        self._write_lock = threading.Lock()
+        workers = [threading.Thread(target=self._serve_requests) for _ in range(threads)]
+
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            self._read_requests()
+        finally:
+            # The workers answer the requests already read before the
+            # connection is closed.
+            for _ in workers:
+                self._requests.put(None)
+
+            for worker in workers:
+                worker.join()
+
+    def _read_requests(self):
+        while True:
+            try:
+                frame = read_frame(self.rfile)
+            except (ProtocolError, socket.error) as error:
+                logger.warning('Dropping RPC connection from %s: %s',
+                               self.client_address[0], error)
+                return
+
+            if frame is None:
+                return
+
+            self._requests.put(frame)
+
+    def _serve_requests(self):
+        while True:
+            frame = self._requests.get()
+
+            if frame is None:
+                return
+
+            request_id, _, parts = frame
+
+            try:
+                response = encode_frame(request_id, [self.server.execute(parts)])
+            except Exception as error:
+                response = encode_frame(request_id, [type(error).__name__,
+                                                     _error_message(error)], ERROR)
+
+            try:
+                with self._write_lock:
+                    self.wfile.write(response)
+            except socket.error:
+                # The client has gone, which the reading thread finds out.
+                pass
+
+
+class RPCServer(socketserver.ThreadingTCPServer):
+    """
+    Serves store over the binary protocol on (host, port), with a thread per
+    connection reading requests and connection_threads threads per
+    connection running them. Port 0 picks a free port, which server_address
+    then holds.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store, host='127.0.0.1', port=0, connection_threads=4):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), RPCRequestHandler)
+        self.store = store
+        self.metrics = store.metrics
+        self.connection_threads = connection_threads
+
+    def execute(self, parts):
+        """
+        Run the operation a request's fields describe and return its encoded
+        result.
+        """
+        if not parts:
+            raise ValueError('A request must name an operation.')
+
+        operation, args = parts[0], parts[1:]
+
+        if operation == 'batch':
+            if len(args) != 1 or not isinstance(args[0], list):
+                raise ValueError('batch takes a single list of operations.')
+
+            if self.metrics.enabled:
+                self.metrics.inc('keycolval_rpc_requests_total', operation=operation)
+
+            return [self.execute(call) for call in args[0]]
+
+        if operation not in OPERATIONS:
+            raise ValueError("Unknown operation '%s'." % operation)
+
+        if self.metrics.enabled:
+            self.metrics.inc('keycolval_rpc_requests_total', operation=operation)
+
+        converters, encode_result, _ = OPERATIONS[operation]
+        args = [converters[i](arg) if i < len(converters) and converters[i] is not None
+                else arg for i, arg in enumerate(args)]
+        result = getattr(self.store, operation)(*args)
+
+        return encode_result(result) if encode_result is not None else result
+
+    def start(self):
+        """
+        Serve on a daemon thread and return it.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def _error_message(error):
+    # KeyError's str is the repr of the key, so send the key itself.
+    if len(error.args) == 1:
+        return u'%s' % (error.args[0],)
+    return u'%s' % (error,)
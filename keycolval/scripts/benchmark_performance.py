@@ -11,8 +11,16 @@ a rough time for setting and getting all of the data in the test data file.
 You can also pass a --profile option which will use cProfile to show you the
 performance profile of your data store's implementation.
 
+Passing --compress stores values with a ValueCompressor (compressing every
+value regardless of size) and reports the compression ratio and the CPU time
+spent compressing and decompressing.
+
+Passing --value-index maintains a ValueIndex while loading, so the load time
+includes the cost of indexing, and reports the index's size and the time
+taken to look up every value.
+
 Usage:
-python -m keycolval.scripts.benchmark_performance /path/to/test/data [--profile]
+python -m keycolval.scripts.benchmark_performance /path/to/test/data [--profile] [--compress] [--value-index]
 """
 
 import csv
@@ -24,8 +32,10 @@ import random
 import cProfile
 
 
-from keycolval.stores.doubledict import DoubleDictKeyColValStore
-from keycolval.stores.binarytreestore import BinaryTreeKeyColumnValueStore
+from keycolval.data_structures.compressedvalue import ValueCompressor
+from keycolval.data_structures.valueindex import ValueIndex
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
 
 
 # Define which data store implementation you want to test.
@@ -35,7 +45,7 @@ STORE_CLASS = DoubleDictKeyColValStore
 class PerformanceTestClass(object):
 
     def __init__(self, store_class, test_data_file, *args, **kwargs):
-        self._store = store_class()
+        self._store = store_class(**kwargs)
         self._test_data_filepath = test_data_file
 
     def run_performance_tests(self):
@@ -49,6 +59,12 @@ class PerformanceTestClass(object):
 
         self._run_all_get_slices()
 
+        if getattr(self._store, 'compressor', None) is not None:
+            self._report_compression()
+
+        if getattr(self._store, 'value_index', None) is not None:
+            self._run_value_lookups()
+
     def _load_test_data(self):
         print "Loading test data from file %s." % self._test_data_filepath
 
@@ -133,6 +149,43 @@ class PerformanceTestClass(object):
         print "Took %s to run %s get slices." % (total_time,
                                                  len(slice_indices_lookup.keys()))
 
+    def _report_compression(self):
+        compressor = self._store.compressor
+
+        print "Compressed %s values with %s. Stored size is %.1f%% of %s raw bytes." % (
+                                                compressor.values_compressed,
+                                                compressor.method,
+                                                compressor.ratio() * 100,
+                                                compressor.raw_bytes)
+
+        print "Spent %.3fs compressing and %.3fs decompressing %s values." % (
+                                                compressor.compress_seconds,
+                                                compressor.decompress_seconds,
+                                                compressor.values_decompressed)
+
+    def _run_value_lookups(self):
+        usage = self._store.value_index.usage()
+
+        print "Value index holds %s values of %s cells in about %s bytes." % (
+                                                usage['values'],
+                                                usage['cells'],
+                                                usage['approximate_bytes'])
+
+        values = [val for key in self._store.get_keys()
+                  for col, val in self._store.get_key(key)]
+        random.shuffle(values)
+
+        start_time = datetime.now()
+
+        for val in values:
+            self._store.find_value(val)
+
+        end_time = datetime.now()
+
+        total_time = end_time - start_time
+
+        print "Took %s to run find_value on all %s values." % (total_time, len(values))
+
     def _get_slice_indices_lookup(self):
         keys = list(self._store.get_keys())
         random.shuffle(keys)
@@ -151,12 +204,17 @@ class PerformanceTestClass(object):
 if __name__ == "__main__":
     file_path = sys.argv[1]
 
-    if len(sys.argv) > 2:
-        run_profiler = True if sys.argv[2] == '--profile' else False
-    else:
-        run_profiler = False
+    run_profiler = '--profile' in sys.argv[2:]
+
+    store_kwargs = {}
+
+    if '--compress' in sys.argv[2:]:
+        store_kwargs['compressor'] = ValueCompressor(threshold=0)
+
+    if '--value-index' in sys.argv[2:]:
+        store_kwargs['value_index'] = ValueIndex()
 
-    test_runner = PerformanceTestClass(STORE_CLASS, file_path)
+    test_runner = PerformanceTestClass(STORE_CLASS, file_path, **store_kwargs)
     
     if run_profiler:
         cProfile.run('test_runner.run_performance_tests()')
@@ -0,0 +1,125 @@
+"""
+Measures the request throughput of a running keycolval server.
+
+A number of client threads each send requests over one kept-alive connection,
+alternating a POST /set/ with a GET /get/ of the column just set, and the
+requests per second across all clients are reported along with the number of
+connections used, as connections the server closes are reopened. Start the
+server with run_server.py, with or without --production, before running this.
+
+With --rpc the same calls are made with an RPCClient per client thread to a
+server started with --rpc-port, and host:port is the RPC port. The mean
+latency of a request and the CPU time the benchmark itself spent per request
+are reported for either protocol.
+
+Usage:
+python -m keycolval.scripts.benchmark_server host:port [--clients N] [--requests N] [--rpc]
+"""
+
+import os
+import sys
+import threading
+import time
+
+try:
+    from httplib import HTTPConnection
+    from urllib import urlencode
+except ImportError:
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode
+
+from keycolval.rpc.client import RPCClient
+
+
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def run_client(address, client, requests, results):
+    """
+    Send requests requests and record how many connections they took.
+    """
+    connection = HTTPConnection(address)
+    connections = 1
+
+    for i in range(requests):
+        key = 'bench-%d' % client
+        col = 'col-%d' % (i // 2)
+
+        if i % 2 == 0:
+            body = urlencode({'key': key, 'column': col, 'value': 'value-%d' % i})
+            connection.request('POST', '/set/', body, FORM_HEADERS)
+        else:
+            connection.request('GET', '/get/%s/%s/' % (key, col))
+
+        response = connection.getresponse()
+        response.read()
+
+        if response.status != 200:
+            raise IOError('%s responded with %s.' % (address, response.status))
+
+        if response.will_close:
+            # The connection reopens itself for the next request.
+            connections += 1
+
+    connection.close()
+    results[client] = connections
+
+
+def run_rpc_client(address, client, requests, results):
+    """
+    Make the same calls as run_client over one RPC connection.
+    """
+    host, port = address.rsplit(':', 1)
+    connection = RPCClient(host, int(port))
+
+    for i in range(requests):
+        key = 'bench-%d' % client
+        col = 'col-%d' % (i // 2)
+
+        if i % 2 == 0:
+            connection.set(key, col, 'value-%d' % i)
+        else:
+            connection.get(key, col)
+
+    connection.close()
+    results[client] = 1
+
+
+def option(name, default):
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return int(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+
+    address = sys.argv[1]
+    clients = option('--clients', 8)
+    requests = option('--requests', 1000)
+    results = {}
+    target = run_rpc_client if '--rpc' in sys.argv else run_client
+
+    threads = [threading.Thread(target=target, args=(address, client, requests, results))
+               for client in range(clients)]
+
+    start = time.time()
+    start_cpu = sum(os.times()[:2])
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - start_cpu
+    total = clients * requests
+
+    print('%s requests from %s clients in %.2f seconds: %.0f requests per second '
+          'over %s connections.' % (total, clients, elapsed, total / elapsed,
+                                    sum(results.values())))
+    print('Mean latency %.0f microseconds, client CPU %.0f microseconds per request.'
+          % (elapsed * clients / total * 1e6, cpu / total * 1e6))
@@ -0,0 +1,112 @@
+"""
+Measures how long the application takes to start, phase by phase: importing
+keycolval.api, loading the data store, which replays its data log, and
+serving the first request.
+
+A data log of --records writes across --keys keys is written first, and with
+--snapshot a snapshot of it, so that loading replays the snapshot instead.
+Each start runs in a fresh interpreter so that its imports aren't cached. It's
+measured twice: once loading the data store before the first request, as the
+servers in run_server.py do, and once leaving the first request to load it.
+
+Usage:
+python -m keycolval.scripts.benchmark_startup [--records N] [--keys N] [--snapshot]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+MODULE = 'keycolval.scripts.benchmark_startup'
+
+
+def write_data_log(path, records, keys, snapshot):
+    """
+    Write a data log of records sets spread over keys keys.
+    """
+    store = DoubleDictKeyColValStore(path=path)
+
+    for i in range(records):
+        store.set('key-%d' % (i % keys), 'col-%d' % (i // keys), 'value-%d' % i)
+
+    if snapshot:
+        store.query_persistor.snapshot(wait=True)
+
+    store.query_persistor.flush()
+
+
+def measure_start(path, preload):
+    """
+    Start the application on the data log at path and return the seconds
+    each phase took. Run in a fresh interpreter by main.
+    """
+    start = default_timer()
+
+    from keycolval.api import app
+    from keycolval.api import load_data_store
+
+    imported = default_timer()
+    app.config['DATA_STORE_FILE'] = path
+    app.config['SNAPSHOT_EVERY_RECORDS'] = None
+
+    if preload:
+        load_data_store(app)
+
+    loaded = default_timer()
+    app.test_client().get('/get-keys/?limit=1')
+    served = default_timer()
+
+    return {'import': imported - start, 'load': loaded - imported,
+            'first_request': served - loaded,
+            'records': app.load_progress.records}
+
+
+def start_in_subprocess(path, preload):
+    """
+    Run measure_start in a fresh interpreter and return what it measured.
+    """
+    output = subprocess.check_output([sys.executable, '-m', MODULE, '--child', path,
+                                      'preload' if preload else 'lazy'])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def option(name, default):
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return int(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+
+if __name__ == '__main__':
+    if '--child' in sys.argv:
+        child_args = sys.argv[sys.argv.index('--child') + 1:]
+        print(json.dumps(measure_start(child_args[0], child_args[1] == 'preload')))
+        sys.stdout.flush()
+        # Tearing down the interpreter and the data store's threads isn't
+        # part of starting up.
+        os._exit(0)
+
+    records = option('--records', 200000)
+    keys = option('--keys', 1000)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'data')
+
+    try:
+        write_data_log(path, records, keys, '--snapshot' in sys.argv)
+
+        for preload in (True, False):
+            phases = start_in_subprocess(path, preload)
+            print('%s: import %.3fs, load %.3fs, first request %.3fs (%d records).'
+                  % ('Loaded on start-up' if preload else 'Loaded by the first request',
+                     phases['import'], phases['load'], phases['first_request'],
+                     phases['records']))
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+        os.rmdir(directory)
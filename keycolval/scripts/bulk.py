@@ -0,0 +1,48 @@
+"""
+Imports cells in bulk into a keycolval data log, or exports them from one.
+
+import loads a CSV, TSV, JSON lines or dump file into the store persisted at
+the data log, writing each key's columns as one logged record, and export
+writes a consistent copy of that store to a file. The format is guessed from
+the file's extension unless it's given with --format. --processes parses an
+import's input in that many worker processes.
+
+Usage:
+python -m keycolval.scripts.bulk import /path/to/data/log file [--format F] [--processes N]
+python -m keycolval.scripts.bulk export /path/to/data/log file [--format F]
+"""
+
+import sys
+import time
+
+from keycolval.persistence.bulk import export_file
+from keycolval.persistence.bulk import import_file
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+def option(args, name, default=None):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return default
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] not in ('import', 'export'):
+        print(__doc__)
+        sys.exit(2)
+
+    command, log_path, file_path = sys.argv[1], sys.argv[2], sys.argv[3]
+    file_format = option(sys.argv[4:], '--format')
+
+    store = DoubleDictKeyColValStore(path=log_path)
+    start = time.time()
+
+    if command == 'import':
+        cells = import_file(store, file_path, file_format,
+                            processes=int(option(sys.argv[4:], '--processes', 1)))
+        print('Imported %s cells from %s in %.2f seconds.' % (
+            cells, file_path, time.time() - start))
+    else:
+        written = export_file(store, file_path, file_format)
+        print('Exported %s bytes to %s in %.2f seconds.' % (
+            written, file_path, time.time() - start))
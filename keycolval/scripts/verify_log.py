@@ -0,0 +1,45 @@
+"""
+Checks a keycolval data log for torn or corrupt records and optionally repairs it.
+
+verify reports how many valid records the log holds and how many bytes follow
+them. A store truncates those bytes when it opens the log if they're a torn
+tail, but refuses to open it if they hold intact records. repair truncates them
+right away, and with --salvage keeps any intact records found after a corrupted
+one as well. Data logs in the old CSV format are converted when a store opens
+them and can't be checked with this script.
+
+Usage:
+python -m keycolval.scripts.verify_log verify /path/to/data/log
+python -m keycolval.scripts.verify_log repair /path/to/data/log [--salvage]
+"""
+
+import sys
+
+from keycolval.persistence.records import repair_log
+from keycolval.persistence.records import verify_log
+
+
+def print_report(file_path, report):
+    print('%s: %s valid records in %s of %s bytes.' % (
+        file_path, report['records'], report['valid_bytes'], report['file_size']))
+
+    if report['dropped_bytes']:
+        print('%s bytes after the last valid record hold %s intact records.' % (
+            report['dropped_bytes'], report['salvageable_records']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('verify', 'repair'):
+        print(__doc__)
+        sys.exit(2)
+
+    command, file_path = sys.argv[1], sys.argv[2]
+
+    if command == 'verify':
+        report = verify_log(file_path)
+        print_report(file_path, report)
+        sys.exit(1 if report['dropped_bytes'] else 0)
+
+    report = repair_log(file_path, salvage='--salvage' in sys.argv[3:])
+    print_report(file_path, report)
+    print('Repaired %s.' % file_path if report['dropped_bytes'] else 'Nothing to repair.')
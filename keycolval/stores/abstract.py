@@ -1,11 +1,46 @@
 from abc import ABCMeta
 from abc import abstractmethod
+from time import time
+
+from keycolval.data_structures.numericcolumns import NumericColumns
+from keycolval.instrumentation.metrics import instrument
+from keycolval.persistence.query_persistor import persist
+from keycolval.stores.memory import SHRINKING_CALLS
+from keycolval.stores.versions import ReadSnapshot
 
 
 class KeyColValStore(object):
     """
     This is the abstract class which defines the interface for KeyColValStore
     objects.
+
+    The atomic operations defined here are built out of set and get. They rely
+    on implementations providing a write_lock (an RLock) and a query_persistor
+    for the persist decorator, which holds the lock for the whole operation
+    and logs it as a single record.
+
+    Cells can be given an expiry time. Implementations track expiring cells in
+    an ExpiryIndex called expiry, drop a key's expired cells before reading it
+    by calling prepare_key, which calls expire_due, and may run an ExpiryReaper to reclaim expired
+    cells which aren't read. Expired cells are removed with logged deletes so
+    that replay never depends on the clock.
+
+    Implementations given a MemoryBudget as memory_budget keep it attached,
+    call prepare_key before reading a key so that an evicted key is brought
+    back first, and provide _take_columns and _put_columns for the budget to
+    move a key's stored columns out of and back into memory.
+
+    Implementations keep a VersionHistory called versions, which numbers
+    the data altering calls, for open_snapshot, or set it to None if they
+    don't support snapshots.
+
+    Implementations given a ValueIndex as value_index report every column set
+    and removed to it, alongside their key_stats, so that cells can be looked
+    up by value. Those given a ChangeFeed as change_feed keep it attached and
+    the persist decorator publishes every logged call's changes to it.
+
+    Implementations keep a NumericColumnCache called numeric_columns for the
+    slice aggregates, or set it to None to build the columns for every call.
     """
     __metaclass__ = ABCMeta
 
@@ -33,11 +68,440 @@ class KeyColValStore(object):
     def delete_key(self, key):
         """ removes all data associated with the given key """
     
+    @instrument
+    @persist
+    def delete_slice(self, key, start, stop):
+        """
+        removes the columns of the given key between the start and stop
+        values inclusive, either of which can be None, as one operation.
+        Returns the number of columns removed
+        """
+        columns = self.get_slice(key, start, stop)
+
+        for col, val in columns:
+            self.delete(key, col)
+
+        return len(columns)
+
     @abstractmethod
-    def get_slice(self, key, start, stop):
+    def get_slice(self, key, start, stop, reverse=False, limit=None, offset=0):
         """
         returns a sorted list of column/value tuples where the column
         values are between the start and stop values, inclusive of the
         start and stop values. Start and/or stop can be None values,
         leaving the slice open ended in that direction
+
+        If reverse is set the columns are returned in descending order.
+        offset columns are skipped and at most limit columns are returned,
+        counting from the stop end of the slice when reversed
+        """
+
+    @abstractmethod
+    def get_prefix(self, key, prefix, reverse=False, limit=None, offset=0):
+        """
+        returns a sorted list of column/value tuples where the columns
+        start with prefix, paged in the same way as get_slice
+        """
+
+    @instrument
+    @persist
+    def compare_and_set(self, key, col, expected, val):
+        """
+        sets the value at the given key/column only if its current value is
+        expected, or if it doesn't exist when expected is None. Returns
+        whether the value was set
+        """
+        if self.get(key, col) != expected:
+            return False
+
+        self.set(key, col, val)
+        return True
+
+    @instrument
+    @persist
+    def increment(self, key, col, amount=1):
+        """
+        adds amount to the integer value at the given key/column, treating a
+        missing column as 0, and returns the new value. Raises ValueError if
+        the current value isn't an integer
+        """
+        current = self.get(key, col)
+        val = int(current or 0) + int(amount)
+        self.set(key, col, str(val))
+        return val
+
+    @instrument
+    @persist
+    def append(self, key, col, suffix):
+        """
+        appends suffix to the value at the given key/column, treating a
+        missing column as empty, and returns the new value
+        """
+        current = self.get(key, col)
+        val = suffix if current is None else current + suffix
+        self.set(key, col, val)
+        return val
+
+    @instrument
+    @persist
+    def set_columns(self, key, columns):
+        """
+        sets every column/value pair in the list columns on the given key as
+        one operation. After a crash either all of them or none are restored
+        """
+        for col, val in columns:
+            self.set(key, col, val)
+
+    @instrument
+    @persist
+    def set_until(self, key, col, val, expire_at):
+        """
+        sets the value at the given key/column to expire at the unix time
+        expire_at
+        """
+        self.set(key, col, val)
+        self.expiry.set(key, col, float(expire_at))
+
+    def set_with_ttl(self, key, col, val, ttl):
         """
+        sets the value at the given key/column to expire after ttl seconds.
+        The absolute expiry time is what gets logged. Raises ValueError
+        unless ttl is a finite number of seconds of at least 0
+        """
+        ttl = float(ttl)
+
+        # NaN fails both comparisons.
+        if not 0 <= ttl < float('inf'):
+            raise ValueError('ttl must be a finite number of seconds of at least 0, not %r.'
+                             % ttl)
+
+        self.set_until(key, col, val, time() + ttl)
+
+    @instrument
+    @persist
+    def expire(self, key, col, expire_at):
+        """
+        sets the unix time at which an existing key/column expires, or stops
+        it from expiring if expire_at is None. Returns whether the column
+        exists
+        """
+        if self.get(key, col) is None:
+            return False
+
+        if expire_at is None:
+            self.expiry.discard(key, col)
+        else:
+            self.expiry.set(key, col, float(expire_at))
+
+        return True
+
+    def before_persisted_call(self, func_name, args):
+        """
+        called by the persist decorator before a data altering call so that
+        the key it touches is in memory and its expired cells are deleted, and
+        logged as deleted, before it runs. Enforces the memory budget, if
+        there is one, by rejecting the call or evicting other keys, and
+        numbers the call in the version history, which copies the key first
+        if an open snapshot needs it. The key's cached numeric columns are
+        dropped
+        """
+        if not args:
+            return
+
+        self.prepare_key(args[0])
+
+        if self.memory_budget is not None:
+            if not getattr(self, 'replaying', False):
+                self.memory_budget.check_write(func_name)
+
+            self.memory_budget.make_room(self, args[0])
+
+            if func_name not in SHRINKING_CALLS:
+                # The call may create the key, which is only tracked once the
+                # budget has accepted the call.
+                self.memory_budget.touch(args[0])
+
+        if self.versions is not None:
+            self.versions.before_write(self, args[0])
+
+        if self.numeric_columns is not None:
+            self.numeric_columns.invalidate(args[0])
+
+    def prepare_key(self, key):
+        """
+        brings the given key back into memory if it was evicted, marks it as
+        recently used if it exists and deletes its expired cells, before it's
+        read or written
+        """
+        budget = self.memory_budget
+
+        if budget is not None:
+            if budget.is_evicted(key):
+                with self.write_lock:
+                    if budget.is_evicted(key):
+                        budget.load(self, key)
+                        budget.make_room(self, key)
+
+            if key in self.keys:
+                budget.touch(key)
+
+        self.expire_due(key)
+
+    def expire_due(self, key):
+        """
+        deletes the cells of the given key which have expired. Does nothing
+        while replaying the data log or inside a data altering call, so that
+        what gets replayed never depends on when it's replayed
+        """
+        if (not self.expiry.is_due(key, time()) or getattr(self, 'replaying', False)
+                or getattr(self, '_persisting', False)):
+            return
+
+        with self.write_lock:
+            self._delete_expired([(key, col)
+                                  for col in self.expiry.pop_due_columns(key, time())])
+
+    def reap_expired(self, limit=1000):
+        """
+        deletes up to limit expired cells, earliest first, and returns the
+        number deleted. Cells are found from the expiry index so this costs
+        time proportional to the number of expired cells
+        """
+        if getattr(self, 'replaying', False):
+            return 0
+
+        with self.write_lock:
+            cells = self.expiry.pop_due(time(), limit)
+            self._delete_expired(cells)
+
+        return len(cells)
+
+    def _delete_expired(self, cells):
+        for key, col in cells:
+            self.delete(key, col)
+
+        if cells and self.metrics.enabled:
+            self.metrics.inc('keycolval_expired_cells_total', len(cells))
+
+    def get_key_stats(self, key):
+        """
+        returns a dict of statistics for the given key (column_count,
+        total_bytes, min_column, max_column, last_write, writes and
+        write_rate) or None if the key doesn't exist. Implementations
+        provide these by maintaining a KeyStatisticsCatalog in key_stats.
+        """
+        return self.key_stats.get(key)
+
+    def get_top_keys(self, by='total_bytes', limit=10):
+        """
+        returns a list of (key, stats) tuples for the keys with the largest
+        value of the named statistic
+        """
+        return self.key_stats.top_keys(by, limit)
+
+    def iter_cells(self):
+        """
+        generates (key, column, value) tuples for every cell in the store, in
+        no particular order. Values are yielded as they are stored, so
+        compressed values stay compressed. Used to write snapshots
+        """
+        for key in self.get_keys():
+            for col, val in self.get_key(key):
+                yield key, col, val
+
+    def iter_all_cells(self, log_offset=None):
+        """
+        generates (key, column, value) tuples like iter_cells, including the
+        cells of keys the memory budget has moved out of memory as of the data
+        log offset log_offset
+        """
+        for cell in self.iter_cells():
+            yield cell
+
+        if self.memory_budget is not None:
+            for cell in self.memory_budget.iter_cells(self, log_offset):
+                yield cell
+
+    def find_value(self, val):
+        """
+        returns a sorted list of the (key, column) tuples holding the value
+        val. Needs a ValueIndex in value_index and raises ValueError otherwise
+        """
+        return [cell for cell in self._value_index().find(val) if self._is_live(*cell)]
+
+    def find_value_prefix(self, prefix, limit=None):
+        """
+        returns a list of (value, key, column) tuples for the cells holding a
+        string value which starts with prefix, in value then key order and at
+        most limit long. Needs a ValueIndex like find_value
+        """
+        index = self._value_index()
+
+        if len(self.expiry) == 0:
+            return index.find_prefix(prefix, limit)
+
+        return [found for found in index.find_prefix(prefix)
+                if self._is_live(found[1], found[2])][:limit]
+
+    def _value_index(self):
+        if getattr(self, 'value_index', None) is None:
+            raise ValueError('%s has no value index.' % self.__class__.__name__)
+
+        return self.value_index
+
+    def open_snapshot(self):
+        """
+        returns a ReadSnapshot which reads the store as it is now, without
+        the writes made after, until it's closed. Raises ValueError if the
+        store doesn't support snapshots
+        """
+        if getattr(self, 'versions', None) is None:
+            raise ValueError('%s does not support snapshots.' % self.__class__.__name__)
+
+        # Opening waits for the call in progress, if any, to finish.
+        with self.write_lock:
+            return ReadSnapshot(self, self.versions.open())
+
+    def get_many(self, keys):
+        """
+        returns a list of (key, sorted list of column/value tuples) tuples
+        for the given keys, all as of the same moment
+        """
+        with self.open_snapshot() as snapshot:
+            return [(key, snapshot.get_key(key)) for key in keys]
+
+    def count_slice(self, key, start, stop):
+        """
+        returns a dict of the number of columns between start and stop
+        inclusive (count) and the first and last of them, which are None if
+        there are none. Start and/or stop can be None values
+        """
+        return self._numeric_columns(key, start, stop).count(start, stop)
+
+    def sum_slice(self, key, start, stop):
+        """
+        returns a dict of the number (count), sum, min and max of the values
+        between start and stop inclusive which are numbers, along with the
+        number of values skipped as they aren't (skipped)
+        """
+        return self._numeric_columns(key, start, stop).summarize(start, stop)
+
+    def histogram_slice(self, key, start, stop, bins=10, lower=None, upper=None):
+        """
+        returns a dict of the counts of the numeric values between start and
+        stop inclusive in bins equal width bins from lower to upper (counts),
+        the edges of the bins (edges) and the number of values skipped as they
+        aren't numbers. lower and upper default to the smallest and largest
+        value, and values outside them aren't counted
+        """
+        return self._numeric_columns(key, start, stop).histogram(start, stop, bins,
+                                                                 lower, upper)
+
+    def _numeric_columns(self, key, start, stop):
+        """
+        returns a NumericColumns holding at least the columns of key between
+        start and stop. Those of keys with enough columns are built from the
+        whole key and cached until the key is next written
+        """
+        cache = self.numeric_columns
+
+        if cache is None or self.key_stats.column_count(key) < cache.min_columns:
+            return NumericColumns(self.get_slice(key, start, stop))
+
+        # Deleting expired cells also drops the key's cached columns.
+        self.prepare_key(key)
+
+        numeric_columns = cache.get(key)
+
+        if numeric_columns is None:
+            # Holding the write lock keeps the key from changing while it's
+            # read, so that the cached columns match it.
+            with self.write_lock:
+                numeric_columns = cache.get(key)
+
+                if numeric_columns is None:
+                    numeric_columns = NumericColumns(self.get_key(key))
+                    cache.put(key, numeric_columns)
+
+        return numeric_columns
+
+    def read_changes(self, after=0, key=None, prefix=None, limit=1000, wait=0,
+                     epoch=None):
+        """
+        returns a dict of the changes made after the sequence number after
+        (changes), filtered to key or to keys starting with prefix and at most
+        limit long, the sequence number to read on from (next) and the feed's
+        epoch, waiting up to wait seconds for a change. Needs a ChangeFeed in
+        change_feed and raises ValueError otherwise, and ChangesExpiredError
+        if the changes after after are gone or epoch isn't the feed's epoch
+        """
+        if getattr(self, 'change_feed', None) is None:
+            raise ValueError('%s has no change feed.' % self.__class__.__name__)
+
+        changes, next_sequence = self.change_feed.read(after, key, prefix, limit, wait, epoch)
+        return {'epoch': self.change_feed.epoch, 'changes': changes, 'next': next_sequence}
+
+    def _is_live(self, key, col):
+        """
+        returns whether a cell hasn't expired, whether or not it's been
+        deleted yet
+        """
+        expire_at = self.expiry.get(key, col)
+        return expire_at is None or expire_at > time()
+
+    def memory_usage(self):
+        """
+        returns a dict with the approximate bytes of data held in memory
+        (used_bytes) along with the memory budget (max_bytes), its policy,
+        the number and bytes of keys moved out of memory and the approximate
+        bytes of the value index, of the keys copied for snapshots and of the
+        cached numeric columns
+        """
+        if self.memory_budget is not None:
+            usage = self.memory_budget.usage()
+        else:
+            usage = {
+                'used_bytes': self.key_stats.total_bytes,
+                'max_bytes': None,
+                'policy': None,
+                'evicted_keys': 0,
+                'evicted_bytes': 0,
+            }
+
+        usage['value_index_bytes'] = (self.value_index.approximate_bytes
+                                      if self.value_index is not None else 0)
+        usage['version_history_bytes'] = (self.versions.approximate_bytes
+                                          if self.versions is not None else 0)
+        usage['numeric_columns_bytes'] = (self.numeric_columns.approximate_bytes
+                                          if self.numeric_columns is not None else 0)
+        return usage
+
+    def scan_keys(self, start=None, stop=None, limit=None, reverse=False):
+        """
+        returns a sorted list of the keys between start and stop inclusive,
+        at most limit long. Start and/or stop can be None values. Keys come
+        from the ordered key_index which implementations maintain so that
+        no full copy of the keys is made.
+        """
+        return self.key_index.range(start, stop, limit, reverse)
+
+    def scan(self, key_start=None, key_stop=None, col_start=None, col_stop=None,
+             batch_size=1000):
+        """
+        generates (key, column, value) tuples for every key between key_start
+        and key_stop and every column of those keys between col_start and
+        col_stop, in key then column order. Keys are fetched from the key
+        index batch_size at a time.
+        """
+        while True:
+            keys = self.scan_keys(key_start, key_stop, batch_size + 1)
+
+            for key in keys[:batch_size]:
+                for col, val in self.get_slice(key, col_start, col_stop):
+                    yield key, col, val
+
+            if len(keys) <= batch_size:
+                return
+
+            # The extra key we fetched starts the next batch.
+            key_start = keys[batch_size]
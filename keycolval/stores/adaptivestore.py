@@ -0,0 +1,545 @@
+import threading
+
+from keycolval.data_structures.expiryindex import ExpiryIndex
+from keycolval.data_structures.keyindex import SortedKeyIndex
+from keycolval.data_structures.numericcolumns import NumericColumnCache
+from keycolval.data_structures.sortedcolumns import SortedColumns
+from keycolval.data_structures.sortedcolumns import bisect_prefix
+from keycolval.data_structures.sortedcolumns import bisect_range
+from keycolval.data_structures.sortedcolumns import page
+from keycolval.stores.abstract import KeyColValStore
+from keycolval.stores.reaper import ExpiryReaper
+from keycolval.stores.statistics import KeyStatisticsCatalog
+from keycolval.stores.versions import VersionHistory
+
+from keycolval.instrumentation.metrics import NULL_METRICS
+from keycolval.instrumentation.metrics import instrument
+
+from keycolval.persistence.query_persistor import QueryPersistor
+from keycolval.persistence.query_persistor import persist
+
+
+# Names of the two column layouts as reported by layout_counts.
+HASH_LAYOUT = 'hash'
+SORTED_LAYOUT = 'sorted'
+
+
+class AdaptiveLayoutPolicy(object):
+    """
+    Decides which layout a key's columns should be stored in.
+
+    A key is promoted from a dict to SortedColumns once it has at least
+    promote_columns columns and at least promote_read_ratio of its recent
+    operations were ordered reads (get_key/get_slice) rather than writes
+    (sets, including overwrites, and deletes). It is demoted back to a dict when it shrinks below
+    demote_columns or its read ratio drops below demote_read_ratio.
+
+    The gap between the promote and demote thresholds is the hysteresis which
+    stops keys near a boundary from flapping between layouts. Each key is only
+    re-evaluated every evaluation_interval operations.
+    """
+
+    def __init__(self, promote_columns=512, demote_columns=128,
+                 promote_read_ratio=0.5, demote_read_ratio=0.2,
+                 evaluation_interval=64):
+        self.promote_columns = promote_columns
+        self.demote_columns = demote_columns
+        self.promote_read_ratio = promote_read_ratio
+        self.demote_read_ratio = demote_read_ratio
+        self.evaluation_interval = evaluation_interval
+
+    def choose_layout(self, current_layout, column_count, ordered_reads, writes):
+        """
+        Return the layout a key should be in given its size and how many
+        ordered reads and writes it has seen recently.
+        """
+        operations = ordered_reads + writes
+        read_ratio = float(ordered_reads) / operations if operations else 0.0
+
+        if current_layout == HASH_LAYOUT:
+            if (column_count >= self.promote_columns and
+                    read_ratio >= self.promote_read_ratio):
+                return SORTED_LAYOUT
+        elif (column_count < self.demote_columns or
+                read_ratio < self.demote_read_ratio):
+            return HASH_LAYOUT
+
+        return current_layout
+
+
+class AdaptiveKeyColValStore(KeyColValStore):
+    """
+    A KeyColValStore implementation which picks the column layout per key.
+
+    DoubleDictKeyColValStore is fast for everything but ordered access and
+    BinaryTreeKeyColValStore pays for ordering on every write. Most keys are
+    small or mostly written to, where a dict wins, but a few large keys are
+    sliced over and over, where re-sorting the whole dict for every slice
+    dominates.
+
+    This store keeps every key as a dict and tracks each key's mix of ordered
+    reads and writes. An AdaptiveLayoutPolicy promotes large,
+    slice-heavy keys to SortedColumns and demotes them again when that stops
+    paying off. Promotion and demotion counts and the number of keys in each
+    layout are available from layout_counts and in the metrics registry.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.keys = {}
+
+        # Held by every data altering call, see the persist decorator.
+        self.write_lock = threading.RLock()
+
+        # Per key [ordered_reads, writes, operations since last evaluation].
+        self._access = {}
+
+        self.policy = kwargs.get('policy') or AdaptiveLayoutPolicy()
+        self.promotions = 0
+        self.demotions = 0
+
+        # Operations are reported to a MetricsRegistry when one is given.
+        self.metrics = kwargs.get('metrics', NULL_METRICS)
+
+        # Note: Callbacks close over the keys dict rather than self to avoid
+        # reference cycles which would delay closing the data log.
+        keys = self.keys
+        self.metrics.register_gauge('keycolval_store_keys',
+                                    lambda: len(keys),
+                                    store=self.__class__.__name__)
+        self.metrics.register_gauge('keycolval_store_columns',
+                                    lambda: sum(len(cols) for cols in list(keys.values())),
+                                    store=self.__class__.__name__)
+        self.metrics.register_gauge('keycolval_adaptive_sorted_keys',
+                                    lambda: sum(1 for cols in list(keys.values())
+                                                if isinstance(cols, SortedColumns)),
+                                    store=self.__class__.__name__)
+
+        # Slow get_key/get_slice calls are recorded to a SlowQueryLog when
+        # one is given.
+        self.slow_query_log = kwargs.get('slow_query_log')
+
+        # Per-key statistics are kept up to date by every mutation and
+        # supply the column counts the layout policy works from.
+        key_stats = self.key_stats = KeyStatisticsCatalog(lambda key: list(keys[key]))
+        self.metrics.register_gauge('keycolval_store_bytes',
+                                    lambda: key_stats.total_bytes,
+                                    store=self.__class__.__name__)
+
+        # Ordered index of the keys for scan_keys and scan.
+        self.key_index = SortedKeyIndex()
+
+        # Values above the compressor's threshold are stored compressed when
+        # a ValueCompressor is given.
+        self.compressor = kwargs.get('compressor')
+
+        # Expiry times of the cells which expire.
+        self.expiry = ExpiryIndex()
+
+        # Data altering calls are numbered, and keys copied before they
+        # change while snapshots need them, for open_snapshot.
+        self.versions = VersionHistory()
+
+        # Large keys which are aggregated over are kept as arrays of numbers
+        # for count_slice, sum_slice and histogram_slice until next written.
+        self.numeric_columns = NumericColumnCache()
+
+        # Values are indexed for find_value and find_value_prefix when a
+        # ValueIndex is given.
+        self.value_index = kwargs.get('value_index')
+
+        if self.value_index is not None:
+            self.value_index.attach(self)
+
+        # The changes made by every logged call are published to a
+        # ChangeFeed for read_changes when one is given.
+        self.change_feed = kwargs.get('change_feed')
+
+        if self.change_feed is not None:
+            self.change_feed.attach(self)
+
+        # Memory use is kept within a MemoryBudget when one is given. Keys
+        # it moves out of memory are brought back by prepare_key.
+        self.memory_budget = kwargs.get('memory_budget')
+
+        if self.memory_budget is not None:
+            self.memory_budget.attach(self, persisted='path' in kwargs)
+
+        self.query_persistor = lambda *args, **kwargs: None
+
+        if 'path' in kwargs:
+            self.query_persistor = QueryPersistor(kwargs['path'], self,
+                                                  snapshot_every=kwargs.get('snapshot_every'),
+                                                  image_path=kwargs.get('image_path'),
+                                                  publish_interval=kwargs.get('publish_interval'),
+                                                  coalesce_window=kwargs.get('coalesce_window'),
+                                                  load_progress=kwargs.get('load_progress'))
+
+        # Expired cells which aren't read are reclaimed by a background
+        # reaper when a reap_interval in seconds is given.
+        self.reaper = None
+
+        if kwargs.get('reap_interval'):
+            self.reaper = ExpiryReaper(self, kwargs['reap_interval'])
+            self.reaper.start()
+
+    @instrument
+    @persist
+    def set(self, key, col, val):
+        """ sets the value at the given key/column """
+        if not key in self.keys:
+            self.keys[key] = {}
+            self.key_index.add(key)
+            self._access[key] = [0, 0, 0]
+
+        if self.compressor is not None:
+            val = self.compressor.compress(val)
+
+        columns = self.keys[key]
+
+        if isinstance(columns, dict):
+            old_val = columns.get(col)
+            columns[col] = val
+        else:
+            old_val = columns.set(col, val)
+
+        self.key_stats.record_set(key, col, val, old_val)
+        self.expiry.discard(key, col)
+
+        if self.value_index is not None:
+            self.value_index.record_set(key, col, val, old_val)
+
+        self._record_access(key, 1)
+
+    @instrument
+    @persist
+    def set_columns(self, key, columns):
+        """
+        sets every column/value pair in the list columns on the given key as
+        one operation. After a crash either all of them or none are restored
+
+        The columns are written straight into the key's current layout and
+        its statistics are updated once for the whole batch, which is what
+        bulk imports go through.
+        """
+        if not key in self.keys:
+            self.keys[key] = {}
+            self.key_index.add(key)
+            self._access[key] = [0, 0, 0]
+
+        stored = self.keys[key]
+        compressor = self.compressor
+        discard_expiry = self.expiry.discard
+        changes = []
+
+        for col, val in columns:
+            if compressor is not None:
+                val = compressor.compress(val)
+
+            if isinstance(stored, dict):
+                old_val = stored.get(col)
+                stored[col] = val
+            else:
+                old_val = stored.set(col, val)
+
+            changes.append((col, val, old_val))
+            discard_expiry(key, col)
+
+        self.key_stats.record_sets(key, changes)
+
+        if self.value_index is not None:
+            self.value_index.record_sets(key, changes)
+
+        self._record_access(key, 1, len(changes))
+
+    @instrument
+    def get(self, key, col):
+        """ return the value at the specified key/column """
+        self.prepare_key(key)
+
+        if not key in self.keys:
+            return None
+
+        val = self.keys[key].get(col)
+
+        if self.compressor is not None:
+            val = self.compressor.decompress(val)
+
+        return val
+
+    @instrument
+    def get_key(self, key):
+        """ returns a sorted list of column/value tuples """
+        self.prepare_key(key)
+
+        if not key in self.keys:
+            return []
+
+        self._record_access(key, 0)
+
+        return self._sorted_columns(key)
+
+    def _sorted_columns(self, key):
+        """
+        Return the sorted list of column/value tuples for a key held in
+        memory, without counting a get_key or an ordered read, or bringing an
+        evicted key back.
+        """
+        columns = self.keys.get(key)
+
+        if columns is None:
+            return []
+
+        if isinstance(columns, dict):
+            items = sorted(columns.items(), key=lambda tup: tup[0])
+        else:
+            items = columns.items()
+
+        if self.compressor is not None:
+            items = self.compressor.decompress_items(items)
+
+        return items
+
+    @instrument
+    def get_keys(self):
+        """ returns a set containing all of the keys in the store """
+        keys = set(self.keys.keys())
+
+        if self.memory_budget is not None:
+            keys.update(self.memory_budget.evicted_keys())
+
+        return keys
+
+    def _take_columns(self, key):
+        """
+        removes a key's columns from memory, leaving its statistics, index
+        entry and expiry times, and returns them as stored
+        """
+        return list(self.keys.pop(key).items())
+
+    def _put_columns(self, key, cells):
+        """
+        puts back the columns of a key taken by _take_columns, in the hash
+        layout
+        """
+        self.keys[key] = dict(cells)
+
+    def iter_cells(self):
+        """
+        generates (key, column, value) tuples for every cell in the store
+        straight from the stored columns, without sorting or decompressing
+        """
+        for key, columns in self.keys.items():
+            for col, val in columns.items():
+                yield key, col, val
+
+    @instrument
+    @persist
+    def delete(self, key, col):
+        """ removes a column/value from the given key """
+        columns = self.keys[key]
+
+        if isinstance(columns, dict):
+            val = columns.pop(col)
+        else:
+            val = columns.delete(col)
+
+        self.key_stats.record_delete(key, col, val)
+        self.expiry.discard(key, col)
+
+        if self.value_index is not None:
+            self.value_index.record_delete(key, col, val)
+
+        # A key which shrinks is re-evaluated so that it can be demoted.
+        self._record_access(key, 1)
+
+    @instrument
+    @persist
+    def delete_slice(self, key, start, stop):
+        """
+        removes the columns of the given key between the start and stop
+        values inclusive, either of which can be None, as one operation.
+        Returns the number of columns removed
+
+        Sorted keys bisect for the range, hash keys check every column.
+        """
+        if not key in self.keys:
+            return 0
+
+        columns = self.keys[key]
+
+        if isinstance(columns, dict):
+            removed = [(col, columns.pop(col)) for col in
+                       sorted(col for col in columns
+                              if (start is None or col >= start) and
+                              (stop is None or col <= stop))]
+        else:
+            removed = columns.delete_range(start, stop)
+
+        self.key_stats.record_deletes(key, removed)
+
+        if self.value_index is not None:
+            self.value_index.record_deletes(key, removed)
+
+        for col, val in removed:
+            self.expiry.discard(key, col)
+
+        self._record_access(key, 1)
+
+        return len(removed)
+
+    @instrument
+    @persist
+    def delete_key(self, key):
+        """ removes all data associated with the given key """
+        if self.value_index is not None:
+            self.value_index.record_deletes(key, list(self.keys[key].items()))
+
+        del self.keys[key]
+        del self._access[key]
+        self.key_stats.record_delete_key(key)
+        self.expiry.discard_key(key)
+        self.key_index.discard(key)
+
+        if self.memory_budget is not None:
+            self.memory_budget.forget(key)
+
+    @instrument
+    def get_slice(self, key, start, stop, reverse=False, limit=None, offset=0):
+        """
+        returns a sorted list of column/value tuples where the column
+        values are between the start and stop values, inclusive of the
+        start and stop values. Start and/or stop can be None values,
+        leaving the slice open ended in that direction
+
+        Keys in the sorted layout bisect for the slice boundaries and page in
+        O(log n + limit). Keys still in the hash layout sort their columns
+        first and then bisect.
+        """
+        return self._page_columns(key, lambda columns: bisect_range(columns, start, stop),
+                                  reverse, limit, offset)
+
+    @instrument
+    def get_prefix(self, key, prefix, reverse=False, limit=None, offset=0):
+        """
+        returns a sorted list of column/value tuples where the columns
+        start with prefix, paged in the same way as get_slice
+        """
+        return self._page_columns(key, lambda columns: bisect_prefix(columns, prefix),
+                                  reverse, limit, offset)
+
+    def _page_columns(self, key, find_bounds, reverse, limit, offset):
+        """
+        Find the (lower, upper) bounds of the requested columns in the sorted
+        list of a key's columns with find_bounds and return the requested page
+        of column/value tuples.
+        """
+        self.prepare_key(key)
+        columns = self.keys.get(key)
+
+        if columns is None:
+            return []
+
+        self._record_access(key, 0)
+
+        if isinstance(columns, dict):
+            sorted_columns = sorted(columns)
+        else:
+            sorted_columns = columns.columns()
+
+        lower, upper = find_bounds(sorted_columns)
+        column_slice = [(col, columns[col])
+                        for col in page(sorted_columns, lower, upper, reverse, limit, offset)]
+
+        if self.metrics.enabled:
+            # Keys in the hash layout have to look at every column to sort them.
+            columns_scanned = (len(sorted_columns) if isinstance(columns, dict)
+                               else len(column_slice))
+            self.metrics.observe_slice(columns_scanned, len(column_slice))
+
+        if self.compressor is not None:
+            column_slice = self.compressor.decompress_items(column_slice)
+
+        return column_slice
+
+    def layout_of(self, key):
+        """
+        Return the name of the layout a key is currently stored in, or None if
+        the key doesn't exist.
+        """
+        if not key in self.keys:
+            return None
+
+        return HASH_LAYOUT if isinstance(self.keys[key], dict) else SORTED_LAYOUT
+
+    def layout_counts(self):
+        """
+        Return a dict with the number of keys in each layout along with the
+        total number of promotions and demotions so far.
+        """
+        sorted_keys = sum(1 for columns in self.keys.values()
+                          if isinstance(columns, SortedColumns))
+
+        return {
+            HASH_LAYOUT: len(self.keys) - sorted_keys,
+            SORTED_LAYOUT: sorted_keys,
+            'promotions': self.promotions,
+            'demotions': self.demotions,
+        }
+
+    def _record_access(self, key, is_write, operations=1):
+        """
+        Count operations ordered reads (is_write 0) or writes (is_write 1) on a
+        key and re-evaluate its layout every evaluation_interval operations.
+
+        Reads only update the counts without the write lock. The layout is
+        changed holding it, so that no write is made to the columns being
+        replaced, and only if the key is still there to change.
+        """
+        access = self._access.get(key)
+
+        if access is None:
+            # Deleted by a concurrent delete_key.
+            return
+
+        access[is_write] += operations
+        access[2] += operations
+
+        if access[2] < self.policy.evaluation_interval:
+            return
+
+        with self.write_lock:
+            self._evaluate_layout(key, access)
+
+    def _evaluate_layout(self, key, access):
+        """
+        Move a key to the layout the policy chooses for it, holding the write
+        lock, given the access counts read by _record_access.
+        """
+        columns = self.keys.get(key)
+
+        # The key may have been deleted, re-created or evaluated by another
+        # reader since its counts were read.
+        if (columns is None or self._access.get(key) is not access or
+                access[2] < self.policy.evaluation_interval):
+            return
+
+        current_layout = HASH_LAYOUT if isinstance(columns, dict) else SORTED_LAYOUT
+        layout = self.policy.choose_layout(current_layout,
+                                           self.key_stats.column_count(key),
+                                           access[0], access[1])
+
+        if layout != current_layout:
+            if layout == SORTED_LAYOUT:
+                self.keys[key] = SortedColumns(columns.items())
+                self.promotions += 1
+            else:
+                self.keys[key] = columns.to_dict()
+                self.demotions += 1
+
+            if self.metrics.enabled:
+                self.metrics.inc('keycolval_adaptive_layout_changes_total', layout=layout)
+
+        # Halve the counts so that the mix reflects recent operations.
+        access[0] //= 2
+        access[1] //= 2
+        access[2] = 0
@@ -0,0 +1,46 @@
+"""
+A registry of the store implementations an application can be configured to
+use by name, which imports each one only when it's asked for.
+
+Backends are registered with the dotted path of their class so that
+registering one costs nothing, and an application only imports the store it
+runs. Other packages can register their own KeyColValStore implementations,
+by path or by class, before the application loads its data store.
+"""
+
+from importlib import import_module
+
+
+# name -> dotted path of the store class, or the class once imported.
+BACKENDS = {
+    'doubledict': 'keycolval.stores.doubledictstore.DoubleDictKeyColValStore',
+    'binarytree': 'keycolval.stores.binarytreestore.BinaryTreeKeyColValStore',
+    'adaptive': 'keycolval.stores.adaptivestore.AdaptiveKeyColValStore',
+    'shared-image': 'keycolval.stores.sharedstore.SharedImageKeyColValStore',
+}
+
+
+def register_backend(name, store_class):
+    """
+    Register a store class, or the dotted path of one, under name, replacing
+    any backend already registered under it.
+    """
+    BACKENDS[name] = store_class
+
+
+def load_backend(name):
+    """
+    Return the store class registered under name, importing it if needed.
+    Raises ValueError if no backend is registered under name.
+    """
+    try:
+        store_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown store backend %r, expected one of %s.'
+                         % (name, ', '.join(sorted(BACKENDS))))
+
+    if isinstance(store_class, str):
+        module_name, class_name = store_class.rsplit('.', 1)
+        store_class = BACKENDS[name] = getattr(import_module(module_name), class_name)
+
+    return store_class
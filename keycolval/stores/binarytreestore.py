@@ -1,5 +1,20 @@
+import threading
+from itertools import islice
+
 from keycolval.data_structures.binarytree import BinaryTree
+from keycolval.data_structures.expiryindex import ExpiryIndex
+from keycolval.data_structures.keyindex import SortedKeyIndex
+from keycolval.data_structures.numericcolumns import NumericColumnCache
 from keycolval.stores.abstract import KeyColValStore
+from keycolval.stores.reaper import ExpiryReaper
+from keycolval.stores.statistics import KeyStatisticsCatalog
+from keycolval.stores.versions import VersionHistory
+
+from keycolval.instrumentation.metrics import NULL_METRICS
+from keycolval.instrumentation.metrics import instrument
+
+from keycolval.persistence.query_persistor import QueryPersistor
+from keycolval.persistence.query_persistor import persist
 
 
 class BinaryTreeKeyColValStore(KeyColValStore):
@@ -15,49 +30,306 @@ class BinaryTreeKeyColValStore(KeyColValStore):
     def __init__(self, *args, **kwargs):
         self.keys = {}
 
+        # Held by every data altering call, see the persist decorator.
+        self.write_lock = threading.RLock()
+
+        # Operations are reported to a MetricsRegistry when one is given.
+        self.metrics = kwargs.get('metrics', NULL_METRICS)
+
+        # Note: Callbacks close over the keys dict rather than self to avoid
+        # reference cycles which would delay closing the data log.
+        keys = self.keys
+        self.metrics.register_gauge('keycolval_store_keys',
+                                    lambda: len(keys),
+                                    store=self.__class__.__name__)
+        self.metrics.register_gauge('keycolval_store_columns',
+                                    lambda: sum(len(tree) for tree in list(keys.values())),
+                                    store=self.__class__.__name__)
+
+        # Slow get_key/get_slice calls are recorded to a SlowQueryLog when
+        # one is given.
+        self.slow_query_log = kwargs.get('slow_query_log')
+
+        # Per-key statistics are kept up to date by every mutation.
+        key_stats = self.key_stats = KeyStatisticsCatalog(
+            lambda key: [col for col, val in keys[key].all()])
+        self.metrics.register_gauge('keycolval_store_bytes',
+                                    lambda: key_stats.total_bytes,
+                                    store=self.__class__.__name__)
+
+        # Ordered index of the keys for scan_keys and scan.
+        self.key_index = SortedKeyIndex()
+
+        # Values above the compressor's threshold are stored compressed when
+        # a ValueCompressor is given.
+        self.compressor = kwargs.get('compressor')
+
+        # Expiry times of the cells which expire.
+        self.expiry = ExpiryIndex()
+
+        # Data altering calls are numbered, and keys copied before they
+        # change while snapshots need them, for open_snapshot.
+        self.versions = VersionHistory()
+
+        # Large keys which are aggregated over are kept as arrays of numbers
+        # for count_slice, sum_slice and histogram_slice until next written.
+        self.numeric_columns = NumericColumnCache()
+
+        # Values are indexed for find_value and find_value_prefix when a
+        # ValueIndex is given.
+        self.value_index = kwargs.get('value_index')
+
+        if self.value_index is not None:
+            self.value_index.attach(self)
+
+        # The changes made by every logged call are published to a
+        # ChangeFeed for read_changes when one is given.
+        self.change_feed = kwargs.get('change_feed')
+
+        if self.change_feed is not None:
+            self.change_feed.attach(self)
+
+        # Memory use is kept within a MemoryBudget when one is given. Keys
+        # it moves out of memory are brought back by prepare_key.
+        self.memory_budget = kwargs.get('memory_budget')
+
+        if self.memory_budget is not None:
+            self.memory_budget.attach(self, persisted='path' in kwargs)
+
+        self.query_persistor = lambda *args, **kwargs: None
+
+        if 'path' in kwargs:
+            self.query_persistor = QueryPersistor(kwargs['path'], self,
+                                                  snapshot_every=kwargs.get('snapshot_every'),
+                                                  image_path=kwargs.get('image_path'),
+                                                  publish_interval=kwargs.get('publish_interval'),
+                                                  coalesce_window=kwargs.get('coalesce_window'),
+                                                  load_progress=kwargs.get('load_progress'))
+
+        # Expired cells which aren't read are reclaimed by a background
+        # reaper when a reap_interval in seconds is given.
+        self.reaper = None
+
+        if kwargs.get('reap_interval'):
+            self.reaper = ExpiryReaper(self, kwargs['reap_interval'])
+            self.reaper.start()
+
+    @instrument
+    @persist
     def set(self, key, col, val):
         """ sets the value at the given key/column """
         if not key in self.keys:
             self.keys[key] = BinaryTree()
+            self.key_index.add(key)
+
+        if self.compressor is not None:
+            val = self.compressor.compress(val)
+
+        old_val = self.keys[key].insert(col, val)
+        self.key_stats.record_set(key, col, val, old_val)
+        self.expiry.discard(key, col)
+
+        if self.value_index is not None:
+            self.value_index.record_set(key, col, val, old_val)
+
+    @instrument
+    @persist
+    def set_columns(self, key, columns):
+        """
+        sets every column/value pair in the list columns on the given key as
+        one operation. After a crash either all of them or none are restored
+
+        The columns are sorted and loaded into the key's tree as a batch,
+        which builds a balanced tree rather than inserting them one by one.
+        """
+        if not key in self.keys:
+            self.keys[key] = BinaryTree()
+            self.key_index.add(key)
+
+        # Later values for a repeated column win, as they would with a set
+        # call per column.
+        batch = sorted(dict(columns).items())
 
-        self.keys[key].insert(col, val)
+        if self.compressor is not None:
+            batch = [(col, self.compressor.compress(val)) for col, val in batch]
 
+        old_values = self.keys[key].bulk_load(batch)
+        changes = [(col, val, old_val) for (col, val), old_val in zip(batch, old_values)]
+        self.key_stats.record_sets(key, changes)
 
+        if self.value_index is not None:
+            self.value_index.record_sets(key, changes)
+
+        for col, val in batch:
+            self.expiry.discard(key, col)
+
+    @instrument
     def get(self, key, col):
         """ return the value at the specified key/column """
+        self.prepare_key(key)
+
         if not key in self.keys:
             return None
 
-        return self.keys[key].get(col)
+        val = self.keys[key].get(col)
+
+        if self.compressor is not None:
+            val = self.compressor.decompress(val)
+
+        return val
 
 
+    @instrument
     def get_key(self, key):
         """ returns a sorted list of column/value tuples """
+        self.prepare_key(key)
+        return self._sorted_columns(key)
+
+    def _sorted_columns(self, key):
+        """
+        Return the sorted list of column/value tuples for a key held in
+        memory, without counting a get_key or bringing an evicted key back.
+        """
         if not key in self.keys:
             return []
 
-        return self.keys[key].all()
+        columns = self.keys[key].all()
+
+        if self.compressor is not None:
+            columns = self.compressor.decompress_items(columns)
+
+        return columns
 
+    @instrument
     def get_keys(self):
         """ returns a set containing all of the keys in the store """
-        return set(self.keys.keys())
+        keys = set(self.keys.keys())
 
+        if self.memory_budget is not None:
+            keys.update(self.memory_budget.evicted_keys())
+
+        return keys
+
+    def _take_columns(self, key):
+        """
+        removes a key's columns from memory, leaving its statistics, index
+        entry and expiry times, and returns them as stored
+        """
+        return self.keys.pop(key).all()
+
+    def _put_columns(self, key, cells):
+        """
+        puts back the columns of a key taken by _take_columns
+        """
+        self.keys[key] = BinaryTree.from_sorted(cells)
+
+    def iter_cells(self):
+        """
+        generates (key, column, value) tuples for every cell in the store
+        straight from the trees, without decompressing
+        """
+        for key, tree in self.keys.items():
+            for col, val in tree.all():
+                yield key, col, val
+
+    @instrument
+    @persist
     def delete(self, key, col):
         """ removes a column/value from the given key """
-        self.keys[key].delete(col)
+        val = self.keys[key].delete(col)
+
+        if val is not None:
+            self.key_stats.record_delete(key, col, val)
+            self.expiry.discard(key, col)
+
+            if self.value_index is not None:
+                self.value_index.record_delete(key, col, val)
+
+    @instrument
+    @persist
+    def delete_slice(self, key, start, stop):
+        """
+        removes the columns of the given key between the start and stop
+        values inclusive, either of which can be None, as one operation.
+        Returns the number of columns removed
+
+        The columns are cut out of the tree in O(height + k).
+        """
+        if not key in self.keys:
+            return 0
+
+        removed = self.keys[key].delete_range(start, stop)
+        self.key_stats.record_deletes(key, removed)
+
+        if self.value_index is not None:
+            self.value_index.record_deletes(key, removed)
+
+        for col, val in removed:
+            self.expiry.discard(key, col)
+
+        return len(removed)
 
+    @instrument
+    @persist
     def delete_key(self, key):
         """ removes all data associated with the given key """
+        if self.value_index is not None:
+            self.value_index.record_deletes(key, self.keys[key].all())
+
         del self.keys[key]
+        self.key_stats.record_delete_key(key)
+        self.expiry.discard_key(key)
+        self.key_index.discard(key)
+
+        if self.memory_budget is not None:
+            self.memory_budget.forget(key)
 
-    def get_slice(self, key, start, stop):
+    @instrument
+    def get_slice(self, key, start, stop, reverse=False, limit=None, offset=0):
         """
         returns a sorted list of column/value tuples where the column
         values are between the start and stop values, inclusive of the
         start and stop values. Start and/or stop can be None values,
         leaving the slice open ended in that direction
+
+        The tree is walked from the boundary of the slice so this costs
+        O(height + offset + limit).
         """
-        node_range = self.keys[key].find_range(start, stop)
-        column_slice = [(node.key, node.value) for  node in node_range]
-        return column_slice
+        self.prepare_key(key)
+
+        if not key in self.keys:
+            return []
+
+        node_range = self.keys[key].iterate_range(start, stop, reverse)
+        return self._page_nodes(node_range, limit, offset)
+
+    @instrument
+    def get_prefix(self, key, prefix, reverse=False, limit=None, offset=0):
+        """
+        returns a sorted list of column/value tuples where the columns
+        start with prefix, paged in the same way as get_slice
+        """
+        self.prepare_key(key)
 
+        if not key in self.keys:
+            return []
+
+        node_range = self.keys[key].iterate_prefix(prefix, reverse)
+        return self._page_nodes(node_range, limit, offset)
+
+    def _page_nodes(self, node_range, limit, offset):
+        """
+        Skip offset nodes of a node iterator and return at most limit of the
+        following nodes as column/value tuples.
+        """
+        stop = None if limit is None else offset + limit
+        column_slice = [(node.key, node.value)
+                        for node in islice(node_range, offset, stop)]
+
+        if self.metrics.enabled:
+            self.metrics.observe_slice(offset + len(column_slice), len(column_slice))
+
+        if self.compressor is not None:
+            column_slice = self.compressor.decompress_items(column_slice)
+
+        return column_slice
@@ -1,4 +1,18 @@
+import threading
+
+from keycolval.data_structures.expiryindex import ExpiryIndex
+from keycolval.data_structures.keyindex import SortedKeyIndex
+from keycolval.data_structures.numericcolumns import NumericColumnCache
+from keycolval.data_structures.sortedcolumns import bisect_prefix
+from keycolval.data_structures.sortedcolumns import bisect_range
+from keycolval.data_structures.sortedcolumns import page
 from keycolval.stores.abstract import KeyColValStore
+from keycolval.stores.reaper import ExpiryReaper
+from keycolval.stores.statistics import KeyStatisticsCatalog
+from keycolval.stores.versions import VersionHistory
+
+from keycolval.instrumentation.metrics import NULL_METRICS
+from keycolval.instrumentation.metrics import instrument
 
 from keycolval.persistence.query_persistor import QueryPersistor
 from keycolval.persistence.query_persistor import persist
@@ -31,7 +45,75 @@ class DoubleDictKeyColValStore(KeyColValStore):
     """
     def __init__(self, *args, **kwargs):
         self.keys = {}
-        
+
+        # Held by every data altering call, see the persist decorator.
+        self.write_lock = threading.RLock()
+
+        # Operations are reported to a MetricsRegistry when one is given.
+        # The metrics attribute must be set before the persistor is created
+        # so that the persistor can report to the same registry.
+        self.metrics = kwargs.get('metrics', NULL_METRICS)
+
+        # Note: Callbacks close over the keys dict rather than self to avoid
+        # reference cycles which would delay closing the data log.
+        keys = self.keys
+        self.metrics.register_gauge('keycolval_store_keys',
+                                    lambda: len(keys),
+                                    store=self.__class__.__name__)
+        self.metrics.register_gauge('keycolval_store_columns',
+                                    lambda: sum(len(cols) for cols in list(keys.values())),
+                                    store=self.__class__.__name__)
+
+        # Slow get_key/get_slice calls are recorded to a SlowQueryLog when
+        # one is given.
+        self.slow_query_log = kwargs.get('slow_query_log')
+
+        # Per-key statistics are kept up to date by every mutation. This must
+        # exist before the persistor replays previously logged mutations.
+        key_stats = self.key_stats = KeyStatisticsCatalog(lambda key: keys[key].keys())
+        self.metrics.register_gauge('keycolval_store_bytes',
+                                    lambda: key_stats.total_bytes,
+                                    store=self.__class__.__name__)
+
+        # Ordered index of the keys for scan_keys and scan.
+        self.key_index = SortedKeyIndex()
+
+        # Values above the compressor's threshold are stored compressed when
+        # a ValueCompressor is given.
+        self.compressor = kwargs.get('compressor')
+
+        # Expiry times of the cells which expire.
+        self.expiry = ExpiryIndex()
+
+        # Data altering calls are numbered, and keys copied before they
+        # change while snapshots need them, for open_snapshot.
+        self.versions = VersionHistory()
+
+        # Large keys which are aggregated over are kept as arrays of numbers
+        # for count_slice, sum_slice and histogram_slice until next written.
+        self.numeric_columns = NumericColumnCache()
+
+        # Values are indexed for find_value and find_value_prefix when a
+        # ValueIndex is given.
+        self.value_index = kwargs.get('value_index')
+
+        if self.value_index is not None:
+            self.value_index.attach(self)
+
+        # The changes made by every logged call are published to a
+        # ChangeFeed for read_changes when one is given.
+        self.change_feed = kwargs.get('change_feed')
+
+        if self.change_feed is not None:
+            self.change_feed.attach(self)
+
+        # Memory use is kept within a MemoryBudget when one is given. Keys
+        # it moves out of memory are brought back by prepare_key.
+        self.memory_budget = kwargs.get('memory_budget')
+
+        if self.memory_budget is not None:
+            self.memory_budget.attach(self, persisted='path' in kwargs)
+
         # We are using QueryPersistor to persist this data store so we 
         # first set a dummy persistor which will do nothing if called.
         self.query_persistor = lambda *args, **kwargs: None
@@ -39,29 +121,105 @@ class DoubleDictKeyColValStore(KeyColValStore):
         # Then if a data path was specified we initialize an actual
         # persistor object.
         if 'path' in kwargs:
-            self.query_persistor = QueryPersistor(kwargs['path'], self)
-
+            self.query_persistor = QueryPersistor(kwargs['path'], self,
+                                                  snapshot_every=kwargs.get('snapshot_every'),
+                                                  image_path=kwargs.get('image_path'),
+                                                  publish_interval=kwargs.get('publish_interval'),
+                                                  coalesce_window=kwargs.get('coalesce_window'),
+                                                  load_progress=kwargs.get('load_progress'))
+
+        # Expired cells which aren't read are reclaimed by a background
+        # reaper when a reap_interval in seconds is given.
+        self.reaper = None
+
+        if kwargs.get('reap_interval'):
+            self.reaper = ExpiryReaper(self, kwargs['reap_interval'])
+            self.reaper.start()
+
+    @instrument
     @persist
     def set(self, key, col, val):
         """ sets the value at the given key/column """
 
         if not key in self.keys:
             self.keys[key] = {}
+            self.key_index.add(key)
+
+        if self.compressor is not None:
+            val = self.compressor.compress(val)
+
+        columns = self.keys[key]
+        old_val = columns.get(col)
+        self.key_stats.record_set(key, col, val, old_val)
+        self.expiry.discard(key, col)
+
+        if self.value_index is not None:
+            self.value_index.record_set(key, col, val, old_val)
 
         # Average O(1) performance.
-        self.keys[key][col] = val
+        columns[col] = val
+
+    @instrument
+    @persist
+    def set_columns(self, key, columns):
+        """
+        sets every column/value pair in the list columns on the given key as
+        one operation. After a crash either all of them or none are restored
+
+        The columns are written straight into the key's dict and its
+        statistics are updated once for the whole batch, which is what bulk
+        imports go through.
+        """
+        if not key in self.keys:
+            self.keys[key] = {}
+            self.key_index.add(key)
 
+        stored = self.keys[key]
+        compressor = self.compressor
+        discard_expiry = self.expiry.discard
+        changes = []
+
+        for col, val in columns:
+            if compressor is not None:
+                val = compressor.compress(val)
+
+            changes.append((col, val, stored.get(col)))
+            discard_expiry(key, col)
+            stored[col] = val
+
+        self.key_stats.record_sets(key, changes)
+
+        if self.value_index is not None:
+            self.value_index.record_sets(key, changes)
+
+    @instrument
     def get(self, key, col):
         """ return the value at the specified key/column """
+        self.prepare_key(key)
 
         if not key in self.keys or not col in self.keys[key]:
             return None
         
         # Average O(1) performance.
-        return self.keys[key][col]
+        val = self.keys[key][col]
 
+        if self.compressor is not None:
+            val = self.compressor.decompress(val)
+
+        return val
+
+    @instrument
     def get_key(self, key):
         """ returns a sorted list of column/value tuples """
+        self.prepare_key(key)
+        return self._sorted_columns(key)
+
+    def _sorted_columns(self, key):
+        """
+        Build the sorted list of column/value tuples for a key held in memory.
+        Unlike get_key it isn't counted by the instrumentation and doesn't
+        bring an evicted key back, so the version history copies keys with it.
+        """
         if not key in self.keys:
             return []
 
@@ -73,25 +231,100 @@ class DoubleDictKeyColValStore(KeyColValStore):
         # Sort using Timsort. Great for data that has already sorted
         # chunks.
         sorted_columns = sorted(columns, key=lambda tup: tup[0])
+        if self.compressor is not None:
+            sorted_columns = self.compressor.decompress_items(sorted_columns)
+
         return sorted_columns
 
+    @instrument
     def get_keys(self):
         """ returns a set containing all of the keys in the store """
-        return set(self.keys.keys())
+        keys = set(self.keys.keys())
+
+        if self.memory_budget is not None:
+            keys.update(self.memory_budget.evicted_keys())
+
+        return keys
+
+    def _take_columns(self, key):
+        """
+        removes a key's columns from memory, leaving its statistics, index
+        entry and expiry times, and returns them as stored
+        """
+        return list(self.keys.pop(key).items())
+
+    def _put_columns(self, key, cells):
+        """
+        puts back the columns of a key taken by _take_columns
+        """
+        self.keys[key] = dict(cells)
 
+    def iter_cells(self):
+        """
+        generates (key, column, value) tuples for every cell in the store
+        straight from the stored columns, without sorting or decompressing
+        """
+        for key, columns in self.keys.items():
+            for col, val in columns.items():
+                yield key, col, val
+
+    @instrument
     @persist
     def delete(self, key, col):
         """ removes a column/value from the given key """
 
-        del self.keys[key][col]
+        val = self.keys[key].pop(col)
+        self.key_stats.record_delete(key, col, val)
+        self.expiry.discard(key, col)
+
+        if self.value_index is not None:
+            self.value_index.record_delete(key, col, val)
+
+    @instrument
+    @persist
+    def delete_slice(self, key, start, stop):
+        """
+        removes the columns of the given key between the start and stop
+        values inclusive, either of which can be None, as one operation.
+        Returns the number of columns removed
+
+        Every column of the key is checked, so this is O(n) in its columns.
+        """
+        if not key in self.keys:
+            return 0
+
+        columns = self.keys[key]
+        removed = [(col, columns.pop(col)) for col in
+                   [col for col in columns
+                    if (start is None or col >= start) and (stop is None or col <= stop)]]
+
+        self.key_stats.record_deletes(key, removed)
+
+        if self.value_index is not None:
+            self.value_index.record_deletes(key, removed)
+
+        for col, val in removed:
+            self.expiry.discard(key, col)
 
+        return len(removed)
+
+    @instrument
     @persist
     def delete_key(self, key):
         """ removes all data associated with the given key """
-        
+        if self.value_index is not None:
+            self.value_index.record_deletes(key, list(self.keys[key].items()))
+
         del self.keys[key]
+        self.key_stats.record_delete_key(key)
+        self.expiry.discard_key(key)
+        self.key_index.discard(key)
 
-    def get_slice(self, key, start, stop):
+        if self.memory_budget is not None:
+            self.memory_budget.forget(key)
+
+    @instrument
+    def get_slice(self, key, start, stop, reverse=False, limit=None, offset=0):
         """
         returns a sorted list of column/value tuples where the column
         values are between the start and stop values, inclusive of the
@@ -106,28 +339,46 @@ class DoubleDictKeyColValStore(KeyColValStore):
 
         Some data structures to try would be sorted lists, ordered trees (binary tree)
         and balanced ordered trees (Splay Tree, etc...)
+
+        Once the columns are sorted we bisect for the slice boundaries, so the
+        reverse, limit and offset options add nothing to the cost of the sort.
         """
+        return self._page_sorted_columns(key, lambda columns: bisect_range(columns, start, stop),
+                                         reverse, limit, offset)
 
-        # This call iterates and then sorts all the columns in a key.
-        columns = self.get_key(key)
+    @instrument
+    def get_prefix(self, key, prefix, reverse=False, limit=None, offset=0):
+        """
+        returns a sorted list of column/value tuples where the columns
+        start with prefix, paged in the same way as get_slice
+        """
+        return self._page_sorted_columns(key, lambda columns: bisect_prefix(columns, prefix),
+                                         reverse, limit, offset)
 
-        result_set = []
-        
-        cur_col = columns.pop(0) if columns else None
-        done = False if cur_col else True
+    def _page_sorted_columns(self, key, find_bounds, reverse, limit, offset):
+        """
+        Sort the columns of a key, find the (lower, upper) bounds of the
+        requested columns with find_bounds and return the requested page of
+        column/value tuples.
+        """
+        self.prepare_key(key)
+
+        if not key in self.keys:
+            return []
+
+        values = self.keys[key]
 
-        while not done:
-            # Run until we're done.
+        # This sorts all the columns in a key.
+        columns = sorted(values)
+        lower, upper = find_bounds(columns)
 
-            if (start is None or cur_col[0] >= start) and (stop is None or cur_col[0] <= stop):
-                # We have a column in our target range.
-                result_set.append(cur_col)
+        result_set = [(col, values[col])
+                      for col in page(columns, lower, upper, reverse, limit, offset)]
 
-            # Grab the next column if there is one.
-            cur_col = columns.pop(0) if columns else None
+        if self.metrics.enabled:
+            self.metrics.observe_slice(len(columns), len(result_set))
 
-            if not cur_col or (stop and cur_col[0] > stop):
-                # We are done if we ran out of columns or if we ran past our stop_index.
-                done = True
+        if self.compressor is not None:
+            result_set = self.compressor.decompress_items(result_set)
 
         return result_set
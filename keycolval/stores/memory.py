@@ -0,0 +1,348 @@
+"""
+Memory accounting and eviction for the in-memory stores.
+
+Every store keeps the approximate payload bytes of each key in its
+KeyStatisticsCatalog. A MemoryBudget given to a store as the memory_budget
+keyword argument caps the bytes held in memory and applies a policy when a
+write would go over the cap:
+
+    REJECT  writes which could grow the store raise MemoryBudgetExceededError
+            until deletes bring it back under the cap.
+    EVICT   the least recently used keys are moved whole to a DiskTier file
+            and brought back the next time they're read or written.
+    DROP    the least recently used keys are dropped from memory and rebuilt
+            from the snapshot and data log the next time they're needed. Only
+            for persisted stores and keys which are rarely read, as bringing
+            one back reads through the whole data log.
+
+Evicted and dropped keys still exist as far as the store's interface is
+concerned: they're listed by get_keys and scan_keys, keep their statistics
+and expiry times and are included in snapshots.
+"""
+
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+from keycolval.instrumentation.metrics import NULL_METRICS
+from keycolval.persistence.records import decode_field
+from keycolval.persistence.records import encode_field
+
+
+REJECT = 'reject'
+EVICT = 'evict'
+DROP = 'drop'
+POLICIES = (REJECT, EVICT, DROP)
+
+# Logged calls which never grow a store, so they're still accepted when a
+# store with the REJECT policy is over its budget.
+SHRINKING_CALLS = ('delete', 'delete_key', 'delete_slice', 'expire')
+
+# The DiskTier file is rewritten once it holds at least this many bytes of
+# keys which have been taken back and more of those than of live keys.
+COMPACT_MIN_BYTES = 1 << 20
+
+
+class MemoryBudgetExceededError(Exception):
+    """
+    Exception raised when a write is rejected because the store is over its
+    memory budget.
+    """
+
+
+class DiskTier(object):
+    """
+    An append-only file holding the columns of keys evicted from memory, with
+    an in-memory index of where each key's columns are.
+
+    The file is a cache of data which is also in the store's data log, if it
+    has one, so it's emptied when opened. Reads map the file rather than
+    seeking, so a snapshot process forked off the store can read it while the
+    store carries on using it.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, 'w+b')
+        # key -> (offset, length)
+        self._index = {}
+        self._live_bytes = 0
+        self._dead_bytes = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def put(self, key, cells):
+        """
+        Write a list of a key's (column, value) tuples to the file.
+        """
+        flat = []
+
+        for col, val in cells:
+            flat.append(col)
+            flat.append(val)
+
+        data = encode_field([key, flat])
+
+        self._file.seek(0, os.SEEK_END)
+        self._index[key] = (self._file.tell(), len(data))
+        self._file.write(data)
+        self._file.flush()
+        self._live_bytes += len(data)
+
+    def take(self, key):
+        """
+        Remove a key from the file and return its (column, value) tuples.
+        """
+        offset, length = self._index.pop(key)
+        cells = self._read(self._file, offset, length)
+
+        self._live_bytes -= length
+        self._dead_bytes += length
+
+        if self._dead_bytes >= COMPACT_MIN_BYTES and self._dead_bytes > self._live_bytes:
+            self._compact()
+
+        return cells
+
+    def items(self):
+        """
+        Generate (key, column, value) tuples for every cell in the file.
+        """
+        for key, (offset, length) in list(self._index.items()):
+            for col, val in self._read(self._file, offset, length):
+                yield key, col, val
+
+    def _read(self, disk_file, offset, length):
+        buf = mmap.mmap(disk_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            key, flat = decode_field(buf, offset)[0]
+        finally:
+            buf.close()
+
+        return list(zip(flat[0::2], flat[1::2]))
+
+    def _compact(self):
+        """
+        Rewrite the file with only the keys which are still in it. The new
+        file is renamed over the old one, which a forked snapshot process may
+        still have open.
+        """
+        old_file = self._file
+        old_index = self._index
+        temp_path = '%s.compact' % self.file_path
+
+        self._file = open(temp_path, 'w+b')
+        self._index = {}
+        self._live_bytes = 0
+        self._dead_bytes = 0
+
+        for key, (offset, length) in old_index.items():
+            self.put(key, self._read(old_file, offset, length))
+
+        os.rename(temp_path, self.file_path)
+        old_file.close()
+
+
+class MemoryBudget(object):
+    """
+    Caps the approximate bytes of data a store holds in memory at max_bytes.
+
+    Under the EVICT and DROP policies keys are removed least recently used
+    first until the store is down to low_watermark of max_bytes, so eviction
+    happens in batches rather than on every write. EVICT needs the path of
+    the DiskTier file as disk_path.
+
+    A MemoryBudget tracks the keys of one store and is attached to it when
+    the store is created.
+    """
+
+    def __init__(self, max_bytes, policy=REJECT, disk_path=None, low_watermark=0.9):
+        if policy not in POLICIES:
+            raise ValueError('Unknown memory policy %r.' % policy)
+
+        if policy == EVICT and disk_path is None:
+            raise ValueError('The %s policy needs a disk_path.' % EVICT)
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.low_watermark = low_watermark
+        self.disk_tier = DiskTier(disk_path) if policy == EVICT else None
+        self.metrics = NULL_METRICS
+
+        # Resident keys, least recently used first.
+        self._lru = OrderedDict()
+        self._lru_lock = threading.Lock()
+        # Evicted or dropped key -> its bytes.
+        self._evicted = {}
+        self.evicted_bytes = 0
+        self._key_stats = None
+
+    def attach(self, store, persisted):
+        """
+        Start tracking store, whose KeyStatisticsCatalog does the byte
+        accounting.
+        """
+        if self.policy == DROP and not persisted:
+            raise ValueError('The %s policy needs a persisted store.' % DROP)
+
+        self._key_stats = store.key_stats
+        self.metrics = store.metrics
+
+        # Note: The gauges close over the budget, which holds no reference
+        # to the store.
+        self.metrics.register_gauge('keycolval_memory_used_bytes', self.used_bytes)
+        self.metrics.register_gauge('keycolval_memory_budget_bytes', lambda: self.max_bytes)
+        self.metrics.register_gauge('keycolval_memory_evicted_keys', lambda: len(self._evicted))
+
+    def used_bytes(self):
+        """
+        Return the approximate bytes of data held in memory.
+        """
+        return self._key_stats.total_bytes - self.evicted_bytes
+
+    def usage(self):
+        """
+        Return a dict describing the store's memory use.
+        """
+        return {
+            'used_bytes': self.used_bytes(),
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'evicted_keys': len(self._evicted),
+            'evicted_bytes': self.evicted_bytes,
+        }
+
+    def is_evicted(self, key):
+        return key in self._evicted
+
+    def evicted_keys(self):
+        """
+        Return a list of the keys which aren't in memory.
+        """
+        return list(self._evicted)
+
+    def touch(self, key):
+        """
+        Mark a key which is in memory, or is about to be, as the most
+        recently used.
+        """
+        with self._lru_lock:
+            self._lru.pop(key, None)
+            self._lru[key] = True
+
+    def forget(self, key):
+        """
+        Stop tracking a key which has been deleted.
+        """
+        with self._lru_lock:
+            self._lru.pop(key, None)
+
+    def check_write(self, func_name):
+        """
+        Raise MemoryBudgetExceededError if a logged call named func_name
+        can't be accepted.
+        """
+        if (self.policy == REJECT and func_name not in SHRINKING_CALLS and
+                self.used_bytes() >= self.max_bytes):
+            if self.metrics.enabled:
+                self.metrics.inc('keycolval_memory_rejected_writes_total')
+
+            raise MemoryBudgetExceededError(
+                'The store is using %d bytes of its %d byte memory budget.'
+                % (self.used_bytes(), self.max_bytes))
+
+    def make_room(self, store, keep_key):
+        """
+        Evict or drop least recently used keys other than keep_key until the
+        store is down to its low watermark, if it's over budget. Called with
+        the store's write lock held.
+        """
+        if self.policy == REJECT or self.used_bytes() <= self.max_bytes:
+            return
+
+        if self.policy == DROP and getattr(store, 'replaying', False):
+            # Dropped keys are rebuilt from the data log, which is still
+            # being loaded.
+            return
+
+        target = self.max_bytes * self.low_watermark
+
+        while self.used_bytes() > target:
+            key = self._pop_least_recently_used(keep_key)
+
+            if key is None:
+                break
+
+            if key in store.keys:
+                self._evict(store, key)
+
+    def _pop_least_recently_used(self, keep_key):
+        with self._lru_lock:
+            for key in self._lru:
+                if key != keep_key:
+                    break
+            else:
+                return None
+
+            del self._lru[key]
+            return key
+
+    def _evict(self, store, key):
+        size = self._key_stats.key_bytes(key)
+        cells = store._take_columns(key)
+
+        if self.policy == EVICT:
+            self.disk_tier.put(key, cells)
+
+        self._evicted[key] = size
+        self.evicted_bytes += size
+
+        if self.metrics.enabled:
+            self.metrics.inc('keycolval_memory_evictions_total', policy=self.policy)
+
+    def load(self, store, key):
+        """
+        Bring an evicted or dropped key back into memory. Called with the
+        store's write lock held.
+        """
+        if self.policy == EVICT:
+            cells = self.disk_tier.take(key)
+        else:
+            scratch = self._recover(store, set([key]), None)
+            cells = scratch._take_columns(key) if key in scratch.keys else []
+
+        store._put_columns(key, cells)
+        self.evicted_bytes -= self._evicted.pop(key)
+
+        if self.metrics.enabled:
+            self.metrics.inc('keycolval_memory_loads_total', policy=self.policy)
+
+    def iter_cells(self, store, log_offset=None):
+        """
+        Generate (key, column, value) tuples for every cell of the keys which
+        aren't in memory, as of the data log offset log_offset for dropped
+        keys.
+        """
+        if self.policy == EVICT:
+            for cell in self.disk_tier.items():
+                yield cell
+        elif self._evicted:
+            scratch = self._recover(store, set(self._evicted), log_offset)
+
+            for cell in scratch.iter_cells():
+                yield cell
+
+    def _recover(self, store, keys, log_offset):
+        """
+        Rebuild dropped keys in a new, empty store of the same class by
+        replaying their logged calls.
+        """
+        scratch = store.__class__(compressor=store.compressor)
+        store.query_persistor.replay_keys(scratch, keys, log_offset)
+        return scratch
@@ -0,0 +1,44 @@
+import threading
+import weakref
+
+
+class ExpiryReaper(threading.Thread):
+    """
+    A daemon thread which deletes a store's expired cells every interval
+    seconds, batch_size cells at a time so that writers get the write lock in
+    between batches.
+
+    Expired cells are already hidden from reads, which delete them on the
+    spot, so the reaper only reclaims the memory of cells which aren't read.
+
+    The reaper only holds a weak reference to its store and stops once the
+    store is gone.
+    """
+
+    def __init__(self, store, interval=1.0, batch_size=1000):
+        threading.Thread.__init__(self, name='keycolval-expiry-reaper')
+        self.daemon = True
+
+        self._store = weakref.ref(store)
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            store = self._store()
+
+            if store is None:
+                return
+
+            while store.reap_expired(self.batch_size) == self.batch_size:
+                pass
+
+            # Don't keep the store alive while waiting.
+            del store
+
+    def stop(self):
+        """
+        Stop the reaper after its current batch.
+        """
+        self._stopped.set()
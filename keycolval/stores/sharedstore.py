@@ -0,0 +1,290 @@
+import os
+import threading
+from time import time
+from timeit import default_timer
+
+from keycolval.data_structures.sortedcolumns import page
+from keycolval.data_structures.sortedcolumns import page_bounds
+from keycolval.persistence.image import ImageView
+from keycolval.stores.abstract import KeyColValStore
+
+from keycolval.instrumentation.metrics import NULL_METRICS
+from keycolval.instrumentation.metrics import instrument
+
+
+class ReadOnlyStoreError(Exception):
+    """
+    Exception raised when a data altering function is called on a read-only
+    store.
+    """
+
+
+class SharedImageKeyColValStore(KeyColValStore):
+    """
+    A read-only KeyColValStore implementation which answers queries from an
+    image file (see keycolval/persistence/image.py) published by a single
+    writer process.
+
+    The image is memory mapped rather than loaded, so every reader process on
+    the machine shares the one copy of the data in the page cache and a new
+    reader starts instantly. Lookups bisect the image in place.
+
+    The writer publishes a new image, versioned by the data log offset it's
+    consistent with, every time its QueryPersistor takes a snapshot when the
+    writer store is created with image_path, and with publish_interval set
+    also every publish_interval seconds while there are new writes. Readers
+    check for a new image at most every refresh_interval seconds and switch
+    to it atomically, so each call sees a single consistent version and
+    writes become visible to readers one published version at a time, at
+    most publish_interval plus refresh_interval seconds, and the time the
+    image takes to write, after they're made.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.path = kwargs['path']
+        self.refresh_interval = kwargs.get('refresh_interval', 0.5)
+
+        # Note: The image state lives in a dict the gauge callbacks can close
+        # over rather than on self to avoid reference cycles.
+        state = self._state = {'view': ImageView(), 'file_id': None, 'checked': None}
+
+        # Operations are reported to a MetricsRegistry when one is given.
+        self.metrics = kwargs.get('metrics', NULL_METRICS)
+
+        self.metrics.register_gauge('keycolval_store_keys',
+                                    lambda: state['view'].key_count,
+                                    store=self.__class__.__name__)
+        self.metrics.register_gauge('keycolval_shared_image_version',
+                                    lambda: state['view'].version or 0)
+
+        # Slow get_key/get_slice calls are recorded to a SlowQueryLog when
+        # one is given.
+        self.slow_query_log = kwargs.get('slow_query_log')
+
+        # The ValueCompressor the writer used, needed to read compressed values.
+        self.compressor = kwargs.get('compressor')
+
+        # The atomic operations of KeyColValStore need these to get as far
+        # as calling set, which rejects the write.
+        self.write_lock = threading.RLock()
+        self.query_persistor = lambda *args, **kwargs: None
+        self.memory_budget = None
+        self.versions = None
+        self.numeric_columns = None
+
+        self._view()
+
+    @property
+    def version(self):
+        """
+        The version of the image being read, which is the writer's data log
+        offset the image is consistent with, or None before one is published.
+        """
+        return self._view().version
+
+    @property
+    def expiry(self):
+        """
+        The ExpiryIndex of the expiring cells in the image being read. Cells
+        which expired after the image was written are skipped by every read.
+        """
+        return self._view().expiry
+
+    def _view(self):
+        """
+        Return the ImageView of the current image, mapping a newly published
+        image first if one has appeared since the last check.
+        """
+        state = self._state
+        now = default_timer()
+
+        if state['checked'] is not None and now - state['checked'] < self.refresh_interval:
+            return state['view']
+
+        state['checked'] = now
+
+        try:
+            stat = os.stat(self.path)
+            file_id = (stat.st_ino, stat.st_mtime, stat.st_size)
+        except OSError:
+            file_id = None
+
+        if file_id != state['file_id']:
+            # The old view stays valid for calls still using it and is
+            # unmapped once they're done with it.
+            state['view'] = ImageView(self.path)
+            state['file_id'] = file_id
+
+        return state['view']
+
+    def _decompress_items(self, items):
+        if self.compressor is not None:
+            return self.compressor.decompress_items(items)
+        return items
+
+    def set(self, key, col, val):
+        """ sets the value at the given key/column """
+        raise ReadOnlyStoreError('%s is read-only.' % self.__class__.__name__)
+
+    def delete(self, key, col):
+        """ removes a column/value from the given key """
+        raise ReadOnlyStoreError('%s is read-only.' % self.__class__.__name__)
+
+    def delete_key(self, key):
+        """ removes all data associated with the given key """
+        raise ReadOnlyStoreError('%s is read-only.' % self.__class__.__name__)
+
+    @instrument
+    def get(self, key, col):
+        """ return the value at the specified key/column """
+        view = self._view()
+        table = view.find_key(key)
+
+        if table is None or not view.is_live(key, col, time()):
+            return None
+
+        val = view.find_value(table, col)
+
+        if self.compressor is not None:
+            val = self.compressor.decompress(val)
+
+        return val
+
+    @instrument
+    def get_key(self, key):
+        """ returns a sorted list of column/value tuples """
+        view = self._view()
+        table = view.find_key(key)
+
+        if table is None:
+            return []
+
+        items = self._live_items(view, key, view.items(table, 0, view.column_count(table)))
+        return self._decompress_items(items)
+
+    @instrument
+    def get_keys(self):
+        """ returns a set containing all of the keys in the store """
+        view = self._view()
+        return set(view.keys(0, view.key_count))
+
+    @instrument
+    def get_slice(self, key, start, stop, reverse=False, limit=None, offset=0):
+        """
+        returns a sorted list of column/value tuples where the column
+        values are between the start and stop values, inclusive of the
+        start and stop values. Start and/or stop can be None values,
+        leaving the slice open ended in that direction
+
+        Slices bisect the key's column table in the image and decode only the
+        returned columns.
+        """
+        return self._page_columns(key, lambda view, table: view.column_bounds(table, start, stop),
+                                  reverse, limit, offset)
+
+    @instrument
+    def get_prefix(self, key, prefix, reverse=False, limit=None, offset=0):
+        """
+        returns a sorted list of column/value tuples where the columns
+        start with prefix, paged in the same way as get_slice
+        """
+        return self._page_columns(key, lambda view, table: view.prefix_bounds(table, prefix),
+                                  reverse, limit, offset)
+
+    def _page_columns(self, key, find_bounds, reverse, limit, offset):
+        """
+        Find the (lower, upper) bounds of the requested columns in a key's
+        column table with find_bounds and return the requested page of
+        column/value tuples.
+        """
+        view = self._view()
+        table = view.find_key(key)
+
+        if table is None:
+            return []
+
+        lower, upper = find_bounds(view, table)
+
+        if view.expiry.is_due(key, time()):
+            # Expired columns don't count towards the page.
+            items = self._live_items(view, key, view.items(table, lower, upper))
+            column_slice = page(items, 0, len(items), reverse, limit, offset)
+        else:
+            lower, upper = page_bounds(lower, upper, reverse, limit, offset)
+            column_slice = view.items(table, lower, upper, reverse)
+
+        if self.metrics.enabled:
+            self.metrics.observe_slice(len(column_slice), len(column_slice))
+
+        return self._decompress_items(column_slice)
+
+    def get_key_stats(self, key):
+        """
+        returns a dict with the column_count, min_column and max_column of the
+        given key or None if the key doesn't exist. Images don't carry the
+        other statistics
+        """
+        view = self._view()
+        table = view.find_key(key)
+
+        if table is None:
+            return None
+
+        count = view.column_count(table)
+        first = view.items(table, 0, 1)
+        last = view.items(table, count - 1, count)
+
+        return {
+            'column_count': count,
+            'min_column': first[0][0] if first else None,
+            'max_column': last[0][0] if last else None,
+        }
+
+    def get_top_keys(self, by='total_bytes', limit=10):
+        """
+        not available as images don't carry key statistics
+        """
+        raise ValueError('Key statistics are not available from a shared image.')
+
+    def memory_usage(self):
+        """
+        not available as the data is mapped from the image rather than held
+        in memory
+        """
+        raise ValueError('Memory usage is not tracked for a shared image.')
+
+    def scan_keys(self, start=None, stop=None, limit=None, reverse=False):
+        """
+        returns a sorted list of the keys between start and stop inclusive,
+        at most limit long, straight from the image's key directory
+        """
+        view = self._view()
+        lower, upper = page_bounds(*view.key_bounds(start, stop), reverse=reverse, limit=limit)
+        keys = view.keys(lower, upper)
+        return keys[::-1] if reverse else keys
+
+    def iter_cells(self):
+        """
+        generates (key, column, value) tuples for every cell in the image
+        """
+        view = self._view()
+
+        for index in range(view.key_count):
+            key = view.key(index)
+            table = view.find_key(key)
+
+            for col, val in self._live_items(view, key,
+                                             view.items(table, 0, view.column_count(table))):
+                yield key, col, val
+
+    def _live_items(self, view, key, items):
+        """
+        Return the column/value tuples of a key in items which haven't
+        expired.
+        """
+        now = time()
+
+        if not view.expiry.is_due(key, now):
+            return items
+
+        return [(col, val) for col, val in items if view.is_live(key, col, now)]
@@ -0,0 +1,276 @@
+"""
+Per-key statistics which KeyColValStore implementations maintain incrementally
+as data is written, so that hot and huge keys can be found without scanning
+every key with get_key.
+"""
+
+import heapq
+import math
+import sys
+import time
+
+
+# Time constant, in seconds, of the exponentially decayed write rate.
+WRITE_RATE_WINDOW = 60.0
+
+
+def approximate_size(obj):
+    """
+    Return the approximate number of bytes of payload in a key, column or
+    value. Strings are measured by length, anything else by getsizeof.
+    """
+    try:
+        return len(obj)
+    except TypeError:
+        return sys.getsizeof(obj)
+
+
+class KeyStatistics(object):
+    """
+    The statistics kept for a single key.
+    """
+    __slots__ = ('column_count', 'total_bytes', 'min_column', 'max_column',
+                 'bounds_stale', 'last_write', 'writes', '_write_rate')
+
+    def __init__(self):
+        self.column_count = 0
+        self.total_bytes = 0
+        self.min_column = None
+        self.max_column = None
+        # Set when the min or max column was deleted. The bounds are then
+        # recomputed the next time they are read.
+        self.bounds_stale = False
+        self.last_write = None
+        self.writes = 0
+        self._write_rate = 0.0
+
+    def record_write(self, now, count=1):
+        """
+        Update the write counters for count writes which happened at time now.
+        """
+        self._write_rate = self.write_rate(now) + float(count) / WRITE_RATE_WINDOW
+        self.last_write = now
+        self.writes += count
+
+    def write_rate(self, now):
+        """
+        Return the exponentially decayed number of writes per second as of
+        time now.
+        """
+        if self.last_write is None:
+            return 0.0
+
+        elapsed = max(now - self.last_write, 0.0)
+        return self._write_rate * math.exp(-elapsed / WRITE_RATE_WINDOW)
+
+
+class KeyStatisticsCatalog(object):
+    """
+    A catalog of KeyStatistics for every key in a store.
+
+    The store reports each mutation with the record_* methods. column_source
+    is a callable which returns an iterable of a key's columns and is only
+    used to recompute the min/max column after one of them is deleted.
+    """
+
+    def __init__(self, column_source):
+        self._column_source = column_source
+        self._stats = {}
+        # The approximate payload bytes of every key together.
+        self.total_bytes = 0
+
+    def record_set(self, key, col, val, old_val):
+        """
+        Record that col was set to val in key. old_val is the previous value of
+        the column or None if the column is new.
+        """
+        stats = self._stats.get(key)
+
+        if stats is None:
+            stats = self._stats[key] = KeyStatistics()
+
+        if old_val is None:
+            size = approximate_size(col) + approximate_size(val)
+            stats.column_count += 1
+            stats.total_bytes += size
+            self.total_bytes += size
+
+            if not stats.bounds_stale:
+                try:
+                    if stats.min_column is None or col < stats.min_column:
+                        stats.min_column = col
+                    if stats.max_column is None or col > stats.max_column:
+                        stats.max_column = col
+                except TypeError:
+                    # Columns that can't be ordered leave the bounds unknown.
+                    stats.bounds_stale = True
+        else:
+            size = approximate_size(val) - approximate_size(old_val)
+            stats.total_bytes += size
+            self.total_bytes += size
+
+        stats.record_write(time.time())
+
+    def record_sets(self, key, changes):
+        """
+        Record a batch of columns set in key at once, where changes is a list
+        of (col, val, old_val) tuples as for record_set. The write counters
+        are only updated once for the batch.
+        """
+        if not changes:
+            return
+
+        stats = self._stats.get(key)
+
+        if stats is None:
+            stats = self._stats[key] = KeyStatistics()
+
+        size = 0
+        new_columns = []
+
+        for col, val, old_val in changes:
+            if old_val is None:
+                size += approximate_size(col) + approximate_size(val)
+                new_columns.append(col)
+            else:
+                size += approximate_size(val) - approximate_size(old_val)
+
+        stats.column_count += len(new_columns)
+        stats.total_bytes += size
+        self.total_bytes += size
+
+        if new_columns and not stats.bounds_stale:
+            try:
+                low = min(new_columns)
+                high = max(new_columns)
+
+                if stats.min_column is None or low < stats.min_column:
+                    stats.min_column = low
+                if stats.max_column is None or high > stats.max_column:
+                    stats.max_column = high
+            except TypeError:
+                stats.bounds_stale = True
+
+        stats.record_write(time.time(), len(changes))
+
+    def record_delete(self, key, col, old_val):
+        """
+        Record that col, which held old_val, was removed from key.
+        """
+        stats = self._stats.get(key)
+
+        if stats is None:
+            return
+
+        size = approximate_size(col) + approximate_size(old_val)
+        stats.column_count -= 1
+        stats.total_bytes -= size
+        self.total_bytes -= size
+
+        if col == stats.min_column or col == stats.max_column:
+            stats.bounds_stale = True
+
+        stats.record_write(time.time())
+
+    def record_deletes(self, key, removed):
+        """
+        Record a batch of columns removed from key at once, where removed is a
+        list of the (col, old_val) tuples which were removed. The write
+        counters are only updated once for the batch.
+        """
+        stats = self._stats.get(key)
+
+        if stats is None or not removed:
+            return
+
+        size = sum(approximate_size(col) + approximate_size(old_val)
+                   for col, old_val in removed)
+        stats.column_count -= len(removed)
+        stats.total_bytes -= size
+        self.total_bytes -= size
+
+        cols = [col for col, old_val in removed]
+
+        if stats.min_column in cols or stats.max_column in cols:
+            stats.bounds_stale = True
+
+        stats.record_write(time.time(), len(removed))
+
+    def record_delete_key(self, key):
+        """
+        Record that key was removed entirely.
+        """
+        stats = self._stats.pop(key, None)
+
+        if stats is not None:
+            self.total_bytes -= stats.total_bytes
+
+    def get(self, key):
+        """
+        Return the statistics for key as a dict, or None if there is no such
+        key.
+        """
+        stats = self._stats.get(key)
+
+        if stats is None:
+            return None
+
+        if stats.bounds_stale:
+            self._refresh_bounds(key, stats)
+
+        return {
+            'column_count': stats.column_count,
+            'total_bytes': stats.total_bytes,
+            'min_column': stats.min_column,
+            'max_column': stats.max_column,
+            'last_write': stats.last_write,
+            'writes': stats.writes,
+            'write_rate': stats.write_rate(time.time()),
+        }
+
+    def column_count(self, key):
+        """
+        Return the number of columns in key without building a stats dict.
+        """
+        stats = self._stats.get(key)
+        return stats.column_count if stats is not None else 0
+
+    def key_bytes(self, key):
+        """
+        Return the approximate payload bytes of key without building a stats
+        dict.
+        """
+        stats = self._stats.get(key)
+        return stats.total_bytes if stats is not None else 0
+
+    def top_keys(self, by='total_bytes', limit=10):
+        """
+        Return a list of (key, stats dict) tuples for the limit keys with the
+        largest value for the statistic named by.
+        """
+        if by not in ('column_count', 'total_bytes', 'writes', 'write_rate'):
+            raise ValueError('Cannot rank keys by %r.' % by)
+
+        now = time.time()
+
+        if by == 'write_rate':
+            sort_key = lambda item: item[1].write_rate(now)
+        else:
+            sort_key = lambda item: getattr(item[1], by)
+
+        top = heapq.nlargest(limit, self._stats.items(), key=sort_key)
+        return [(key, self.get(key)) for key, stats in top]
+
+    def _refresh_bounds(self, key, stats):
+        """
+        Recompute the min and max column of a key by scanning its columns.
+        """
+        columns = list(self._column_source(key))
+
+        try:
+            stats.min_column = min(columns) if columns else None
+            stats.max_column = max(columns) if columns else None
+        except TypeError:
+            stats.min_column = stats.max_column = None
+
+        stats.bounds_stale = False
@@ -0,0 +1,249 @@
+"""
+Multi-version reads: a ReadSnapshot reads a store as of the moment it was
+opened, across any number of calls and keys, while writes carry on.
+
+Every data altering call made to a store is numbered by its VersionHistory,
+from before_persisted_call, and a snapshot is opened at the number of the
+last call. While any snapshot is open the first call to change a key after
+the newest snapshot was opened copies the key as it was before the call. A
+snapshot opened at sequence S reads a key from its oldest copy numbered after
+S, since that copy holds the key as of S, and from the store itself when
+there is no such copy, as the key hasn't changed since.
+
+Readers don't take the write lock. They read the key from the store first and
+look for a copy afterwards. A key is copied before it's changed, so if the
+read saw a change made after the snapshot, or failed because the key changed
+underneath it, the copy is there to be read instead.
+
+Copies which no open snapshot reads are dropped whenever a snapshot is
+closed. With no snapshots open nothing is copied and numbering a call is the
+only cost.
+"""
+
+from bisect import bisect_left
+from bisect import insort
+
+from keycolval.data_structures.sortedcolumns import bisect_prefix
+from keycolval.data_structures.sortedcolumns import bisect_range
+from keycolval.data_structures.sortedcolumns import page
+from keycolval.stores.statistics import approximate_size
+
+
+# Approximate bytes of bookkeeping per copy of a key and per copied column.
+COPY_OVERHEAD_BYTES = 200
+COLUMN_OVERHEAD_BYTES = 100
+
+
+class VersionHistory(object):
+    """
+    Numbers a store's data altering calls and keeps the copies of keys which
+    its open ReadSnapshots need. Its methods which change anything are called
+    holding the store's write lock.
+    """
+
+    def __init__(self):
+        # The number of the last data altering call.
+        self.sequence = 0
+        self.approximate_bytes = 0
+
+        # The sequence numbers of the open snapshots, sorted, with repeats.
+        self._open = []
+        # key -> list of (sequence, sorted columns, values dict, bytes)
+        # copies, oldest first. Lists are only ever appended to or replaced,
+        # so readers can use them without a lock.
+        self._copies = {}
+
+    def open_count(self):
+        """
+        Return the number of open snapshots.
+        """
+        return len(self._open)
+
+    def copies(self):
+        """
+        Return the number of copies of keys held.
+        """
+        return sum(len(copies) for copies in list(self._copies.values()))
+
+    def before_write(self, store, key):
+        """
+        Number a data altering call on key which is about to run, copying
+        the key first if an open snapshot needs it as it is now.
+        """
+        self.sequence += 1
+
+        if not self._open:
+            return
+
+        copies = self._copies.get(key)
+
+        if copies and copies[-1][0] > self._open[-1]:
+            # Already copied since the newest snapshot was opened.
+            return
+
+        # Not through get_key, which would count a read of the key.
+        columns = store._sorted_columns(key)
+        size = COPY_OVERHEAD_BYTES + sum(approximate_size(col) + approximate_size(val) +
+                                         COLUMN_OVERHEAD_BYTES for col, val in columns)
+        copy = (self.sequence, [col for col, val in columns], dict(columns), size)
+        self.approximate_bytes += size
+
+        if copies is None:
+            self._copies[key] = [copy]
+        else:
+            copies.append(copy)
+
+    def open(self):
+        """
+        Register a snapshot as of the last call and return its sequence.
+        """
+        insort(self._open, self.sequence)
+        return self.sequence
+
+    def close(self, sequence):
+        """
+        Unregister a snapshot opened at sequence and drop the copies which no
+        other open snapshot reads.
+        """
+        self._open.remove(sequence)
+
+        if not self._open:
+            self._copies = {}
+            self.approximate_bytes = 0
+            return
+
+        for key, copies in list(self._copies.items()):
+            kept = []
+            previous = 0
+
+            for copy in copies:
+                # A copy is read by the snapshots opened from the previous
+                # copy's sequence up to before its own.
+                if bisect_left(self._open, previous) < bisect_left(self._open, copy[0]):
+                    kept.append(copy)
+                else:
+                    self.approximate_bytes -= copy[3]
+
+                previous = copy[0]
+
+            if not kept:
+                del self._copies[key]
+            elif len(kept) < len(copies):
+                self._copies[key] = kept
+
+    def copy_for(self, key, sequence):
+        """
+        Return the copy of key which a snapshot opened at sequence reads, or
+        None if it reads the store.
+        """
+        copies = self._copies.get(key)
+
+        if not copies:
+            return None
+
+        index = bisect_left(copies, (sequence + 1,))
+        return copies[index] if index < len(copies) else None
+
+    def copies_for(self, sequence):
+        """
+        Generate (key, copy) for every key a snapshot opened at sequence
+        reads from a copy.
+        """
+        for key in list(self._copies):
+            copy = self.copy_for(key, sequence)
+
+            if copy is not None:
+                yield key, copy
+
+
+class ReadSnapshot(object):
+    """
+    Reads a store as of the data altering call numbered sequence. Returned by
+    KeyColValStore.open_snapshot and closed with close, or by using it as a
+    context manager.
+    """
+
+    def __init__(self, store, sequence):
+        self.store = store
+        self.sequence = sequence
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the snapshot so that the copies it needed can be dropped.
+        """
+        with self.store.write_lock:
+            if not self.closed:
+                self.closed = True
+                self.store.versions.close(self.sequence)
+
+    def get(self, key, col):
+        """ returns the value at the given key/column """
+        return self._read(key, lambda: self.store.get(key, col),
+                          lambda copy: copy[2].get(col))
+
+    def get_key(self, key):
+        """ returns a sorted list of column/value tuples """
+        return self._read(key, lambda: self.store.get_key(key),
+                          lambda copy: [(col, copy[2][col]) for col in copy[1]])
+
+    def get_slice(self, key, start, stop, reverse=False, limit=None, offset=0):
+        """ returns a page of the columns between start and stop inclusive """
+        return self._read(key,
+                          lambda: self.store.get_slice(key, start, stop, reverse, limit, offset),
+                          lambda copy: _page(copy, bisect_range(copy[1], start, stop),
+                                             reverse, limit, offset))
+
+    def get_prefix(self, key, prefix, reverse=False, limit=None, offset=0):
+        """ returns a page of the columns which start with prefix """
+        return self._read(key,
+                          lambda: self.store.get_prefix(key, prefix, reverse, limit, offset),
+                          lambda copy: _page(copy, bisect_prefix(copy[1], prefix),
+                                             reverse, limit, offset))
+
+    def get_keys(self):
+        """ returns a set containing all of the keys """
+        self._check_open()
+        keys = self.store.get_keys()
+
+        for key, copy in self.store.versions.copies_for(self.sequence):
+            if copy[1]:
+                keys.add(key)
+            else:
+                keys.discard(key)
+
+        return keys
+
+    def _read(self, key, read_store, read_copy):
+        self._check_open()
+
+        try:
+            result = read_store()
+        except Exception:
+            # The key may have changed while it was read, in which case it
+            # was copied first.
+            copy = self.store.versions.copy_for(key, self.sequence)
+
+            if copy is None:
+                raise
+
+            return read_copy(copy)
+
+        copy = self.store.versions.copy_for(key, self.sequence)
+        return result if copy is None else read_copy(copy)
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError('The snapshot is closed.')
+
+
+def _page(copy, bounds, reverse, limit, offset):
+    columns, values = copy[1], copy[2]
+    return [(col, values[col]) for col in page(columns, bounds[0], bounds[1],
+                                               reverse, limit, offset)]
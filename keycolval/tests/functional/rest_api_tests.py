@@ -1,7 +1,12 @@
 import unittest
 import keycolval.api
 from keycolval.api import app
+from keycolval.api.serialization import BINARY_MIMETYPE
+from keycolval.api.serialization import decode_columns
+from keycolval.persistence.changefeed import ChangeFeed
+from keycolval.persistence.progress import LoadProgress
 import json
+import time
 from datetime import datetime
 
 class RestAPITests(unittest.TestCase):
@@ -63,7 +68,15 @@ class RestAPITests(unittest.TestCase):
 
 		response = self.client.get('/get-keys/')
 		data = json.loads(response.data)
-		self.assertEqual(data, {'keys': ['b-key', 'a-key']})
+		self.assertEqual(data, {'keys': ['a-key', 'b-key'], 'next': None})
+
+		response = self.client.get('/get-keys/?limit=1')
+		data = json.loads(response.data)
+		self.assertEqual(data, {'keys': ['a-key'], 'next': 'b-key'})
+
+		response = self.client.get('/get-keys/?start=b-key&limit=1')
+		data = json.loads(response.data)
+		self.assertEqual(data, {'keys': ['b-key'], 'next': None})
 
 
 		self.client.post('/set/',
@@ -133,5 +146,328 @@ class RestAPITests(unittest.TestCase):
 
 		response = self.client.get('/get-keys/')
 		data = json.loads(response.data)
-		self.assertEqual(data, {'keys': ['b-key']})
+		self.assertEqual(data, {'keys': ['b-key'], 'next': None})
+
+
+	def test_metrics(self):
+		self.client.post('/set/',
+						 data={
+						 	'key': 'm-key',
+						 	'column': 'm-column',
+						 	'value': 'm-value'
+						 })
+		self.client.get('/get/m-key/m-column/')
+
+		response = self.client.get('/metrics')
+		self.assertEqual(response.status_code, 200)
+		self.assertIn('keycolval_store_operations_total{operation="set"}', response.data)
+		self.assertIn('keycolval_http_requests_total{endpoint="get_keycol"', response.data)
+
+		self.client.delete('/delete-key/m-key/')
+
+	def test_slow_queries(self):
+		self.client.post('/slow-queries/', data={'threshold': '0', 'clear': '1'})
+		self.client.post('/set/',
+						 data={
+						 	'key': 's-key',
+						 	'column': 's-column',
+						 	'value': 's-value'
+						 })
+		self.client.get('/get-key/s-key/')
+
+		response = self.client.get('/slow-queries/')
+		data = json.loads(response.data)
+		self.assertEqual(data['threshold'], 0)
+		self.assertEqual([(query['operation'], query['key'], query['columns'])
+						  for query in data['queries']],
+						 [('get_key', 's-key', 1)])
+
+		self.client.post('/slow-queries/', data={'threshold': 'none'})
+		self.client.delete('/delete-key/s-key/')
+
+	def test_profile(self):
+		response = self.client.post('/profile/', data={'sample_rate': '1', 'reset': '1'})
+		self.assertEqual(json.loads(response.data), {'sample_rate': 1.0, 'samples': 0})
+
+		self.client.get('/get-keys/')
+		self.client.post('/profile/', data={'sample_rate': '0'})
+
+		response = self.client.get('/profile/')
+		self.assertIn('sampled profiles', response.data)
+
+	def test_key_stats(self):
+		self.client.post('/set/',
+						 data={
+						 	'key': 'stats-key',
+						 	'column': 'col-a',
+						 	'value': 'value'
+						 })
+		self.client.post('/set/',
+						 data={
+						 	'key': 'stats-key',
+						 	'column': 'col-b',
+						 	'value': 'value'
+						 })
+
+		response = self.client.get('/stats/stats-key/')
+		data = json.loads(response.data)
+		self.assertEqual(data['column_count'], 2)
+		self.assertEqual((data['min_column'], data['max_column']), ('col-a', 'col-b'))
+
+		response = self.client.get('/stats/not-key/')
+		self.assertEqual(json.loads(response.data), {})
+
+		response = self.client.get('/stats/?by=column_count&limit=1')
+		data = json.loads(response.data)
+		self.assertEqual(len(data['keys']), 1)
+
+		response = self.client.get('/stats/?by=not-a-stat')
+		self.assertEqual(response.status_code, 400)
+
+		self.client.delete('/delete-key/stats-key/')
+
+	def test_get_prefix_and_paging(self):
+		for column in ['2026-10-16T23', '2026-10-17T01', '2026-10-17T03', '2026-10-18T00']:
+			self.client.post('/set/',
+							 data={
+							 	'key': 'time-key',
+							 	'column': column,
+							 	'value': 'value'
+							 })
+
+		response = self.client.get('/get-prefix/time-key/2026-10-17/')
+		data = json.loads(response.data)
+		self.assertEqual(sorted(data.keys()), ['2026-10-17T01', '2026-10-17T03'])
+
+		response = self.client.get('/get-slice/time-key/none/none/?reverse=1&limit=2')
+		data = json.loads(response.data)
+		self.assertEqual(sorted(data.keys()), ['2026-10-17T03', '2026-10-18T00'])
+
+		response = self.client.get('/get-slice/time-key/none/none/?limit=1&offset=1')
+		data = json.loads(response.data)
+		self.assertEqual(list(data.keys()), ['2026-10-17T01'])
+
+		for query in ('limit=abc', 'limit=-1', 'offset=1.5', 'offset=-2'):
+			response = self.client.get('/get-slice/time-key/none/none/?' + query)
+			self.assertEqual(response.status_code, 400)
+			response = self.client.get('/get-prefix/time-key/2026/?' + query)
+			self.assertEqual(response.status_code, 400)
+
+		self.client.delete('/delete-key/time-key/')
+
+	def test_snapshot(self):
+		self.client.post('/set/',
+						 data={
+						 	'key': 'snapshot-key',
+						 	'column': 'col-a',
+						 	'value': 'value'
+						 })
+
+		response = self.client.post('/snapshot/')
+		data = json.loads(response.data)
+		self.assertTrue(data['started'] in [True, False])
+
+		app.data_store.query_persistor.snapshot(wait=True)
+
+		response = self.client.get('/snapshot/')
+		data = json.loads(response.data)
+		self.assertFalse(data['in_progress'])
+		self.assertTrue(data['last_snapshot_offset'] > 0)
+
+		self.client.delete('/delete-key/snapshot-key/')
+
+	def test_binary_columns(self):
+		for column in ['col-b', 'col-a', 'col-c']:
+			self.client.post('/set/',
+							 data={
+							 	'key': 'binary-key',
+							 	'column': column,
+							 	'value': 'value,with\ncomma'
+							 })
+
+		response = self.client.get('/get-slice/binary-key/col-a/col-b/',
+								   headers={'Accept': BINARY_MIMETYPE})
+		self.assertEqual(response.mimetype, BINARY_MIMETYPE)
+		self.assertEqual(decode_columns(response.data),
+						 [('col-a', 'value,with\ncomma'), ('col-b', 'value,with\ncomma')])
+
+		# JSON responses keep the columns in order.
+		response = self.client.get('/get-key/binary-key/')
+		self.assertEqual(response.data.decode('utf-8').index('col-a') <
+						 response.data.decode('utf-8').index('col-c'), True)
+
+		self.client.delete('/delete-key/binary-key/')
+
+	def test_atomic_operations(self):
+		response = self.client.post('/compare-and-set/',
+									data={'key': 'atomic-key', 'column': 'state', 'value': 'started'})
+		self.assertEqual(json.loads(response.data), {'set': True})
+
+		response = self.client.post('/compare-and-set/',
+									data={'key': 'atomic-key', 'column': 'state',
+										  'expected': 'stopped', 'value': 'started'})
+		self.assertEqual(json.loads(response.data), {'set': False})
+
+		response = self.client.post('/increment/',
+									data={'key': 'atomic-key', 'column': 'counter', 'amount': '3'})
+		self.assertEqual(json.loads(response.data), {'value': 3})
+
+		response = self.client.post('/increment/',
+									data={'key': 'atomic-key', 'column': 'state'})
+		self.assertEqual(response.status_code, 400)
+
+		response = self.client.post('/append/',
+									data={'key': 'atomic-key', 'column': 'log', 'value': 'one'})
+		self.assertEqual(json.loads(response.data), {'value': 'one'})
+
+		self.client.post('/set-columns/',
+						 data={'key': 'atomic-key', 'column': ['col-a', 'col-b'],
+							   'value': ['val-a', 'val-b']})
+		response = self.client.get('/get/atomic-key/col-b/')
+		self.assertEqual(json.loads(response.data), {'value': 'val-b'})
+
+		response = self.client.delete('/delete-slice/atomic-key/col-a/col-b/')
+		self.assertEqual(json.loads(response.data), {'key': 'atomic-key', 'deleted': 2})
+		response = self.client.get('/get/atomic-key/col-a/')
+		self.assertEqual(json.loads(response.data), {'value': None})
+
+		self.client.delete('/delete-key/atomic-key/')
+
+	def test_set_with_ttl(self):
+		self.client.post('/set/', data={'key': 'ttl-key', 'column': 'col-a',
+										'value': 'val-a', 'ttl': '60'})
+		self.client.post('/set/', data={'key': 'ttl-key', 'column': 'col-b',
+										'value': 'val-b', 'ttl': '0.01'})
+		time.sleep(0.02)
+
+		response = self.client.get('/get/ttl-key/col-b/')
+		self.assertEqual(json.loads(response.data), {'value': None})
+		response = self.client.get('/get/ttl-key/col-a/')
+		self.assertEqual(json.loads(response.data), {'value': 'val-a'})
+
+		for ttl in ('abc', '-1', 'nan', 'inf'):
+			response = self.client.post('/set/', data={'key': 'ttl-key', 'column': 'col-c',
+														'value': 'val-c', 'ttl': ttl})
+			self.assertEqual(response.status_code, 400)
+
+		response = self.client.get('/get/ttl-key/col-c/')
+		self.assertEqual(json.loads(response.data), {'value': None})
+
+		self.client.delete('/delete-key/ttl-key/')
+
+	def test_memory(self):
+		self.client.post('/set/', data={'key': 'memory-key', 'column': 'col-a', 'value': 'val-a'})
+
+		response = self.client.get('/memory/')
+		data = json.loads(response.data)
+		self.assertTrue(data['used_bytes'] >= 10)
+		self.assertEqual(data['max_bytes'], None)
+
+		self.client.delete('/delete-key/memory-key/')
+
+	def test_find_value(self):
+		# The value index is off by default.
+		self.assertEqual(self.client.get('/find/some-value/').status_code, 404)
+		self.assertEqual(self.client.get('/find-prefix/some/').status_code, 404)
+
+	def test_get_many(self):
+		self.client.post('/set/', data={'key': 'many-a', 'column': 'col', 'value': 'a'})
+		self.client.post('/set/', data={'key': 'many-b', 'column': 'col', 'value': 'b'})
+		self.client.post('/set/', data={'key': 'many-b', 'column': 'another', 'value': 'c'})
+
+		data = json.loads(self.client.get('/get-many/?key=many-a&key=many-b&key=many-c').data)
+		self.assertEqual(data['keys'], [
+			{'key': 'many-a', 'columns': [['col', 'a']]},
+			{'key': 'many-b', 'columns': [['another', 'c'], ['col', 'b']]},
+			{'key': 'many-c', 'columns': []},
+		])
+
+		self.client.delete('/delete-key/many-a/')
+		self.client.delete('/delete-key/many-b/')
+
+	def test_changes(self):
+		# The change feed is off by default.
+		self.assertEqual(self.client.get('/changes/').status_code, 404)
+
+		app.data_store.change_feed = ChangeFeed()
+
+		try:
+			self.client.post('/set/', data={'key': 'feed-key', 'column': 'col', 'value': 'val'})
+			self.client.post('/set/', data={'key': 'other-key', 'column': 'col', 'value': 'val'})
+			self.client.delete('/delete-key/feed-key/')
+
+			data = json.loads(self.client.get('/changes/?prefix=feed-').data)
+			self.assertEqual(data['changes'], [
+				{'sequence': 1, 'type': 'set', 'key': 'feed-key', 'column': 'col', 'value': 'val'},
+				{'sequence': 3, 'type': 'delete_key', 'key': 'feed-key'},
+			])
+			self.assertEqual(data['next'], 3)
+
+			# Nothing has changed since, so this waits and returns nothing.
+			response = self.client.get('/changes/?after=3&wait=0.1&epoch=%s' % data['epoch'])
+			self.assertEqual(json.loads(response.data)['changes'], [])
+
+			self.assertEqual(self.client.get('/changes/?after=3&epoch=old').status_code, 410)
+		finally:
+			app.data_store.change_feed = None
+			self.client.delete('/delete-key/other-key/')
+
+	def test_import_export(self):
+		response = self.client.post('/import/?format=csv',
+									data='bulk-key,col-a,val-a\nbulk-key,col-b,val-b\n')
+		self.assertEqual(json.loads(response.data), {'cells': 2})
+
+		response = self.client.get('/export/?format=jsonl')
+		lines = [json.loads(line) for line in response.data.splitlines()]
+		self.assertTrue({'key': 'bulk-key', 'column': 'col-b', 'value': 'val-b'} in lines)
+
+		self.assertEqual(self.client.get('/export/?format=xml').status_code, 400)
+		self.client.delete('/delete-key/bulk-key/')
+
+	def test_slice_aggregates(self):
+		for i in range(10):
+			self.client.post('/set/', data={'key': 'agg-key', 'column': 'col-%d' % i,
+											 'value': str(i)})
+
+		self.client.post('/set/', data={'key': 'agg-key', 'column': 'name', 'value': 'text'})
+
+		data = json.loads(self.client.get('/count-slice/agg-key/col-2/none/').data)
+		self.assertEqual(data, {'count': 9, 'first': 'col-2', 'last': 'name'})
+
+		data = json.loads(self.client.get('/sum-slice/agg-key/none/none/').data)
+		self.assertEqual(data, {'count': 10, 'skipped': 1, 'sum': 45.0, 'min': 0.0, 'max': 9.0})
+
+		data = json.loads(self.client.get('/histogram-slice/agg-key/none/col-9/?bins=3').data)
+		self.assertEqual(data, {'counts': [3, 3, 4], 'edges': [0.0, 3.0, 6.0, 9.0],
+								'skipped': 0})
+
+		response = self.client.get('/histogram-slice/agg-key/none/none/?bins=0')
+		self.assertEqual(response.status_code, 400)
+
+		self.client.delete('/delete-key/agg-key/')
+
+	def test_ready(self):
+		response = self.client.get('/ready/')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(json.loads(response.data)['state'], 'ready')
+
+		loaded_progress = app.load_progress
+		app.load_progress = LoadProgress()
+		app.load_progress.begin()
+		app.load_progress.enter_phase('log', 1000)
+		app.load_progress.advance(250, 10)
+
+		try:
+			# While the data store loads only /ready/ and /metrics are served.
+			response = self.client.get('/ready/')
+			self.assertEqual(response.status_code, 503)
+			data = json.loads(response.data)
+			self.assertEqual((data['state'], data['phase'], data['phase_bytes']),
+							 ('loading', 'log', 250))
 
+			response = self.client.get('/get/a-key/a-column/')
+			self.assertEqual(response.status_code, 503)
+			self.assertEqual(response.headers['Retry-After'], '1')
+			self.assertEqual(self.client.get('/metrics').status_code, 200)
+		finally:
+			app.load_progress = loaded_progress
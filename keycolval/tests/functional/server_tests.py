@@ -0,0 +1,64 @@
+import json
+import threading
+import unittest
+from datetime import datetime
+
+try:
+	from httplib import HTTPConnection
+except ImportError:
+	from http.client import HTTPConnection
+
+from keycolval.api import app
+from keycolval.api.server import ThreadPoolWSGIServer
+from keycolval.api.server import warm_up
+
+class ServerTests(unittest.TestCase):
+
+	def setUp(self):
+		app.config['DATA_STORE_FILE'] = '/tmp/server-tests-data.%s' % datetime.now()
+		warm_up(app)
+
+		self.server = ThreadPoolWSGIServer('127.0.0.1', 0, app, threads=2)
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_keep_alive(self):
+		connection = HTTPConnection('127.0.0.1', self.server.server_address[1])
+
+		connection.request('POST', '/set/', 'key=server-key&column=col-a&value=val-a',
+						   {'Content-Type': 'application/x-www-form-urlencoded'})
+		response = connection.getresponse()
+		response.read()
+		self.assertFalse(response.will_close)
+		first_socket = connection.sock
+
+		connection.request('GET', '/get/server-key/col-a/')
+		response = connection.getresponse()
+		self.assertEqual(json.loads(response.read().decode('utf-8')), {'value': 'val-a'})
+		self.assertTrue(connection.sock is first_socket)
+
+		# Column responses are kept alive too.
+		for _ in range(2):
+			connection.request('GET', '/get-slice/server-key/col-a/col-z/')
+			response = connection.getresponse()
+			self.assertEqual(response.status, 200)
+			self.assertEqual(json.loads(response.read().decode('utf-8')), {'col-a': 'val-a'})
+			self.assertFalse(response.will_close)
+			self.assertTrue(connection.sock is first_socket)
+
+		# Only responses too large to send in one piece are streamed, without
+		# a Content-Length, so they close the connection.
+		app.data_store.set_columns('server-key', [('col-%06d' % i, 'x' * 100)
+												  for i in range(1000)])
+		connection.request('GET', '/get-key/server-key/')
+		response = connection.getresponse()
+		self.assertEqual(len(json.loads(response.read().decode('utf-8'))), 1001)
+		self.assertTrue(response.will_close)
+
+		connection.close()
+		app.data_store.delete_key('server-key')
@@ -0,0 +1,156 @@
+import time
+import unittest
+
+from keycolval.data_structures import numericcolumns
+from keycolval.data_structures.numericcolumns import NumericColumnCache
+from keycolval.data_structures.numericcolumns import NumericColumns
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+STORE_CLASSES = (DoubleDictKeyColValStore, BinaryTreeKeyColValStore, AdaptiveKeyColValStore)
+
+ITEMS = [('col-%02d' % i, str(i)) for i in range(10)] + [('col-x', 'not a number'),
+                                                        ('col-y', 'inf')]
+
+
+def layouts():
+    """
+    Return the array layouts to test: pure Python, and NumPy when it's
+    installed.
+    """
+    return (False, True) if numericcolumns.numpy is not None else (False,)
+
+
+class NumericColumnsTests(unittest.TestCase):
+    """
+    Unit tests for aggregating over the array backed NumericColumns.
+    """
+
+    def test_count(self):
+        for use_numpy in layouts():
+            columns = NumericColumns(ITEMS, use_numpy)
+
+            self.assertEqual(columns.count('col-03', 'col-05'),
+                             {'count': 3, 'first': 'col-03', 'last': 'col-05'})
+            self.assertEqual(columns.count(None, None)['count'], 12)
+            self.assertEqual(columns.count('z', None),
+                             {'count': 0, 'first': None, 'last': None})
+
+    def test_summarize(self):
+        for use_numpy in layouts():
+            columns = NumericColumns(ITEMS, use_numpy)
+
+            self.assertEqual(columns.summarize('col-02', 'col-04'),
+                             {'count': 3, 'skipped': 0, 'sum': 9.0, 'min': 2.0, 'max': 4.0})
+            # Values which aren't finite numbers are skipped.
+            self.assertEqual(columns.summarize(None, None),
+                             {'count': 10, 'skipped': 2, 'sum': 45.0, 'min': 0.0, 'max': 9.0})
+            self.assertEqual(columns.summarize('col-x', None),
+                             {'count': 0, 'skipped': 2, 'sum': 0.0, 'min': None, 'max': None})
+
+    def test_histogram(self):
+        for use_numpy in layouts():
+            columns = NumericColumns(ITEMS, use_numpy)
+
+            histogram = columns.histogram(None, None, bins=3)
+            self.assertEqual(histogram['edges'], [0.0, 3.0, 6.0, 9.0])
+            # Values on an edge go in the bin above, except in the last bin.
+            self.assertEqual(histogram['counts'], [3, 3, 4])
+            self.assertEqual(histogram['skipped'], 2)
+
+            histogram = columns.histogram('col-00', 'col-09', bins=2, lower=2, upper=6)
+            self.assertEqual(histogram['counts'], [2, 3])
+
+            # A single value gets a range of one around it.
+            histogram = columns.histogram('col-05', 'col-05', bins=2)
+            self.assertEqual((histogram['edges'], histogram['counts']),
+                             ([4.5, 5.0, 5.5], [0, 1]))
+
+            self.assertRaises(ValueError, columns.histogram, None, None, bins=0)
+            self.assertRaises(ValueError, columns.histogram, None, None, lower=2, upper=1)
+
+    def test_histogram_edges_match_scaling(self):
+        # Bin widths which aren't exact in binary put values near the edges
+        # to the test.
+        items = [('col-%04d' % i, repr(i * 0.1)) for i in range(1001)]
+        histogram = NumericColumns(items, False).histogram(None, None, bins=7)
+        edges = histogram['edges']
+        expected = [0] * 7
+
+        for col, val in items:
+            # The first bin whose upper edge is above the value, or the last.
+            below = [i for i in range(7) if float(val) < edges[i + 1]]
+            expected[below[0] if below else 6] += 1
+
+        self.assertEqual(histogram['counts'], expected)
+
+    def test_cache(self):
+        cache = NumericColumnCache(max_cells=24)
+        cache.put('a', NumericColumns(ITEMS))
+        cache.put('b', NumericColumns(ITEMS))
+        self.assertEqual(cache.cells, 24)
+
+        # a is used more recently than b, so b is dropped for c.
+        self.assertTrue(cache.get('a') is not None)
+        cache.put('c', NumericColumns(ITEMS[:1]))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.cells, 13)
+
+        cache.invalidate('a')
+        self.assertEqual((len(cache), cache.cells), (1, 1))
+
+        # Keys larger than the whole cache aren't held.
+        cache.put('d', NumericColumns(ITEMS * 3))
+        self.assertEqual(cache.get('d'), None)
+
+
+class SliceAggregateTests(unittest.TestCase):
+    """
+    Unit tests for the slice aggregates of the stores.
+    """
+
+    def test_aggregates(self):
+        for store_class in STORE_CLASSES:
+            for min_columns in (1000, 5):
+                store = store_class()
+                store.numeric_columns.min_columns = min_columns
+                store.set_columns('key', ITEMS)
+
+                self.assertEqual(store.count_slice('key', 'col-03', None)['count'], 9,
+                                 store_class.__name__)
+                self.assertEqual(store.sum_slice('key', 'col-05', 'col-09')['sum'], 35.0)
+                self.assertEqual(store.histogram_slice('key', None, None, bins=3)['counts'],
+                                 [3, 3, 4])
+                self.assertEqual(store.count_slice('missing', None, None)['count'], 0)
+                self.assertEqual(len(store.numeric_columns), 1 if min_columns == 5 else 0)
+
+    def test_writes_invalidate_cached_columns(self):
+        store = DoubleDictKeyColValStore()
+        store.numeric_columns.min_columns = 5
+        store.set_columns('key', ITEMS)
+        self.assertEqual(store.sum_slice('key', None, None)['sum'], 45.0)
+
+        store.increment('key', 'col-00', 10)
+        self.assertEqual(store.sum_slice('key', None, None)['sum'], 55.0)
+        store.delete_slice('key', 'col-05', 'col-09')
+        self.assertEqual(store.sum_slice('key', None, None)['sum'], 20.0)
+        self.assertTrue(store.memory_usage()['numeric_columns_bytes'] > 0)
+
+        store.delete_key('key')
+        self.assertEqual(store.count_slice('key', None, None)['count'], 0)
+        self.assertEqual(len(store.numeric_columns), 0)
+
+    def test_expired_cells_are_not_counted(self):
+        store = DoubleDictKeyColValStore()
+        store.numeric_columns.min_columns = 5
+        store.set_columns('key', ITEMS)
+        store.set_with_ttl('key', 'col-brief', '100', 0.05)
+        self.assertEqual(store.sum_slice('key', None, None)['sum'], 145.0)
+
+        time.sleep(0.1)
+        self.assertEqual(store.sum_slice('key', None, None)['sum'], 45.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
 from keycolval.data_structures.binarytree import BinaryTree
+import random
 import unittest
 
+
+def height(node):
+    if node is None:
+        return 0
+    return 1 + max(height(node.left), height(node.right))
+
+
 class ColumnTreeTests(unittest.TestCase):
     """
     Quick and dirty tests for our BinaryTree implementation.
@@ -60,3 +68,100 @@ class ColumnTreeTests(unittest.TestCase):
                           ('af', 'xfxx'),
                           ('ag', 'xgxx')])
 
+    def test_tree_iterate_range_success(self):
+        tree = BinaryTree()
+        for key in ['ad', 'ab', 'af', 'aa', 'ac', 'ae', 'ag']:
+            tree.insert(key, 'x%sx' % key)
+
+        self.assertEqual([node.key for node in tree.iterate_range('ab', 'ae')],
+                         ['ab', 'ac', 'ad', 'ae'])
+        self.assertEqual([node.key for node in tree.iterate_range('ab', 'ae', reverse=True)],
+                         ['ae', 'ad', 'ac', 'ab'])
+        self.assertEqual([node.key for node in tree.iterate_range(None, 'ab')],
+                         ['aa', 'ab'])
+        self.assertEqual([node.key for node in tree.iterate_prefix('a', reverse=True)][:2],
+                         ['ag', 'af'])
+        self.assertEqual(list(tree.iterate_range('b', None)), [])
+
+    def test_tree_from_sorted_success(self):
+        items = [('col-%04d' % i, 'val-%d' % i) for i in range(1680)]
+        tree = BinaryTree.from_sorted(items)
+
+        self.assertEqual(tree.all(), items)
+        self.assertEqual(len(tree), 1680)
+        self.assertEqual(height(tree._root), 11)
+        self.assertEqual(tree.get('col-0999'), 'val-999')
+
+        # Parent links are set up for deletes.
+        tree.delete('col-0840')
+        tree.delete('col-0000')
+        self.assertEqual(len(tree.all()), 1678)
+        self.assertEqual(len(BinaryTree.from_sorted([])), 0)
+
+    def test_tree_bulk_load_success(self):
+        tree = BinaryTree()
+        for i in range(0, 100, 2):
+            tree.insert('%03d' % i, 'old')
+
+        old_values = tree.bulk_load([('%03d' % i, 'new') for i in range(90, 110)])
+
+        self.assertEqual(old_values, ['old', None] * 5 + [None] * 10)
+        self.assertEqual(len(tree), 110 - 45)
+        self.assertEqual(tree.get('090'), 'new')
+        self.assertEqual(tree.get('088'), 'old')
+        self.assertEqual([key for key, value in tree.all()],
+                         sorted(set(['%03d' % i for i in range(0, 100, 2)] +
+                                    ['%03d' % i for i in range(90, 110)])))
+
+        # The sorted inserts left the tree a chain, which a large batch rebuilds.
+        self.assertEqual(height(tree._root), 7)
+
+        # A small batch is inserted a pair at a time.
+        self.assertEqual(tree.bulk_load([('050', 'newer')]), ['old'])
+        self.assertEqual(tree.get('050'), 'newer')
+
+    def test_tree_delete_edge_cases_success(self):
+        # The root with only one child.
+        tree = BinaryTree()
+        tree.insert('ab', 'xbxx')
+        tree.insert('ac', 'xcxx')
+        tree.delete('ab')
+        self.assertEqual(tree.all(), [('ac', 'xcxx')])
+
+        # The only node.
+        tree.delete('ac')
+        self.assertEqual(tree.all(), [])
+        self.assertEqual(len(tree), 0)
+
+        # A successor with a right child keeps it.
+        for key in ['ad', 'ab', 'ah', 'ae', 'af']:
+            tree.insert(key, 'x')
+        tree.delete('ad')
+        self.assertEqual([key for key, value in tree.all()], ['ab', 'ae', 'af', 'ah'])
+
+    def test_tree_delete_range_success(self):
+        rng = random.Random(7)
+
+        for _ in range(50):
+            keys = rng.sample(range(200), 60)
+            tree = BinaryTree()
+            for key in keys:
+                tree.insert(key, -key)
+
+            start, end = sorted(rng.sample(range(-10, 210), 2))
+            start = None if start < 0 else start
+            end = None if end > 199 else end
+            expected = sorted(key for key in keys if (start is None or key >= start) and
+                              (end is None or key <= end))
+
+            self.assertEqual(tree.delete_range(start, end), [(key, -key) for key in expected])
+            self.assertEqual([key for key, value in tree.all()],
+                             sorted(set(keys) - set(expected)))
+            self.assertEqual(len(tree), 60 - len(expected))
+
+            # Parent links still lead back to the root.
+            for node in tree.iterate_range():
+                top = node
+                while top.parent is not None:
+                    top = top.parent
+                self.assertTrue(top is tree._root)
@@ -0,0 +1,136 @@
+import io
+import os
+import time
+import unittest
+from datetime import datetime
+
+from keycolval.data_structures.compressedvalue import ValueCompressor
+from keycolval.persistence.bulk import export_file
+from keycolval.persistence.bulk import export_stream
+from keycolval.persistence.bulk import import_file
+from keycolval.persistence.bulk import import_stream
+from keycolval.persistence.bulk import iter_export
+from keycolval.persistence.records import verify_log
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+CSV_DATA = (b'b-key,col-b,val-b\n'
+            b'a-key,col-b,val-b\n'
+            b'a-key,col-a,"val, with a comma"\n'
+            b'b-key,col-a,"val with a\nline break and ""quotes"""\n'
+            b'a-key,col-b,newer-val-b\n')
+
+CELLS = [('a-key', 'col-a', 'val, with a comma'),
+         ('a-key', 'col-b', 'newer-val-b'),
+         ('b-key', 'col-a', 'val with a\nline break and "quotes"'),
+         ('b-key', 'col-b', 'val-b')]
+
+
+def sorted_cells(store):
+    return sorted(cell for key in store.get_keys() for cell in
+                  [(key, col, val) for col, val in store.get_key(key)])
+
+
+class BulkImportExportTests(unittest.TestCase):
+    """
+    Unit tests for bulk imports and exports.
+    """
+
+    STORE_CLASSES = [DoubleDictKeyColValStore, BinaryTreeKeyColValStore, AdaptiveKeyColValStore]
+
+    def setUp(self):
+        self.file_path = '/tmp/keycolval.testdata.%s' % datetime.now()
+
+    def tearDown(self):
+        for suffix in ('.log', '.csv', '.tsv', '.jsonl', '.dump'):
+            if os.path.exists(self.file_path + suffix):
+                os.remove(self.file_path + suffix)
+
+    def test_import_csv(self):
+        for store_class in self.STORE_CLASSES:
+            # Tiny chunks make chunk boundaries fall inside quoted fields.
+            for chunk_bytes in (8, 1 << 20):
+                store = store_class()
+                import_stream(store, io.BytesIO(CSV_DATA), 'csv', chunk_bytes=chunk_bytes)
+                self.assertEqual(sorted_cells(store), CELLS)
+
+            # Rows for the same column within a chunk are only written once.
+            self.assertEqual(import_stream(store_class(), io.BytesIO(CSV_DATA), 'csv'), 4)
+
+    def test_import_logs_a_record_per_key(self):
+        store = DoubleDictKeyColValStore(path=self.file_path + '.log')
+        import_stream(store, io.BytesIO(CSV_DATA), 'csv')
+        del store
+
+        self.assertEqual(verify_log(self.file_path + '.log')['records'], 2)
+
+        store = DoubleDictKeyColValStore(path=self.file_path + '.log')
+        self.assertEqual(sorted_cells(store), CELLS)
+
+    def test_import_with_processes(self):
+        data = b''.join(b'key-%d,col-%d,val-%d\n' % (i % 7, i, i) for i in range(1000))
+        store = DoubleDictKeyColValStore()
+
+        self.assertEqual(import_stream(store, io.BytesIO(data), 'csv', processes=2,
+                                       chunk_bytes=1000), 1000)
+        self.assertEqual(store.get('key-3', 'col-997'), 'val-997')
+        self.assertEqual(store.get_key_stats('key-0')['column_count'], 143)
+
+    def test_round_trips(self):
+        source = DoubleDictKeyColValStore(compressor=ValueCompressor(threshold=0))
+        import_stream(source, io.BytesIO(CSV_DATA), 'csv')
+
+        for extension in ('.csv', '.tsv', '.jsonl', '.dump'):
+            self.assertTrue(export_file(source, self.file_path + extension) > 0)
+
+            for store_class in self.STORE_CLASSES:
+                store = store_class()
+                self.assertEqual(import_file(store, self.file_path + extension), 4)
+                self.assertEqual(sorted_cells(store), CELLS)
+
+    def test_export_is_consistent(self):
+        store = DoubleDictKeyColValStore()
+        import_stream(store, io.BytesIO(CSV_DATA), 'csv')
+
+        chunks = iter_export(store, 'jsonl')
+        store.set('c-key', 'col-a', 'val-a')
+        store.delete_key('a-key')
+
+        exported = DoubleDictKeyColValStore()
+        import_stream(exported, io.BytesIO(b''.join(chunks)), 'jsonl')
+        self.assertEqual(sorted_cells(exported), CELLS)
+
+    def test_expiring_cells(self):
+        store = DoubleDictKeyColValStore()
+        import_stream(store, io.BytesIO(CSV_DATA), 'csv')
+        store.set_with_ttl('a-key', 'col-brief', 'val', 0.05)
+        store.set_with_ttl('c-key', 'col-brief', 'val', 0.05)
+        store.set_with_ttl('a-key', 'col-c', 'val-c', 3600)
+        expire_at = store.expiry.get('a-key', 'col-c')
+        time.sleep(0.1)
+
+        for file_format in ('csv', 'dump'):
+            exported = io.BytesIO()
+            export_stream(store, exported, file_format)
+            imported = DoubleDictKeyColValStore()
+            self.assertEqual(import_stream(imported, io.BytesIO(exported.getvalue()),
+                                           file_format), 5)
+
+            # Expired cells are left out and dumps keep the expiry times.
+            self.assertEqual(sorted_cells(imported), sorted(CELLS + [('a-key', 'col-c', 'val-c')]))
+            self.assertEqual(imported.expiry.get('a-key', 'col-c'),
+                             expire_at if file_format == 'dump' else None)
+
+    def test_corrupt_dump(self):
+        store = DoubleDictKeyColValStore()
+        import_stream(store, io.BytesIO(CSV_DATA), 'csv')
+
+        dump = io.BytesIO()
+        export_stream(store, dump, 'dump')
+
+        self.assertRaises(ValueError, import_stream, DoubleDictKeyColValStore(),
+                          io.BytesIO(dump.getvalue()[:-30]), 'dump')
+        self.assertRaises(ValueError, import_stream, DoubleDictKeyColValStore(),
+                          io.BytesIO(CSV_DATA), 'dump')
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+import unittest
+from datetime import datetime
+
+from keycolval.persistence.changefeed import ChangeFeed
+from keycolval.persistence.changefeed import ChangesExpiredError
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+class ChangeFeedTests(unittest.TestCase):
+    """
+    Unit tests for the ChangeFeed and the changes stores publish to it.
+    """
+
+    def test_store_changes(self):
+        for store_class in (DoubleDictKeyColValStore, BinaryTreeKeyColValStore,
+                            AdaptiveKeyColValStore):
+            store = store_class(change_feed=ChangeFeed())
+
+            store.set('key', 'a', '1')
+            store.set_columns('key', [('b', '2'), ('c', '3')])
+            self.assertTrue(store.compare_and_set('key', 'a', '1', '4'))
+            self.assertFalse(store.compare_and_set('key', 'a', '1', '5'))
+            store.increment('key', 'd', 2)
+            store.append('key', 'a', '!')
+            store.set_with_ttl('key', 'e', '6', 3600)
+            store.expire('key', 'e', None)
+            store.delete('key', 'e')
+            store.delete_slice('key', 'b', 'c')
+            store.delete_slice('key', 'x', 'z')
+            store.delete_key('key')
+
+            self.assertEqual(store.read_changes()['changes'], [
+                (1, 'set', 'key', 'a', '1'),
+                (2, 'set', 'key', 'b', '2'),
+                (3, 'set', 'key', 'c', '3'),
+                (4, 'set', 'key', 'a', '4'),
+                (5, 'set', 'key', 'd', '2'),
+                (6, 'set', 'key', 'a', '4!'),
+                (7, 'set', 'key', 'e', '6'),
+                (8, 'delete', 'key', 'e'),
+                (9, 'delete_slice', 'key', 'b', 'c'),
+                (10, 'delete_key', 'key'),
+            ], store_class.__name__)
+
+    def test_expired_cells_are_deletes(self):
+        store = DoubleDictKeyColValStore(change_feed=ChangeFeed())
+        store.set_until('key', 'col', 'val', time.time() - 1)
+        store.get('key', 'col')
+
+        self.assertEqual(store.read_changes()['changes'],
+                         [(1, 'set', 'key', 'col', 'val'), (2, 'delete', 'key', 'col')])
+
+    def test_failed_and_replayed_calls_are_not_published(self):
+        path = '/tmp/changefeed-tests-data.%s' % datetime.now()
+
+        try:
+            store = DoubleDictKeyColValStore(path=path, change_feed=ChangeFeed())
+            store.set('key', 'col', '1')
+            self.assertRaises(ValueError, store.increment, 'key', 'col', 'x')
+            self.assertEqual(store.change_feed.last_sequence, 1)
+            store.query_persistor.flush()
+
+            reopened = DoubleDictKeyColValStore(path=path, change_feed=ChangeFeed())
+            self.assertEqual(reopened.get('key', 'col'), '1')
+            self.assertEqual(reopened.read_changes()['changes'], [])
+        finally:
+            os.remove(path)
+
+    def test_filters_and_paging(self):
+        feed = ChangeFeed()
+        feed.publish([('set', 'user-1', 'col', 'a'), ('set', 'item-1', 'col', 'b'),
+                      ('delete', 'user-2', 'col'), ('delete_key', 'user-1')])
+
+        changes, cursor = feed.read(key='user-1')
+        self.assertEqual(changes, [(1, 'set', 'user-1', 'col', 'a'), (4, 'delete_key', 'user-1')])
+        self.assertEqual(cursor, 4)
+
+        changes, cursor = feed.read(prefix='user-', limit=2)
+        self.assertEqual([change[0] for change in changes], [1, 3])
+        self.assertEqual(cursor, 3)
+
+        changes, cursor = feed.read(cursor, prefix='user-')
+        self.assertEqual([change[0] for change in changes], [4])
+
+        # Changes which don't match still move the cursor on.
+        self.assertEqual(feed.read(prefix='nothing-'), ([], 4))
+        self.assertEqual(feed.read(4), ([], 4))
+
+    def test_bounded_history(self):
+        feed = ChangeFeed(capacity=3)
+        feed.publish([('delete', 'key', str(i)) for i in range(5)])
+
+        self.assertEqual([change[0] for change in feed.read(2)[0]], [3, 4, 5])
+        self.assertRaises(ChangesExpiredError, feed.read, 1)
+        self.assertRaises(ChangesExpiredError, feed.read, 6)
+        self.assertRaises(ChangesExpiredError, feed.read, 5, epoch='other')
+        self.assertEqual(feed.read(5, epoch=feed.epoch), ([], 5))
+
+    def test_wait_for_changes(self):
+        feed = ChangeFeed()
+        results = []
+
+        consumer = threading.Thread(target=lambda: results.append(feed.read(wait=5)))
+        consumer.start()
+        time.sleep(0.05)
+        start = time.time()
+        feed.publish([('delete_key', 'key')])
+        consumer.join()
+
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(results, [([(1, 'delete_key', 'key')], 1)])
+
+        start = time.time()
+        self.assertEqual(feed.read(1, wait=0.05), ([], 1))
+        self.assertTrue(time.time() - start >= 0.05)
+
+    def test_no_change_feed(self):
+        self.assertRaises(ValueError, DoubleDictKeyColValStore().read_changes)
+
+
+if __name__ == '__main__':
+    unittest.main()
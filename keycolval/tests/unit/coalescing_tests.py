@@ -0,0 +1,159 @@
+import gc
+import os
+import time
+import unittest
+import weakref
+from datetime import datetime
+
+from keycolval.data_structures.compressedvalue import ValueCompressor
+from keycolval.instrumentation.metrics import MetricsRegistry
+from keycolval.persistence import query_persistor
+from keycolval.persistence.snapshot import snapshot_path
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+class WriteCoalescingTests(unittest.TestCase):
+    """
+    Unit tests for coalescing repeated writes to the same cell in the data log.
+    """
+
+    def setUp(self):
+        self.file_path = '/tmp/keycolval.coalescing.%s.log' % datetime.now()
+
+    def tearDown(self):
+        for path in (self.file_path, snapshot_path(self.file_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_hot_cells_are_logged_once(self):
+        for store_class in (DoubleDictKeyColValStore, BinaryTreeKeyColValStore,
+                            AdaptiveKeyColValStore):
+            store = store_class(path=self.file_path, coalesce_window=60)
+
+            for i in range(1000):
+                store.increment('key', 'count')
+                store.set('key', 'last-seen', str(i))
+
+            store.append('key', 'log', 'a')
+            store.append('key', 'log', 'b')
+            self.assertTrue(store.compare_and_set('key', 'last-seen', '999', 'done'))
+            self.assertFalse(store.compare_and_set('key', 'last-seen', '999', 'never'))
+            store.set('other', 'col', 'val')
+            store.query_persistor.flush()
+
+            reopened = store_class(path=self.file_path)
+            self.assertEqual(reopened.get_key('key'),
+                             [('count', '1000'), ('last-seen', 'done'), ('log', 'ab')],
+                             store_class.__name__)
+            self.assertEqual(reopened.get('other', 'col'), 'val')
+            # One set_columns record per key.
+            self.assertEqual(reopened.query_persistor.replayed_records, 2)
+
+            del store, reopened
+            os.remove(self.file_path)
+
+    def test_order_with_other_calls(self):
+        store = DoubleDictKeyColValStore(path=self.file_path, coalesce_window=60)
+        store.set('key', 'a', '1')
+        store.set('key', 'b', '1')
+        store.delete_key('key')
+        store.set('key', 'a', '2')
+        store.set('key', 'c', '1')
+        store.delete_slice('key', 'b', 'c')
+        store.set('key', 'b', '2')
+        store.set_columns('key', [('d', '1')])
+        store.set('key', 'd', '2')
+        store.set_with_ttl('key', 'e', '1', 3600)
+        store.set('key', 'e', '2')
+        expected = store.get_key('key')
+        store.query_persistor.flush()
+
+        self.assertEqual(expected, [('a', '2'), ('b', '2'), ('d', '2'), ('e', '2')])
+        self.assertEqual(DoubleDictKeyColValStore(path=self.file_path).get_key('key'), expected)
+
+    def test_held_cells_are_written_when_the_store_is_dropped(self):
+        store = DoubleDictKeyColValStore(path=self.file_path, coalesce_window=60)
+        store.set('key', 'col', '1')
+        store.set('key', 'col', '2')
+        del store
+
+        self.assertEqual(DoubleDictKeyColValStore(path=self.file_path).get('key', 'col'), '2')
+
+    def test_flushing_the_last_held_key_restarts_the_window(self):
+        store = DoubleDictKeyColValStore(path=self.file_path, coalesce_window=60)
+        store.set('key', 'col', '1')
+        self.assertTrue(store.query_persistor.coalesced_age() is not None)
+
+        # Deleting the key writes its held cells ahead of the delete.
+        store.delete_key('key')
+        self.assertEqual(store.query_persistor.coalesced_age(), None)
+
+    def test_persistors_share_one_exit_hook(self):
+        stores = [DoubleDictKeyColValStore(path=self.file_path, coalesce_window=60)
+                  for i in range(3)]
+
+        for store in stores:
+            self.assertTrue(store.query_persistor in query_persistor._coalescing_persistors)
+
+        persistor_ref = weakref.ref(stores[0].query_persistor)
+        del store, stores
+        gc.collect()
+        self.assertEqual(persistor_ref(), None)
+
+    def test_window(self):
+        store = DoubleDictKeyColValStore(path=self.file_path, coalesce_window=0.05)
+        store.set('key', 'col', '1')
+        size = os.path.getsize(self.file_path)
+
+        # The writer thread logs cells once they've been held for the window.
+        time.sleep(0.3)
+        store.query_persistor.query_log_file.flush()
+        self.assertTrue(os.path.getsize(self.file_path) > size)
+        self.assertEqual(store.query_persistor.coalesced_age(), None)
+
+    def test_max_cells(self):
+        store = DoubleDictKeyColValStore(path=self.file_path, coalesce_window=60)
+        store.query_persistor.coalesce_max_cells = 10
+
+        for i in range(10):
+            store.set('key-%d' % i, 'col', 'val')
+
+        self.assertEqual(store.query_persistor._coalesced, {})
+
+    def test_snapshots_include_held_cells(self):
+        store = DoubleDictKeyColValStore(path=self.file_path, coalesce_window=60,
+                                         snapshot_every=2)
+
+        for i in range(5):
+            store.set('key-%d' % i, 'col', 'val')
+
+        store.query_persistor.snapshot(wait=True)
+        self.assertEqual(len(DoubleDictKeyColValStore(path=self.file_path).get_keys()), 5)
+
+    def test_compressed_values(self):
+        store = DoubleDictKeyColValStore(path=self.file_path, coalesce_window=60,
+                                         compressor=ValueCompressor(threshold=10))
+        store.set('key', 'col', 'x' * 100)
+        store.append('key', 'col', 'y' * 100)
+        store.query_persistor.flush()
+
+        self.assertTrue(os.path.getsize(self.file_path) < 100)
+        reopened = DoubleDictKeyColValStore(path=self.file_path,
+                                            compressor=ValueCompressor(threshold=10))
+        self.assertEqual(reopened.get('key', 'col'), 'x' * 100 + 'y' * 100)
+
+    def test_metrics(self):
+        metrics = MetricsRegistry()
+        store = DoubleDictKeyColValStore(path=self.file_path, coalesce_window=60,
+                                         metrics=metrics)
+
+        for i in range(10):
+            store.set('key', 'col', str(i))
+
+        self.assertEqual(metrics.snapshot()['keycolval_log_coalesced_writes_total'][0]['value'], 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import unittest
+from datetime import datetime
+
+from keycolval.data_structures.compressedvalue import CompressedValue
+from keycolval.data_structures.compressedvalue import ValueCompressor
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+
+
+# A JSON blob of a few KB like the values we want to compress.
+LARGE_VALUE = json.dumps([{'id': i, 'name': 'item-%s' % i, 'tags': ['a', 'b']}
+                          for i in range(100)])
+
+
+class ValueCompressorTests(unittest.TestCase):
+    """
+    Tests for the ValueCompressor.
+    """
+
+    def test_small_values_are_not_compressed(self):
+        compressor = ValueCompressor(threshold=1024)
+
+        self.assertEqual(compressor.compress('small'), 'small')
+
+    def test_round_trip(self):
+        for method in ('zlib', 'lzma'):
+            try:
+                compressor = ValueCompressor(method=method, threshold=16)
+            except ValueError:
+                # lzma needs Python 3.3 or backports.lzma.
+                continue
+
+            compressed = compressor.compress(LARGE_VALUE)
+
+            self.assertTrue(isinstance(compressed, CompressedValue))
+            self.assertTrue(len(compressed) < len(LARGE_VALUE))
+            self.assertEqual(compressor.decompress(compressed), LARGE_VALUE)
+            self.assertTrue(compressor.ratio() < 1.0)
+
+    def test_totals_from_concurrent_threads(self):
+        compressor = ValueCompressor(threshold=16)
+
+        def compress(thread):
+            for i in range(200):
+                compressor.compress(LARGE_VALUE + '%d-%03d' % (thread, i))
+
+        threads = [threading.Thread(target=compress, args=(thread,)) for thread in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(compressor.values_compressed, 800)
+        self.assertEqual(compressor.raw_bytes, 800 * (len(LARGE_VALUE) + 5))
+
+
+class StoreCompressionTests(unittest.TestCase):
+    """
+    Tests that stores compress large values transparently.
+    """
+
+    STORE_CLASSES = (DoubleDictKeyColValStore, BinaryTreeKeyColValStore,
+                     AdaptiveKeyColValStore)
+
+    def test_values_are_compressed_in_memory(self):
+        for store_class in self.STORE_CLASSES:
+            compressor = ValueCompressor(threshold=64)
+            store = store_class(compressor=compressor)
+
+            store.set('a-key', 'col-a', LARGE_VALUE)
+            store.set('a-key', 'col-b', 'small')
+
+            self.assertEqual(store.get('a-key', 'col-a'), LARGE_VALUE)
+            self.assertEqual(store.get_key('a-key'), [('col-a', LARGE_VALUE),
+                                                      ('col-b', 'small')])
+            self.assertEqual(store.get_slice('a-key', 'col-b', None), [('col-b', 'small')])
+            self.assertTrue(store.get_key_stats('a-key')['total_bytes'] < len(LARGE_VALUE))
+            self.assertEqual(compressor.values_compressed, 1)
+
+    def test_compressed_values_persist(self):
+        test_file_path = '/tmp/keycolval.testdata.%s.csv' % datetime.now()
+
+        store = DoubleDictKeyColValStore(path=test_file_path,
+                                         compressor=ValueCompressor(threshold=64))
+        store.set('a-key', 'col-a', LARGE_VALUE)
+        store.set('a-key', 'col-b', 'small')
+        del store
+
+        log_size = os.path.getsize(test_file_path)
+        self.assertTrue(log_size < len(LARGE_VALUE))
+
+        second_store = DoubleDictKeyColValStore(path=test_file_path,
+                                                compressor=ValueCompressor(threshold=64))
+        self.assertEqual(second_store.get('a-key', 'col-a'), LARGE_VALUE)
+        self.assertEqual(second_store.get('a-key', 'col-b'), 'small')
+
+        self.assertRaises(ValueError, DoubleDictKeyColValStore, path=test_file_path)
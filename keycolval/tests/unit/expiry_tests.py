@@ -0,0 +1,126 @@
+import os
+import time
+import unittest
+from datetime import datetime
+
+from keycolval.data_structures.expiryindex import ExpiryIndex
+from keycolval.persistence.records import MappedLog
+from keycolval.persistence.records import scan_records
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+
+
+class ExpiryIndexTests(unittest.TestCase):
+    """
+    Unit tests for ExpiryIndex.
+    """
+
+    def test_pop_due_in_expiry_order(self):
+        index = ExpiryIndex()
+        index.set('a-key', 'col-a', 30)
+        index.set('a-key', 'col-b', 10)
+        index.set('b-key', 'col-a', 20)
+        index.set('b-key', 'col-b', 5)
+
+        # Changed and cleared expiries leave stale heap entries behind.
+        index.set('b-key', 'col-b', 40)
+        index.discard('b-key', 'col-a')
+
+        self.assertEqual(index.pop_due(25), [('a-key', 'col-b')])
+        self.assertEqual(index.pop_due(100, limit=1), [('a-key', 'col-a')])
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get('b-key', 'col-b'), 40)
+
+    def test_per_key_due_columns(self):
+        index = ExpiryIndex()
+        index.set('a-key', 'col-a', 10)
+        index.set('a-key', 'col-b', 20)
+
+        self.assertFalse(index.is_due('a-key', 5))
+        self.assertTrue(index.is_due('a-key', 15))
+        self.assertEqual(index.pop_due_columns('a-key', 15), ['col-a'])
+        self.assertFalse(index.is_due('a-key', 15))
+
+        index.discard_key('a-key')
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.pop_due(100), [])
+
+
+class StoreExpiryTests(unittest.TestCase):
+    """
+    Unit tests for cell expiry in the stores.
+    """
+
+    STORE_CLASSES = [DoubleDictKeyColValStore, BinaryTreeKeyColValStore, AdaptiveKeyColValStore]
+
+    def test_expired_cells_are_not_read(self):
+        for store_class in self.STORE_CLASSES:
+            store = store_class()
+            store.set('a-key', 'col-a', 'val-a')
+            store.set_until('a-key', 'col-b', 'val-b', time.time() - 1)
+            store.set_with_ttl('a-key', 'col-c', 'val-c', 60)
+            store.set_until('a-key', 'col-d', 'val-d', time.time() - 1)
+
+            self.assertEqual(store.get('a-key', 'col-b'), None)
+            self.assertEqual(store.get_slice('a-key', None, None, limit=2),
+                             [('col-a', 'val-a'), ('col-c', 'val-c')])
+            self.assertEqual(len(store.expiry), 1)
+
+            # A plain set stops a cell from expiring.
+            store.set('a-key', 'col-c', 'new-c')
+            self.assertEqual(store.expiry.get('a-key', 'col-c'), None)
+
+            # Atomic operations don't see expired cells.
+            store.set_until('a-key', 'lock', 'owner', time.time() - 1)
+            self.assertTrue(store.compare_and_set('a-key', 'lock', None, 'new-owner'))
+
+    def test_reap_expired(self):
+        store = DoubleDictKeyColValStore()
+
+        # Cells of different keys, as writing a key deletes its expired cells.
+        for i in range(5):
+            store.set_until('key-%d' % i, 'col-a', 'val', time.time() - 1)
+        store.set_with_ttl('live-key', 'col-a', 'val', 60)
+
+        self.assertEqual(store.reap_expired(limit=3), 3)
+        self.assertEqual(store.reap_expired(), 2)
+        self.assertEqual(store.reap_expired(), 0)
+        self.assertEqual(sum(len(columns) for columns in store.keys.values()), 1)
+
+    def test_background_reaper(self):
+        store = DoubleDictKeyColValStore(reap_interval=0.01)
+        store.set_with_ttl('a-key', 'col-a', 'val', 0.01)
+
+        deadline = time.time() + 5
+        while store.keys['a-key'] and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(store.keys['a-key'], {})
+        store.reaper.stop()
+
+    def test_expirations_persist(self):
+        file_path = '/tmp/keycolval.testdata.%s.log' % datetime.now()
+
+        store = DoubleDictKeyColValStore(path=file_path)
+        store.set_with_ttl('a-key', 'col-a', 'val-a', 0.5)
+        store.set_with_ttl('a-key', 'col-b', 'val-b', 0.01)
+        store.expire('a-key', 'col-a', time.time() + 60)
+        time.sleep(0.02)
+        store.reap_expired()
+        expire_at = store.expiry.get('a-key', 'col-a')
+        store.query_persistor.snapshot(wait=True)
+        store.set_with_ttl('a-key', 'col-d', 'val-d', 60)
+        del store
+
+        with MappedLog(file_path) as buf:
+            calls = [parts[0] for offset, end, parts in scan_records(buf)]
+        self.assertEqual(calls, ['set_until', 'set_until', 'expire', 'delete', 'set_until'])
+
+        store = DoubleDictKeyColValStore(path=file_path)
+        self.assertEqual(store.get_key('a-key'), [('col-a', 'val-a'), ('col-d', 'val-d')])
+        self.assertEqual(store.expiry.get('a-key', 'col-a'), expire_at)
+        del store
+
+        for path in (file_path, '%s.snapshot' % file_path):
+            os.remove(path)
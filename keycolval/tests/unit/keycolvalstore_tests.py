@@ -1,9 +1,13 @@
+import threading
 import unittest
 from datetime import datetime
 import os
 
+from keycolval.persistence.records import verify_log
 from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
 from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.adaptivestore import AdaptiveLayoutPolicy
 
 
 class KeyColValStorePersistenceUnitTests(unittest.TestCase):
@@ -79,6 +83,45 @@ class KeyColValStorePersistenceUnitTests(unittest.TestCase):
         self.assertEqual(second_store.get_key('a-key'), [])
         self.assertEqual(second_store.get('b-key', 'b-column'), 'b-value')
 
+    def test_atomic_operations_persist_as_single_records(self):
+        TEST_FILE_PATH = '/tmp/keycolval.testdata.%s.csv' % datetime.now()
+
+        store = self._keycolvalstore_factory(TEST_FILE_PATH)
+        store.increment('a-key', 'counter', 5)
+        store.increment('a-key', 'counter')
+        store.compare_and_set('a-key', 'state', None, 'started')
+        store.compare_and_set('a-key', 'state', 'not-started', 'stopped')
+        store.append('a-key', 'log', 'one,')
+        store.set_columns('b-key', [('col-a', 'val-a'), ('col-b', 'val-b')])
+
+        self.assertRaises(ValueError, store.increment, 'a-key', 'state')
+
+        del store
+
+        self.assertEqual(verify_log(TEST_FILE_PATH)['records'], 6)
+
+        second_store = self._keycolvalstore_factory(TEST_FILE_PATH)
+        self.assertEqual(second_store.get_key('a-key'),
+                         [('counter', '6'), ('log', 'one,'), ('state', 'started')])
+        self.assertEqual(second_store.get_key('b-key'),
+                         [('col-a', 'val-a'), ('col-b', 'val-b')])
+
+
+    def test_delete_slice_persists_as_a_single_record(self):
+        TEST_FILE_PATH = '/tmp/keycolval.testdata.%s.csv' % datetime.now()
+
+        store = self._keycolvalstore_factory(TEST_FILE_PATH)
+        store.set_columns('a-key', [('col-%02d' % i, 'val') for i in range(20)])
+        self.assertEqual(store.delete_slice('a-key', 'col-05', 'col-14'), 10)
+
+        del store
+
+        self.assertEqual(verify_log(TEST_FILE_PATH)['records'], 2)
+
+        second_store = self._keycolvalstore_factory(TEST_FILE_PATH)
+        self.assertEqual([col for col, val in second_store.get_key('a-key')],
+                         ['col-%02d' % i for i in list(range(5)) + list(range(15, 20))])
+
 
 
 class KeyColValStoreUnitTests(unittest.TestCase):
@@ -330,6 +373,151 @@ class KeyColValStoreUnitTests(unittest.TestCase):
                           ('column-a4', 'val'),
                           ('column-a5', 'val')])
 
+    def test_get_slice_paging(self):
+        """
+        Test that get_slice honours reverse, limit and offset.
+        """
+        store = self._keycolvalstore_factory()
+
+        for col in ['column-a4', 'column-a2', 'column-a5', 'column-a1', 'column-a3']:
+            store.set('a-key', col, col.replace('column', 'value'))
+
+        self.assertEqual(store.get_slice('a-key', 'column-a2', None, limit=2),
+                         [('column-a2', 'value-a2'),
+                          ('column-a3', 'value-a3')])
+
+        self.assertEqual(store.get_slice('a-key', None, None, limit=2, offset=1),
+                         [('column-a2', 'value-a2'),
+                          ('column-a3', 'value-a3')])
+
+        # Reversed slices count the limit and offset from the stop end.
+        self.assertEqual(store.get_slice('a-key', None, None, reverse=True, limit=2),
+                         [('column-a5', 'value-a5'),
+                          ('column-a4', 'value-a4')])
+
+        self.assertEqual(store.get_slice('a-key', 'column-a2', 'column-a4',
+                                         reverse=True, limit=5, offset=1),
+                         [('column-a3', 'value-a3'),
+                          ('column-a2', 'value-a2')])
+
+        self.assertEqual(store.get_slice('a-key', None, None, offset=10), [])
+
+    def test_get_prefix(self):
+        """
+        Test that get_prefix returns only the columns starting with the prefix.
+        """
+        store = self._keycolvalstore_factory()
+
+        for col in ['2026-10-17T03', '2026-10-16T23', '2026-10-17T01',
+                    '2026-10-18T00', '2026-10-17', '2026-10-1']:
+            store.set('a-key', col, 'val')
+
+        self.assertEqual([col for col, val in store.get_prefix('a-key', '2026-10-17')],
+                         ['2026-10-17', '2026-10-17T01', '2026-10-17T03'])
+
+        # The latest N columns of a prefix.
+        self.assertEqual([col for col, val in store.get_prefix('a-key', '2026-10-17T',
+                                                               limit=1, reverse=True)],
+                         ['2026-10-17T03'])
+
+        # The paging arguments are in the same order as get_slice's.
+        self.assertEqual(store.get_prefix('a-key', '2026-10-17', True, 2, 1),
+                         store.get_slice('a-key', '2026-10-17', '2026-10-17T03', True, 2, 1))
+
+        self.assertEqual(store.get_prefix('a-key', '2027'), [])
+        self.assertEqual(store.get_prefix('z-key', '2026'), [])
+
+    def test_atomic_operations(self):
+        """
+        Test compare_and_set, increment, append and set_columns.
+        """
+        store = self._keycolvalstore_factory()
+
+        self.assertTrue(store.compare_and_set('a-key', 'state', None, 'started'))
+        self.assertFalse(store.compare_and_set('a-key', 'state', None, 'again'))
+        self.assertTrue(store.compare_and_set('a-key', 'state', 'started', 'stopped'))
+        self.assertEqual(store.get('a-key', 'state'), 'stopped')
+
+        self.assertEqual(store.increment('a-key', 'counter'), 1)
+        self.assertEqual(store.increment('a-key', 'counter', -3), -2)
+        self.assertEqual(store.get('a-key', 'counter'), '-2')
+        self.assertRaises(ValueError, store.increment, 'a-key', 'state')
+
+        self.assertEqual(store.append('a-key', 'log', 'one'), 'one')
+        self.assertEqual(store.append('a-key', 'log', ',two'), 'one,two')
+
+        store.set_columns('b-key', [('col-b', 'val-b'), ('col-a', 'val-a')])
+        self.assertEqual(store.get_key('b-key'), [('col-a', 'val-a'), ('col-b', 'val-b')])
+
+    def test_delete_slice(self):
+        """
+        Test that delete_slice removes the columns in an inclusive, optionally
+        open, range and keeps the key statistics up to date.
+        """
+        store = self._keycolvalstore_factory()
+
+        for i in [7, 3, 9, 1, 5, 0, 8, 2, 6, 4]:
+            store.set('a-key', 'col-%d' % i, 'val-%d' % i)
+
+        # Ordered reads may move the key to an ordered layout.
+        store.get_slice('a-key', None, None)
+
+        self.assertEqual(store.delete_slice('a-key', 'col-3', 'col-5'), 3)
+        self.assertEqual(store.delete_slice('a-key', 'col-3', 'col-5'), 0)
+        self.assertEqual(store.delete_slice('a-key', None, 'col-1'), 2)
+        self.assertEqual(store.delete_slice('a-key', 'col-8', None), 2)
+        self.assertEqual(store.get_key('a-key'),
+                         [('col-2', 'val-2'), ('col-6', 'val-6'), ('col-7', 'val-7')])
+
+        stats = store.get_key_stats('a-key')
+        self.assertEqual(stats['column_count'], 3)
+        self.assertEqual(stats['min_column'], 'col-2')
+        self.assertEqual(stats['total_bytes'], 3 * 10)
+
+        self.assertEqual(store.delete_slice('a-key', None, None), 3)
+        self.assertEqual(store.get_key('a-key'), [])
+        self.assertEqual(store.delete_slice('no-key', None, None), 0)
+
+    def test_concurrent_increments(self):
+        """
+        Test that increments from several threads aren't lost.
+        """
+        store = self._keycolvalstore_factory()
+
+        def increment():
+            for _ in range(200):
+                store.increment('a-key', 'counter')
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(store.get('a-key', 'counter'), '800')
+
+    def test_scan_keys_and_scan(self):
+        """
+        Test that scan_keys lists keys in order and that scan walks ranges of
+        keys and columns.
+        """
+        store = self._keycolvalstore_factory()
+
+        store.set('c-key', 'column-c1', 'value-c1')
+        store.set('a-key', 'column-a1', 'value-a1')
+        store.set('b-key', 'column-b1', 'value-b1')
+        store.set('b-key', 'column-b2', 'value-b2')
+        store.set('d-key', 'column-d1', 'value-d1')
+        store.delete_key('d-key')
+
+        self.assertEqual(store.scan_keys(), ['a-key', 'b-key', 'c-key'])
+        self.assertEqual(store.scan_keys('b-key', limit=1), ['b-key'])
+        self.assertEqual(store.scan_keys(None, 'b-key', reverse=True), ['b-key', 'a-key'])
+
+        self.assertEqual(list(store.scan('b-key', None, 'column-b2', None, batch_size=1)),
+                         [('b-key', 'column-b2', 'value-b2'),
+                          ('c-key', 'column-c1', 'value-c1')])
+
     def test_invalid_slice_handling(self):
         """
         Test that when get_slice is called with boundary values that are not of a valid range,
@@ -414,3 +602,158 @@ class KeyColValStoreUnitTests(unittest.TestCase):
         self.assertEqual(store.get_slice('a', 'ae', None), [('ae', 'x'), ('af', 'x'), ('ag', 'x')])
         self.assertEqual(store.get_slice('a', None, 'ac'), [('aa', 'x'), ('ab', 'x'), ('ac', 'x')])
 
+
+
+class BinaryTreeKeyColValStoreUnitTests(KeyColValStoreUnitTests):
+    """
+    Runs the KeyColValStore interface tests against BinaryTreeKeyColValStore.
+    """
+
+    STORE_CLASS = BinaryTreeKeyColValStore
+
+    def test_non_string_lookups(self):
+        """
+        The tree has to order its columns so only non-string values can be
+        stored. Keys are hashed and don't need to be ordered.
+        """
+        store = self._keycolvalstore_factory()
+
+        not_a_string = object()
+
+        store.set(not_a_string, 'column-name', 'my-little-value')
+        store.set('a-key', 'column-name', not_a_string)
+
+
+class BinaryTreeKeyColValStorePersistenceUnitTests(KeyColValStorePersistenceUnitTests):
+    """
+    Runs the persistence tests against BinaryTreeKeyColValStore.
+    """
+
+    STORE_CLASS = BinaryTreeKeyColValStore
+
+
+class AdaptiveKeyColValStoreUnitTests(KeyColValStoreUnitTests):
+    """
+    Runs the KeyColValStore interface tests against AdaptiveKeyColValStore with
+    a policy which moves keys between layouts after very few operations so
+    that both layouts are exercised.
+    """
+
+    STORE_CLASS = AdaptiveKeyColValStore
+
+    @classmethod
+    def _keycolvalstore_factory(cls):
+        policy = AdaptiveLayoutPolicy(promote_columns=2, demote_columns=1,
+                                      promote_read_ratio=0.1, demote_read_ratio=0.0,
+                                      evaluation_interval=1)
+        return cls.STORE_CLASS(policy=policy)
+
+    def test_layout_promotion_and_demotion(self):
+        policy = AdaptiveLayoutPolicy(promote_columns=4, demote_columns=2,
+                                      promote_read_ratio=0.5, demote_read_ratio=0.1,
+                                      evaluation_interval=4)
+        store = self.STORE_CLASS(policy=policy)
+
+        for col in ['col-d', 'col-b', 'col-a', 'col-c']:
+            store.set('a-key', col, 'val')
+
+        # Write-only keys stay in the hash layout.
+        self.assertEqual(store.layout_of('a-key'), 'hash')
+
+        for _ in range(8):
+            store.get_slice('a-key', 'col-b', 'col-c')
+
+        self.assertEqual(store.layout_of('a-key'), 'sorted')
+        self.assertEqual(store.get_slice('a-key', 'col-b', 'col-c'),
+                         [('col-b', 'val'), ('col-c', 'val')])
+
+        # Shrinking below demote_columns moves the key back to a dict.
+        store.delete('a-key', 'col-a')
+        store.delete('a-key', 'col-b')
+        store.delete('a-key', 'col-c')
+
+        for _ in range(4):
+            store.get_key('a-key')
+
+        self.assertEqual(store.layout_of('a-key'), 'hash')
+        self.assertEqual(store.get_key('a-key'), [('col-d', 'val')])
+        self.assertEqual(store.layout_counts(),
+                         {'hash': 1, 'sorted': 0, 'promotions': 1, 'demotions': 1})
+
+    def test_writes_demote_sorted_keys(self):
+        policy = AdaptiveLayoutPolicy(promote_columns=4, demote_columns=2,
+                                      promote_read_ratio=0.5, demote_read_ratio=0.3,
+                                      evaluation_interval=4)
+        store = self.STORE_CLASS(policy=policy)
+        store.set_columns('a-key', [('col-a', 'val'), ('col-b', 'val'),
+                                    ('col-c', 'val'), ('col-d', 'val')])
+
+        for _ in range(8):
+            store.get_key('a-key')
+
+        self.assertEqual(store.layout_of('a-key'), 'sorted')
+
+        # Overwrites of existing columns count as writes as well.
+        for _ in range(8):
+            store.set('a-key', 'col-a', 'new-val')
+
+        self.assertEqual(store.layout_of('a-key'), 'hash')
+
+        for _ in range(8):
+            store.get_key('a-key')
+
+        self.assertEqual(store.layout_of('a-key'), 'sorted')
+
+        # Deletes alone re-evaluate a key, so one which shrinks is demoted.
+        store.delete_slice('a-key', 'col-b', 'col-b')
+        store.delete('a-key', 'col-c')
+        store.delete('a-key', 'col-d')
+        store.delete_slice('a-key', None, 'col-0')
+
+        self.assertEqual(store.layout_of('a-key'), 'hash')
+        self.assertEqual(store.get_key('a-key'), [('col-a', 'new-val')])
+
+    def test_concurrent_reads_keep_writes(self):
+        # Layouts flip on nearly every evaluation, so readers keep changing
+        # the layout of the key the writer is writing to.
+        policy = AdaptiveLayoutPolicy(promote_columns=1, demote_columns=1,
+                                      promote_read_ratio=0.5, demote_read_ratio=0.5,
+                                      evaluation_interval=1)
+        store = self.STORE_CLASS(policy=policy)
+        store.set('a-key', 'col', 'val')
+        errors = []
+
+        def read():
+            try:
+                for _ in range(2000):
+                    store.get_slice('a-key', None, None, limit=5)
+                    store.get_key('other-key')
+            except Exception as e:
+                errors.append(e)
+
+        def write():
+            for i in range(2000):
+                store.set('a-key', 'col-%04d' % i, 'val')
+                store.set('other-key', 'col', 'val')
+                store.delete_key('other-key')
+
+        threads = [threading.Thread(target=read) for _ in range(3)]
+        threads.append(threading.Thread(target=write))
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(store.get_key('a-key')), 2001)
+        self.assertTrue(store.promotions > 0 and store.demotions > 0)
+
+
+class AdaptiveKeyColValStorePersistenceUnitTests(KeyColValStorePersistenceUnitTests):
+    """
+    Runs the persistence tests against AdaptiveKeyColValStore.
+    """
+
+    STORE_CLASS = AdaptiveKeyColValStore
@@ -0,0 +1,72 @@
+import threading
+import unittest
+
+from keycolval.data_structures.keyindex import SortedKeyIndex
+
+
+class SortedKeyIndexTests(unittest.TestCase):
+    """
+    Unit tests for the SortedKeyIndex data structure.
+    """
+
+    def test_add_and_discard(self):
+        index = SortedKeyIndex()
+
+        for key in ['d', 'b', 'a', 'c']:
+            index.add(key)
+
+        self.assertEqual(index.range(), ['a', 'b', 'c', 'd'])
+
+        # Merged keys are removed by the next read, pending keys straight away.
+        index.discard('b')
+        index.add('e')
+        index.discard('e')
+        index.discard('missing')
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.range('b', None), ['c', 'd'])
+
+        # A key added back before the next read is listed once.
+        index.discard('c')
+        index.add('c')
+        self.assertEqual(index.prefix(''), ['a', 'c', 'd'])
+        self.assertEqual(index.range(limit=1, reverse=True), ['d'])
+
+    def test_concurrent_reads_and_writes(self):
+        index = SortedKeyIndex()
+        errors = []
+
+        def write(worker):
+            try:
+                for i in range(2000):
+                    key = 'key-%d-%04d' % (worker, i)
+                    index.add(key)
+
+                    if i % 3 == 0:
+                        index.discard(key)
+            except Exception as error:
+                errors.append(error)
+
+        def read():
+            try:
+                for _ in range(200):
+                    keys = index.range()
+                    self.assertEqual(keys, sorted(set(keys)))
+            except Exception as error:
+                errors.append(error)
+
+        threads = ([threading.Thread(target=write, args=(worker,)) for worker in range(3)] +
+                   [threading.Thread(target=read) for _ in range(2)])
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(index.range()), 3 * 1333)
+        self.assertEqual(len(index), 3 * 1333)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import os
+import unittest
+from datetime import datetime
+
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.memory import DROP
+from keycolval.stores.memory import EVICT
+from keycolval.stores.memory import DiskTier
+from keycolval.stores.memory import MemoryBudget
+from keycolval.stores.memory import MemoryBudgetExceededError
+
+
+def fill(store, keys=10, columns=10, start=0):
+    """
+    Write the keys from start up to keys, with columns columns each of 20
+    bytes per cell.
+    """
+    for i in range(start, keys):
+        for j in range(columns):
+            store.set('key-%02d' % i, 'col-%04d' % j, 'value-%06d' % j)
+
+
+class MemoryBudgetTests(unittest.TestCase):
+    """
+    Unit tests for memory accounting and the MemoryBudget policies.
+    """
+
+    STORE_CLASSES = [DoubleDictKeyColValStore, BinaryTreeKeyColValStore, AdaptiveKeyColValStore]
+
+    def setUp(self):
+        stamp = datetime.now()
+        self.data_path = '/tmp/keycolval.testdata.%s.log' % stamp
+        self.disk_path = '/tmp/keycolval.testdata.%s.evicted' % stamp
+
+    def tearDown(self):
+        for path in (self.data_path, self.disk_path, '%s.snapshot' % self.data_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_memory_accounting(self):
+        for store_class in self.STORE_CLASSES:
+            store = store_class()
+            fill(store, keys=2, columns=5)
+            self.assertEqual(store.memory_usage()['used_bytes'], 200)
+
+            store.set('key-00', 'col-0000', 'longer-value-0')
+            store.delete('key-00', 'col-0001')
+            store.delete_key('key-01')
+            self.assertEqual(store.memory_usage()['used_bytes'], 82)
+            self.assertEqual(store.memory_usage()['max_bytes'], None)
+
+    def test_reject_policy(self):
+        store = DoubleDictKeyColValStore(path=self.data_path,
+                                         memory_budget=MemoryBudget(100))
+        fill(store, keys=1, columns=5)
+
+        self.assertRaises(MemoryBudgetExceededError, store.set, 'key-00', 'col-999', 'value')
+        self.assertRaises(MemoryBudgetExceededError, store.increment, 'key-00', 'count')
+
+        # Deletes are still accepted and make room again.
+        store.delete('key-00', 'col-0000')
+        store.set('key-00', 'col-999', 'val')
+        self.assertEqual(store.memory_usage()['used_bytes'], 90)
+        del store
+
+        # Replaying the data log isn't subject to the budget.
+        store = DoubleDictKeyColValStore(path=self.data_path,
+                                         memory_budget=MemoryBudget(50))
+        self.assertEqual(len(store.get_key('key-00')), 5)
+
+    def test_evict_policy(self):
+        for store_class in self.STORE_CLASSES:
+            budget = MemoryBudget(1500, EVICT, disk_path=self.disk_path, low_watermark=0.6)
+            store = store_class(memory_budget=budget)
+            fill(store, keys=5)
+            # Reading the first key makes it the most recently used.
+            store.get('key-00', 'col-0000')
+            fill(store, keys=10, start=5)
+
+            usage = store.memory_usage()
+            self.assertEqual(usage['used_bytes'], 1200)
+            self.assertEqual(usage['evicted_keys'], 4)
+            self.assertFalse(budget.is_evicted('key-00'))
+            self.assertTrue(budget.is_evicted('key-01'))
+
+            # Evicted keys are still there as far as the store's users can tell.
+            self.assertEqual(len(store.get_keys()), 10)
+            self.assertEqual(store.get_key_stats('key-01')['column_count'], 10)
+            self.assertEqual(store.get_slice('key-01', 'col-0003', 'col-0004'),
+                             [('col-0003', 'value-000003'), ('col-0004', 'value-000004')])
+            self.assertFalse(budget.is_evicted('key-01'))
+
+            store.delete_key('key-02')
+            self.assertEqual(len(store.get_keys()), 9)
+            self.assertEqual(len(store.get_key('key-03')), 10)
+            self.assertEqual(sum(1 for cell in store.iter_all_cells()), 90)
+
+    def test_only_existing_keys_are_tracked(self):
+        for store_class in self.STORE_CLASSES:
+            budget = MemoryBudget(1500, EVICT, disk_path=self.disk_path)
+            store = store_class(memory_budget=budget)
+            fill(store, keys=2, columns=1)
+
+            for i in range(100):
+                store.get('missing-%d' % i, 'col')
+                store.get_key('missing-%d' % i)
+
+            self.assertRaises(KeyError, store.delete_key, 'missing')
+            store.delete_key('key-00')
+            self.assertEqual(list(budget._lru), ['key-01'])
+
+    def test_drop_policy(self):
+        self.assertRaises(ValueError, DoubleDictKeyColValStore,
+                          memory_budget=MemoryBudget(1000, DROP))
+
+        budget = MemoryBudget(1500, DROP, low_watermark=0.5)
+        store = DoubleDictKeyColValStore(path=self.data_path, memory_budget=budget)
+        fill(store, keys=5)
+        store.query_persistor.snapshot(wait=True)
+        store.append('key-01', 'col-0000', '-appended')
+        store.delete('key-03', 'col-0000')
+        store.get('key-00', 'col-0000')
+        fill(store, keys=10, start=5)
+
+        self.assertTrue(budget.is_evicted('key-01'))
+        self.assertTrue(budget.is_evicted('key-03'))
+
+        # Dropped keys are rebuilt from the snapshot and the data log.
+        self.assertEqual(store.get('key-01', 'col-0000'), 'value-000000-appended')
+        self.assertEqual(len(store.get_key('key-03')), 9)
+
+        # Snapshots include the dropped keys.
+        fill(store, keys=10)
+        store.query_persistor.snapshot(wait=True)
+        store.set('key-05', 'col-0000', 'after-snapshot')
+        del store
+
+        store = DoubleDictKeyColValStore(path=self.data_path)
+        self.assertEqual(store.memory_usage()['used_bytes'], 10 * 10 * 20 + 2)
+        self.assertEqual(store.get('key-05', 'col-0000'), 'after-snapshot')
+
+    def test_disk_tier(self):
+        tier = DiskTier(self.disk_path)
+        cells = [('col-%04d' % i, 'x' * 1000) for i in range(100)]
+
+        for i in range(30):
+            tier.put('key-%d' % i, cells)
+
+        self.assertEqual(tier.take('key-3'), cells)
+        self.assertEqual(len(tier), 29)
+
+        # Taking most of the keys back compacts the file.
+        for i in range(4, 30):
+            tier.take('key-%d' % i)
+
+        self.assertTrue(os.path.getsize(self.disk_path) < 1 << 20)
+        self.assertEqual(sorted(set(key for key, col, val in tier.items())),
+                         ['key-0', 'key-1', 'key-2'])
@@ -0,0 +1,104 @@
+import unittest
+from datetime import datetime
+
+from keycolval.instrumentation.metrics import MetricsRegistry
+from keycolval.instrumentation.metrics import NULL_METRICS
+from keycolval.persistence.records import encode_record
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+
+
+class MetricsRegistryTests(unittest.TestCase):
+    """
+    Tests for the MetricsRegistry and its Prometheus rendering.
+    """
+
+    def test_counters_and_histograms_in_snapshot(self):
+        registry = MetricsRegistry()
+        registry.inc('ops_total', operation='set')
+        registry.inc('ops_total', 2, operation='set')
+        registry.observe('latency_seconds', 0.002, operation='set')
+
+        snapshot = registry.snapshot()
+
+        self.assertEqual(snapshot['ops_total'],
+                         [{'labels': {'operation': 'set'}, 'value': 3}])
+        self.assertEqual(snapshot['latency_seconds'][0]['count'], 1)
+
+    def test_render_prometheus(self):
+        registry = MetricsRegistry()
+        registry.inc('ops_total', operation='get')
+        registry.register_gauge('size', lambda: 7)
+        registry.observe('latency_seconds', 0.5, buckets=(0.1, 1.0))
+
+        text = registry.render_prometheus()
+
+        self.assertIn('# TYPE ops_total counter', text)
+        self.assertIn('ops_total{operation="get"} 1', text)
+        self.assertIn('size 7', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('latency_seconds_count 1', text)
+
+    def test_null_metrics_discards_everything(self):
+        NULL_METRICS.inc('ops_total')
+        NULL_METRICS.register_gauge('size', lambda: 1)
+
+        self.assertFalse(NULL_METRICS.enabled)
+        self.assertEqual(NULL_METRICS.snapshot(), {})
+
+
+class StoreInstrumentationTests(unittest.TestCase):
+    """
+    Tests that KeyColValStore implementations report to their registry.
+    """
+
+    STORE_CLASSES = (DoubleDictKeyColValStore, BinaryTreeKeyColValStore)
+
+    def test_operations_are_counted(self):
+        for store_class in self.STORE_CLASSES:
+            registry = MetricsRegistry()
+            store = store_class(metrics=registry)
+
+            store.set('a-key', 'column-a', 'val')
+            store.set('a-key', 'column-b', 'val')
+            store.get('a-key', 'column-a')
+            store.get_slice('a-key', 'column-a', 'column-a')
+
+            snapshot = registry.snapshot()
+            operations = dict((sample['labels']['operation'], sample['value'])
+                              for sample in snapshot['keycolval_store_operations_total'])
+
+            self.assertEqual(operations, {'set': 2, 'get': 1, 'get_slice': 1})
+            self.assertEqual(snapshot['keycolval_slice_columns_returned'][0]['sum'], 1)
+            self.assertEqual(snapshot['keycolval_store_columns'][0]['value'], 2)
+
+    def test_raising_operations_are_counted(self):
+        registry = MetricsRegistry()
+        store = DoubleDictKeyColValStore(metrics=registry)
+        self.assertRaises(KeyError, store.delete, 'a-key', 'column-a')
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['keycolval_store_operations_total'][0]['labels']['operation'],
+                         'delete')
+        self.assertEqual(snapshot['keycolval_store_operations_total'][0]['value'], 1)
+
+    def test_disabled_registry_records_nothing(self):
+        registry = MetricsRegistry(enabled=False)
+        store = DoubleDictKeyColValStore(metrics=registry)
+        store.set('a-key', 'column-a', 'val')
+
+        self.assertNotIn('keycolval_store_operations_total', registry.snapshot())
+
+    def test_log_writes_are_counted(self):
+        registry = MetricsRegistry()
+        store = DoubleDictKeyColValStore(path='/tmp/keycolval.testdata.%s.csv' % datetime.now(),
+                                         metrics=registry)
+        store.set('a-key', 'column-a', 'val')
+        store.query_persistor.flush()
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['keycolval_log_bytes_written_total'][0]['value'],
+                         len(encode_record(['set', 'a-key', 'column-a', 'val'])))
+        self.assertEqual(snapshot['keycolval_log_flush_seconds'][0]['count'], 1)
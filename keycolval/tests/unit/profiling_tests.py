@@ -0,0 +1,66 @@
+import unittest
+
+from keycolval.instrumentation.profiling import SamplingProfiler
+from keycolval.instrumentation.profiling import SlowQueryLog
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+class SamplingProfilerTests(unittest.TestCase):
+    """
+    Tests for the SamplingProfiler.
+    """
+
+    def test_disabled_profiler_samples_nothing(self):
+        profiler = SamplingProfiler(sample_rate=0)
+
+        profile = profiler.start()
+        profiler.stop(profile)
+
+        self.assertIsNone(profile)
+        self.assertEqual(profiler.samples, 0)
+
+    def test_samples_are_aggregated(self):
+        profiler = SamplingProfiler(sample_rate=1)
+
+        for _ in range(2):
+            profile = profiler.start()
+            sorted(range(1000), reverse=True)
+            profiler.stop(profile)
+
+        self.assertEqual(profiler.samples, 2)
+        self.assertIn('Aggregated 2 sampled profiles', profiler.report())
+
+        profiler.reset()
+        self.assertEqual(profiler.samples, 0)
+
+
+class SlowQueryLogTests(unittest.TestCase):
+    """
+    Tests for the SlowQueryLog and its integration with the stores.
+    """
+
+    def test_only_slow_tracked_operations_are_logged(self):
+        slow_query_log = SlowQueryLog(threshold=0.5)
+
+        slow_query_log.record('get_slice', ('a-key', 'a', 'z'), [('b', 'val')], 1.0)
+        slow_query_log.record('get_slice', ('a-key', 'a', 'z'), [], 0.1)
+        slow_query_log.record('set', ('a-key', 'a', 'val'), None, 1.0)
+
+        entries = slow_query_log.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['key'], 'a-key')
+        self.assertEqual((entries[0]['start'], entries[0]['stop']), ('a', 'z'))
+        self.assertEqual(entries[0]['columns'], 1)
+
+    def test_store_reads_are_offered_to_the_log(self):
+        slow_query_log = SlowQueryLog(threshold=0)
+        store = DoubleDictKeyColValStore(slow_query_log=slow_query_log)
+
+        store.set('a-key', 'column-a', 'val')
+        store.set('a-key', 'column-b', 'val')
+        store.get_key('a-key')
+        store.get_slice('a-key', 'column-b', None)
+
+        operations = sorted((entry['operation'], entry['columns'])
+                            for entry in slow_query_log.entries())
+        self.assertEqual(operations, [('get_key', 2), ('get_slice', 1)])
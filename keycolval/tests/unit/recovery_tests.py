@@ -0,0 +1,201 @@
+import os
+import time
+import unittest
+from datetime import datetime
+
+from keycolval.persistence.records import CorruptRecordError
+from keycolval.persistence.records import LOG_MAGIC
+from keycolval.persistence.records import encode_record
+from keycolval.persistence.records import repair_log
+from keycolval.persistence.records import verify_log
+from keycolval.persistence.snapshot import read_snapshot_offset
+from keycolval.persistence.snapshot import snapshot_path
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+class DataLogRecoveryTests(unittest.TestCase):
+    """
+    Unit tests for the framed data log and recovering from torn writes.
+    """
+
+    def setUp(self):
+        self.file_path = '/tmp/keycolval.testdata.%s.log' % datetime.now()
+
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        store.set('a-key', 'col-a', 'val,with\ncomma and newline')
+        store.set('a-key', 'col-b', 'val-b')
+        store.set('b-key', 'col-a', 'val-c')
+        del store
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def _append(self, data):
+        with open(self.file_path, 'ab') as log_file:
+            log_file.write(data)
+
+    def test_values_round_trip(self):
+        store = DoubleDictKeyColValStore(path=self.file_path)
+
+        self.assertEqual(store.get('a-key', 'col-a'), 'val,with\ncomma and newline')
+        self.assertEqual(store.query_persistor.replayed_records, 3)
+        self.assertEqual(store.query_persistor.truncated_bytes, 0)
+
+    def test_non_ascii_text_round_trips(self):
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        store.set(u'cl\xe9', u'col-\u2603', u'val-\xe9')
+        del store
+
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        self.assertEqual(store.get(u'cl\xe9', u'col-\u2603'), u'val-\xe9')
+        self.assertTrue(u'cl\xe9' in store.get_keys())
+
+    def test_torn_tail_is_truncated(self):
+        valid_size = os.path.getsize(self.file_path)
+        record = encode_record(['set', 'b-key', 'col-b', 'never-acknowledged'])
+        self._append(record[:-3])
+
+        store = DoubleDictKeyColValStore(path=self.file_path)
+
+        self.assertEqual(store.get('b-key', 'col-b'), None)
+        self.assertEqual(store.query_persistor.truncated_bytes, len(record) - 3)
+        self.assertEqual(os.path.getsize(self.file_path), valid_size)
+
+        # New records are appended right after the last valid one.
+        store.set('b-key', 'col-b', 'val-d')
+        del store
+
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        self.assertEqual(store.get('b-key', 'col-b'), 'val-d')
+        self.assertEqual(store.get('b-key', 'col-a'), 'val-c')
+
+    def test_checksum_mismatch_stops_replay(self):
+        record = bytearray(encode_record(['set', 'b-key', 'col-b', 'corrupt']))
+        record[-1] ^= 0xff
+        self._append(bytes(record))
+
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        self.assertEqual(store.get('b-key', 'col-b'), None)
+        self.assertEqual(store.query_persistor.replayed_records, 3)
+
+    def test_corrupt_record_mid_log_is_not_truncated(self):
+        with open(self.file_path, 'r+b') as log_file:
+            log_file.seek(30)
+            byte = log_file.read(1)
+            log_file.seek(30)
+            log_file.write(bytes(bytearray([ord(byte) ^ 0xff])))
+
+        size = os.path.getsize(self.file_path)
+        self.assertEqual(verify_log(self.file_path)['salvageable_records'], 2)
+
+        # The intact records after the corrupt one are left for repair_log.
+        self.assertRaises(CorruptRecordError, DoubleDictKeyColValStore, path=self.file_path)
+        self.assertEqual(os.path.getsize(self.file_path), size)
+
+        repair_log(self.file_path, salvage=True)
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        self.assertEqual(store.get('a-key', 'col-a'), None)
+        self.assertEqual(store.get('b-key', 'col-a'), 'val-c')
+
+    def test_verify_and_repair(self):
+        self.assertEqual(verify_log(self.file_path)['dropped_bytes'], 0)
+
+        corrupt = bytearray(encode_record(['set', 'b-key', 'col-b', 'corrupt']))
+        corrupt[-1] ^= 0xff
+        self._append(bytes(corrupt) + encode_record(['set', 'b-key', 'col-c', 'intact']))
+
+        report = verify_log(self.file_path)
+        self.assertEqual(report['records'], 3)
+        self.assertEqual(report['salvageable_records'], 1)
+
+        repair_log(self.file_path, salvage=True)
+        self.assertEqual(verify_log(self.file_path)['records'], 4)
+
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        self.assertEqual(store.get('b-key', 'col-b'), None)
+        self.assertEqual(store.get('b-key', 'col-c'), 'intact')
+
+    def test_csv_log_is_converted(self):
+        with open(self.file_path, 'w') as log_file:
+            log_file.write('set,a-key,col-a,val-a\nset,a-key,col-b,val-b\nset,a-key,col-c,va')
+
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        self.assertEqual(store.get_key('a-key'), [('col-a', 'val-a'), ('col-b', 'val-b')])
+        del store
+
+        with open(self.file_path, 'rb') as log_file:
+            self.assertEqual(log_file.read(len(LOG_MAGIC)), LOG_MAGIC)
+
+        self.assertEqual(verify_log(self.file_path)['records'], 2)
+
+
+class SnapshotTests(unittest.TestCase):
+    """
+    Unit tests for snapshotting a persisted store and recovering from a
+    snapshot plus the tail of the data log.
+    """
+
+    def setUp(self):
+        self.file_path = '/tmp/keycolval.testdata.%s.log' % datetime.now()
+
+    def tearDown(self):
+        for path in (self.file_path, snapshot_path(self.file_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_recovery_replays_only_the_tail(self):
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        store.set('a-key', 'col-a', 'val-a')
+        store.set('a-key', 'col-b', 'val-b')
+        self.assertTrue(store.query_persistor.snapshot(wait=True))
+
+        store.set('a-key', 'col-c', 'val-c')
+        store.delete('a-key', 'col-a')
+        del store
+
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        self.assertEqual(store.get_key('a-key'), [('col-b', 'val-b'), ('col-c', 'val-c')])
+        self.assertEqual(store.query_persistor.snapshot_records, 2)
+        self.assertEqual(store.query_persistor.replayed_records, 2)
+
+    def test_wait_for_snapshot_in_progress(self):
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        store.set_columns('a-key', [('col-%05d' % i, 'val-%d' % i) for i in range(20000)])
+
+        self.assertTrue(store.query_persistor.snapshot())
+
+        # If the first snapshot is still being written no other is started,
+        # but the call still waits for it to complete.
+        store.query_persistor.snapshot(wait=True)
+        self.assertFalse(store.query_persistor.snapshot_in_progress())
+        self.assertEqual(read_snapshot_offset(snapshot_path(self.file_path)),
+                         store.query_persistor.log_offset())
+
+    def test_writes_continue_during_snapshot(self):
+        store = AdaptiveKeyColValStore(path=self.file_path, snapshot_every=10)
+
+        for i in range(25):
+            store.set('a-key', 'col-%02d' % i, 'val-%d' % i)
+
+        while store.query_persistor.snapshot_in_progress():
+            time.sleep(0.01)
+
+        self.assertTrue(store.query_persistor.last_snapshot_offset is not None)
+        del store
+
+        store = AdaptiveKeyColValStore(path=self.file_path)
+        self.assertEqual(len(store.get_key('a-key')), 25)
+        self.assertTrue(store.query_persistor.snapshot_records > 0)
+
+    def test_mismatched_snapshot_is_ignored(self):
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        store.set('a-key', 'col-a', 'val-a')
+        store.query_persistor.snapshot(wait=True)
+        del store
+
+        # Replace the data log with a shorter one.
+        os.remove(self.file_path)
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        self.assertEqual(store.get_key('a-key'), [])
+        self.assertEqual(store.query_persistor.snapshot_records, 0)
@@ -0,0 +1,201 @@
+import socket
+import threading
+import time
+import unittest
+
+from keycolval.data_structures.valueindex import ValueIndex
+from keycolval.persistence.changefeed import ChangeFeed
+from keycolval.persistence.changefeed import ChangesExpiredError
+from keycolval.rpc.client import RPCClient
+from keycolval.rpc.protocol import ERROR
+from keycolval.rpc.protocol import OPERATIONS
+from keycolval.rpc.protocol import RemoteError
+from keycolval.rpc.protocol import encode_frame
+from keycolval.rpc.protocol import read_frame
+from keycolval.rpc.server import RPCServer
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+class RPCTests(unittest.TestCase):
+    """
+    Unit tests for the binary RPC server and client, against a store served
+    on a free local port.
+    """
+
+    def setUp(self):
+        self.store = DoubleDictKeyColValStore(value_index=ValueIndex(),
+                                              change_feed=ChangeFeed())
+        self.server = RPCServer(self.store)
+        self.server.start()
+        self.client = RPCClient(*self.server.server_address)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_operations(self):
+        client = self.client
+
+        client.set('a/key', 'col,1', 'val\n1')
+        client.set_columns('a/key', [('col-2', 'b'), ('col-3', 'c')])
+        self.assertEqual(client.get('a/key', 'col,1'), 'val\n1')
+        self.assertEqual(client.get_key('a/key'),
+                         [('col,1', 'val\n1'), ('col-2', 'b'), ('col-3', 'c')])
+        self.assertEqual(client.get_keys(), set(['a/key']))
+        self.assertEqual(client.get_many(['a/key', 'b/key']),
+                         [('a/key', client.get_key('a/key')), ('b/key', [])])
+        self.assertEqual(client.get_slice('a/key', 'col-2', None), [('col-2', 'b'), ('col-3', 'c')])
+        self.assertEqual(client.get_slice('a/key', None, None, reverse=True, limit=1),
+                         [('col-3', 'c')])
+        self.assertEqual(client.get_prefix('a/key', 'col-', offset=1), [('col-3', 'c')])
+
+        self.assertTrue(client.compare_and_set('a/key', 'col-2', 'b', 'bb'))
+        self.assertFalse(client.compare_and_set('a/key', 'col-2', 'b', 'bbb'))
+        self.assertEqual(client.increment('a/key', 'count'), 1)
+        self.assertEqual(client.increment('a/key', 'count', 5), 6)
+        client.append('a/key', 'col-2', '!')
+        self.assertEqual(client.get('a/key', 'col-2'), 'bb!')
+
+        client.set_with_ttl('a/key', 'brief', 'x', 3600.5)
+        self.assertTrue(client.expire('a/key', 'brief', 1.0))
+        self.assertEqual(client.get('a/key', 'brief'), None)
+
+        self.assertEqual(client.find_value('c'), [('a/key', 'col-3')])
+        self.assertEqual(client.find_value_prefix('bb'), [('bb!', 'a/key', 'col-2')])
+        self.assertEqual(client.scan_keys(), ['a/key'])
+        self.assertEqual(client.get_top_keys(limit=1)[0][0], 'a/key')
+        self.assertEqual(client.get_key_stats('a/key')['column_count'], 4)
+        self.assertIn('used_bytes', client.memory_usage())
+
+        self.assertEqual(client.count_slice('a/key', 'col-2', None)['count'], 3)
+        self.assertEqual(client.sum_slice('a/key', None, None)['sum'], 6.0)
+        self.assertEqual(client.histogram_slice('a/key', None, None, bins=2, lower=0,
+                                                upper=10)['counts'], [0, 1])
+
+        self.assertEqual(client.delete_slice('a/key', 'col-2', 'col-3'), 2)
+        client.delete('a/key', 'col,1')
+        self.assertEqual(client.get_key('a/key'), [('count', '6')])
+        client.delete_key('a/key')
+        self.assertEqual(client.get_keys(), set())
+
+    def test_read_changes(self):
+        self.client.set('key', 'col', b'\x00bytes')
+        self.client.delete_key('key')
+
+        # Values come back with the type they were set with.
+        found = self.client.read_changes(prefix='k', wait=1)
+        self.assertEqual(found['changes'], [(1, 'set', 'key', 'col', b'\x00bytes'),
+                                            (2, 'delete_key', 'key')])
+        self.assertEqual(found['next'], 2)
+
+        self.assertRaises(ChangesExpiredError, self.client.read_changes, 3)
+
+    def test_every_operation_is_a_client_method(self):
+        for operation in OPERATIONS:
+            self.assertTrue(callable(getattr(self.client, operation)))
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('missing', 'col'), None)
+        self.assertRaises(KeyError, self.client.delete, 'missing', 'col')
+        self.assertRaises(ValueError, self.client.call, 'nothing')
+        self.assertRaises(TypeError, self.client.get_slice, 'key', 'a', 'b', bogus=1)
+
+        try:
+            self.client.delete('missing', 'col')
+        except KeyError as error:
+            self.assertEqual(error.args[0], 'missing')
+
+        # The connection is still usable after errors.
+        self.client.set('key', 'col', 'val')
+        self.assertEqual(self.client.get('key', 'col'), 'val')
+
+    def test_remote_error(self):
+        self.store.get_keys = lambda: 1 / 0
+        self.assertRaises(RemoteError, self.client.get_keys)
+
+    def test_batch(self):
+        results = self.client.batch([
+            ('set', 'key', 'a', '1'),
+            ('increment', 'key', 'b', 2),
+            ('get_key', 'key'),
+        ])
+        self.assertEqual(results, [None, 2, [('a', '1'), ('b', '2')]])
+
+        # A batch stops at the first operation which raises.
+        self.assertRaises(KeyError, self.client.batch, [
+            ('set', 'key', 'c', '3'),
+            ('delete', 'missing', 'col'),
+            ('set', 'key', 'd', '4'),
+        ])
+        self.assertEqual(self.store.get_key('key'), [('a', '1'), ('b', '2'), ('c', '3')])
+
+    def test_pipelined_calls(self):
+        pending = [self.client.call_async('set', 'key', 'col-%03d' % i, str(i))
+                   for i in range(100)]
+        self.assertEqual([call.result() for call in reversed(pending)], [None] * 100)
+
+        pending = [self.client.call_async('get', 'key', 'col-%03d' % i) for i in range(100)]
+        self.assertEqual([call.result() for call in pending], [str(i) for i in range(100)])
+
+    def test_slow_calls_dont_hold_up_the_connection(self):
+        # Waits for a change to another key, which the get doesn't make.
+        waiting = self.client.call_async('read_changes', '0', 'other-key', None, '10', '5')
+        self.client.set('key', 'col', 'val')
+        started = time.time()
+
+        self.assertEqual(self.client.get('key', 'col'), 'val')
+        self.assertTrue(time.time() - started < 1)
+        self.assertFalse(waiting.done)
+
+        self.client.set('other-key', 'col', 'val')
+        self.assertEqual(len(waiting.result()['changes']), 1)
+
+    def test_shared_between_threads(self):
+        errors = []
+
+        def run(thread):
+            try:
+                for i in range(200):
+                    self.client.set('key-%d' % thread, 'col-%d' % i, str(i))
+                    self.assertEqual(self.client.get('key-%d' % thread, 'col-%d' % i), str(i))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=run, args=(thread,)) for thread in range(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.store.get_keys()), 8)
+        self.assertEqual(len(self.store.get_key('key-3')), 200)
+
+    def test_frames(self):
+        connection = socket.create_connection(self.server.server_address)
+        stream = connection.makefile('rb')
+
+        # Responses carry the ids of the requests they answer.
+        connection.sendall(encode_frame(7, ['set', 'key', 'col', 'val']) +
+                           encode_frame(9, ['get', 'key', 'col']))
+        self.assertEqual(read_frame(stream), (7, 0, [None]))
+        self.assertEqual(read_frame(stream), (9, 0, ['val']))
+
+        # Only the operations in OPERATIONS can be called.
+        connection.sendall(encode_frame(3, ['iter_cells']))
+        self.assertEqual(read_frame(stream),
+                         (3, ERROR, ['ValueError', "Unknown operation 'iter_cells'."]))
+
+        # A malformed frame closes the connection.
+        connection.sendall(b'\x00\x00\x00\x02\x00\x00\x00\x01\x00xx')
+        self.assertEqual(read_frame(stream), None)
+
+        stream.close()
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import time
+import unittest
+from datetime import datetime
+
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+from keycolval.stores.sharedstore import ReadOnlyStoreError
+from keycolval.stores.sharedstore import SharedImageKeyColValStore
+
+
+class SharedImageKeyColValStoreTests(unittest.TestCase):
+    """
+    Unit tests for reading a writer's published image with
+    SharedImageKeyColValStore.
+    """
+
+    def setUp(self):
+        self.file_path = '/tmp/keycolval.testdata.%s.log' % datetime.now()
+        self.image_path = '%s.image' % self.file_path
+
+        self.writer = DoubleDictKeyColValStore(path=self.file_path, image_path=self.image_path)
+
+        for key in ['b-key', 'a-key', 'c-key']:
+            for col in ['col-d', 'col-b', 'col-a', 'col-c', 'other']:
+                self.writer.set(key, col, '%s-%s' % (key, col))
+
+        self.writer.query_persistor.snapshot(wait=True)
+        self.reader = SharedImageKeyColValStore(path=self.image_path, refresh_interval=0)
+
+    def tearDown(self):
+        del self.writer
+
+        for path in (self.file_path, self.image_path, '%s.snapshot' % self.file_path):
+            os.remove(path)
+
+    def test_reads_match_the_writer(self):
+        self.assertEqual(self.reader.get('a-key', 'col-b'), 'a-key-col-b')
+        self.assertEqual(self.reader.get('a-key', 'not-col'), None)
+        self.assertEqual(self.reader.get('not-key', 'col-b'), None)
+        self.assertEqual(self.reader.get_keys(), set(['a-key', 'b-key', 'c-key']))
+
+        for key in ['a-key', 'b-key', 'not-key']:
+            self.assertEqual(self.reader.get_key(key), self.writer.get_key(key))
+
+        for args in [('col-b', 'col-c'), (None, 'col-b'), ('col-c', None), ('z', 'a')]:
+            self.assertEqual(self.reader.get_slice('b-key', *args),
+                             self.writer.get_slice('b-key', *args))
+
+        self.assertEqual(self.reader.get_slice('b-key', None, None, reverse=True, limit=2, offset=1),
+                         self.writer.get_slice('b-key', None, None, reverse=True, limit=2, offset=1))
+        self.assertEqual(self.reader.get_prefix('c-key', 'col-', limit=3),
+                         self.writer.get_prefix('c-key', 'col-', limit=3))
+        self.assertEqual(self.reader.scan_keys('b-key', None), ['b-key', 'c-key'])
+        self.assertEqual(self.reader.scan_keys(reverse=True, limit=2), ['c-key', 'b-key'])
+        self.assertEqual(self.reader.get_key_stats('a-key')['max_column'], 'other')
+
+    def test_new_versions_become_visible(self):
+        version = self.reader.version
+        self.writer.set('a-key', 'col-e', 'new')
+
+        self.assertEqual(self.reader.get('a-key', 'col-e'), None)
+
+        self.writer.query_persistor.snapshot(wait=True)
+
+        self.assertEqual(self.reader.get('a-key', 'col-e'), 'new')
+        self.assertTrue(self.reader.version > version)
+
+    def test_expired_cells_are_not_served(self):
+        self.writer.set_with_ttl('d-key', 'col-a', 'brief', 0.2)
+        self.writer.set_until('d-key', 'col-b', 'gone', time.time() - 1)
+        self.writer.set('d-key', 'col-c', 'kept')
+        self.writer.query_persistor.snapshot(wait=True)
+
+        self.assertEqual(self.reader.get_key('d-key'), [('col-a', 'brief'), ('col-c', 'kept')])
+        # Cells which had expired already aren't written to the image.
+        self.assertEqual(len(self.reader.expiry), 1)
+
+        time.sleep(0.3)
+
+        self.assertEqual(self.reader.get('d-key', 'col-a'), None)
+        self.assertEqual(self.reader.get_key('d-key'), self.writer.get_key('d-key'))
+        self.assertEqual(self.reader.get_slice('d-key', None, None, limit=1),
+                         [('col-c', 'kept')])
+        self.assertEqual([cell for cell in self.reader.iter_cells() if cell[0] == 'd-key'],
+                         [('d-key', 'col-c', 'kept')])
+
+    def test_images_are_published_between_snapshots(self):
+        file_path = '%s.published' % self.file_path
+        image_path = '%s.image' % file_path
+        writer = DoubleDictKeyColValStore(path=file_path, image_path=image_path,
+                                          publish_interval=0.05)
+        writer.set('a-key', 'col-a', 'val')
+
+        try:
+            reader = None
+            deadline = time.time() + 5
+
+            while time.time() < deadline:
+                if os.path.exists(image_path):
+                    reader = SharedImageKeyColValStore(path=image_path, refresh_interval=0)
+
+                    if reader.get('a-key', 'col-a') == 'val':
+                        break
+
+                time.sleep(0.05)
+
+            self.assertEqual(reader.get('a-key', 'col-a'), 'val')
+            # Only the image is written, not a snapshot.
+            self.assertFalse(os.path.exists('%s.snapshot' % file_path))
+            self.assertEqual(writer.query_persistor.last_snapshot_offset, None)
+        finally:
+            del writer
+
+            for path in (file_path, image_path):
+                os.remove(path)
+
+    def test_writes_are_rejected(self):
+        self.assertRaises(ReadOnlyStoreError, self.reader.set, 'a-key', 'col-a', 'val')
+        self.assertRaises(ReadOnlyStoreError, self.reader.delete_key, 'a-key')
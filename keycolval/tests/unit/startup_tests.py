@@ -0,0 +1,84 @@
+import os
+import unittest
+from datetime import datetime
+
+from keycolval.persistence.progress import LoadProgress
+from keycolval.persistence.snapshot import snapshot_path
+from keycolval.stores import backends
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+class StoreBackendTests(unittest.TestCase):
+    """
+    Unit tests for the registry of store backends.
+    """
+
+    def tearDown(self):
+        backends.BACKENDS.pop('test', None)
+
+    def test_load_backend(self):
+        self.assertTrue(backends.load_backend('doubledict') is DoubleDictKeyColValStore)
+        self.assertTrue(backends.load_backend('adaptive') is AdaptiveKeyColValStore)
+        self.assertRaises(ValueError, backends.load_backend, 'nothing')
+
+    def test_register_backend(self):
+        backends.register_backend('test', 'keycolval.stores.doubledictstore.DoubleDictKeyColValStore')
+        self.assertTrue(backends.load_backend('test') is DoubleDictKeyColValStore)
+
+        backends.register_backend('test', AdaptiveKeyColValStore)
+        self.assertTrue(backends.load_backend('test') is AdaptiveKeyColValStore)
+
+
+class LoadProgressTests(unittest.TestCase):
+    """
+    Unit tests for reporting the progress of loading a persisted store.
+    """
+
+    def setUp(self):
+        self.file_path = '/tmp/keycolval.startup.%s.log' % datetime.now()
+
+    def tearDown(self):
+        for path in (self.file_path, snapshot_path(self.file_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_states(self):
+        progress = LoadProgress()
+        self.assertEqual(progress.report()['state'], 'pending')
+
+        progress.begin()
+        progress.enter_phase('log', 100)
+        progress.advance(40, 7)
+        report = progress.report()
+        self.assertFalse(report['ready'])
+        self.assertEqual((report['phase'], report['phase_bytes'], report['phase_total_bytes'],
+                          report['records']), ('log', 40, 100, 7))
+
+        progress.finish(ValueError('bad'))
+        self.assertEqual(progress.report()['state'], 'failed')
+        self.assertEqual(progress.report()['error'], 'ValueError: bad')
+
+    def test_replay_progress(self):
+        store = DoubleDictKeyColValStore(path=self.file_path)
+
+        for i in range(2500):
+            store.set('key-%d' % (i % 10), 'col-%d' % i, 'val')
+
+        store.query_persistor.snapshot(wait=True)
+        store.set('key', 'col', 'val')
+        store.query_persistor.flush()
+
+        progress = LoadProgress()
+        progress.begin()
+        DoubleDictKeyColValStore(path=self.file_path, load_progress=progress)
+        progress.finish()
+
+        report = progress.report()
+        self.assertTrue(report['ready'])
+        self.assertEqual(report['records'], 2501)
+        self.assertEqual(progress.phase_bytes, progress.phase_total_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+
+
+class KeyStatisticsTests(unittest.TestCase):
+    """
+    Tests for the per-key statistics maintained by KeyColValStore implementations.
+    """
+
+    STORE_CLASSES = (DoubleDictKeyColValStore, BinaryTreeKeyColValStore)
+
+    def test_stats_follow_set_and_delete(self):
+        for store_class in self.STORE_CLASSES:
+            store = store_class()
+
+            store.set('a-key', 'col-b', 'val')
+            store.set('a-key', 'col-a', 'val')
+            store.set('a-key', 'col-c', 'val')
+            # Overwrites don't add columns but do change the size.
+            store.set('a-key', 'col-c', 'value')
+
+            stats = store.get_key_stats('a-key')
+            self.assertEqual(stats['column_count'], 3)
+            self.assertEqual(stats['total_bytes'], 3 * len('col-a') + 2 * len('val') + len('value'))
+            self.assertEqual((stats['min_column'], stats['max_column']), ('col-a', 'col-c'))
+            self.assertEqual(stats['writes'], 4)
+            self.assertTrue(stats['write_rate'] > 0)
+
+            # Deleting a boundary column recomputes the bounds.
+            store.delete('a-key', 'col-a')
+
+            stats = store.get_key_stats('a-key')
+            self.assertEqual(stats['column_count'], 2)
+            self.assertEqual(stats['total_bytes'], 2 * len('col-a') + len('val') + len('value'))
+            self.assertEqual((stats['min_column'], stats['max_column']), ('col-b', 'col-c'))
+
+            store.delete_key('a-key')
+            self.assertIsNone(store.get_key_stats('a-key'))
+
+    def test_top_keys(self):
+        store = DoubleDictKeyColValStore()
+
+        store.set('small-key', 'col', 'val')
+        store.set('big-key', 'col-a', 'val')
+        store.set('big-key', 'col-b', 'val')
+
+        top_keys = store.get_top_keys('column_count', 1)
+        self.assertEqual([(key, stats['column_count']) for key, stats in top_keys],
+                         [('big-key', 2)])
+
+        self.assertRaises(ValueError, store.get_top_keys, 'not-a-stat')
@@ -0,0 +1,102 @@
+import os
+import time
+import unittest
+from datetime import datetime
+
+from keycolval.data_structures.compressedvalue import ValueCompressor
+from keycolval.data_structures.valueindex import ValueIndex
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+
+class ValueIndexTests(unittest.TestCase):
+    """
+    Unit tests for the ValueIndex data structure.
+    """
+
+    def test_find_and_find_prefix(self):
+        index = ValueIndex()
+        index.record_set('b-key', 'col-a', 'red', None)
+        index.record_set('a-key', 'col-a', 'red', None)
+        index.record_set('a-key', 'col-b', 'reddish', None)
+        index.record_set('a-key', 'col-c', 'blue', None)
+        index.record_set('a-key', 'col-d', 7, None)
+
+        self.assertEqual(index.find('red'), [('a-key', 'col-a'), ('b-key', 'col-a')])
+        self.assertEqual(index.find(7), [('a-key', 'col-d')])
+        self.assertEqual(index.find('green'), [])
+        self.assertEqual(index.find_prefix('red'),
+                         [('red', 'a-key', 'col-a'), ('red', 'b-key', 'col-a'),
+                          ('reddish', 'a-key', 'col-b')])
+        self.assertEqual(len(index.find_prefix('red', limit=2)), 2)
+
+        index.record_set('a-key', 'col-a', 'green', 'red')
+        index.record_delete('a-key', 'col-b', 'reddish')
+        self.assertEqual(index.find_prefix('red'), [('red', 'b-key', 'col-a')])
+        self.assertEqual(index.usage()['values'], 4)
+        self.assertEqual(len(index), 4)
+
+        index.record_deletes('a-key', [('col-a', 'green'), ('col-c', 'blue'), ('col-d', 7)])
+        index.record_delete('b-key', 'col-a', 'red')
+        self.assertEqual(index.usage(), {'values': 0, 'cells': 0, 'approximate_bytes': 0})
+
+
+class StoreValueIndexTests(unittest.TestCase):
+    """
+    Unit tests for value lookups on the stores.
+    """
+
+    STORE_CLASSES = [DoubleDictKeyColValStore, BinaryTreeKeyColValStore, AdaptiveKeyColValStore]
+
+    def setUp(self):
+        self.file_path = '/tmp/keycolval.testdata.%s.log' % datetime.now()
+
+    def tearDown(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def test_index_follows_writes(self):
+        for store_class in self.STORE_CLASSES:
+            store = store_class(value_index=ValueIndex(),
+                                compressor=ValueCompressor(threshold=8))
+            long_value = 'a long value ' * 10
+
+            store.set('a-key', 'col-a', long_value)
+            store.set('a-key', 'col-b', 'short')
+            store.set_columns('b-key', [('col-a', long_value), ('col-b', 'shorter')])
+            store.set('c-key', 'col-a', 'short')
+
+            self.assertEqual(store.find_value(long_value), [('a-key', 'col-a'), ('b-key', 'col-a')])
+            self.assertEqual(store.find_value_prefix('short'),
+                             [('short', 'a-key', 'col-b'), ('short', 'c-key', 'col-a'),
+                              ('shorter', 'b-key', 'col-b')])
+
+            store.set('a-key', 'col-b', 'changed')
+            store.delete('c-key', 'col-a')
+            store.delete_slice('b-key', 'col-b', None)
+            self.assertEqual(store.find_value_prefix('short'), [])
+
+            store.delete_key('a-key')
+            self.assertEqual(store.find_value(long_value), [('b-key', 'col-a')])
+            self.assertEqual(store.find_value('changed'), [])
+            self.assertTrue(store.memory_usage()['value_index_bytes'] > 0)
+
+    def test_expired_cells_are_not_found(self):
+        store = DoubleDictKeyColValStore(value_index=ValueIndex())
+        store.set_until('a-key', 'col-a', 'val', time.time() - 1)
+        store.set('b-key', 'col-a', 'val')
+
+        self.assertEqual(store.find_value('val'), [('b-key', 'col-a')])
+        self.assertEqual(store.find_value_prefix('v'), [('val', 'b-key', 'col-a')])
+
+    def test_index_is_rebuilt_on_replay(self):
+        store = DoubleDictKeyColValStore(path=self.file_path)
+        store.set('a-key', 'col-a', 'val')
+        store.set('b-key', 'col-a', 'val')
+        store.delete('a-key', 'col-a')
+        self.assertRaises(ValueError, store.find_value, 'val')
+        del store
+
+        store = DoubleDictKeyColValStore(path=self.file_path, value_index=ValueIndex())
+        self.assertEqual(store.find_value('val'), [('b-key', 'col-a')])
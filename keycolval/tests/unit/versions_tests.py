@@ -0,0 +1,155 @@
+import threading
+import unittest
+
+from keycolval.data_structures.compressedvalue import ValueCompressor
+from keycolval.instrumentation.metrics import MetricsRegistry
+from keycolval.stores.adaptivestore import AdaptiveKeyColValStore
+from keycolval.stores.binarytreestore import BinaryTreeKeyColValStore
+from keycolval.stores.doubledictstore import DoubleDictKeyColValStore
+
+STORE_CLASSES = (DoubleDictKeyColValStore, BinaryTreeKeyColValStore, AdaptiveKeyColValStore)
+
+
+class ReadSnapshotTests(unittest.TestCase):
+    """
+    Unit tests for reading stores through snapshots while they're written.
+    """
+
+    def test_snapshot_reads(self):
+        for store_class in STORE_CLASSES:
+            store = store_class()
+            store.set_columns('key', [('a', '1'), ('b', '2'), ('c', '3')])
+            store.set('gone', 'col', 'val')
+
+            snapshot = store.open_snapshot()
+
+            store.set('key', 'a', 'changed')
+            store.delete('key', 'b')
+            store.set('key', 'd', '4')
+            store.delete_key('gone')
+            store.set('new', 'col', 'val')
+
+            self.assertEqual(snapshot.get('key', 'a'), '1', store_class.__name__)
+            self.assertEqual(snapshot.get('key', 'd'), None)
+            self.assertEqual(snapshot.get_key('key'), [('a', '1'), ('b', '2'), ('c', '3')])
+            self.assertEqual(snapshot.get_slice('key', 'b', None), [('b', '2'), ('c', '3')])
+            self.assertEqual(snapshot.get_slice('key', None, None, reverse=True, limit=2,
+                                                offset=1), [('b', '2'), ('a', '1')])
+            self.assertEqual(snapshot.get_prefix('key', 'c'), [('c', '3')])
+            self.assertEqual(snapshot.get_key('gone'), [('col', 'val')])
+            self.assertEqual(snapshot.get_key('new'), [])
+            self.assertEqual(snapshot.get_keys(), set(['key', 'gone']))
+
+            # The store itself is as written.
+            self.assertEqual(store.get_key('key'), [('a', 'changed'), ('c', '3'), ('d', '4')])
+            self.assertEqual(store.get_keys(), set(['key', 'new']))
+
+            snapshot.close()
+            self.assertRaises(ValueError, snapshot.get, 'key', 'a')
+
+    def test_unchanged_keys_are_not_copied(self):
+        store = DoubleDictKeyColValStore()
+        store.set('key', 'col', 'val')
+
+        with store.open_snapshot() as snapshot:
+            self.assertEqual(store.versions.copies(), 0)
+            self.assertEqual(snapshot.get('key', 'col'), 'val')
+
+            # Only the first change after the snapshot copies the key.
+            store.set('key', 'col', 'val2')
+            store.set('key', 'col', 'val3')
+            self.assertEqual(store.versions.copies(), 1)
+            self.assertEqual(snapshot.get('key', 'col'), 'val')
+
+    def test_copies_are_not_counted_as_reads(self):
+        for store_class in STORE_CLASSES:
+            metrics = MetricsRegistry()
+            store = store_class(metrics=metrics)
+            store.set('key', 'col', 'val')
+
+            with store.open_snapshot() as snapshot:
+                store.set('key', 'col', 'val2')
+                self.assertEqual(store.versions.copies(), 1)
+                self.assertEqual(snapshot.get('key', 'col'), 'val')
+
+            operations = [sample['labels']['operation'] for sample in
+                          metrics.snapshot()['keycolval_store_operations_total']]
+            self.assertFalse('get_key' in operations, store_class.__name__)
+
+    def test_several_snapshots(self):
+        store = DoubleDictKeyColValStore()
+        store.set('key', 'col', '1')
+        first = store.open_snapshot()
+        store.set('key', 'col', '2')
+        second = store.open_snapshot()
+        third = store.open_snapshot()
+        store.set('key', 'col', '3')
+        store.set('other', 'col', '1')
+        fourth = store.open_snapshot()
+
+        self.assertEqual([snapshot.get('key', 'col') for snapshot in (first, second, third, fourth)],
+                         ['1', '2', '2', '3'])
+        self.assertEqual(store.versions.copies(), 3)
+
+        # Copies are dropped once no open snapshot reads them.
+        second.close()
+        self.assertEqual(store.versions.copies(), 3)
+        first.close()
+        self.assertEqual(store.versions.copies(), 2)
+        self.assertEqual(third.get('key', 'col'), '2')
+        self.assertEqual(third.get_keys(), set(['key']))
+        third.close()
+        self.assertEqual(store.versions.copies(), 0)
+        self.assertEqual(fourth.get('key', 'col'), '3')
+        fourth.close()
+
+        self.assertEqual(store.versions.open_count(), 0)
+        self.assertEqual(store.memory_usage()['version_history_bytes'], 0)
+
+    def test_compressed_values(self):
+        store = DoubleDictKeyColValStore(compressor=ValueCompressor(threshold=10))
+        store.set('key', 'col', 'x' * 100)
+
+        with store.open_snapshot() as snapshot:
+            store.set('key', 'col', 'y' * 100)
+            self.assertEqual(snapshot.get('key', 'col'), 'x' * 100)
+            self.assertTrue(store.memory_usage()['version_history_bytes'] > 100)
+
+    def test_consistent_while_writing(self):
+        store = DoubleDictKeyColValStore()
+        store.set('a', 'count', '0')
+        store.set('b', 'count', '0')
+        stop = threading.Event()
+
+        def write():
+            # b is only ever set after a, to the same count.
+            i = 0
+
+            while not stop.is_set():
+                i += 1
+                store.set_columns('a', [('count', str(i)), ('col-%d' % (i % 50), 'x')])
+                store.set('b', 'count', str(i))
+
+                if i > 25:
+                    store.delete('a', 'col-%d' % ((i + 25) % 50))
+
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        try:
+            for _ in range(1000):
+                found = dict(store.get_many(['a', 'b']))
+                a = int(dict(found['a'])['count'])
+                b = int(dict(found['b'])['count'])
+
+                # Read without a snapshot b could have moved on past a.
+                self.assertTrue(a - 1 <= b <= a, (a, b))
+        finally:
+            stop.set()
+            writer.join()
+
+        self.assertEqual(store.versions.copies(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,49 @@
 """
-This is an entry point for running the flask app using the default flask
-server.
+This is an entry point for running the flask app, using the default flask
+debug server unless --production is given.
+
+--production serves the app with the thread pool server in
+keycolval/api/server.py, which loads the data store before accepting
+connections and keeps connections alive. --threads sets the number of threads
+(16 by default) and --processes the number of pre-forked processes, which is
+only allowed for READ_ONLY_WORKER applications. --rpc-port also serves the
+data store over the binary protocol in keycolval/rpc on that port.
+
+Either way the data store is loaded before the server binds its port.
+--load-after-bind binds first and loads it in the background instead, with
+/ready/ reporting the progress.
+
+Usage:
+python run_server.py [--production] [--host H] [--port P] [--threads N] [--processes N]
+                     [--rpc-port P] [--load-after-bind]
 """
 
+import os
+import sys
+
 from keycolval.api import *
+from keycolval.api.server import serve
+
+
+def option(name, default):
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+host = option('--host', '127.0.0.1')
+port = int(option('--port', 5000))
+
+if '--production' in sys.argv:
+    serve(app, host, port,
+          threads=int(option('--threads', 16)),
+          processes=int(option('--processes', 1)),
+          rpc_port=int(option('--rpc-port', 0)) or None,
+          load_before_bind='--load-after-bind' not in sys.argv)
+else:
+    # The reloader's parent process only watches for changes, so the data
+    # store is loaded by the child process it starts to serve.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        load_data_store(app, background='--load-after-bind' in sys.argv)
 
-app.run(debug=True)
+    app.run(host=host, port=port, debug=True)